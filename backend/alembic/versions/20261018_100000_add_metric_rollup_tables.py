@@ -0,0 +1,52 @@
+"""Add metric rollup tables
+
+Revision ID: 20261018_100000
+Revises: 20251026_141000
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_100000'
+down_revision = '20251026_141000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Создаем таблицу предагрегированных счетчиков
+    op.create_table('metric_rollups',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('metric', sa.String(length=100), nullable=False),
+        sa.Column('granularity', sa.String(length=20), nullable=False),
+        sa.Column('bucket_start', sa.DateTime(), nullable=False),
+        sa.Column('dimension', sa.String(length=100), nullable=False, server_default=''),
+        sa.Column('value', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('metric', 'granularity', 'bucket_start', 'dimension', name='uq_metric_rollup_bucket')
+    )
+    op.create_index(op.f('ix_metric_rollups_id'), 'metric_rollups', ['id'], unique=False)
+    op.create_index('ix_metric_rollups_lookup', 'metric_rollups', ['metric', 'granularity', 'bucket_start'], unique=False)
+    op.create_index('ix_metric_rollups_top', 'metric_rollups', ['metric', 'granularity', 'value'], unique=False)
+
+    # Создаем таблицу водяных знаков инкрементальной обработки
+    op.create_table('rollup_watermarks',
+        sa.Column('source', sa.String(length=100), nullable=False),
+        sa.Column('last_id', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('rows_processed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('source')
+    )
+
+
+def downgrade():
+    # Удаляем таблицы в обратном порядке
+    op.drop_table('rollup_watermarks')
+
+    op.drop_index('ix_metric_rollups_top', table_name='metric_rollups')
+    op.drop_index('ix_metric_rollups_lookup', table_name='metric_rollups')
+    op.drop_index(op.f('ix_metric_rollups_id'), table_name='metric_rollups')
+    op.drop_table('metric_rollups')
@@ -0,0 +1,44 @@
+"""Add analysis jobs table
+
+Revision ID: 20261018_110000
+Revises: 20261018_100000
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_110000'
+down_revision = '20261018_100000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Создаем таблицу фоновых задач AI-анализа
+    op.create_table('analysis_jobs',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('job_type', sa.String(length=50), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('priority', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('dedup_key', sa.String(length=255), nullable=True),
+        sa.Column('payload', sa.JSON(), nullable=False),
+        sa.Column('target', sa.JSON(), nullable=True),
+        sa.Column('result', sa.JSON(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_analysis_jobs_dedup_key'), 'analysis_jobs', ['dedup_key'], unique=False)
+    op.create_index('ix_analysis_jobs_queue', 'analysis_jobs', ['status', 'priority', 'created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_analysis_jobs_queue', table_name='analysis_jobs')
+    op.drop_index(op.f('ix_analysis_jobs_dedup_key'), table_name='analysis_jobs')
+    op.drop_table('analysis_jobs')
@@ -0,0 +1,28 @@
+"""Add rolling context summary to chat sessions
+
+Revision ID: 20261018_120000
+Revises: 20261018_110000
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_120000'
+down_revision = '20261018_110000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Скользящее резюме старых сообщений сессии
+    op.add_column('chat_sessions', sa.Column('context_summary', sa.Text(), nullable=True))
+    op.add_column('chat_sessions', sa.Column('summary_message_id', sa.Integer(), nullable=True))
+    op.add_column('chat_sessions', sa.Column('summary_updated_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('chat_sessions', 'summary_updated_at')
+    op.drop_column('chat_sessions', 'summary_message_id')
+    op.drop_column('chat_sessions', 'context_summary')
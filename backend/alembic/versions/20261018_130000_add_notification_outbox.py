@@ -0,0 +1,45 @@
+"""Add notification outbox table
+
+Revision ID: 20261018_130000
+Revises: 20261018_120000
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_130000'
+down_revision = '20261018_120000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Персистентная очередь исходящих сообщений во внешние каналы
+    op.create_table('notification_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('notification_id', sa.Integer(), nullable=True),
+        sa.Column('channel_id', sa.Integer(), nullable=False),
+        sa.Column('channel_type', sa.String(length=20), nullable=False),
+        sa.Column('recipient', sa.String(length=255), nullable=True),
+        sa.Column('payload', sa.JSON(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('max_attempts', sa.Integer(), nullable=False, server_default='3'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['notification_id'], ['admin_notifications.id'], ),
+        sa.ForeignKeyConstraint(['channel_id'], ['notification_channels.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_notification_outbox_notification_id'), 'notification_outbox', ['notification_id'], unique=False)
+    op.create_index('ix_notification_outbox_due', 'notification_outbox', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_outbox_due', table_name='notification_outbox')
+    op.drop_index(op.f('ix_notification_outbox_notification_id'), table_name='notification_outbox')
+    op.drop_table('notification_outbox')
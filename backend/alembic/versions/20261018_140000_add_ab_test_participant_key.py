@@ -0,0 +1,56 @@
+"""Add participant key to A/B test participants
+
+Revision ID: 20261018_140000
+Revises: 20261018_130000
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_140000'
+down_revision = '20261018_130000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Ключ участника для идемпотентной пакетной вставки без поиска по user_id OR session_id
+    op.add_column('ab_test_participants', sa.Column('participant_key', sa.String(length=300), nullable=True))
+    op.execute("""
+        UPDATE ab_test_participants
+        SET participant_key = CASE
+            WHEN user_id IS NOT NULL THEN 'u:' || CAST(user_id AS VARCHAR)
+            WHEN session_id IS NOT NULL THEN 's:' || session_id
+        END
+    """)
+    # Дубликаты, возникшие из-за гонок при старом назначении, оставляем без ключа
+    op.execute("""
+        UPDATE ab_test_participants
+        SET participant_key = NULL
+        WHERE participant_key IS NOT NULL AND id NOT IN (
+            SELECT min_id FROM (
+                SELECT MIN(id) AS min_id
+                FROM ab_test_participants
+                WHERE participant_key IS NOT NULL
+                GROUP BY test_id, participant_key
+            ) AS first_participants
+        )
+    """)
+    op.create_unique_constraint(
+        'uq_ab_test_participants_test_key', 'ab_test_participants', ['test_id', 'participant_key']
+    )
+
+    # Счетчики вариантов уже учитывают существующие строки - rollup начинает с текущего максимума
+    for source, table in (('ab_test_participants', 'ab_test_participants'), ('ab_test_events', 'ab_test_events')):
+        op.execute(f"""
+            INSERT INTO rollup_watermarks (source, last_id, rows_processed, updated_at)
+            SELECT '{source}', COALESCE(MAX(id), 0), 0, CURRENT_TIMESTAMP FROM {table}
+        """)
+
+
+def downgrade():
+    op.execute("DELETE FROM rollup_watermarks WHERE source IN ('ab_test_participants', 'ab_test_events')")
+    op.drop_constraint('uq_ab_test_participants_test_key', 'ab_test_participants', type_='unique')
+    op.drop_column('ab_test_participants', 'participant_key')
@@ -0,0 +1,33 @@
+"""Add keyset index to moderation queue
+
+Revision ID: 20261018_150000
+Revises: 20261018_140000
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_150000'
+down_revision = '20261018_140000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keyset-пагинация очереди модерации по (ранг приоритета, created_at, id)
+    op.create_index(
+        'ix_moderation_queue_keyset',
+        'moderation_queue',
+        [
+            sa.text("(CASE WHEN priority = 'high' THEN 0 WHEN priority = 'medium' THEN 1 ELSE 2 END)"),
+            'created_at',
+            'id'
+        ],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_moderation_queue_keyset', table_name='moderation_queue')
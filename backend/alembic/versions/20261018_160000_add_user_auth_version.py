@@ -0,0 +1,24 @@
+"""Add auth version to users
+
+Revision ID: 20261018_160000
+Revises: 20261018_150000
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_160000'
+down_revision = '20261018_150000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Версия учетных данных в токене: кеш пользователя сверяет ее без запроса к БД
+    op.add_column('users', sa.Column('auth_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'auth_version')
@@ -0,0 +1,45 @@
+"""Add export jobs table
+
+Revision ID: 20261018_180000
+Revises: 20261018_170000
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_180000'
+down_revision = '20261018_170000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Задачи экспорта со статусом и прогрессом (вместо словаря в памяти процесса)
+    op.create_table('export_jobs',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('export_type', sa.String(length=50), nullable=False),
+        sa.Column('export_format', sa.String(length=10), nullable=False),
+        sa.Column('filters', sa.JSON(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('rows_total', sa.Integer(), nullable=True),
+        sa.Column('rows_written', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('file_path', sa.String(length=500), nullable=True),
+        sa.Column('file_size', sa.BigInteger(), nullable=True),
+        sa.Column('error_message', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_export_jobs_user', 'export_jobs', ['user_id', 'created_at'], unique=False)
+    op.create_index('ix_export_jobs_status', 'export_jobs', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_export_jobs_status', table_name='export_jobs')
+    op.drop_index('ix_export_jobs_user', table_name='export_jobs')
+    op.drop_table('export_jobs')
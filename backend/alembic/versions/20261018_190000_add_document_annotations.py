@@ -0,0 +1,90 @@
+"""Add document annotations tables
+
+Revision ID: 20261018_190000
+Revises: 20261018_180000
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_190000'
+down_revision = '20261018_180000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Аннотации документов (вместо словаря в памяти процесса); span_bin - ячейка сетки для поиска по окну текста
+    op.create_table('document_annotations',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('document_id', sa.String(length=255), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('annotation_type', sa.String(length=30), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='active'),
+        sa.Column('is_public', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('start_offset', sa.Integer(), nullable=False),
+        sa.Column('end_offset', sa.Integer(), nullable=False),
+        sa.Column('start_line', sa.Integer(), nullable=False),
+        sa.Column('end_line', sa.Integer(), nullable=False),
+        sa.Column('span_bin', sa.Integer(), nullable=False),
+        sa.Column('selected_text', sa.Text(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('color', sa.String(length=50), nullable=True),
+        sa.Column('style', sa.JSON(), nullable=False),
+        sa.Column('tags', sa.JSON(), nullable=False),
+        sa.Column('metadata', sa.JSON(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_document_annotations_span', 'document_annotations', ['document_id', 'span_bin', 'start_offset'], unique=False)
+    op.create_index('ix_document_annotations_document', 'document_annotations', ['document_id', 'status', 'start_offset'], unique=False)
+    op.create_index('ix_document_annotations_user', 'document_annotations', ['user_id', 'status', 'created_at'], unique=False)
+
+    op.create_table('document_annotation_replies',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('annotation_id', sa.String(length=64), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False, server_default='active'),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_document_annotation_replies_annotation', 'document_annotation_replies', ['annotation_id', 'created_at'], unique=False)
+    op.create_index('ix_document_annotation_replies_user', 'document_annotation_replies', ['user_id', 'status'], unique=False)
+
+    op.create_table('annotation_tags',
+        sa.Column('tag', sa.String(length=100), nullable=False),
+        sa.Column('annotation_id', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('tag', 'annotation_id')
+    )
+    op.create_index('ix_annotation_tags_annotation', 'annotation_tags', ['annotation_id'], unique=False)
+
+    # Обратный индекс слов для поиска по содержимому
+    op.create_table('annotation_terms',
+        sa.Column('term', sa.String(length=64), nullable=False),
+        sa.Column('annotation_id', sa.String(length=64), nullable=False),
+        sa.Column('field', sa.String(length=10), nullable=False),
+        sa.PrimaryKeyConstraint('term', 'annotation_id', 'field')
+    )
+    op.create_index('ix_annotation_terms_prefix', 'annotation_terms', ['term'], unique=False,
+                    postgresql_ops={'term': 'text_pattern_ops'})
+    op.create_index('ix_annotation_terms_annotation', 'annotation_terms', ['annotation_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_annotation_terms_annotation', table_name='annotation_terms')
+    op.drop_index('ix_annotation_terms_prefix', table_name='annotation_terms')
+    op.drop_table('annotation_terms')
+    op.drop_index('ix_annotation_tags_annotation', table_name='annotation_tags')
+    op.drop_table('annotation_tags')
+    op.drop_index('ix_document_annotation_replies_user', table_name='document_annotation_replies')
+    op.drop_index('ix_document_annotation_replies_annotation', table_name='document_annotation_replies')
+    op.drop_table('document_annotation_replies')
+    op.drop_index('ix_document_annotations_user', table_name='document_annotations')
+    op.drop_index('ix_document_annotations_document', table_name='document_annotations')
+    op.drop_index('ix_document_annotations_span', table_name='document_annotations')
+    op.drop_table('document_annotations')
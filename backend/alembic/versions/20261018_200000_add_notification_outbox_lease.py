@@ -0,0 +1,24 @@
+"""Add lease timestamp to notification outbox
+
+Revision ID: 20261018_200000
+Revises: 20261018_190000
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_200000'
+down_revision = '20261018_190000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Аренда строки воркером: в очередь возвращаются только строки с истекшей арендой
+    op.add_column('notification_outbox', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('notification_outbox', 'claimed_at')
@@ -0,0 +1,24 @@
+"""Add lease timestamp to webhook deliveries
+
+Revision ID: 20261018_210000
+Revises: 20261018_200000
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_210000'
+down_revision = '20261018_200000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Аренда доставки диспетчером: в очередь возвращаются только строки с истекшей арендой
+    op.add_column('webhook_deliveries', sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('webhook_deliveries', 'claimed_at')
@@ -0,0 +1,24 @@
+"""Add heartbeat to export jobs
+
+Revision ID: 20261018_220000
+Revises: 20261018_210000
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_220000'
+down_revision = '20261018_210000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Heartbeat выполняемой задачи: перезапускаются только задачи с устаревшей арендой
+    op.add_column('export_jobs', sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('export_jobs', 'heartbeat_at')
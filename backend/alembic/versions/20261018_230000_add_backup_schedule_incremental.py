@@ -0,0 +1,27 @@
+"""Add incremental flag to backup schedules
+
+Revision ID: 20261018_230000
+Revises: 20261018_220000
+Create Date: 2026-10-18 23:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_230000'
+down_revision = '20261018_220000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Расписание может создавать инкрементальные копии через хранилище блоков
+    op.add_column(
+        'backup_schedules',
+        sa.Column('incremental', sa.Boolean(), nullable=False, server_default=sa.false())
+    )
+
+
+def downgrade():
+    op.drop_column('backup_schedules', 'incremental')
@@ -0,0 +1,27 @@
+"""Add lease heartbeat and retry backoff to analysis jobs
+
+Revision ID: 20261018_233000
+Revises: 20261018_230000
+Create Date: 2026-10-18 23:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '20261018_233000'
+down_revision = '20261018_230000'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Аренда задачи воркером: в очередь возвращаются только задачи без свежего heartbeat
+    op.add_column('analysis_jobs', sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+    # Экспоненциальная задержка перед повторной попыткой
+    op.add_column('analysis_jobs', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('analysis_jobs', 'next_attempt_at')
+    op.drop_column('analysis_jobs', 'heartbeat_at')
@@ -913,7 +913,9 @@ async def upload_document(
                     "document_type": result.get('metadata', {}).get('document_type', 'unknown'),
                     "structure_score": result.get('metadata', {}).get('structure_score', 0),
                     "processing_time": result.get('processing_time', 0),
-                    "filename": file.filename
+                    "filename": file.filename,
+                    "analysis_job_id": result.get('analysis_job_id'),
+                    "analysis_status": result.get('analysis_status')
                 }
             else:
                 return {
@@ -16,6 +16,8 @@ from ..models.audit_log import AuditLog, SecurityEvent, ActionType, SeverityLeve
 from ..schemas.user import User as UserSchema
 from ..services.auth_service import AuthService
 from ..core.admin_security import admin_security
+from ..models.rollup import RollupGranularity
+from ..services.rollup_service import rollup_service
 # Импорт не нужен, используем auth_service.get_current_user
 
 logger = logging.getLogger(__name__)
@@ -39,49 +41,48 @@ async def get_dashboard_stats(
 ):
     """Получение статистики для админ-панели"""
     try:
-        # Статистика пользователей
-        total_users = db.query(User).count()
-        active_users = db.query(User).filter(User.is_active == True).count()
-        premium_users = db.query(User).filter(User.is_premium == True).count()
-        admin_users = db.query(User).filter(User.is_admin == True).count()
-        
-        # Статистика чатов
-        total_sessions = db.query(ChatSession).count()
-        total_messages = db.query(ChatMessage).count()
+        # Все счетчики читаются из rollup-таблиц, которые обновляет фоновая задача
+        totals = rollup_service.get_values(
+            db, ["sessions.created", "messages.created"], RollupGranularity.TOTAL
+        )
+        snapshots = rollup_service.get_values(
+            db, ["users.total", "users.active", "users.premium", "users.admins"], RollupGranularity.SNAPSHOT
+        )
         
         # Статистика за последние 24 часа
         yesterday = datetime.utcnow() - timedelta(days=1)
-        new_users_24h = db.query(User).filter(User.created_at >= yesterday).count()
-        new_sessions_24h = db.query(ChatSession).filter(ChatSession.created_at >= yesterday).count()
-        new_messages_24h = db.query(ChatMessage).filter(ChatMessage.created_at >= yesterday).count()
+        last_24h = rollup_service.get_sums_since(
+            db, ["users.created", "sessions.created", "messages.created", "security.events"], yesterday
+        )
         
-        # Статистика безопасности
-        security_events = db.query(SecurityEvent).filter(
-            SecurityEvent.created_at >= yesterday
-        ).count()
+        # Топ пользователи по количеству сессий
+        top_dimensions = rollup_service.get_top_dimensions(db, "sessions.by_user", limit=5)
+        top_ids = [int(dimension) for dimension, _ in top_dimensions]
+        users_by_id = {
+            user.id: user for user in db.query(User).filter(User.id.in_(top_ids)).all()
+        } if top_ids else {}
+        top_users = [users_by_id[user_id] for user_id in top_ids if user_id in users_by_id]
         
-        # Топ пользователи по активности
-        top_users = db.query(User).join(ChatSession).group_by(User.id).order_by(
-            db.func.count(ChatSession.id).desc()
-        ).limit(5).all()
+        rollup_updated_at = rollup_service.get_last_updated(db)
         
         return {
             "users": {
-                "total": total_users,
-                "active": active_users,
-                "premium": premium_users,
-                "admins": admin_users,
-                "new_24h": new_users_24h
+                "total": int(snapshots["users.total"]),
+                "active": int(snapshots["users.active"]),
+                "premium": int(snapshots["users.premium"]),
+                "admins": int(snapshots["users.admins"]),
+                "new_24h": int(last_24h["users.created"])
             },
             "chats": {
-                "total_sessions": total_sessions,
-                "total_messages": total_messages,
-                "new_sessions_24h": new_sessions_24h,
-                "new_messages_24h": new_messages_24h
+                "total_sessions": int(totals["sessions.created"]),
+                "total_messages": int(totals["messages.created"]),
+                "new_sessions_24h": int(last_24h["sessions.created"]),
+                "new_messages_24h": int(last_24h["messages.created"])
             },
             "security": {
-                "events_24h": security_events
+                "events_24h": int(last_24h["security.events"])
             },
+            "rollup_updated_at": rollup_updated_at.isoformat() if rollup_updated_at else None,
             "top_users": [
                 {
                     "id": user.id,
@@ -48,7 +48,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Создаем нового пользователя
-    hashed_password = auth_service.get_password_hash(validated_password)
+    hashed_password = await auth_service.get_password_hash_async(validated_password)
     
     db_user = User(
         email=validated_email,
@@ -72,7 +72,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db), request: Request = None):
     """Вход пользователя"""
     # form_data.username может содержать email
-    user = auth_service.authenticate_user(db, form_data.username, form_data.password)
+    user = await auth_service.authenticate_user_async(db, form_data.username, form_data.password)
     if not user:
         # Логируем неудачную попытку входа
         log_security_incident(
@@ -92,13 +92,13 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
     if user.is_admin:
         # Админские токены - короткий срок жизни (30 минут)
         access_token = auth_service.create_access_token(
-            data={"sub": user.email}, is_admin=True
+            data=auth_service.token_claims(user), is_admin=True
         )
     else:
         # Обычные пользователи - стандартный срок (8 часов)
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = auth_service.create_access_token(
-            data={"sub": user.email}, expires_delta=access_token_expires
+            data=auth_service.token_claims(user), expires_delta=access_token_expires
         )
     
     # Логируем успешный вход
@@ -114,7 +114,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
 @router.post("/login-email", response_model=Token)
 async def login_with_email(login_data: UserLogin, db: Session = Depends(get_db)):
     """Вход пользователя по email"""
-    user = auth_service.authenticate_user(db, login_data.email, login_data.password)
+    user = await auth_service.authenticate_user_async(db, login_data.email, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -126,13 +126,13 @@ async def login_with_email(login_data: UserLogin, db: Session = Depends(get_db))
     if user.is_admin:
         # Админские токены - короткий срок жизни (30 минут)
         access_token = auth_service.create_access_token(
-            data={"sub": user.email}, is_admin=True
+            data=auth_service.token_claims(user), is_admin=True
         )
     else:
         # Обычные пользователи - стандартный срок (8 часов)
         access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = auth_service.create_access_token(
-            data={"sub": user.email}, expires_delta=access_token_expires
+            data=auth_service.token_claims(user), expires_delta=access_token_expires
         )
     
     return {"access_token": access_token, "token_type": "bearer"}
@@ -167,7 +167,7 @@ async def admin_login(
         )
     
     # 3. Аутентификация
-    user = auth_service.authenticate_user(db, login_data.email, login_data.password)
+    user = await auth_service.authenticate_user_async(db, login_data.email, login_data.password)
     if not user:
         admin_security.record_failed_admin_login(request)
         log_security_incident(
@@ -240,7 +240,7 @@ async def admin_login(
     
     # 6. Создаем админский токен (30 минут)
     access_token = auth_service.create_access_token(
-        data={"sub": user.email}, is_admin=True
+        data=auth_service.token_claims(user), is_admin=True
     )
     
     # 7. Логируем успешный админский вход
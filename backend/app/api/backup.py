@@ -60,7 +60,8 @@ async def create_backup(
             backup_type=BackupType.MANUAL,
             compression_enabled=backup_data.compression_enabled,
             encryption_enabled=backup_data.encryption_enabled,
-            retention_days=backup_data.retention_days
+            retention_days=backup_data.retention_days,
+            incremental=backup_data.incremental
         )
         
         return {
@@ -273,6 +274,7 @@ async def create_backup_schedule(
             retention_days=schedule_data.retention_days,
             compression_enabled=schedule_data.compression_enabled,
             encryption_enabled=schedule_data.encryption_enabled,
+            incremental=schedule_data.incremental,
             notify_on_success=schedule_data.notify_on_success,
             notify_on_failure=schedule_data.notify_on_failure,
             notification_channels=schedule_data.notification_channels,
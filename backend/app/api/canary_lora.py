@@ -54,6 +54,7 @@ async def deploy_canary(
     canary_percentage: float = 10.0,
     rollback_threshold: float = 0.7,
     evaluation_period_hours: int = 24,
+    adapter_path: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -71,7 +72,8 @@ async def deploy_canary(
             version=version,
             canary_percentage=canary_percentage,
             rollback_threshold=rollback_threshold,
-            evaluation_period_hours=evaluation_period_hours
+            evaluation_period_hours=evaluation_period_hours,
+            adapter_path=adapter_path
         )
         
         return {
@@ -24,8 +24,10 @@ from ..schemas.chat import (
 from ..services.auth_service import AuthService
 # Используем новый унифицированный LLM сервис
 from ..services.unified_llm_service import unified_llm_service
+from ..services.chat_context_service import chat_context_service
 from ..services.websocket_service import websocket_service
 from ..services.token_service import token_service
+from ..services.rollup_service import rollup_service
 from ..core.rate_limiter import user_rate_limit
 from ..core.cache import cache_service, ChatCache
 from ..core.config import settings
@@ -193,31 +195,6 @@ async def send_message(
     try:
         logger.info(f"Обрабатываем сообщение от пользователя {current_user.id}: {chat_request.message}")
         
-        # Получаем историю чата для контекста
-        chat_history = ""
-        try:
-            # Получаем последние 10 сообщений для контекста
-            recent_messages = db.query(ChatMessage).filter(
-                ChatMessage.session_id == session.id
-            ).order_by(ChatMessage.created_at.desc()).limit(10).all()
-            
-            # Формируем историю в обратном порядке (от старых к новым)
-            history_parts = []
-            for msg in reversed(recent_messages):
-                if msg.role == "user":
-                    history_parts.append(f"Пользователь: {msg.content}")
-                elif msg.role == "assistant":
-                    history_parts.append(f"Ассистент: {msg.content}")
-            
-            if history_parts:
-                chat_history = "\n".join(history_parts)
-                logger.info(f"Загружена история чата: {len(history_parts)} сообщений")
-            else:
-                logger.info("История чата пуста - это первое сообщение")
-        except Exception as e:
-            logger.warning(f"Ошибка загрузки истории чата: {e}")
-            chat_history = ""
-        
         # Проверяем баланс токенов (мягкая проверка)
         estimated_cost = 150  # Примерная стоимость запроса
         current_balance = token_service.get_user_balance(db, current_user.id)
@@ -229,19 +206,30 @@ async def send_message(
         
         # Используем Vistral-24B модель через unified_llm_service
         logger.info("Используем Vistral-24B модель через unified_llm_service")
+        context_used = False
         try:
-            # Создаем промпт с историей чата
-            prompt = unified_llm_service.create_legal_prompt(
+            # Упаковываем историю и резюме сессии в бюджет контекста модели
+            assembled = chat_context_service.build_prompt(
+                db=db,
+                session=session,
                 question=chat_request.message,
-                context=chat_history
+                max_tokens=settings.AI_CHAT_RESPONSE_TOKENS,
+                exclude_message_id=user_message.id
+            )
+            chat_context_service.schedule_summary_update(assembled)
+            context_used = assembled.context_used
+            prompt = assembled.prompt
+            logger.info(
+                f"Контекст чата: {assembled.prompt_tokens}/{assembled.budget} токенов, "
+                f"сообщений истории: {assembled.history_messages}, резюме: {assembled.summary_used}"
             )
-            logger.info(f"Вызываем unified_llm_service.generate_response с промптом: {prompt[:100]}...")
             
             # Используем таймаут и токены из конфигурации для чата
             response_generator = unified_llm_service.generate_response(
                 prompt=prompt,
                 max_tokens=settings.AI_CHAT_RESPONSE_TOKENS,
-                stream=False
+                stream=False,
+                user_id=str(current_user.id)
             )
             
             # Собираем ответ из генератора
@@ -288,7 +276,7 @@ async def send_message(
             message_metadata={
                 "sources": sources,
                 "processing_time": processing_time,
-                "context_used": False,
+                "context_used": context_used,
                 "tokens_cost": actual_cost
             }
         )
@@ -378,6 +366,9 @@ async def delete_chat_session(
             detail="Сессия чата не найдена"
         )
     
+    # Итоги админ-дашборда уменьшаются в той же транзакции, что и удаление
+    rollup_service.record_deletions(db, "chat_messages", ChatMessage.session_id == session.id)
+    rollup_service.record_deletions(db, "chat_sessions", ChatSession.id == session.id)
     db.delete(session)
     db.commit()
     
@@ -423,28 +414,9 @@ async def send_message_stream(
         assistant_message = None
         full_response_parts: List[str] = []
         sources = [{"title": "Vistral-24B", "text": "Ответ от Vistral-24B"}]
-        chat_history = ""
+        context_used = False
 
         try:
-            # Собираем историю
-            try:
-                recent_messages = (
-                    db.query(ChatMessage)
-                    .filter(ChatMessage.session_id == session.id)
-                    .order_by(ChatMessage.created_at.desc())
-                    .limit(10)
-                    .all()
-                )
-                if recent_messages:
-                    history_lines = []
-                    for msg in reversed(recent_messages):
-                        prefix = "Пользователь" if msg.role == "user" else "Ассистент"
-                        history_lines.append(f"{prefix}: {msg.content}")
-                    chat_history = "\n".join(history_lines)
-                    logger.info(f"Загружена история для стриминга: {len(history_lines)} сообщений")
-            except Exception as history_err:
-                logger.warning(f"Ошибка загрузки истории чата: {history_err}")
-
             # Сообщаем клиенту о старте
             yield f"data: {json.dumps({'type': 'start', 'session_id': session.id, 'message_id': user_message.id})}\n\n"
 
@@ -465,18 +437,29 @@ async def send_message_stream(
                 yield f"data: {json.dumps({'type': 'chunk', 'content': warning_text})}\n\n"
             else:
                 try:
-                    prompt = unified_llm_service.create_legal_prompt(
+                    max_tokens = min(2000, getattr(settings, "AI_CHAT_RESPONSE_TOKENS", 2000))
+                    assembled = chat_context_service.build_prompt(
+                        db=db,
+                        session=session,
                         question=chat_request.message,
-                        context=chat_history
+                        max_tokens=max_tokens,
+                        exclude_message_id=user_message.id
+                    )
+                    chat_context_service.schedule_summary_update(assembled)
+                    context_used = assembled.context_used
+                    prompt = assembled.prompt
+                    logger.info(
+                        f"Старт стриминга unified_llm_service (prompt {assembled.prompt_tokens}/{assembled.budget} токенов, "
+                        f"сообщений истории: {assembled.history_messages})"
                     )
-                    logger.info(f"Старт стриминга unified_llm_service (prompt {len(prompt)} символов)")
 
                     response_generator = unified_llm_service.generate_response(
                         prompt=prompt,
-                        max_tokens=min(2000, getattr(settings, "AI_CHAT_RESPONSE_TOKENS", 2000)),
+                        max_tokens=max_tokens,
                         stream=True,
                         temperature=getattr(settings, "VISTRAL_TEMPERATURE", 0.3),
-                        top_p=getattr(settings, "VISTRAL_TOP_P", 0.8)
+                        top_p=getattr(settings, "VISTRAL_TOP_P", 0.8),
+                        user_id=str(current_user.id)
                     )
 
                     deadline = time.monotonic() + getattr(settings, "AI_CHAT_RESPONSE_TIMEOUT", 600)
@@ -529,7 +512,7 @@ async def send_message_stream(
                 message_metadata={
                     "sources": sources,
                     "processing_time": processing_time,
-                    "context_used": bool(chat_history)
+                    "context_used": context_used
                 }
             )
             db.add(assistant_message)
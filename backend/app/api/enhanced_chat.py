@@ -105,8 +105,7 @@ async def chat_with_ai(
         else:
             # Используем только UnifiedLLMService без RAG
             async for response_chunk in unified_llm_service.generate_response(
-                prompt=request.message,
-                context=request.context,
+                prompt=unified_llm_service.create_legal_prompt(request.message, request.context),
                 stream=False,  # Для API используем не-streaming режим
                 max_tokens=1024,
                 temperature=0.3,
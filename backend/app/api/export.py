@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Response
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
@@ -43,11 +44,30 @@ class ExportRequestResponse(BaseModel):
     file_path: Optional[str]
     file_size: Optional[int]
     error_message: Optional[str]
+    rows_total: Optional[int] = None
+    rows_written: int = 0
+    progress: float = 0.0
+
+def _to_response(export_request: ExportRequest) -> ExportRequestResponse:
+    return ExportRequestResponse(
+        id=export_request.id,
+        user_id=export_request.user_id,
+        export_type=export_request.export_type.value,
+        export_format=export_request.export_format.value,
+        filters=export_request.filters,
+        created_at=export_request.created_at,
+        status=export_request.status,
+        file_path=export_request.file_path,
+        file_size=export_request.file_size,
+        error_message=export_request.error_message,
+        rows_total=export_request.rows_total,
+        rows_written=export_request.rows_written,
+        progress=export_request.progress
+    )
 
 @router.post("/request", response_model=ExportRequestResponse)
 async def create_export_request(
     request: ExportRequestModel,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -69,21 +89,10 @@ async def create_export_request(
             filters=request.filters
         )
         
-        # Запускаем обработку в фоне
-        background_tasks.add_task(manager.process_export, export_request.id)
+        # Запускаем обработку в фоновом пуле экспорта
+        manager.submit(export_request.id)
         
-        return ExportRequestResponse(
-            id=export_request.id,
-            user_id=export_request.user_id,
-            export_type=export_request.export_type.value,
-            export_format=export_request.export_format.value,
-            filters=export_request.filters,
-            created_at=export_request.created_at,
-            status=export_request.status,
-            file_path=export_request.file_path,
-            file_size=export_request.file_size,
-            error_message=export_request.error_message
-        )
+        return _to_response(export_request)
         
     except HTTPException:
         raise
@@ -108,18 +117,7 @@ async def get_export_request(
         if export_request.user_id != current_user.id:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        return ExportRequestResponse(
-            id=export_request.id,
-            user_id=export_request.user_id,
-            export_type=export_request.export_type.value,
-            export_format=export_request.export_format.value,
-            filters=export_request.filters,
-            created_at=export_request.created_at,
-            status=export_request.status,
-            file_path=export_request.file_path,
-            file_size=export_request.file_size,
-            error_message=export_request.error_message
-        )
+        return _to_response(export_request)
         
     except HTTPException:
         raise
@@ -136,21 +134,7 @@ async def get_my_export_requests(
         manager = get_export_manager()
         requests = manager.get_user_export_requests(current_user.id)
         
-        return [
-            ExportRequestResponse(
-                id=req.id,
-                user_id=req.user_id,
-                export_type=req.export_type.value,
-                export_format=req.export_format.value,
-                filters=req.filters,
-                created_at=req.created_at,
-                status=req.status,
-                file_path=req.file_path,
-                file_size=req.file_size,
-                error_message=req.error_message
-            )
-            for req in requests
-        ]
+        return [_to_response(req) for req in requests]
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -180,28 +164,14 @@ async def download_export_file(
         if not export_request.file_path or not os.path.exists(export_request.file_path):
             raise HTTPException(status_code=404, detail="Export file not found")
         
-        # Определяем MIME тип
-        mime_types = {
-            ExportFormat.PDF: "application/pdf",
-            ExportFormat.DOCX: "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            ExportFormat.XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            ExportFormat.JSON: "application/json",
-            ExportFormat.CSV: "text/csv"
-        }
-        
-        mime_type = mime_types.get(export_request.export_format, "application/octet-stream")
-        
-        # Читаем файл
-        with open(export_request.file_path, 'rb') as f:
-            file_content = f.read()
-        
         # Определяем имя файла
         filename = f"export_{request_id}.{export_request.export_format.value}"
         
-        return Response(
-            content=file_content,
-            media_type=mime_type,
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        # Файл отдается потоком, без чтения в память
+        return FileResponse(
+            export_request.file_path,
+            media_type=_get_format_mime_type(export_request.export_format),
+            filename=filename
         )
         
     except HTTPException:
@@ -281,23 +251,13 @@ async def export_health():
     """Проверка здоровья сервиса экспорта"""
     try:
         manager = get_export_manager()
-        
-        # Тестируем создание запроса
-        test_request = manager.create_export_request(
-            user_id=999999,
-            export_type=ExportType.CHAT_HISTORY,
-            export_format=ExportFormat.JSON
-        )
+        stats = manager.get_export_stats()
         
         return {
             "status": "healthy",
             "timestamp": datetime.now().isoformat(),
-            "test_request": {
-                "id": test_request.id,
-                "type": test_request.export_type.value,
-                "format": test_request.export_format.value
-            },
-            "total_requests": len(manager.export_requests)
+            "total_requests": stats["total_requests"],
+            "active_requests": stats["active_requests"]
         }
         
     except Exception as e:
@@ -314,6 +274,7 @@ def _get_format_name(format_type: ExportFormat) -> str:
         ExportFormat.DOCX: "Microsoft Word",
         ExportFormat.XLSX: "Microsoft Excel",
         ExportFormat.JSON: "JSON",
+        ExportFormat.JSONL: "JSON Lines",
         ExportFormat.CSV: "CSV"
     }
     return names.get(format_type, format_type.value.upper())
@@ -325,6 +286,7 @@ def _get_format_description(format_type: ExportFormat) -> str:
         ExportFormat.DOCX: "Документ Microsoft Word",
         ExportFormat.XLSX: "Таблица Microsoft Excel",
         ExportFormat.JSON: "Формат обмена данными JSON",
+        ExportFormat.JSONL: "JSON, одна запись на строку (для больших выгрузок)",
         ExportFormat.CSV: "Текстовый формат с разделителями"
     }
     return descriptions.get(format_type, "Неизвестный формат")
@@ -336,6 +298,7 @@ def _get_format_mime_type(format_type: ExportFormat) -> str:
         ExportFormat.DOCX: "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
         ExportFormat.XLSX: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         ExportFormat.JSON: "application/json",
+        ExportFormat.JSONL: "application/x-ndjson",
         ExportFormat.CSV: "text/csv"
     }
     return mime_types.get(format_type, "application/octet-stream")
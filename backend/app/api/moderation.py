@@ -42,6 +42,7 @@ async def get_moderation_queue(
     assigned_to_me: bool = False,
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
     current_user: User = Depends(auth_service.get_current_active_user),
     db: Session = Depends(get_db)
 ):
@@ -56,6 +57,7 @@ async def get_moderation_queue(
     - **assigned_to_me**: показать только назначенные мне
     - **page**: номер страницы
     - **page_size**: размер страницы (1-100)
+    - **cursor**: курсор следующей страницы из предыдущего ответа (next_cursor); вместо page
     """
     check_moderator_permission(current_user, db)
     
@@ -66,20 +68,25 @@ async def get_moderation_queue(
         assigned_to_me=assigned_to_me
     )
     
-    queue, total = await moderation_service.get_moderation_queue(
-        db=db,
-        moderator_id=current_user.id,
-        filters=filters,
-        page=page,
-        page_size=page_size
-    )
+    try:
+        queue, total, next_cursor = await moderation_service.get_moderation_queue(
+            db=db,
+            moderator_id=current_user.id,
+            filters=filters,
+            page=page,
+            page_size=page_size,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     
     return {
         "items": queue,
         "total": total,
         "page": page,
         "page_size": page_size,
-        "total_pages": (total + page_size - 1) // page_size
+        "total_pages": (total + page_size - 1) // page_size,
+        "next_cursor": next_cursor
     }
 
 
@@ -10,6 +10,7 @@ from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
 
 from ..services.smart_document_processor import smart_document_processor
+from ..services.background_analysis_service import background_analysis_service
 from ..services.vector_store_service import vector_store_service
 from ..core.security import validate_file_type, validate_file_size
 
@@ -64,14 +65,17 @@ async def upload_document_with_analysis(
             
             return JSONResponse({
                 "success": True,
-                "message": "Документ успешно загружен и проанализирован",
+                "message": "Документ успешно загружен, AI-анализ поставлен в очередь",
                 "filename": file.filename,
                 "processing_time": result["processing_time"],
                 "chunks_created": result["chunks_count"],
                 "articles_found": result["articles_count"],
                 "sections_found": result["sections_count"],
                 "document_type": result["metadata"]["document_type"],
-                "structure_score": result["metadata"]["structure_score"]
+                "structure_score": result["metadata"]["structure_score"],
+                "document_id": result.get("document_id"),
+                "analysis_job_id": result.get("analysis_job_id"),
+                "analysis_status": result.get("analysis_status")
             })
         else:
             raise HTTPException(
@@ -128,7 +132,8 @@ async def upload_multiple_documents(
                     "success": True,
                     "chunks_created": result["chunks_count"],
                     "articles_found": result["articles_count"],
-                    "document_type": result["metadata"]["document_type"]
+                    "document_type": result["metadata"]["document_type"],
+                    "analysis_job_id": result.get("analysis_job_id")
                 })
                 
                 # Добавляем в фоновые задачи
@@ -204,6 +209,38 @@ async def get_analysis_status(filename: str) -> JSONResponse:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/analysis-jobs/{job_id}")
+async def get_analysis_job(job_id: str) -> JSONResponse:
+    """
+    Получает статус фоновой задачи AI-анализа документа
+    """
+    try:
+        job = await asyncio.to_thread(background_analysis_service.get_job, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Задача анализа не найдена")
+        return JSONResponse(job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения задачи анализа: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/analysis-queue")
+async def get_analysis_queue_stats() -> JSONResponse:
+    """
+    Получает состояние фоновой очереди AI-анализа
+    """
+    try:
+        stats = await asyncio.to_thread(background_analysis_service.get_queue_stats)
+        return JSONResponse(stats)
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка получения состояния очереди: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/database-stats")
 async def get_database_stats() -> JSONResponse:
     """
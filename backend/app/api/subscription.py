@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
@@ -36,7 +38,7 @@ class SubscriptionUpgradeRequest(BaseModel):
 
 class FeatureUsageRequest(BaseModel):
     feature_type: str = Field(..., description="Тип функции")
-    amount: int = Field(default=1, description="Количество использования")
+    amount: int = Field(default=1, ge=1, description="Количество использования")
 
 class SubscriptionPlanResponse(BaseModel):
     tier: str
@@ -337,7 +339,8 @@ async def get_usage_summary(
     """Получение сводки по использованию"""
     try:
         manager = get_subscription_manager()
-        usage_summary = manager.get_usage_summary(current_user.id)
+        # Счетчики квот читаются из Redis - синхронный клиент уводим из event loop
+        usage_summary = await asyncio.to_thread(manager.get_usage_summary, current_user.id)
         
         return UsageSummaryResponse(**usage_summary)
         
@@ -359,13 +362,14 @@ async def check_feature_access(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid feature type")
         
-        has_access, message = manager.check_feature_access(current_user.id, feature_type)
+        has_access, message = await asyncio.to_thread(manager.check_feature_access, current_user.id, feature_type)
+        current_usage = await asyncio.to_thread(manager.get_feature_usage, current_user.id, feature_type, "monthly")
         
         return {
             "feature_type": request.feature_type,
             "has_access": has_access,
             "message": message,
-            "current_usage": manager.get_feature_usage(current_user.id, feature_type, "monthly"),
+            "current_usage": current_usage,
             "limit": manager.get_user_subscription(current_user.id).plan.features[feature_type].limit
         }
         
@@ -389,19 +393,20 @@ async def use_feature(
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid feature type")
         
-        # Проверяем доступ
-        has_access, message = manager.check_feature_access(current_user.id, feature_type)
+        # Проверяем лимит и списываем использование одной атомарной операцией;
+        # вызовы Redis синхронные, поэтому выполняются в пуле потоков
+        has_access, message = await asyncio.to_thread(
+            manager.consume_feature, current_user.id, feature_type, request.amount
+        )
         if not has_access:
             raise HTTPException(status_code=403, detail=message)
         
-        # Увеличиваем счетчик использования
-        manager.increment_feature_usage(current_user.id, feature_type, request.amount)
-        
+        usage_summary = await asyncio.to_thread(manager.get_usage_summary, current_user.id)
         return {
             "message": "Feature used successfully",
             "feature_type": request.feature_type,
             "amount": request.amount,
-            "remaining_usage": manager.get_usage_summary(current_user.id)["features"][request.feature_type]["remaining"]
+            "remaining_usage": usage_summary["features"][request.feature_type]["remaining"]
         }
         
     except HTTPException:
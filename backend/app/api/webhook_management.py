@@ -208,11 +208,13 @@ async def update_webhook_subscription(
                     detail=f"Invalid event type: {event_str}"
                 )
         
-        # Обновляем подписку
-        subscription.url = subscription_data.url
-        subscription.events = valid_events
-        subscription.secret = subscription_data.secret
-        subscription.failure_count = 0  # Сбрасываем счетчик ошибок
+        # Обновляем подписку (счетчик ошибок сбрасывается)
+        webhook_manager.update_subscription(
+            subscription,
+            url=subscription_data.url,
+            events=valid_events,
+            secret=subscription_data.secret
+        )
         
         return {"message": "Webhook subscription updated successfully"}
         
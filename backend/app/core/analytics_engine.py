@@ -10,8 +10,8 @@ import logging
 from typing import Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
-import statistics
+from collections import OrderedDict, defaultdict, deque
+import math
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +41,9 @@ class PerformanceMetrics:
     error_rate: float
     throughput: float  # запросов в минуту
     uptime: float
+    p50_response_time: float = 0.0
+    p95_response_time: float = 0.0
+    p99_response_time: float = 0.0
 
 
 @dataclass
@@ -53,12 +56,132 @@ class QualityMetrics:
     response_completeness: float
 
 
+class LatencySketch:
+    """
+    Логарифмическая гистограмма задержек
+    
+    Значения попадают в ячейки с шагом GAMMA, поэтому квантиль оценивается с
+    относительной ошибкой не больше (GAMMA - 1) / 2, а число ячеек ограничено
+    диапазоном задержек. Гистограммы разных бакетов сливаются сложением.
+    """
+    
+    GAMMA = 1.1
+    MIN_VALUE = 0.001  # 1 мс
+    
+    __slots__ = ("bins", "count")
+    
+    def __init__(self):
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+    
+    def add(self, value: float):
+        index = math.ceil(math.log(max(value, self.MIN_VALUE)) / math.log(self.GAMMA))
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+    
+    def merge(self, other: "LatencySketch"):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+    
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # Середина ячейки (GAMMA^(i-1), GAMMA^i]
+                return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+        return self.GAMMA ** max(self.bins)
+
+
+class MetricsBucket:
+    """Суммы и счетчики запросов за одну минуту"""
+    
+    __slots__ = (
+        "minute", "count", "response_time_sum", "fast_responses", "errors",
+        "quality_sum", "validated", "complete", "confidence_sum", "specialized", "latency"
+    )
+    
+    def __init__(self, minute: int = -1):
+        self.minute = minute
+        self.count = 0
+        self.response_time_sum = 0.0
+        self.fast_responses = 0  # Ответ быстрее секунды (приближение попадания в кэш)
+        self.errors = 0  # quality_score < 0.3
+        self.quality_sum = 0.0
+        self.validated = 0  # quality_score > 0.7
+        self.complete = 0  # quality_score > 0.5
+        self.confidence_sum = 0.0
+        self.specialized = 0  # Отрасль права определена (не general)
+        self.latency = LatencySketch()
+    
+    def add(self, query: QueryAnalytics):
+        self.count += 1
+        self.response_time_sum += query.response_time
+        self.fast_responses += query.response_time < 1.0
+        self.errors += query.quality_score < 0.3
+        self.quality_sum += query.quality_score
+        self.validated += query.quality_score > 0.7
+        self.complete += query.quality_score > 0.5
+        self.confidence_sum += query.confidence
+        self.specialized += query.legal_field != "general"
+        self.latency.add(query.response_time)
+    
+    def merge(self, other: "MetricsBucket"):
+        self.count += other.count
+        self.response_time_sum += other.response_time_sum
+        self.fast_responses += other.fast_responses
+        self.errors += other.errors
+        self.quality_sum += other.quality_sum
+        self.validated += other.validated
+        self.complete += other.complete
+        self.confidence_sum += other.confidence_sum
+        self.specialized += other.specialized
+        self.latency.merge(other.latency)
+
+
+class UserStats:
+    """Накопленная статистика пользователя (фиксированный размер вместо списка запросов)"""
+    
+    __slots__ = ("total_queries", "response_time_sum", "quality_sum", "legal_fields", "first_query", "last_query")
+    
+    def __init__(self):
+        self.total_queries = 0
+        self.response_time_sum = 0.0
+        self.quality_sum = 0.0
+        self.legal_fields: Dict[str, int] = defaultdict(int)
+        self.first_query: Optional[float] = None
+        self.last_query: Optional[float] = None
+    
+    def add(self, query: QueryAnalytics):
+        self.total_queries += 1
+        self.response_time_sum += query.response_time
+        self.quality_sum += query.quality_score
+        self.legal_fields[query.legal_field] += 1
+        if self.first_query is None or query.timestamp < self.first_query:
+            self.first_query = query.timestamp
+        if self.last_query is None or query.timestamp > self.last_query:
+            self.last_query = query.timestamp
+
+
 class AnalyticsEngine:
-    """Движок аналитики"""
+    """
+    Движок аналитики
+    
+    Метрики за последний час считаются по кольцу из 60 минутных бакетов:
+    запись запроса обновляет один бакет, запрос окна сливает не больше 60
+    бакетов. Алерты проверяются фоновой задачей по таймеру, а не на каждом
+    запросе. Статистика хранится для ограниченного числа недавних пользователей.
+    """
+    
+    WINDOW_MINUTES = 60
     
     def __init__(self):
-        self.queries = deque(maxlen=10000)  # Храним последние 10k запросов
-        self.user_sessions = defaultdict(list)
+        self.buckets = [MetricsBucket() for _ in range(self.WINDOW_MINUTES)]
+        self.user_sessions: "OrderedDict[str, UserStats]" = OrderedDict()
         self.performance_history = deque(maxlen=1000)
         self.quality_history = deque(maxlen=1000)
         
@@ -74,6 +197,7 @@ class AnalyticsEngine:
         
         # Алерты
         self.alerts = []
+        self._alert_task: Optional[asyncio.Task] = None
         
         # Настройки мониторинга
         self.monitoring_config = {
@@ -81,37 +205,56 @@ class AnalyticsEngine:
             "error_rate_threshold": 0.05,    # 5%
             "quality_score_threshold": 0.7,   # 70%
             "cache_hit_rate_threshold": 0.3,  # 30%
-            "throughput_threshold": 10.0      # запросов в минуту
+            "throughput_threshold": 10.0,     # запросов в минуту
+            "alert_check_interval": 30.0,     # секунд между проверками алертов
+            "max_tracked_users": 10000        # пользователей с персональной статистикой
         }
     
     def record_query(self, query_analytics: QueryAnalytics):
         """Записывает аналитику запроса"""
-        self.queries.append(query_analytics)
+        minute = int(query_analytics.timestamp // 60)
+        bucket = self.buckets[minute % self.WINDOW_MINUTES]
+        if bucket.minute != minute:
+            if minute < bucket.minute:
+                # Запись из прошлого, бакет которой уже переиспользован
+                return
+            bucket = MetricsBucket(minute)
+            self.buckets[minute % self.WINDOW_MINUTES] = bucket
+        bucket.add(query_analytics)
         
         # Обновляем статистику пользователя
         if query_analytics.user_id:
-            self.user_sessions[query_analytics.user_id].append(query_analytics)
+            user_stats = self.user_sessions.get(query_analytics.user_id)
+            if user_stats is None:
+                user_stats = UserStats()
+                self.user_sessions[query_analytics.user_id] = user_stats
+                if len(self.user_sessions) > self.monitoring_config["max_tracked_users"]:
+                    self.user_sessions.popitem(last=False)
+            else:
+                self.user_sessions.move_to_end(query_analytics.user_id)
+            user_stats.add(query_analytics)
         
         # Обновляем статистику по отраслям права
         self.legal_field_stats[query_analytics.legal_field] += 1
         
         # Обновляем статистику по сложности
         self.complexity_stats[query_analytics.complexity] += 1
-        
-        # Проверяем алерты
-        self._check_alerts()
     
-    def get_performance_metrics(self) -> PerformanceMetrics:
+    def _window(self, current_time: Optional[float] = None) -> MetricsBucket:
+        """Сумма бакетов за последний час"""
+        current_minute = int((current_time or time.time()) // 60)
+        total = MetricsBucket(current_minute)
+        for bucket in self.buckets:
+            if current_minute - self.WINDOW_MINUTES < bucket.minute <= current_minute:
+                total.merge(bucket)
+        return total
+    
+    def get_performance_metrics(self, window: Optional[MetricsBucket] = None) -> PerformanceMetrics:
         """Возвращает метрики производительности"""
         current_time = time.time()
+        window = window or self._window(current_time)
         
-        # Фильтруем запросы за последний час
-        recent_queries = [
-            q for q in self.queries 
-            if current_time - q.timestamp < 3600
-        ]
-        
-        if not recent_queries:
+        if not window.count:
             return PerformanceMetrics(
                 total_requests=0,
                 average_response_time=0.0,
@@ -121,50 +264,28 @@ class AnalyticsEngine:
                 uptime=current_time - self.start_time
             )
         
-        # Вычисляем метрики
-        total_requests = len(recent_queries)
-        response_times = [q.response_time for q in recent_queries]
-        average_response_time = statistics.mean(response_times) if response_times else 0.0
-        
-        # Cache hit rate (упрощенная версия)
-        cache_hits = sum(1 for q in recent_queries if q.response_time < 1.0)
-        cache_hit_rate = cache_hits / total_requests if total_requests > 0 else 0.0
-        
-        # Error rate (упрощенная версия)
-        errors = sum(1 for q in recent_queries if q.quality_score < 0.3)
-        error_rate = errors / total_requests if total_requests > 0 else 0.0
-        
-        # Throughput (запросов в минуту)
-        throughput = total_requests / 60.0
+        total_requests = window.count
         
         return PerformanceMetrics(
             total_requests=total_requests,
-            average_response_time=average_response_time,
-            cache_hit_rate=cache_hit_rate,
-            error_rate=error_rate,
-            throughput=throughput,
-            uptime=current_time - self.start_time
+            average_response_time=window.response_time_sum / total_requests,
+            # Cache hit rate (упрощенная версия)
+            cache_hit_rate=window.fast_responses / total_requests,
+            # Error rate (упрощенная версия)
+            error_rate=window.errors / total_requests,
+            # Throughput (запросов в минуту)
+            throughput=total_requests / 60.0,
+            uptime=current_time - self.start_time,
+            p50_response_time=window.latency.quantile(0.5),
+            p95_response_time=window.latency.quantile(0.95),
+            p99_response_time=window.latency.quantile(0.99)
         )
     
-    def get_quality_metrics(self) -> QualityMetrics:
+    def get_quality_metrics(self, window: Optional[MetricsBucket] = None) -> QualityMetrics:
         """Возвращает метрики качества"""
-        if not self.queries:
-            return QualityMetrics(
-                average_quality_score=0.0,
-                validation_success_rate=0.0,
-                user_satisfaction=0.0,
-                legal_accuracy=0.0,
-                response_completeness=0.0
-            )
-        
-        # Фильтруем запросы за последний час
-        current_time = time.time()
-        recent_queries = [
-            q for q in self.queries 
-            if current_time - q.timestamp < 3600
-        ]
+        window = window or self._window()
         
-        if not recent_queries:
+        if not window.count:
             return QualityMetrics(
                 average_quality_score=0.0,
                 validation_success_rate=0.0,
@@ -173,30 +294,17 @@ class AnalyticsEngine:
                 response_completeness=0.0
             )
         
-        # Вычисляем метрики качества
-        quality_scores = [q.quality_score for q in recent_queries]
-        average_quality_score = statistics.mean(quality_scores) if quality_scores else 0.0
-        
-        # Validation success rate
-        validation_successes = sum(1 for q in recent_queries if q.quality_score > 0.7)
-        validation_success_rate = validation_successes / len(recent_queries) if recent_queries else 0.0
-        
-        # User satisfaction (на основе confidence)
-        confidence_scores = [q.confidence for q in recent_queries]
-        user_satisfaction = statistics.mean(confidence_scores) if confidence_scores else 0.0
-        
-        # Legal accuracy (упрощенная версия)
-        legal_accuracy = sum(1 for q in recent_queries if q.legal_field != "general") / len(recent_queries)
-        
-        # Response completeness (упрощенная версия)
-        response_completeness = sum(1 for q in recent_queries if q.quality_score > 0.5) / len(recent_queries)
+        total_requests = window.count
         
         return QualityMetrics(
-            average_quality_score=average_quality_score,
-            validation_success_rate=validation_success_rate,
-            user_satisfaction=user_satisfaction,
-            legal_accuracy=legal_accuracy,
-            response_completeness=response_completeness
+            average_quality_score=window.quality_sum / total_requests,
+            validation_success_rate=window.validated / total_requests,
+            # User satisfaction (на основе confidence)
+            user_satisfaction=window.confidence_sum / total_requests,
+            # Legal accuracy (упрощенная версия)
+            legal_accuracy=window.specialized / total_requests,
+            # Response completeness (упрощенная версия)
+            response_completeness=window.complete / total_requests
         )
     
     def get_legal_field_analytics(self) -> Dict[str, Any]:
@@ -243,45 +351,32 @@ class AnalyticsEngine:
     
     def get_user_analytics(self, user_id: str) -> Dict[str, Any]:
         """Возвращает аналитику пользователя"""
-        if user_id not in self.user_sessions:
+        user_stats = self.user_sessions.get(user_id)
+        if user_stats is None:
             return {"error": "User not found"}
         
-        user_queries = self.user_sessions[user_id]
-        
-        if not user_queries:
+        if not user_stats.total_queries:
             return {"error": "No queries found for user"}
         
-        # Вычисляем метрики пользователя
-        total_queries = len(user_queries)
-        avg_response_time = statistics.mean([q.response_time for q in user_queries])
-        avg_quality_score = statistics.mean([q.quality_score for q in user_queries])
-        
         # Популярные отрасли права
-        user_legal_fields = defaultdict(int)
-        for q in user_queries:
-            user_legal_fields[q.legal_field] += 1
-        
+        user_legal_fields = dict(user_stats.legal_fields)
         top_legal_field = max(user_legal_fields.items(), key=lambda x: x[1])[0] if user_legal_fields else None
         
-        # Временная активность
-        query_times = [q.timestamp for q in user_queries]
-        first_query = min(query_times) if query_times else None
-        last_query = max(query_times) if query_times else None
-        
         return {
-            "total_queries": total_queries,
-            "average_response_time": avg_response_time,
-            "average_quality_score": avg_quality_score,
+            "total_queries": user_stats.total_queries,
+            "average_response_time": user_stats.response_time_sum / user_stats.total_queries,
+            "average_quality_score": user_stats.quality_sum / user_stats.total_queries,
             "top_legal_field": top_legal_field,
-            "first_query": first_query,
-            "last_query": last_query,
-            "legal_fields": dict(user_legal_fields)
+            "first_query": user_stats.first_query,
+            "last_query": user_stats.last_query,
+            "legal_fields": user_legal_fields
         }
     
     def get_system_health(self) -> Dict[str, Any]:
         """Возвращает состояние системы"""
-        performance = self.get_performance_metrics()
-        quality = self.get_quality_metrics()
+        window = self._window()
+        performance = self.get_performance_metrics(window)
+        quality = self.get_quality_metrics(window)
         
         # Определяем статус системы
         health_status = "healthy"
@@ -312,12 +407,38 @@ class AnalyticsEngine:
             "timestamp": time.time()
         }
     
+    async def start(self):
+        """Запуск периодической проверки алертов"""
+        if self._alert_task is None or self._alert_task.done():
+            self._alert_task = asyncio.create_task(self._alert_loop())
+    
+    async def stop(self):
+        """Остановка проверки алертов"""
+        if self._alert_task is not None:
+            self._alert_task.cancel()
+            try:
+                await self._alert_task
+            except asyncio.CancelledError:
+                pass
+            self._alert_task = None
+    
+    async def _alert_loop(self):
+        while True:
+            await asyncio.sleep(self.monitoring_config["alert_check_interval"])
+            try:
+                self._check_alerts()
+            except Exception as e:
+                logger.error(f"Analytics alert check failed: {e}")
+    
     def _check_alerts(self):
         """Проверяет условия для алертов"""
-        current_time = time.time()
+        window = self._window()
+        if not window.count:
+            # Без запросов за час метрики нулевые, алерты по ним ложные
+            return
         
         # Проверяем производительность
-        performance = self.get_performance_metrics()
+        performance = self.get_performance_metrics(window)
         
         if performance.average_response_time > self.monitoring_config["response_time_threshold"]:
             self._add_alert("high_response_time", f"Average response time: {performance.average_response_time:.2f}s")
@@ -326,7 +447,7 @@ class AnalyticsEngine:
             self._add_alert("high_error_rate", f"Error rate: {performance.error_rate:.2%}")
         
         # Проверяем качество
-        quality = self.get_quality_metrics()
+        quality = self.get_quality_metrics(window)
         
         if quality.average_quality_score < self.monitoring_config["quality_score_threshold"]:
             self._add_alert("low_quality", f"Average quality score: {quality.average_quality_score:.2f}")
@@ -358,7 +479,7 @@ class AnalyticsEngine:
     
     def reset_statistics(self):
         """Сбрасывает статистику"""
-        self.queries.clear()
+        self.buckets = [MetricsBucket() for _ in range(self.WINDOW_MINUTES)]
         self.user_sessions.clear()
         self.performance_history.clear()
         self.quality_history.clear()
@@ -371,9 +492,10 @@ class AnalyticsEngine:
     
     def export_analytics(self, format: str = "json") -> str:
         """Экспортирует аналитику"""
+        window = self._window()
         data = {
-            "performance": asdict(self.get_performance_metrics()),
-            "quality": asdict(self.get_quality_metrics()),
+            "performance": asdict(self.get_performance_metrics(window)),
+            "quality": asdict(self.get_quality_metrics(window)),
             "legal_fields": self.get_legal_field_analytics(),
             "complexity": self.get_complexity_analytics(),
             "system_health": self.get_system_health(),
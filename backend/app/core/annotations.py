@@ -1,11 +1,17 @@
 import logging
-from typing import Dict, List, Any, Optional, Tuple
+import re
+from typing import Dict, List, Any, Optional, Set, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
 import uuid
 import json
 
+from sqlalchemy import and_, case, delete, func, or_, select
+
+from .database import SessionLocal
+from ..models.annotation import AnnotationTag, AnnotationTerm, DocumentAnnotation, DocumentAnnotationReply
+
 logger = logging.getLogger(__name__)
 
 class AnnotationType(Enum):
@@ -75,14 +81,62 @@ class DocumentVersion:
     change_summary: str
     annotations_count: int = 0
 
+# Иерархическая сетка ячеек для поиска аннотаций по диапазону текста (схема бинов UCSC).
+# Аннотация хранится в наименьшей ячейке, целиком покрывающей ее диапазон, поэтому для
+# окна X..Y достаточно проверить ячейки, пересекающие окно, на каждом уровне сетки.
+_BIN_SHIFTS = (10, 13, 16, 19, 22, 25)  # Ячейки по 1K, 8K, 64K, 512K, 4M и 32M символов
+_BIN_MAX_OFFSET = (1 << 28) - 1
+_BIN_BASES: List[int] = []
+_bin_base = 0
+for _shift in _BIN_SHIFTS:
+    _BIN_BASES.append(_bin_base)
+    _bin_base += (_BIN_MAX_OFFSET >> _shift) + 1
+_BIN_TOP = _bin_base  # Диапазоны длиннее самой крупной ячейки или за пределами сетки
+_MAX_QUERY_BINS = 4096  # Для более широких окон достаточно индекса по началу диапазона
+
+_TERM_RE = re.compile(r"\w+")
+_TERM_MAX_LENGTH = 64
+_FIELD_CONTENT = "content"
+_FIELD_TEXT = "text"
+
+def _span_bin(start_offset: int, end_offset: int) -> int:
+    """Ячейка сетки, целиком покрывающая диапазон"""
+    start = max(0, start_offset)
+    end = max(start, end_offset)
+    if end > _BIN_MAX_OFFSET:
+        return _BIN_TOP
+    for base, shift in zip(_BIN_BASES, _BIN_SHIFTS):
+        if start >> shift == end >> shift:
+            return base + (start >> shift)
+    return _BIN_TOP
+
+def _overlapping_bins(start_offset: int, end_offset: int) -> Optional[List[int]]:
+    """Ячейки всех уровней, которые могут содержать аннотации, пересекающие окно"""
+    start = min(max(0, start_offset), _BIN_MAX_OFFSET)
+    end = min(max(start, end_offset), _BIN_MAX_OFFSET)
+    bins = []
+    for base, shift in zip(_BIN_BASES, _BIN_SHIFTS):
+        bins.extend(range(base + (start >> shift), base + (end >> shift) + 1))
+        if len(bins) > _MAX_QUERY_BINS:
+            return None
+    bins.append(_BIN_TOP)
+    return bins
+
+def _terms(text: Optional[str]) -> Set[str]:
+    """Слова текста в нижнем регистре для обратного индекса"""
+    return {term[:_TERM_MAX_LENGTH] for term in _TERM_RE.findall((text or "").lower())}
+
 class AnnotationManager:
-    """Менеджер аннотаций"""
+    """
+    Менеджер аннотаций
+    
+    Аннотации хранятся в БД и общие для всех воркеров. Выборка по окну текста
+    идет через сетку ячеек (span_bin), по пользователю и тегам - через индексы,
+    поиск по содержимому - через обратный индекс слов с совпадением по префиксу.
+    """
     
     def __init__(self):
-        self.annotations: Dict[str, Annotation] = {}
-        self.annotation_replies: Dict[str, AnnotationReply] = {}
         self.document_versions: Dict[str, List[DocumentVersion]] = {}
-        self.user_annotations: Dict[int, List[str]] = {}  # user_id -> annotation_ids
     
     def create_annotation(
         self,
@@ -100,31 +154,39 @@ class AnnotationManager:
         """Создание аннотации"""
         try:
             annotation_id = f"ann_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:8]}"
+            now = datetime.now()
             
-            annotation = Annotation(
+            row = DocumentAnnotation(
                 id=annotation_id,
                 document_id=document_id,
                 user_id=user_id,
-                annotation_type=annotation_type,
-                text_range=text_range,
+                annotation_type=annotation_type.value,
+                status=AnnotationStatus.ACTIVE.value,
+                is_public=is_public,
+                start_offset=text_range.start_offset,
+                end_offset=text_range.end_offset,
+                start_line=text_range.start_line,
+                end_line=text_range.end_line,
+                span_bin=_span_bin(text_range.start_offset, text_range.end_offset),
+                selected_text=text_range.text or "",
                 content=content,
                 color=color,
                 style=style or {},
                 tags=tags or [],
-                metadata=metadata or {},
-                created_at=datetime.now(),
-                updated_at=datetime.now(),
-                status=AnnotationStatus.ACTIVE,
-                is_public=is_public,
-                replies=[]
+                annotation_metadata=metadata or {},
+                created_at=now,
+                updated_at=now
             )
             
-            self.annotations[annotation_id] = annotation
-            
-            # Добавляем в список аннотаций пользователя
-            if user_id not in self.user_annotations:
-                self.user_annotations[user_id] = []
-            self.user_annotations[user_id].append(annotation_id)
+            db = SessionLocal()
+            try:
+                db.add(row)
+                self._index_terms(db, row)
+                self._index_tags(db, row)
+                db.commit()
+                annotation = self._to_annotation(row, [])
+            finally:
+                db.close()
             
             logger.info(f"Created annotation {annotation_id} for document {document_id}")
             return annotation
@@ -133,45 +195,115 @@ class AnnotationManager:
             logger.error(f"Annotation creation error: {str(e)}")
             raise
     
+    def _index_terms(self, db, row: DocumentAnnotation):
+        """Перестроение обратного индекса слов аннотации"""
+        db.execute(delete(AnnotationTerm).where(AnnotationTerm.annotation_id == row.id))
+        content_terms = _terms(row.content)
+        text_terms = _terms(row.selected_text)
+        db.add_all(
+            [AnnotationTerm(term=term, annotation_id=row.id, field=_FIELD_CONTENT) for term in content_terms] +
+            [AnnotationTerm(term=term, annotation_id=row.id, field=_FIELD_TEXT) for term in text_terms]
+        )
+    
+    def _index_tags(self, db, row: DocumentAnnotation):
+        """Перестроение индекса тегов аннотации"""
+        db.execute(delete(AnnotationTag).where(AnnotationTag.annotation_id == row.id))
+        db.add_all([AnnotationTag(tag=tag, annotation_id=row.id) for tag in set(row.tags or [])])
+    
+    def _to_annotation(self, row: DocumentAnnotation, replies: List[str]) -> Annotation:
+        return Annotation(
+            id=row.id,
+            document_id=row.document_id,
+            user_id=row.user_id,
+            annotation_type=AnnotationType(row.annotation_type),
+            text_range=TextRange(
+                start_offset=row.start_offset,
+                end_offset=row.end_offset,
+                start_line=row.start_line,
+                end_line=row.end_line,
+                text=row.selected_text
+            ),
+            content=row.content,
+            color=row.color,
+            style=row.style or {},
+            tags=list(row.tags or []),
+            metadata=dict(row.annotation_metadata or {}),
+            created_at=row.created_at,
+            updated_at=row.updated_at,
+            status=AnnotationStatus(row.status),
+            is_public=row.is_public,
+            replies=replies
+        )
+    
+    def _load_annotations(self, db, rows: List[DocumentAnnotation]) -> List[Annotation]:
+        """Преобразование строк в аннотации с ID ответов одним запросом"""
+        replies: Dict[str, List[str]] = {row.id: [] for row in rows}
+        if replies:
+            reply_rows = db.execute(
+                select(DocumentAnnotationReply.annotation_id, DocumentAnnotationReply.id)
+                .where(DocumentAnnotationReply.annotation_id.in_(list(replies)))
+                .order_by(DocumentAnnotationReply.created_at)
+            ).all()
+            for annotation_id, reply_id in reply_rows:
+                replies[annotation_id].append(reply_id)
+        return [self._to_annotation(row, replies[row.id]) for row in rows]
+    
+    def _visibility_conditions(self, user_id: Optional[int], include_public: bool = True) -> List[Any]:
+        conditions = [DocumentAnnotation.status == AnnotationStatus.ACTIVE.value]
+        if user_id is not None:
+            conditions.append(or_(DocumentAnnotation.user_id == user_id, DocumentAnnotation.is_public.is_(True)))
+        if not include_public:
+            conditions.append(DocumentAnnotation.is_public.is_(False))
+        return conditions
+    
     def get_annotation(self, annotation_id: str) -> Optional[Annotation]:
         """Получение аннотации по ID"""
-        return self.annotations.get(annotation_id)
+        db = SessionLocal()
+        try:
+            row = db.get(DocumentAnnotation, annotation_id)
+            return self._load_annotations(db, [row])[0] if row else None
+        finally:
+            db.close()
     
     def get_document_annotations(
         self,
         document_id: str,
         user_id: Optional[int] = None,
         annotation_type: Optional[AnnotationType] = None,
-        include_public: bool = True
+        include_public: bool = True,
+        start_offset: Optional[int] = None,
+        end_offset: Optional[int] = None
     ) -> List[Annotation]:
-        """Получение аннотаций документа"""
-        document_annotations = []
-        
-        for annotation in self.annotations.values():
-            if annotation.document_id != document_id:
-                continue
-            
-            if annotation.status != AnnotationStatus.ACTIVE:
-                continue
-            
-            # Фильтр по пользователю
-            if user_id is not None and annotation.user_id != user_id and not annotation.is_public:
-                continue
-            
-            # Фильтр по типу
-            if annotation_type is not None and annotation.annotation_type != annotation_type:
-                continue
-            
-            # Фильтр по публичности
-            if not include_public and annotation.is_public:
-                continue
-            
-            document_annotations.append(annotation)
+        """
+        Получение аннотаций документа
         
-        # Сортируем по позиции в тексте
-        document_annotations.sort(key=lambda x: x.text_range.start_offset)
+        Если задано окно start_offset..end_offset, возвращаются только аннотации,
+        пересекающиеся с ним (для подгрузки видимой части документа).
+        """
+        conditions = [
+            DocumentAnnotation.document_id == document_id,
+            *self._visibility_conditions(user_id, include_public)
+        ]
+        if annotation_type is not None:
+            conditions.append(DocumentAnnotation.annotation_type == annotation_type.value)
+        if start_offset is not None:
+            conditions.append(DocumentAnnotation.end_offset >= start_offset)
+        if end_offset is not None:
+            conditions.append(DocumentAnnotation.start_offset <= end_offset)
+            bins = _overlapping_bins(start_offset or 0, end_offset)
+            if bins is not None:
+                conditions.append(DocumentAnnotation.span_bin.in_(bins))
         
-        return document_annotations
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(DocumentAnnotation)
+                .where(*conditions)
+                .order_by(DocumentAnnotation.start_offset, DocumentAnnotation.id)
+            ).scalars().all()
+            return self._load_annotations(db, rows)
+        finally:
+            db.close()
     
     def update_annotation(
         self,
@@ -185,29 +317,36 @@ class AnnotationManager:
     ) -> bool:
         """Обновление аннотации"""
         try:
-            annotation = self.get_annotation(annotation_id)
-            if not annotation:
-                return False
-            
-            if content is not None:
-                annotation.content = content
-            
-            if color is not None:
-                annotation.color = color
-            
-            if style is not None:
-                annotation.style = style
-            
-            if tags is not None:
-                annotation.tags = tags
-            
-            if metadata is not None:
-                annotation.metadata.update(metadata)
-            
-            if is_public is not None:
-                annotation.is_public = is_public
-            
-            annotation.updated_at = datetime.now()
+            db = SessionLocal()
+            try:
+                row = db.get(DocumentAnnotation, annotation_id)
+                if not row:
+                    return False
+                
+                if content is not None:
+                    row.content = content
+                    self._index_terms(db, row)
+                
+                if color is not None:
+                    row.color = color
+                
+                if style is not None:
+                    row.style = style
+                
+                if tags is not None:
+                    row.tags = tags
+                    self._index_tags(db, row)
+                
+                if metadata is not None:
+                    row.annotation_metadata = {**(row.annotation_metadata or {}), **metadata}
+                
+                if is_public is not None:
+                    row.is_public = is_public
+                
+                row.updated_at = datetime.now()
+                db.commit()
+            finally:
+                db.close()
             
             logger.info(f"Updated annotation {annotation_id}")
             return True
@@ -219,22 +358,24 @@ class AnnotationManager:
     def delete_annotation(self, annotation_id: str, user_id: int) -> bool:
         """Удаление аннотации"""
         try:
-            annotation = self.get_annotation(annotation_id)
-            if not annotation:
-                return False
-            
-            # Проверяем права доступа
-            if annotation.user_id != user_id:
-                return False
-            
-            # Мягкое удаление
-            annotation.status = AnnotationStatus.DELETED
-            annotation.updated_at = datetime.now()
-            
-            # Удаляем из списка пользователя
-            if user_id in self.user_annotations:
-                if annotation_id in self.user_annotations[user_id]:
-                    self.user_annotations[user_id].remove(annotation_id)
+            db = SessionLocal()
+            try:
+                row = db.get(DocumentAnnotation, annotation_id)
+                if not row:
+                    return False
+                
+                # Проверяем права доступа
+                if row.user_id != user_id:
+                    return False
+                
+                # Мягкое удаление; из индексов тегов и слов аннотация убирается
+                row.status = AnnotationStatus.DELETED.value
+                row.updated_at = datetime.now()
+                db.execute(delete(AnnotationTerm).where(AnnotationTerm.annotation_id == annotation_id))
+                db.execute(delete(AnnotationTag).where(AnnotationTag.annotation_id == annotation_id))
+                db.commit()
+            finally:
+                db.close()
             
             logger.info(f"Deleted annotation {annotation_id}")
             return True
@@ -251,25 +392,30 @@ class AnnotationManager:
     ) -> AnnotationReply:
         """Добавление ответа на аннотацию"""
         try:
-            annotation = self.get_annotation(annotation_id)
-            if not annotation:
-                raise ValueError("Annotation not found")
-            
-            reply_id = f"reply_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:8]}"
-            
-            reply = AnnotationReply(
-                id=reply_id,
-                annotation_id=annotation_id,
-                user_id=user_id,
-                content=content,
-                created_at=datetime.now(),
-                updated_at=datetime.now(),
-                status=AnnotationStatus.ACTIVE
-            )
-            
-            self.annotation_replies[reply_id] = reply
-            annotation.replies.append(reply_id)
-            annotation.updated_at = datetime.now()
+            db = SessionLocal()
+            try:
+                row = db.get(DocumentAnnotation, annotation_id)
+                if not row:
+                    raise ValueError("Annotation not found")
+                
+                reply_id = f"reply_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:8]}"
+                now = datetime.now()
+                
+                reply_row = DocumentAnnotationReply(
+                    id=reply_id,
+                    annotation_id=annotation_id,
+                    user_id=user_id,
+                    content=content,
+                    status=AnnotationStatus.ACTIVE.value,
+                    created_at=now,
+                    updated_at=now
+                )
+                db.add(reply_row)
+                row.updated_at = now
+                db.commit()
+                reply = self._to_reply(reply_row)
+            finally:
+                db.close()
             
             logger.info(f"Added reply {reply_id} to annotation {annotation_id}")
             return reply
@@ -278,18 +424,39 @@ class AnnotationManager:
             logger.error(f"Annotation reply creation error: {str(e)}")
             raise
     
+    def _to_reply(self, row: DocumentAnnotationReply) -> AnnotationReply:
+        return AnnotationReply(
+            id=row.id,
+            annotation_id=row.annotation_id,
+            user_id=row.user_id,
+            content=row.content,
+            created_at=row.created_at,
+            updated_at=row.updated_at,
+            status=AnnotationStatus(row.status)
+        )
+    
     def get_annotation_replies(self, annotation_id: str) -> List[AnnotationReply]:
         """Получение ответов на аннотацию"""
-        replies = []
-        
-        for reply in self.annotation_replies.values():
-            if reply.annotation_id == annotation_id and reply.status == AnnotationStatus.ACTIVE:
-                replies.append(reply)
-        
-        # Сортируем по дате создания
-        replies.sort(key=lambda x: x.created_at)
-        
-        return replies
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(DocumentAnnotationReply)
+                .where(
+                    DocumentAnnotationReply.annotation_id == annotation_id,
+                    DocumentAnnotationReply.status == AnnotationStatus.ACTIVE.value
+                )
+                .order_by(DocumentAnnotationReply.created_at)
+            ).scalars().all()
+            return [self._to_reply(row) for row in rows]
+        finally:
+            db.close()
+    
+    def _term_matches(self, term: str, field: Optional[str] = None):
+        """ID аннотаций, в которых есть слово, начинающееся с term"""
+        statement = select(AnnotationTerm.annotation_id).where(AnnotationTerm.term.startswith(term, autoescape=True))
+        if field is not None:
+            statement = statement.where(AnnotationTerm.field == field)
+        return statement
     
     def search_annotations(
         self,
@@ -297,42 +464,49 @@ class AnnotationManager:
         user_id: Optional[int] = None,
         document_id: Optional[str] = None,
         annotation_type: Optional[AnnotationType] = None,
-        tags: Optional[List[str]] = None
+        tags: Optional[List[str]] = None,
+        limit: int = 100
     ) -> List[Annotation]:
-        """Поиск аннотаций"""
-        results = []
+        """
+        Поиск аннотаций
         
-        for annotation in self.annotations.values():
-            if annotation.status != AnnotationStatus.ACTIVE:
-                continue
-            
-            # Фильтр по пользователю
-            if user_id is not None and annotation.user_id != user_id and not annotation.is_public:
-                continue
-            
-            # Фильтр по документу
-            if document_id is not None and annotation.document_id != document_id:
-                continue
-            
-            # Фильтр по типу
-            if annotation_type is not None and annotation.annotation_type != annotation_type:
-                continue
-            
-            # Фильтр по тегам
-            if tags is not None and not any(tag in annotation.tags for tag in tags):
-                continue
-            
-            # Поиск по содержимому
-            if query.lower() in annotation.content.lower() or query.lower() in annotation.text_range.text.lower():
-                results.append(annotation)
+        Каждое слово запроса должно совпасть с началом слова в содержимом или
+        выделенном тексте. Выше идут аннотации, где все слова есть в содержимом.
+        """
+        conditions = self._visibility_conditions(user_id)
+        
+        # Фильтр по документу
+        if document_id is not None:
+            conditions.append(DocumentAnnotation.document_id == document_id)
+        
+        # Фильтр по типу
+        if annotation_type is not None:
+            conditions.append(DocumentAnnotation.annotation_type == annotation_type.value)
         
-        # Сортируем по релевантности (простая эвристика)
-        results.sort(key=lambda x: (
-            query.lower() in x.content.lower(),
-            x.created_at
-        ), reverse=True)
+        # Фильтр по тегам
+        if tags is not None:
+            conditions.append(DocumentAnnotation.id.in_(
+                select(AnnotationTag.annotation_id).where(AnnotationTag.tag.in_(tags))
+            ))
         
-        return results
+        # Поиск по содержимому
+        terms = sorted(_terms(query))
+        order_by = [DocumentAnnotation.created_at.desc()]
+        if terms:
+            conditions.extend(DocumentAnnotation.id.in_(self._term_matches(term)) for term in terms)
+            in_content = and_(*(
+                DocumentAnnotation.id.in_(self._term_matches(term, _FIELD_CONTENT)) for term in terms
+            ))
+            order_by.insert(0, case((in_content, 0), else_=1))
+        
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(DocumentAnnotation).where(*conditions).order_by(*order_by).limit(limit)
+            ).scalars().all()
+            return self._load_annotations(db, rows)
+        finally:
+            db.close()
     
     def get_user_annotations(
         self,
@@ -342,19 +516,25 @@ class AnnotationManager:
         offset: int = 0
     ) -> List[Annotation]:
         """Получение аннотаций пользователя"""
-        user_annotation_ids = self.user_annotations.get(user_id, [])
-        user_annotations = []
-        
-        for annotation_id in user_annotation_ids:
-            annotation = self.get_annotation(annotation_id)
-            if annotation and annotation.status == AnnotationStatus.ACTIVE:
-                if annotation_type is None or annotation.annotation_type == annotation_type:
-                    user_annotations.append(annotation)
-        
-        # Сортируем по дате создания
-        user_annotations.sort(key=lambda x: x.created_at, reverse=True)
+        conditions = [
+            DocumentAnnotation.user_id == user_id,
+            DocumentAnnotation.status == AnnotationStatus.ACTIVE.value
+        ]
+        if annotation_type is not None:
+            conditions.append(DocumentAnnotation.annotation_type == annotation_type.value)
         
-        return user_annotations[offset:offset + limit]
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(DocumentAnnotation)
+                .where(*conditions)
+                .order_by(DocumentAnnotation.created_at.desc())
+                .offset(offset)
+                .limit(limit)
+            ).scalars().all()
+            return self._load_annotations(db, rows)
+        finally:
+            db.close()
     
     def create_document_version(
         self,
@@ -374,7 +554,16 @@ class AnnotationManager:
             new_version = current_version + 1
             
             # Подсчитываем количество аннотаций
-            annotations_count = len(self.get_document_annotations(document_id))
+            db = SessionLocal()
+            try:
+                annotations_count = db.execute(
+                    select(func.count(DocumentAnnotation.id)).where(
+                        DocumentAnnotation.document_id == document_id,
+                        DocumentAnnotation.status == AnnotationStatus.ACTIVE.value
+                    )
+                ).scalar()
+            finally:
+                db.close()
             
             version = DocumentVersion(
                 id=version_id,
@@ -405,30 +594,48 @@ class AnnotationManager:
     
     def get_annotation_stats(self, user_id: Optional[int] = None) -> Dict[str, Any]:
         """Получение статистики аннотаций"""
-        total_annotations = len([a for a in self.annotations.values() if a.status == AnnotationStatus.ACTIVE])
-        total_replies = len([r for r in self.annotation_replies.values() if r.status == AnnotationStatus.ACTIVE])
+        active = AnnotationStatus.ACTIVE.value
+        db = SessionLocal()
+        try:
+            type_rows = db.execute(
+                select(DocumentAnnotation.annotation_type, func.count(DocumentAnnotation.id))
+                .where(DocumentAnnotation.status == active)
+                .group_by(DocumentAnnotation.annotation_type)
+            ).all()
+            total_replies = db.execute(
+                select(func.count(DocumentAnnotationReply.id)).where(DocumentAnnotationReply.status == active)
+            ).scalar()
+            
+            # Статистика пользователя
+            user_stats = {}
+            if user_id:
+                public_rows = db.execute(
+                    select(DocumentAnnotation.is_public, func.count(DocumentAnnotation.id))
+                    .where(DocumentAnnotation.user_id == user_id, DocumentAnnotation.status == active)
+                    .group_by(DocumentAnnotation.is_public)
+                ).all()
+                by_visibility = {bool(is_public): count for is_public, count in public_rows}
+                user_stats = {
+                    "total_annotations": sum(by_visibility.values()),
+                    "public_annotations": by_visibility.get(True, 0),
+                    "private_annotations": by_visibility.get(False, 0),
+                    "total_replies": db.execute(
+                        select(func.count(DocumentAnnotationReply.id)).where(
+                            DocumentAnnotationReply.user_id == user_id,
+                            DocumentAnnotationReply.status == active
+                        )
+                    ).scalar()
+                }
+        finally:
+            db.close()
         
         # Статистика по типам
-        type_stats = {}
-        for annotation_type in AnnotationType:
-            count = len([a for a in self.annotations.values() 
-                        if a.annotation_type == annotation_type and a.status == AnnotationStatus.ACTIVE])
-            type_stats[annotation_type.value] = count
-        
-        # Статистика пользователя
-        user_stats = {}
-        if user_id:
-            user_annotations = self.get_user_annotations(user_id)
-            user_stats = {
-                "total_annotations": len(user_annotations),
-                "public_annotations": len([a for a in user_annotations if a.is_public]),
-                "private_annotations": len([a for a in user_annotations if not a.is_public]),
-                "total_replies": len([r for r in self.annotation_replies.values() 
-                                    if r.user_id == user_id and r.status == AnnotationStatus.ACTIVE])
-            }
+        type_stats = {annotation_type.value: 0 for annotation_type in AnnotationType}
+        for annotation_type, count in type_rows:
+            type_stats[annotation_type] = count
         
         return {
-            "total_annotations": total_annotations,
+            "total_annotations": sum(type_stats.values()),
             "total_replies": total_replies,
             "type_distribution": type_stats,
             "user_stats": user_stats if user_id else None
@@ -58,6 +58,10 @@ class Settings(BaseSettings):
     VISTRAL_TEMPERATURE: float = float(os.getenv("VISTRAL_TEMPERATURE", "0.7"))  # Температура генерации
     VISTRAL_TOP_P: float = float(os.getenv("VISTRAL_TOP_P", "0.9"))  # Top-p sampling
     VISTRAL_TOP_K: int = int(os.getenv("VISTRAL_TOP_K", "40"))  # Top-k sampling
+    LORA_ADAPTERS_ENABLED: bool = os.getenv("LORA_ADAPTERS_ENABLED", "true").lower() == "true"  # Canary LoRA поверх базовой модели
+    LORA_ADAPTER_CACHE_MB: int = int(os.getenv("LORA_ADAPTER_CACHE_MB", "1024"))  # Бюджет памяти под загруженные адаптеры
+    LORA_ADAPTER_SCALE: float = float(os.getenv("LORA_ADAPTER_SCALE", "1.0"))
+    LORA_ADAPTER_MAX_BATCH: int = int(os.getenv("LORA_ADAPTER_MAX_BATCH", "8"))  # Запросов подряд к адаптеру, пока ждут другие
     VISTRAL_MEMORY_FRACTION: float = float(os.getenv("VISTRAL_MEMORY_FRACTION", "0.8"))  # Доля памяти для модели
     
     # Настройки унифицированных AI-сервисов
@@ -75,7 +79,22 @@ class Settings(BaseSettings):
     SERVICE_RESTART_DELAY: int = int(os.getenv("SERVICE_RESTART_DELAY", "5"))
     MONITORING_COLLECTION_INTERVAL: int = int(os.getenv("MONITORING_COLLECTION_INTERVAL", "30"))
     MONITORING_ALERT_CHECK_INTERVAL: int = int(os.getenv("MONITORING_ALERT_CHECK_INTERVAL", "60"))
-    
+
+    # Предагрегированные счетчики (rollup) для дашбордов
+    ROLLUP_REFRESH_INTERVAL: int = int(os.getenv("ROLLUP_REFRESH_INTERVAL", "60"))  # Период обработки новых строк, сек
+    ROLLUP_SNAPSHOT_INTERVAL: int = int(os.getenv("ROLLUP_SNAPSHOT_INTERVAL", "300"))  # Пересчет метрик состояния, сек
+    ROLLUP_BATCH_SIZE: int = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+    ROLLUP_COMMIT_LAG: int = int(os.getenv("ROLLUP_COMMIT_LAG", "60"))  # Строки моложе обрабатываются на следующем проходе, сек
+
+    # Фоновая очередь AI-анализа документов (низкий приоритет, уступает чату)
+    BACKGROUND_ANALYSIS_ENABLED: bool = os.getenv("BACKGROUND_ANALYSIS_ENABLED", "true").lower() == "true"
+    BACKGROUND_ANALYSIS_POLL_INTERVAL: float = float(os.getenv("BACKGROUND_ANALYSIS_POLL_INTERVAL", "2.0"))  # Опрос очереди, сек
+    BACKGROUND_ANALYSIS_IDLE_GRACE: float = float(os.getenv("BACKGROUND_ANALYSIS_IDLE_GRACE", "3.0"))  # Тишина в чате перед стартом задачи, сек
+    BACKGROUND_ANALYSIS_MAX_ATTEMPTS: int = int(os.getenv("BACKGROUND_ANALYSIS_MAX_ATTEMPTS", "3"))
+    BACKGROUND_ANALYSIS_LEASE_SECONDS: int = int(os.getenv("BACKGROUND_ANALYSIS_LEASE_SECONDS", "120"))  # Задача без heartbeat дольше этого считается брошенной и возвращается в очередь
+    BACKGROUND_ANALYSIS_RETRY_BASE_DELAY: int = int(os.getenv("BACKGROUND_ANALYSIS_RETRY_BASE_DELAY", "30"))  # Секунды до первой повторной попытки
+    BACKGROUND_ANALYSIS_RETRY_MAX_DELAY: int = int(os.getenv("BACKGROUND_ANALYSIS_RETRY_MAX_DELAY", "1800"))
+
     # Таймауты для разных типов AI-анализа
     AI_DOCUMENT_ANALYSIS_TIMEOUT: int = int(os.getenv("AI_DOCUMENT_ANALYSIS_TIMEOUT", "600"))  # 10 минут для анализа документов
     AI_CHAT_RESPONSE_TIMEOUT: int = int(os.getenv("AI_CHAT_RESPONSE_TIMEOUT", "600"))  # 10 минут для чата (увеличено для больших моделей)
@@ -87,6 +106,87 @@ class Settings(BaseSettings):
     AI_CHAT_RESPONSE_TOKENS: int = int(os.getenv("AI_CHAT_RESPONSE_TOKENS", "4000"))  # Больше токенов для мощного железа
     AI_COMPLEX_ANALYSIS_TOKENS: int = int(os.getenv("AI_COMPLEX_ANALYSIS_TOKENS", "20000"))  # 20000 токенов для сложного анализа
     AI_EMBEDDINGS_TOKENS: int = int(os.getenv("AI_EMBEDDINGS_TOKENS", "1000"))  # 1000 токенов для эмбеддингов
+
+    # Сборка контекста чата в бюджете токенов (история + резюме сессии)
+    CHAT_CONTEXT_RESPONSE_RESERVE: int = int(os.getenv("CHAT_CONTEXT_RESPONSE_RESERVE", "1536"))  # Токены, резервируемые под ответ
+    CHAT_CONTEXT_MAX_MESSAGES: int = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "40"))  # Максимум несжатых сообщений для упаковки
+    CHAT_SUMMARY_ENABLED: bool = os.getenv("CHAT_SUMMARY_ENABLED", "true").lower() == "true"
+    CHAT_SUMMARY_MAX_TOKENS: int = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))  # Размер резюме старых сообщений
+
+    # A/B-тесты: назначение по хешу из кешированной конфигурации, пакетная запись, rollup агрегатов
+    AB_TEST_CONFIG_TTL: float = float(os.getenv("AB_TEST_CONFIG_TTL", "30"))  # Время жизни кешированной конфигурации теста, сек
+    AB_TEST_FLUSH_INTERVAL: float = float(os.getenv("AB_TEST_FLUSH_INTERVAL", "1.0"))  # Период записи буферов участников и событий, сек
+    AB_TEST_FLUSH_BATCH: int = int(os.getenv("AB_TEST_FLUSH_BATCH", "1000"))  # Размер буфера, при котором запись начинается раньше
+    AB_TEST_BUFFER_MAX: int = int(os.getenv("AB_TEST_BUFFER_MAX", "100000"))  # Предел буфера событий (при недоступности БД)
+    AB_TEST_ROLLUP_INTERVAL: int = int(os.getenv("AB_TEST_ROLLUP_INTERVAL", "30"))  # Пересчет агрегатов вариантов, сек
+    AB_TEST_ROLLUP_BATCH: int = int(os.getenv("AB_TEST_ROLLUP_BATCH", "5000"))
+    AB_TEST_PARTICIPANT_CACHE_SIZE: int = int(os.getenv("AB_TEST_PARTICIPANT_CACHE_SIZE", "100000"))  # Известных назначений в памяти
+
+    # Очередь модерации
+    MODERATION_QUEUE_COUNT_TTL: int = int(os.getenv("MODERATION_QUEUE_COUNT_TTL", "30"))  # Кеш общего числа элементов очереди, сек
+
+    # Доставка уведомлений во внешние каналы (очередь notification_outbox)
+    NOTIFICATION_DELIVERY_ENABLED: bool = os.getenv("NOTIFICATION_DELIVERY_ENABLED", "true").lower() == "true"
+    NOTIFICATION_DELIVERY_BATCH_SIZE: int = int(os.getenv("NOTIFICATION_DELIVERY_BATCH_SIZE", "200"))  # Сообщений за один проход воркера
+    NOTIFICATION_DELIVERY_POLL_INTERVAL: float = float(os.getenv("NOTIFICATION_DELIVERY_POLL_INTERVAL", "1.0"))  # Секунды между опросами пустой очереди
+    NOTIFICATION_DELIVERY_CONCURRENCY: int = int(os.getenv("NOTIFICATION_DELIVERY_CONCURRENCY", "20"))  # Параллельных отправок
+    NOTIFICATION_DELIVERY_LEASE_SECONDS: int = int(os.getenv("NOTIFICATION_DELIVERY_LEASE_SECONDS", "600"))  # Аренда пачки воркером; по истечении строки sending возвращаются в очередь
+    NOTIFICATION_SMTP_POOL_SIZE: int = int(os.getenv("NOTIFICATION_SMTP_POOL_SIZE", "4"))  # Авторизованных SMTP-соединений на сервер
+    NOTIFICATION_HTTP_POOL_SIZE: int = int(os.getenv("NOTIFICATION_HTTP_POOL_SIZE", "100"))  # Общий пул HTTP-соединений (Slack, Telegram, webhooks)
+    NOTIFICATION_HTTP_POOL_PER_HOST: int = int(os.getenv("NOTIFICATION_HTTP_POOL_PER_HOST", "20"))
+    NOTIFICATION_RETRY_BASE_DELAY: int = int(os.getenv("NOTIFICATION_RETRY_BASE_DELAY", "30"))  # Секунды до первой повторной попытки
+    NOTIFICATION_RETRY_MAX_DELAY: int = int(os.getenv("NOTIFICATION_RETRY_MAX_DELAY", "3600"))
+    NOTIFICATION_TEMPLATE_CACHE_SIZE: int = int(os.getenv("NOTIFICATION_TEMPLATE_CACHE_SIZE", "512"))  # Скомпилированных шаблонов в LRU
+
+    # Rate limiting: общие для всех воркеров token bucket в Redis (local - только память процесса)
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "redis")
+    RATE_LIMIT_KEY_PREFIX: str = os.getenv("RATE_LIMIT_KEY_PREFIX", "rl")
+    RATE_LIMIT_REDIS_TIMEOUT: float = float(os.getenv("RATE_LIMIT_REDIS_TIMEOUT", "0.2"))  # Таймаут Redis, сек
+    RATE_LIMIT_REDIS_RETRY: float = float(os.getenv("RATE_LIMIT_REDIS_RETRY", "30"))  # Пауза перед повторным подключением после сбоя, сек
+
+    # Квоты подписок: счетчики с ключом периода в Redis (local - только память процесса)
+    QUOTA_BACKEND: str = os.getenv("QUOTA_BACKEND", "redis")
+    QUOTA_KEY_PREFIX: str = os.getenv("QUOTA_KEY_PREFIX", "quota")
+    QUOTA_REDIS_TIMEOUT: float = float(os.getenv("QUOTA_REDIS_TIMEOUT", "0.2"))  # Таймаут Redis, сек
+    QUOTA_REDIS_RETRY: float = float(os.getenv("QUOTA_REDIS_RETRY", "30"))  # Пауза перед повторным подключением после сбоя, сек
+    QUOTA_LEASE_FEATURES: str = os.getenv("QUOTA_LEASE_FEATURES", "api_calls")  # Частые функции: квота берется локально блоками
+    QUOTA_LEASE_SIZE: int = int(os.getenv("QUOTA_LEASE_SIZE", "20"))  # Единиц в одном блоке
+    QUOTA_LEASE_SHARE: float = float(os.getenv("QUOTA_LEASE_SHARE", "0.1"))  # Не больше этой доли остатка лимита на блок
+
+    # Хеширование паролей: bcrypt в отдельном пуле потоков, хеши с другим cost пересчитываются при входе
+    PASSWORD_BCRYPT_ROUNDS: int = int(os.getenv("PASSWORD_BCRYPT_ROUNDS", "12"))
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", "0"))  # Потоков пула (0 - min(4, число CPU))
+    PASSWORD_HASH_MAX_PENDING: int = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))  # Проверок в очереди, сверх которых отвечаем 429
+
+    # Кеш пользователей для проверки токенов (0 - без кеша)
+    PRINCIPAL_CACHE_TTL: float = float(os.getenv("PRINCIPAL_CACHE_TTL", "15"))  # Время жизни снимка пользователя, сек
+    PRINCIPAL_CACHE_SIZE: int = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+    # Доставка webhook: персистентная очередь, пул воркеров, лимит параллельных запросов на endpoint
+    WEBHOOK_DELIVERY_ENABLED: bool = os.getenv("WEBHOOK_DELIVERY_ENABLED", "true").lower() == "true"
+    WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", "10"))  # Параллельных отправок всего
+    WEBHOOK_ENDPOINT_CONCURRENCY: int = int(os.getenv("WEBHOOK_ENDPOINT_CONCURRENCY", "4"))  # Параллельных отправок на один хост получателя
+    WEBHOOK_BATCH_SIZE: int = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))  # Доставок, забранных из очереди и еще не завершенных
+    WEBHOOK_POLL_INTERVAL: float = float(os.getenv("WEBHOOK_POLL_INTERVAL", "1.0"))  # Секунды между опросами пустой очереди
+    WEBHOOK_MAX_ATTEMPTS: int = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "3"))
+    WEBHOOK_RETRY_BASE_DELAY: int = int(os.getenv("WEBHOOK_RETRY_BASE_DELAY", "5"))  # Секунды до первой повторной попытки
+    WEBHOOK_RETRY_MAX_DELAY: int = int(os.getenv("WEBHOOK_RETRY_MAX_DELAY", "600"))
+    WEBHOOK_TIMEOUT: int = int(os.getenv("WEBHOOK_TIMEOUT", "10"))  # Таймаут запроса к получателю, сек
+    WEBHOOK_LEASE_SECONDS: int = int(os.getenv("WEBHOOK_LEASE_SECONDS", "300"))  # Аренда забранной доставки; по истечении строка sending возвращается в очередь
+
+    # Пакетная классификация документов: правила по шапке, кеш по хешу текста, несколько документов в одном промпте
+    CLASSIFIER_BATCH_SIZE: int = int(os.getenv("CLASSIFIER_BATCH_SIZE", "8"))  # Документов в одном промпте
+    CLASSIFIER_BATCH_CHARS: int = int(os.getenv("CLASSIFIER_BATCH_CHARS", "800"))  # Символов каждого документа в пакетном промпте
+    CLASSIFIER_CONCURRENCY: int = int(os.getenv("CLASSIFIER_CONCURRENCY", "2"))  # Пакетных запросов к LLM одновременно
+    CLASSIFIER_CACHE_TTL: int = int(os.getenv("CLASSIFIER_CACHE_TTL", "2592000"))  # Время жизни результата в Redis, сек (30 дней)
+    CLASSIFIER_LOCAL_CACHE_SIZE: int = int(os.getenv("CLASSIFIER_LOCAL_CACHE_SIZE", "5000"))
+
+    # Экспорт: строки читаются из БД порциями и сразу пишутся в файл фоновой задачей
+    EXPORT_WORKERS: int = int(os.getenv("EXPORT_WORKERS", "2"))  # Одновременно выполняемых экспортов
+    EXPORT_CHUNK_SIZE: int = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))  # Строк в одной порции курсора
+    EXPORT_LEASE_SECONDS: int = int(os.getenv("EXPORT_LEASE_SECONDS", "120"))  # Задача без heartbeat дольше этого считается брошенной и перезапускается
+    EXPORT_DOCUMENT_MAX_ROWS: int = int(os.getenv("EXPORT_DOCUMENT_MAX_ROWS", "20000"))  # Предел строк для PDF/DOCX (документ собирается в памяти)
+    EXPORT_DOCUMENT_CELL_CHARS: int = int(os.getenv("EXPORT_DOCUMENT_CELL_CHARS", "2000"))  # Символов в ячейке PDF/DOCX
     
     # JWT настройки - КРИТИЧЕСКИ ВАЖНО
     SECRET_KEY: str = Field(
@@ -122,6 +222,20 @@ class Settings(BaseSettings):
     SENTRY_DSN: Optional[str] = os.getenv("SENTRY_DSN")
     # В Docker использует имя сервиса 'jaeger', в локальной разработке - localhost
     JAEGER_ENDPOINT: str = os.getenv("JAEGER_ENDPOINT", "http://jaeger:14268/api/traces")
+    # Системные метрики снимаются при scrape /metrics; результат кешируется на столько секунд
+    METRICS_SYSTEM_CACHE_TTL: float = float(os.getenv("METRICS_SYSTEM_CACHE_TTL", "5"))
+    # Трассировка: head sampling (доля трасс и лимит трасс в секунду на endpoint), tail sampling
+    # сохраняет трассы с ошибкой и медленнее квантиля TRACING_SLOW_PERCENTILE своей операции
+    TRACING_SAMPLE_RATE: float = float(os.getenv("TRACING_SAMPLE_RATE", "0.01"))
+    TRACING_ENDPOINT_RATE_LIMIT: float = float(os.getenv("TRACING_ENDPOINT_RATE_LIMIT", "1"))  # 0 - без лимита
+    TRACING_TAIL_ENABLED: bool = os.getenv("TRACING_TAIL_ENABLED", "true").lower() == "true"
+    TRACING_TAIL_MAX_SPANS: int = int(os.getenv("TRACING_TAIL_MAX_SPANS", "10000"))  # Span'ы в памяти до решения
+    TRACING_MAX_SPANS_PER_TRACE: int = int(os.getenv("TRACING_MAX_SPANS_PER_TRACE", "256"))
+    TRACING_SLOW_PERCENTILE: float = float(os.getenv("TRACING_SLOW_PERCENTILE", "0.99"))
+    TRACING_SLOW_MIN_SAMPLES: int = int(os.getenv("TRACING_SLOW_MIN_SAMPLES", "100"))
+    TRACING_EXPORT_QUEUE_SIZE: int = int(os.getenv("TRACING_EXPORT_QUEUE_SIZE", "1000"))
+    TRACING_EXPORT_BATCH_SIZE: int = int(os.getenv("TRACING_EXPORT_BATCH_SIZE", "50"))
+    TRACING_EXPORT_FLUSH_INTERVAL: float = float(os.getenv("TRACING_EXPORT_FLUSH_INTERVAL", "1"))
     
     # Кэширование
     # В Docker использует имя сервиса 'redis', в локальной разработке - localhost
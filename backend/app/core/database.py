@@ -56,7 +56,7 @@ def init_db():
     """Инициализация базы данных"""
     try:
         # Импортируем все модели здесь для создания таблиц
-        from app.models import user, chat, feedback, analytics
+        from app.models import user, chat, feedback, analytics, rollup, analysis_job
         Base.metadata.create_all(bind=engine)
         logger.info("Database initialized successfully")
     except Exception as e:
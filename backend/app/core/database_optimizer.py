@@ -3,8 +3,9 @@
 """
 import logging
 import asyncio
+from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
-from sqlalchemy import text, create_engine
+from sqlalchemy import text, create_engine, exists
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import QueuePool
 from contextlib import asynccontextmanager
@@ -198,15 +199,18 @@ class DatabaseOptimizer:
             result = session.execute(audit_cleanup_query)
             cleanup_results["deleted_records"] += result.rowcount
             
-            # Очищаем старые сессии чата (старше 30 дней)
-            chat_cleanup_query = text("""
-                DELETE FROM chat_sessions 
-                WHERE created_at < datetime('now', '-30 days')
-                AND (SELECT COUNT(*) FROM chat_messages WHERE session_id = chat_sessions.id) = 0
-            """)
+            # Очищаем старые пустые сессии чата (старше 30 дней)
+            from ..models.chat import ChatSession, ChatMessage
+            from ..services.rollup_service import rollup_service
             
-            result = session.execute(chat_cleanup_query)
-            cleanup_results["deleted_records"] += result.rowcount
+            stale_sessions = (
+                (ChatSession.created_at < datetime.utcnow() - timedelta(days=30))
+                & ~exists().where(ChatMessage.session_id == ChatSession.id)
+            )
+            # Итоги админ-дашборда уменьшаются в той же транзакции, что и удаление
+            rollup_service.record_deletions(session, "chat_sessions", stale_sessions)
+            deleted = session.query(ChatSession).filter(stale_sessions).delete(synchronize_session=False)
+            cleanup_results["deleted_records"] += deleted
             
             # Выполняем VACUUM для SQLite
             if settings.DATABASE_URL.startswith("sqlite"):
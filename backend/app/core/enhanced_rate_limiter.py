@@ -4,11 +4,12 @@
 import time
 import asyncio
 import logging
-from typing import Dict, Optional, Callable, Any
+from typing import Dict, Optional, Callable, Any, Tuple
 from dataclasses import dataclass
 from enum import Enum
 from collections import defaultdict, deque
 from ..core.enhanced_logging import security_logger, SecurityEvent, LogLevel
+from .rate_limit_backend import BucketSpec, get_rate_limit_backend
 
 
 class RateLimitStrategy(Enum):
@@ -29,69 +30,28 @@ class RateLimitConfig:
     penalty_seconds: int = 60
 
 
-class RateLimitEntry:
-    """Запись rate limiting"""
-    
-    def __init__(self, config: RateLimitConfig):
-        self.config = config
-        self.requests = deque()
-        self.tokens = config.max_requests
-        self.last_refill = time.time()
-        self.penalty_until = 0
-        self.violation_count = 0
-    
-    def is_penalized(self) -> bool:
-        """Проверяет, находится ли клиент под штрафом"""
-        return time.time() < self.penalty_until
-    
-    def add_penalty(self):
-        """Добавляет штраф за превышение лимита"""
-        self.penalty_until = time.time() + self.config.penalty_seconds
-        self.violation_count += 1
-    
-    def is_allowed(self) -> bool:
-        """Проверяет, разрешен ли запрос"""
-        current_time = time.time()
-        
-        # Проверяем штраф
-        if self.is_penalized():
-            return False
-        
-        # Очищаем старые запросы
-        if self.config.strategy == RateLimitStrategy.SLIDING_WINDOW:
-            while self.requests and self.requests[0] <= current_time - self.config.window_seconds:
-                self.requests.popleft()
-        
-        # Проверяем лимит
-        if self.config.strategy == RateLimitStrategy.SLIDING_WINDOW:
-            if len(self.requests) >= self.config.max_requests:
-                self.add_penalty()
-                return False
-            self.requests.append(current_time)
-            return True
-        
-        elif self.config.strategy == RateLimitStrategy.TOKEN_BUCKET:
-            # Пополняем токены
-            time_passed = current_time - self.last_refill
-            tokens_to_add = time_passed * (self.config.max_requests / self.config.window_seconds)
-            self.tokens = min(self.config.max_requests, self.tokens + tokens_to_add)
-            self.last_refill = current_time
-            
-            if self.tokens >= 1:
-                self.tokens -= 1
-                return True
-            else:
-                self.add_penalty()
-                return False
-        
-        return True
+@dataclass
+class RateLimitResult:
+    """Решение по запросу вместе с данными для заголовков X-RateLimit-*"""
+    allowed: bool
+    remaining: int
+    reset_after: float  # Секунды до восстановления лимита (или до конца штрафа)
+
+    def __bool__(self) -> bool:
+        return self.allowed
 
 
 class EnhancedRateLimiter:
-    """Улучшенный rate limiter"""
+    """
+    Улучшенный rate limiter
+    
+    Состояние хранится в общем хранилище ведер (Redis), поэтому лимит
+    действует на все воркеры сразу. Окно лимита моделируется token bucket:
+    емкость max_requests (или burst_limit), пополнение max_requests за окно.
+    """
     
     def __init__(self):
-        self.entries: Dict[str, RateLimitEntry] = {}
+        self.backend = get_rate_limit_backend()
         self.global_limits: Dict[str, RateLimitConfig] = {}
         self.endpoint_limits: Dict[str, RateLimitConfig] = {}
         self.user_limits: Dict[int, RateLimitConfig] = {}
@@ -138,31 +98,53 @@ class EnhancedRateLimiter:
         is_admin: bool = False
     ) -> RateLimitConfig:
         """Получает конфигурацию rate limiting"""
+        return self._resolve_config(endpoint, user_type, is_admin)[1]
+    
+    def _resolve_config(
+        self,
+        endpoint: str,
+        user_type: str = "free",
+        is_admin: bool = False
+    ) -> Tuple[str, RateLimitConfig]:
+        """Имя области лимита и ее конфигурация"""
         # Проверяем лимиты для эндпоинта
         if endpoint in self.endpoint_limits:
-            return self.endpoint_limits[endpoint]
+            return f"endpoint:{endpoint}", self.endpoint_limits[endpoint]
         
         # Проверяем лимиты для типа пользователя
         if is_admin:
-            return self.user_limits.get("admin", self.global_limits["admin"])
+            return "tier:admin", self.user_limits.get("admin", self.global_limits["admin"])
         
         if user_type in self.user_limits:
-            return self.user_limits[user_type]
+            return f"tier:{user_type}", self.user_limits[user_type]
         
         # Возвращаем глобальный лимит
-        return self.global_limits["default"]
+        return "global:default", self.global_limits["default"]
+    
+    def _bucket(self, client_key: str, scope: str, config: RateLimitConfig) -> Tuple[BucketSpec, str]:
+        """Ведро клиента в области лимита и ключ его штрафа"""
+        capacity = config.burst_limit or config.max_requests
+        bucket = BucketSpec(
+            key=f"enh:{client_key}:{scope}",
+            capacity=capacity,
+            refill_per_second=config.max_requests / config.window_seconds
+        )
+        return bucket, f"enh:penalty:{client_key}:{scope}"
     
-    def is_allowed(
+    async def is_allowed(
         self,
         ip_address: str,
         endpoint: str,
         user_id: Optional[int] = None,
         user_type: str = "free",
         is_admin: bool = False
-    ) -> bool:
+    ) -> RateLimitResult:
         """
         Проверяет, разрешен ли запрос
         
+        Одна атомарная проверка в хранилище дает и решение, и остаток с
+        временем сброса для заголовков, отдельные peek'и не нужны.
+        
         Args:
             ip_address: IP адрес клиента
             endpoint: Эндпоинт
@@ -171,21 +153,27 @@ class EnhancedRateLimiter:
             is_admin: Является ли админом
             
         Returns:
-            True если запрос разрешен
+            Решение (истинно, если запрос разрешен) с остатком и временем сброса
         """
         try:
             client_key = self._get_client_key(ip_address, user_id)
-            config = self._get_rate_limit_config(endpoint, user_type, is_admin)
+            scope, config = self._resolve_config(endpoint, user_type, is_admin)
+            bucket, penalty_key = self._bucket(client_key, scope, config)
             
-            # Получаем или создаем запись
-            if client_key not in self.entries:
-                self.entries[client_key] = RateLimitEntry(config)
-            
-            entry = self.entries[client_key]
+            # Проверяем разрешение (превышение лимита включает штраф)
+            decision = await self.backend.check_async([bucket], penalty_key, config.penalty_seconds)
+            if decision.penalized or not decision.tokens:
+                result = RateLimitResult(decision.allowed, 0, decision.retry_after)
+            else:
+                tokens = decision.tokens[0]
+                result = RateLimitResult(
+                    decision.allowed,
+                    min(config.max_requests, max(0, int(tokens))),
+                    max(0.0, (bucket.capacity - tokens) / bucket.refill_per_second)
+                )
             
-            # Проверяем разрешение
-            if entry.is_allowed():
-                return True
+            if result.allowed:
+                return result
             else:
                 # Логируем превышение лимита
                 security_logger.log_security_event(
@@ -196,16 +184,16 @@ class EnhancedRateLimiter:
                         "endpoint": endpoint,
                         "user_type": user_type,
                         "is_admin": is_admin,
-                        "violation_count": entry.violation_count,
-                        "penalty_until": entry.penalty_until
+                        "penalized": decision.penalized,
+                        "penalty_until": time.time() + decision.retry_after
                     },
                     severity=LogLevel.WARNING
                 )
-                return False
+                return result
                 
         except Exception as e:
             self.logger.error(f"Rate limiting error: {e}")
-            return True  # В случае ошибки разрешаем запрос
+            return RateLimitResult(True, 0, 0.0)  # В случае ошибки разрешаем запрос
     
     def get_remaining_requests(
         self,
@@ -230,22 +218,14 @@ class EnhancedRateLimiter:
         """
         try:
             client_key = self._get_client_key(ip_address, user_id)
-            config = self._get_rate_limit_config(endpoint, user_type, is_admin)
-            
-            if client_key not in self.entries:
-                return config.max_requests
+            scope, config = self._resolve_config(endpoint, user_type, is_admin)
+            bucket, penalty_key = self._bucket(client_key, scope, config)
             
-            entry = self.entries[client_key]
-            
-            if entry.is_penalized():
+            decision = self.backend.peek([bucket], penalty_key)
+            if decision.penalized:
                 return 0
             
-            if config.strategy == RateLimitStrategy.SLIDING_WINDOW:
-                return max(0, config.max_requests - len(entry.requests))
-            elif config.strategy == RateLimitStrategy.TOKEN_BUCKET:
-                return max(0, int(entry.tokens))
-            
-            return config.max_requests
+            return min(config.max_requests, max(0, int(decision.tokens[0])))
             
         except Exception as e:
             self.logger.error(f"Error getting remaining requests: {e}")
@@ -274,42 +254,26 @@ class EnhancedRateLimiter:
         """
         try:
             client_key = self._get_client_key(ip_address, user_id)
-            config = self._get_rate_limit_config(endpoint, user_type, is_admin)
+            scope, config = self._resolve_config(endpoint, user_type, is_admin)
+            bucket, penalty_key = self._bucket(client_key, scope, config)
             
-            if client_key not in self.entries:
-                return 0
-            
-            entry = self.entries[client_key]
+            decision = self.backend.peek([bucket], penalty_key)
+            if decision.penalized:
+                return decision.retry_after
             
-            if entry.is_penalized():
-                return entry.penalty_until - time.time()
-            
-            if config.strategy == RateLimitStrategy.SLIDING_WINDOW:
-                if entry.requests:
-                    return entry.requests[0] + config.window_seconds - time.time()
-                return 0
-            
-            return 0
+            # Время до полного восстановления ведра
+            missing = bucket.capacity - decision.tokens[0]
+            return max(0.0, missing / bucket.refill_per_second)
             
         except Exception as e:
             self.logger.error(f"Error getting reset time: {e}")
             return 0
     
     def cleanup_old_entries(self, max_age_seconds: int = 3600):
-        """Очищает старые записи"""
+        """Очищает старые записи (ведра истекают сами, когда снова заполнены)"""
         try:
-            current_time = time.time()
-            keys_to_remove = []
-            
-            for key, entry in self.entries.items():
-                if (current_time - entry.last_refill > max_age_seconds and 
-                    not entry.is_penalized()):
-                    keys_to_remove.append(key)
-            
-            for key in keys_to_remove:
-                del self.entries[key]
-                
-            self.logger.info(f"Cleaned up {len(keys_to_remove)} old rate limit entries")
+            removed = self.backend.cleanup()
+            self.logger.info(f"Cleaned up {removed} old rate limit entries")
             
         except Exception as e:
             self.logger.error(f"Error cleaning up old entries: {e}")
@@ -318,10 +282,13 @@ class EnhancedRateLimiter:
         """Сбрасывает штраф для клиента"""
         try:
             client_key = self._get_client_key(ip_address, user_id)
-            if client_key in self.entries:
-                self.entries[client_key].penalty_until = 0
-                self.entries[client_key].violation_count = 0
-                self.logger.info(f"Reset penalty for {client_key}")
+            scopes = (
+                [f"endpoint:{endpoint}" for endpoint in self.endpoint_limits] +
+                [f"tier:{tier}" for tier in self.user_limits] +
+                ["global:default"]
+            )
+            self.backend.reset([f"enh:penalty:{client_key}:{scope}" for scope in scopes])
+            self.logger.info(f"Reset penalty for {client_key}")
                 
         except Exception as e:
             self.logger.error(f"Error resetting penalty: {e}")
@@ -1,19 +1,48 @@
+"""
+Экспорт данных пользователя
+
+Экспорт выполняется фоновой задачей (статус и прогресс хранятся в
+export_jobs). Строки читаются из БД серверным курсором порциями по
+EXPORT_CHUNK_SIZE и сразу пишутся в файл: CSV/JSON/JSONL построчно, XLSX в
+write-only режиме openpyxl, PDF по таблице на порцию. В памяти держится
+только текущая порция; PDF и DOCX собираются библиотеками целиком, поэтому
+для них действует предел EXPORT_DOCUMENT_MAX_ROWS.
+
+Выполняющая задачу сторона держит аренду: started_at отмечает владельца,
+heartbeat_at обновляется фоновым потоком. Перезапускаются только задачи с
+устаревшим heartbeat; воркер, потерявший аренду, прекращает запись.
+"""
+
+import asyncio
+import csv
 import logging
-from typing import Dict, List, Any, Optional, Tuple
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Any, Optional, Tuple
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
+from xml.sax.saxutils import escape
 import uuid
 import json
-import io
-from reportlab.lib.pagesizes import letter, A4
+from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import inch
 from reportlab.lib import colors
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 from docx import Document
-from docx.shared import Inches
+from sqlalchemy import func, select, update
+
+from .config import settings
+from .database import SessionLocal
+from ..models.annotation import DocumentAnnotation
+from ..models.chat import ChatMessage, ChatSession, DocumentAnalysis
+from ..models.export_job import ExportJob, ExportJobStatus
+from ..models.token_balance import TokenBalance, TokenTransaction
+from ..models.user import User
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +52,7 @@ class ExportFormat(Enum):
     DOCX = "docx"
     XLSX = "xlsx"
     JSON = "json"
+    JSONL = "jsonl"
     CSV = "csv"
 
 class ExportType(Enum):
@@ -48,20 +78,149 @@ class ExportRequest:
     file_path: Optional[str] = None
     file_size: Optional[int] = None
     error_message: Optional[str] = None
+    rows_total: Optional[int] = None
+    rows_written: int = 0
+    completed_at: Optional[datetime] = None
+    
+    @property
+    def progress(self) -> float:
+        """Доля выгруженных строк (по оценке COUNT перед началом)"""
+        if self.status == ExportJobStatus.COMPLETED:
+            return 1.0
+        if not self.rows_total:
+            return 0.0
+        return min(1.0, self.rows_written / self.rows_total)
 
 @dataclass
 class ExportData:
-    """Данные для экспорта"""
+    """Данные для экспорта: колонки и порции строк, читаемые из БД по мере записи"""
     title: str
-    data: List[Dict[str, Any]]
+    columns: List[str]
+    chunks: Iterable[List[Dict[str, Any]]]
     metadata: Dict[str, Any]
+    total_rows: Optional[int] = None
+
+class ExportInterrupted(Exception):
+    """Экспорт прерван остановкой приложения или потерей аренды"""
+
+class _JobLease:
+    """Heartbeat выполняемой задачи; lost - задачу перехватил другой воркер"""
+    
+    def __init__(self, manager: "ExportManager", request_id: str, claimed_at: datetime):
+        self._manager = manager
+        self._request_id = request_id
+        self._claimed_at = claimed_at
+        self._interval = max(1.0, manager.lease_seconds / 4)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"export-lease-{request_id}", daemon=True)
+        self.lost = False
+    
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if not self._manager._heartbeat(self._request_id, self._claimed_at):
+                    self.lost = True
+                    return
+            except Exception as e:
+                # Пропущенный heartbeat не страшен, пока аренда не истекла
+                logger.warning(f"Export heartbeat for {self._request_id} failed: {e}")
+    
+    def __enter__(self) -> "_JobLease":
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join(timeout=self._interval)
+
+class _ChunkProgress:
+    """Порции строк экспорта с учетом прогресса, предела строк и остановки"""
+    
+    def __init__(
+        self,
+        chunks: Iterable[List[Dict[str, Any]]],
+        on_progress: Callable[[int], None],
+        max_rows: Optional[int],
+        should_stop: Callable[[], bool]
+    ):
+        self._chunks = chunks
+        self._on_progress = on_progress
+        self._should_stop = should_stop
+        self.max_rows = max_rows
+        self.rows_written = 0
+        self.truncated = False
+    
+    def __iter__(self) -> Iterator[List[Dict[str, Any]]]:
+        for chunk in self._chunks:
+            if self._should_stop():
+                raise ExportInterrupted()
+            if self.max_rows is not None:
+                room = self.max_rows - self.rows_written
+                if room <= 0:
+                    self.truncated = True
+                    break
+                if len(chunk) > room:
+                    chunk = chunk[:room]
+                    self.truncated = True
+            if not chunk:
+                continue
+            self.rows_written += len(chunk)
+            yield chunk
+            # Порция уже записана вызывающим кодом
+            self._on_progress(self.rows_written)
+            if self.truncated:
+                break
+
+class _LazyFlowables(list):
+    """Список flowable для reportlab, который дочитывает следующую порцию, когда текущая закончилась"""
+    
+    def __init__(self, chunks: Iterator[List[Any]]):
+        super().__init__()
+        self._chunks = chunks
+    
+    def __len__(self) -> int:
+        while not list.__len__(self):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self.extend(chunk)
+        return list.__len__(self)
+
+PDF_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black)
+])
+
+XLSX_MAX_ROWS = 1048576 - 10  # Предел строк листа Excel за вычетом шапки
+
+def _format_datetime(value: Optional[datetime]) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else ""
 
 class ExportManager:
     """Менеджер экспорта"""
     
     def __init__(self):
-        self.export_requests: Dict[str, ExportRequest] = {}
         self.export_templates = self._initialize_templates()
+        self.workers = settings.EXPORT_WORKERS
+        self.chunk_size = settings.EXPORT_CHUNK_SIZE
+        self.document_max_rows = settings.EXPORT_DOCUMENT_MAX_ROWS
+        self.document_cell_chars = settings.EXPORT_DOCUMENT_CELL_CHARS
+        self.lease_seconds = settings.EXPORT_LEASE_SECONDS
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._recovery_task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._sources = {
+            ExportType.CHAT_HISTORY: self._chat_history_source,
+            ExportType.DOCUMENT_ANALYSIS: self._document_analysis_source,
+            ExportType.USER_STATISTICS: self._user_statistics_source,
+            ExportType.SUBSCRIPTION_REPORT: self._subscription_report_source,
+            ExportType.PAYMENT_REPORT: self._payment_report_source,
+            ExportType.ANNOTATIONS_REPORT: self._annotations_report_source
+        }
     
     def _initialize_templates(self) -> Dict[ExportType, Dict[str, Any]]:
         """Инициализация шаблонов экспорта"""
@@ -114,17 +273,23 @@ class ExportManager:
         try:
             request_id = f"export_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:8]}"
             
-            request = ExportRequest(
+            job = ExportJob(
                 id=request_id,
                 user_id=user_id,
-                export_type=export_type,
-                export_format=export_format,
+                export_type=export_type.value,
+                export_format=export_format.value,
                 filters=filters or {},
-                created_at=datetime.now(),
-                status="pending"
+                status=ExportJobStatus.PENDING,
+                rows_written=0,
+                created_at=datetime.utcnow()
             )
-            
-            self.export_requests[request_id] = request
+            db = SessionLocal()
+            try:
+                db.add(job)
+                db.commit()
+                request = self._to_request(job)
+            finally:
+                db.close()
             
             logger.info(f"Created export request {request_id} for user {user_id}")
             return request
@@ -133,123 +298,483 @@ class ExportManager:
             logger.error(f"Export request creation error: {str(e)}")
             raise
     
+    def _to_request(self, job: ExportJob) -> ExportRequest:
+        return ExportRequest(
+            id=job.id,
+            user_id=job.user_id,
+            export_type=ExportType(job.export_type),
+            export_format=ExportFormat(job.export_format),
+            filters=job.filters or {},
+            created_at=job.created_at,
+            status=job.status,
+            file_path=job.file_path,
+            file_size=job.file_size,
+            error_message=job.error_message,
+            rows_total=job.rows_total,
+            rows_written=job.rows_written or 0,
+            completed_at=job.completed_at
+        )
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="export"
+                    )
+        return self._executor
+    
+    def submit(self, request_id: str):
+        """Постановка экспорта в фоновый пул (не более EXPORT_WORKERS одновременно)"""
+        self._get_executor().submit(self.process_export, request_id)
+    
+    async def start(self):
+        """Возобновление ожидающих и брошенных экспортов"""
+        self._stopping = False
+        request_ids = await asyncio.to_thread(self._recover_interrupted)
+        for request_id in request_ids:
+            self.submit(request_id)
+        if request_ids:
+            logger.info(f"📦 Resumed {len(request_ids)} export jobs")
+        self._recovery_task = asyncio.create_task(self._recovery_loop())
+    
+    async def stop(self):
+        """Остановка пула: выполняемые экспорты прервутся на границе порции и вернутся в очередь"""
+        self._stopping = True
+        if self._recovery_task is not None:
+            self._recovery_task.cancel()
+            try:
+                await self._recovery_task
+            except asyncio.CancelledError:
+                pass
+            self._recovery_task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    async def _recovery_loop(self):
+        """Подбирает задачи, брошенные упавшими процессами, без перезапуска"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 2)
+            try:
+                for request_id in await asyncio.to_thread(self._recover_interrupted, False):
+                    self.submit(request_id)
+            except Exception as e:
+                logger.error(f"Export recovery error: {e}")
+    
+    def _recover_interrupted(self, include_pending: bool = True) -> List[str]:
+        """
+        Возвращает в очередь задачи с истекшей арендой
+        
+        Returns:
+            Задачи для постановки в пул: все ожидающие или только возвращенные
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        stale = (
+            (ExportJob.status == ExportJobStatus.PROCESSING)
+            & (ExportJob.heartbeat_at.is_(None) | (ExportJob.heartbeat_at < cutoff))
+        )
+        db = SessionLocal()
+        try:
+            recovered = list(db.execute(select(ExportJob.id).where(stale)).scalars())
+            if recovered:
+                db.execute(
+                    update(ExportJob)
+                    .where(ExportJob.id.in_(recovered), stale)
+                    .values(status=ExportJobStatus.PENDING, rows_written=0, heartbeat_at=None)
+                )
+                db.commit()
+                logger.info(f"📦 Requeued {len(recovered)} abandoned export jobs")
+            if not include_pending:
+                return recovered
+            return list(db.execute(
+                select(ExportJob.id)
+                .where(ExportJob.status == ExportJobStatus.PENDING)
+                .order_by(ExportJob.created_at)
+            ).scalars())
+        finally:
+            db.close()
+    
+    def _claim(self, request_id: str, claimed_at: datetime) -> Optional[ExportRequest]:
+        """Переводит задачу в processing; None, если ее уже выполняет другой воркер"""
+        db = SessionLocal()
+        try:
+            claimed = db.execute(
+                update(ExportJob)
+                .where(ExportJob.id == request_id, ExportJob.status == ExportJobStatus.PENDING)
+                .values(
+                    status=ExportJobStatus.PROCESSING,
+                    started_at=claimed_at,
+                    heartbeat_at=claimed_at,
+                    rows_written=0
+                )
+            ).rowcount
+            db.commit()
+            if not claimed:
+                return None
+            return self._to_request(db.get(ExportJob, request_id))
+        finally:
+            db.close()
+    
+    def _owned(self, request_id: str, claimed_at: datetime):
+        """Условие: задача все еще выполняется этим захватом"""
+        return (
+            (ExportJob.id == request_id)
+            & (ExportJob.status == ExportJobStatus.PROCESSING)
+            & (ExportJob.started_at == claimed_at)
+        )
+    
+    def _update_owned(self, request_id: str, claimed_at: datetime, **values) -> bool:
+        """Обновление задачи, только пока аренда принадлежит этому захвату"""
+        db = SessionLocal()
+        try:
+            updated = db.execute(update(ExportJob).where(self._owned(request_id, claimed_at)).values(**values)).rowcount
+            db.commit()
+            return bool(updated)
+        finally:
+            db.close()
+    
+    def _heartbeat(self, request_id: str, claimed_at: datetime) -> bool:
+        """Продлевает аренду; False - задача перезапущена другим воркером"""
+        return self._update_owned(request_id, claimed_at, heartbeat_at=datetime.utcnow())
+    
+    def _finish(self, request_id: str, claimed_at: datetime, **values) -> bool:
+        """Итоговое обновление задачи с освобождением аренды"""
+        return self._update_owned(request_id, claimed_at, heartbeat_at=None, **values)
+    
+    def _progress_reporter(self, request_id: str, claimed_at: datetime) -> Callable[[int], None]:
+        """
+        Запись прогресса после каждой порции
+        
+        Прогресс не обязателен для результата: если БД не дает записать его,
+        пока открыт читающий курсор (SQLite без WAL), экспорт продолжается без него.
+        """
+        state = {"enabled": True}
+        
+        def report(rows_written: int):
+            if not state["enabled"]:
+                return
+            try:
+                self._update_owned(request_id, claimed_at, rows_written=rows_written)
+            except Exception as e:
+                state["enabled"] = False
+                logger.warning(f"Export progress for {request_id} is not persisted: {e}")
+        
+        return report
+    
     def process_export(self, request_id: str) -> bool:
         """Обработка запроса на экспорт"""
+        request = None
+        partial_path = None
+        # Секунды: значение сравнивается на равенство и в БД без дробных секунд
+        claimed_at = datetime.utcnow().replace(microsecond=0)
         try:
-            request = self.export_requests.get(request_id)
+            request = self._claim(request_id, claimed_at)
             if not request:
                 return False
             
-            request.status = "processing"
+            os.makedirs(settings.TEMP_DIR, exist_ok=True)
+            file_path = os.path.join(settings.TEMP_DIR, f"export_{request.id}.{request.export_format.value}")
+            # Свой временный файл у каждого захвата: перехваченная задача не пишет в чужой
+            partial_path = f"{file_path}.{int(claimed_at.timestamp())}.part"
             
-            # Получаем данные для экспорта
-            export_data = self._get_export_data(request)
+            # Курсор живет в своей сессии; прогресс пишется короткими транзакциями
+            db = SessionLocal()
+            try:
+                with _JobLease(self, request.id, claimed_at) as lease:
+                    export_data = self._get_export_data(db, request)
+                    self._update_owned(request.id, claimed_at, rows_total=export_data.total_rows)
+                    chunks = _ChunkProgress(
+                        export_data.chunks,
+                        on_progress=self._progress_reporter(request.id, claimed_at),
+                        max_rows=self._max_rows(request.export_format),
+                        should_stop=lambda: self._stopping or lease.lost
+                    )
+                    self._export_to_format(request, partial_path, export_data, chunks)
+                    if lease.lost:
+                        raise ExportInterrupted()
+            finally:
+                db.close()
             
-            # Экспортируем в нужном формате
-            file_path = self._export_to_format(request, export_data)
+            os.replace(partial_path, file_path)
+            note = None
+            if chunks.truncated:
+                note = (
+                    f"Выгружены первые {chunks.rows_written} строк; полный объем доступен в форматах CSV, JSONL и XLSX"
+                )
+            self._finish(
+                request.id,
+                claimed_at,
+                status=ExportJobStatus.COMPLETED,
+                file_path=file_path,
+                file_size=self._get_file_size(file_path),
+                rows_written=chunks.rows_written,
+                error_message=note,
+                completed_at=datetime.utcnow()
+            )
+            logger.info(f"Export completed: {request_id} ({chunks.rows_written} rows)")
+            return True
             
-            if file_path:
-                request.status = "completed"
-                request.file_path = file_path
-                request.file_size = self._get_file_size(file_path)
-                logger.info(f"Export completed: {request_id}")
-                return True
-            else:
-                request.status = "failed"
-                request.error_message = "Failed to create export file"
-                return False
-                
+        except ExportInterrupted:
+            # При остановке задача возвращается в очередь; потерянную аренду уже перехватили
+            logger.info(f"Export interrupted: {request_id}")
+            self._remove_partial(partial_path)
+            try:
+                self._finish(request_id, claimed_at, status=ExportJobStatus.PENDING, rows_written=0)
+            except Exception as update_error:
+                logger.error(f"Export status update error: {update_error}")
+            return False
         except Exception as e:
             logger.error(f"Export processing error: {str(e)}")
-            if request_id in self.export_requests:
-                self.export_requests[request_id].status = "failed"
-                self.export_requests[request_id].error_message = str(e)
+            self._remove_partial(partial_path)
+            if request is not None:
+                try:
+                    self._finish(
+                        request.id,
+                        claimed_at,
+                        status=ExportJobStatus.FAILED,
+                        error_message=str(e),
+                        completed_at=datetime.utcnow()
+                    )
+                except Exception as update_error:
+                    logger.error(f"Export status update error: {update_error}")
             return False
     
-    def _get_export_data(self, request: ExportRequest) -> ExportData:
-        """Получение данных для экспорта"""
-        # В реальном приложении здесь будут запросы к базе данных
-        # Пока используем тестовые данные
-        
+    def _remove_partial(self, partial_path: Optional[str]):
+        if partial_path and os.path.exists(partial_path):
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+    
+    def _max_rows(self, export_format: ExportFormat) -> Optional[int]:
+        if export_format in (ExportFormat.PDF, ExportFormat.DOCX):
+            return self.document_max_rows
+        if export_format == ExportFormat.XLSX:
+            return XLSX_MAX_ROWS
+        return None
+    
+    def _get_export_data(self, db, request: ExportRequest) -> ExportData:
+        """Источник данных для экспорта: оценка числа строк и ленивые порции из БД"""
         template = self.export_templates.get(request.export_type, {})
-        
-        if request.export_type == ExportType.CHAT_HISTORY:
-            data = [
-                {
-                    "Дата": "2024-01-15 10:30:00",
-                    "Вопрос": "Как оформить трудовой договор?",
-                    "Ответ": "Трудовой договор оформляется в письменной форме...",
-                    "Категория": "Трудовое право",
-                    "Тональность": "Нейтральная"
-                },
-                {
-                    "Дата": "2024-01-15 11:15:00",
-                    "Вопрос": "Какие документы нужны для регистрации ООО?",
-                    "Ответ": "Для регистрации ООО необходимы следующие документы...",
-                    "Категория": "Корпоративное право",
-                    "Тональность": "Положительная"
-                }
-            ]
-        elif request.export_type == ExportType.USER_STATISTICS:
-            data = [
-                {
-                    "Метрика": "Всего сообщений",
-                    "Значение": "150",
-                    "Дата": "2024-01-15",
-                    "Изменение": "+10"
-                },
-                {
-                    "Метрика": "Активные дни",
-                    "Значение": "25",
-                    "Дата": "2024-01-15",
-                    "Изменение": "+2"
-                }
-            ]
+        source = self._sources.get(request.export_type)
+        if source is not None:
+            total_rows, chunks = source(db, request)
         else:
-            data = []
+            # Для реферальной программы в БД пока нет данных
+            total_rows, chunks = 0, iter(())
         
         return ExportData(
             title=template.get("title", "Отчет"),
-            data=data,
+            columns=template.get("columns", []),
+            chunks=chunks,
             metadata={
                 "export_date": datetime.now().isoformat(),
                 "user_id": request.user_id,
                 "filters": request.filters
-            }
+            },
+            total_rows=total_rows
         )
     
-    def _export_to_format(self, request: ExportRequest, data: ExportData) -> Optional[str]:
-        """Экспорт в нужном формате"""
-        try:
-            if request.export_format == ExportFormat.PDF:
-                return self._export_to_pdf(request, data)
-            elif request.export_format == ExportFormat.DOCX:
-                return self._export_to_docx(request, data)
-            elif request.export_format == ExportFormat.XLSX:
-                return self._export_to_xlsx(request, data)
-            elif request.export_format == ExportFormat.JSON:
-                return self._export_to_json(request, data)
-            elif request.export_format == ExportFormat.CSV:
-                return self._export_to_csv(request, data)
-            else:
-                return None
-                
-        except Exception as e:
-            logger.error(f"Export to {request.export_format.value} error: {str(e)}")
-            return None
-    
-    def _export_to_pdf(self, request: ExportRequest, data: ExportData) -> str:
-        """Экспорт в PDF"""
-        from app.core.config import settings
-        import os
-        filename = os.path.join(settings.TEMP_DIR, f"export_{request.id}.pdf")
-        os.makedirs(settings.TEMP_DIR, exist_ok=True)
+    def _stream(self, db, statement, convert: Callable[[Any], Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+        """Порции строк через серверный курсор (yield_per)"""
+        result = db.execute(statement.execution_options(yield_per=self.chunk_size))
+        for partition in result.partitions():
+            yield [convert(row) for row in partition]
+    
+    def _period_conditions(self, column, filters: Dict[str, Any]) -> List[Any]:
+        conditions = []
+        if filters.get("date_from"):
+            conditions.append(column >= datetime.fromisoformat(str(filters["date_from"])))
+        if filters.get("date_to"):
+            conditions.append(column <= datetime.fromisoformat(str(filters["date_to"])))
+        return conditions
+    
+    def _chat_history_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        conditions = [
+            ChatSession.user_id == request.user_id,
+            ChatMessage.role.in_(("user", "assistant")),
+            *self._period_conditions(ChatMessage.created_at, request.filters)
+        ]
+        if request.filters.get("session_id"):
+            conditions.append(ChatMessage.session_id == int(request.filters["session_id"]))
+        
+        total = db.execute(
+            select(func.count(ChatMessage.id))
+            .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+            .where(*conditions, ChatMessage.role == "user")
+        ).scalar()
+        statement = select(
+            ChatMessage.session_id, ChatMessage.role, ChatMessage.content,
+            ChatMessage.message_metadata, ChatMessage.created_at
+        ).join(
+            ChatSession, ChatSession.id == ChatMessage.session_id
+        ).where(*conditions).order_by(ChatMessage.session_id, ChatMessage.created_at, ChatMessage.id)
+        
+        return total, self._chat_pairs(self._stream(db, statement, lambda row: row))
+    
+    def _chat_pairs(self, chunks: Iterator[List[Any]]) -> Iterator[List[Dict[str, Any]]]:
+        """Вопрос пользователя и следующий за ним ответ ассистента в той же сессии"""
+        question = None
+        for chunk in chunks:
+            rows = []
+            for message in chunk:
+                if question is not None and (message.role == "user" or message.session_id != question.session_id):
+                    rows.append(self._chat_row(question, None))
+                    question = None
+                if message.role == "user":
+                    question = message
+                elif question is not None:
+                    rows.append(self._chat_row(question, message))
+                    question = None
+            if rows:
+                yield rows
+        if question is not None:
+            yield [self._chat_row(question, None)]
+    
+    def _chat_row(self, question, answer) -> Dict[str, Any]:
+        metadata = (answer.message_metadata if answer is not None else None) or question.message_metadata
+        if not isinstance(metadata, dict):
+            metadata = {}
+        return {
+            "Дата": _format_datetime(question.created_at),
+            "Вопрос": question.content,
+            "Ответ": answer.content if answer is not None else "",
+            "Категория": metadata.get("category", ""),
+            "Тональность": metadata.get("sentiment", "")
+        }
+    
+    def _document_analysis_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        conditions = [
+            DocumentAnalysis.user_id == request.user_id,
+            *self._period_conditions(DocumentAnalysis.created_at, request.filters)
+        ]
+        total = db.execute(select(func.count(DocumentAnalysis.id)).where(*conditions)).scalar()
+        statement = select(
+            DocumentAnalysis.filename, DocumentAnalysis.file_type,
+            DocumentAnalysis.created_at, DocumentAnalysis.analysis_result
+        ).where(*conditions).order_by(DocumentAnalysis.created_at, DocumentAnalysis.id)
+        
+        return total, self._stream(db, statement, lambda row: {
+            "Документ": row.filename,
+            "Тип": row.file_type,
+            "Статус": "Завершен",
+            "Дата анализа": _format_datetime(row.created_at),
+            "Результат": row.analysis_result
+        })
+    
+    def _payment_report_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        conditions = [
+            TokenTransaction.user_id == request.user_id,
+            *self._period_conditions(TokenTransaction.created_at, request.filters)
+        ]
+        total = db.execute(select(func.count(TokenTransaction.id)).where(*conditions)).scalar()
+        statement = select(
+            TokenTransaction.created_at, TokenTransaction.amount,
+            TokenTransaction.transaction_type, TokenTransaction.description
+        ).where(*conditions).order_by(TokenTransaction.created_at, TokenTransaction.id)
+        
+        return total, self._stream(db, statement, lambda row: {
+            "Дата": _format_datetime(row.created_at),
+            "Сумма": row.amount,
+            "Тип": row.transaction_type,
+            "Статус": "Проведен",
+            "Описание": row.description or ""
+        })
+    
+    def _subscription_report_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        user = db.get(User, request.user_id)
+        if user is None:
+            return 0, iter(())
+        expires = user.subscription_expires
+        active = expires is None or expires > datetime.utcnow()
+        return 1, iter([[{
+            "Пользователь": user.email,
+            "Тариф": user.subscription_type or "free",
+            "Дата начала": _format_datetime(user.created_at),
+            "Дата окончания": _format_datetime(expires),
+            "Статус": "Активна" if active else "Истекла"
+        }]])
+    
+    def _user_statistics_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        user_id = request.user_id
+        month_ago = datetime.utcnow() - timedelta(days=30)
+        message_counts = db.execute(
+            select(
+                func.count(ChatMessage.id),
+                func.count(ChatMessage.id).filter(ChatMessage.created_at >= month_ago)
+            ).join(ChatSession, ChatSession.id == ChatMessage.session_id).where(ChatSession.user_id == user_id)
+        ).one()
+        session_counts = db.execute(
+            select(
+                func.count(ChatSession.id),
+                func.count(ChatSession.id).filter(ChatSession.created_at >= month_ago)
+            ).where(ChatSession.user_id == user_id)
+        ).one()
+        documents = db.execute(
+            select(func.count(DocumentAnalysis.id)).where(DocumentAnalysis.user_id == user_id)
+        ).scalar()
+        balance = db.execute(select(TokenBalance).where(TokenBalance.user_id == user_id)).scalars().first()
         
-        doc = SimpleDocTemplate(filename, pagesize=A4)
+        today = datetime.now().strftime("%Y-%m-%d")
+        rows = [
+            {"Метрика": "Всего сообщений", "Значение": message_counts[0], "Дата": today, "Изменение": f"+{message_counts[1]} за 30 дней"},
+            {"Метрика": "Всего сессий", "Значение": session_counts[0], "Дата": today, "Изменение": f"+{session_counts[1]} за 30 дней"},
+            {"Метрика": "Проанализировано документов", "Значение": documents, "Дата": today, "Изменение": ""},
+            {"Метрика": "Баланс токенов", "Значение": balance.balance if balance else 0, "Дата": today, "Изменение": ""},
+            {"Метрика": "Потрачено токенов", "Значение": balance.total_spent if balance else 0, "Дата": today, "Изменение": ""}
+        ]
+        return len(rows), iter([rows])
+    
+    def _annotations_report_source(self, db, request: ExportRequest) -> Tuple[Optional[int], Iterator[List[Dict[str, Any]]]]:
+        conditions = [
+            DocumentAnnotation.user_id == request.user_id,
+            DocumentAnnotation.status == "active",
+            *self._period_conditions(DocumentAnnotation.created_at, request.filters)
+        ]
+        total = db.execute(select(func.count(DocumentAnnotation.id)).where(*conditions)).scalar()
+        statement = select(
+            DocumentAnnotation.document_id, DocumentAnnotation.annotation_type, DocumentAnnotation.content,
+            DocumentAnnotation.created_at, DocumentAnnotation.user_id
+        ).where(*conditions).order_by(DocumentAnnotation.created_at, DocumentAnnotation.id)
+        
+        return total, self._stream(db, statement, lambda row: {
+            "Документ": row.document_id,
+            "Тип аннотации": row.annotation_type,
+            "Содержимое": row.content,
+            "Дата создания": _format_datetime(row.created_at),
+            "Автор": row.user_id
+        })
+    
+    def _export_to_format(self, request: ExportRequest, path: str, data: ExportData, chunks: _ChunkProgress):
+        """Экспорт в нужном формате"""
+        writers = {
+            ExportFormat.PDF: self._export_to_pdf,
+            ExportFormat.DOCX: self._export_to_docx,
+            ExportFormat.XLSX: self._export_to_xlsx,
+            ExportFormat.JSON: self._export_to_json,
+            ExportFormat.JSONL: self._export_to_jsonl,
+            ExportFormat.CSV: self._export_to_csv
+        }
+        writer = writers.get(request.export_format)
+        if writer is None:
+            raise ValueError(f"Unsupported export format: {request.export_format.value}")
+        writer(path, data, chunks)
+    
+    def _document_cell(self, value: Any) -> str:
+        text = "" if value is None else str(value)
+        if len(text) > self.document_cell_chars:
+            text = text[:self.document_cell_chars] + "…"
+        return text
+    
+    def _truncation_note(self, chunks: _ChunkProgress) -> str:
+        return f"Показаны первые {chunks.rows_written} строк. Полная выгрузка доступна в форматах CSV, JSONL и XLSX."
+    
+    def _export_to_pdf(self, path: str, data: ExportData, chunks: _ChunkProgress):
+        """Экспорт в PDF: по таблице на порцию, порции подгружаются во время верстки"""
+        doc = SimpleDocTemplate(path, pagesize=A4)
         styles = getSampleStyleSheet()
-        story = []
         
-        # Заголовок
         title_style = ParagraphStyle(
             'CustomTitle',
             parent=styles['Heading1'],
@@ -257,56 +782,48 @@ class ExportManager:
             spaceAfter=30,
             alignment=1  # Центрирование
         )
-        story.append(Paragraph(data.title, title_style))
-        story.append(Spacer(1, 12))
-        
-        # Метаданные
         meta_style = ParagraphStyle(
             'Meta',
             parent=styles['Normal'],
             fontSize=10,
             textColor=colors.grey
         )
-        story.append(Paragraph(f"Дата экспорта: {data.metadata['export_date']}", meta_style))
-        story.append(Spacer(1, 20))
+        header_style = ParagraphStyle(
+            'TableHeader',
+            parent=styles['Normal'],
+            fontName='Helvetica-Bold',
+            fontSize=9,
+            textColor=colors.whitesmoke
+        )
+        cell_style = ParagraphStyle('TableCell', parent=styles['Normal'], fontSize=8, leading=10)
         
-        # Таблица данных
-        if data.data:
-            table_data = []
-            
-            # Заголовки
-            if data.data:
-                headers = list(data.data[0].keys())
-                table_data.append(headers)
-                
-                # Данные
-                for row in data.data:
-                    table_data.append([str(row.get(header, "")) for header in headers])
-            
-            table = Table(table_data)
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 12),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black)
-            ]))
-            
-            story.append(table)
+        columns = data.columns
+        col_widths = [doc.width / max(1, len(columns))] * len(columns)
+        header = [Paragraph(escape(column), header_style) for column in columns]
         
+        def tables():
+            for chunk in chunks:
+                rows = [header] + [
+                    [Paragraph(escape(self._document_cell(row.get(column))), cell_style) for column in columns]
+                    for row in chunk
+                ]
+                table = Table(rows, colWidths=col_widths, repeatRows=1)
+                table.setStyle(PDF_TABLE_STYLE)
+                yield [table]
+            if chunks.truncated:
+                yield [Spacer(1, 12), Paragraph(escape(self._truncation_note(chunks)), meta_style)]
+        
+        story = _LazyFlowables(tables())
+        story.extend([
+            Paragraph(escape(data.title), title_style),
+            Spacer(1, 12),
+            Paragraph(f"Дата экспорта: {data.metadata['export_date']}", meta_style),
+            Spacer(1, 20)
+        ])
         doc.build(story)
-        return filename
     
-    def _export_to_docx(self, request: ExportRequest, data: ExportData) -> str:
+    def _export_to_docx(self, path: str, data: ExportData, chunks: _ChunkProgress):
         """Экспорт в DOCX"""
-        from app.core.config import settings
-        import os
-        filename = os.path.join(settings.TEMP_DIR, f"export_{request.id}.docx")
-        os.makedirs(settings.TEMP_DIR, exist_ok=True)
-        
         doc = Document()
         
         # Заголовок
@@ -317,136 +834,146 @@ class ExportManager:
         doc.add_paragraph()
         
         # Таблица данных
-        if data.data:
-            table = doc.add_table(rows=1, cols=len(data.data[0].keys()))
-            table.style = 'Table Grid'
-            
-            # Заголовки
-            hdr_cells = table.rows[0].cells
-            headers = list(data.data[0].keys())
-            for i, header in enumerate(headers):
-                hdr_cells[i].text = header
-            
-            # Данные
-            for row_data in data.data:
-                row_cells = table.add_row().cells
-                for i, header in enumerate(headers):
-                    row_cells[i].text = str(row_data.get(header, ""))
+        columns = data.columns
+        table = doc.add_table(rows=1, cols=len(columns))
+        table.style = 'Table Grid'
+        for cell, column in zip(table.rows[0].cells, columns):
+            cell.text = column
         
-        doc.save(filename)
-        return filename
-    
-    def _export_to_xlsx(self, request: ExportRequest, data: ExportData) -> str:
-        """Экспорт в XLSX"""
-        from app.core.config import settings
-        import os
-        filename = os.path.join(settings.TEMP_DIR, f"export_{request.id}.xlsx")
-        os.makedirs(settings.TEMP_DIR, exist_ok=True)
+        for chunk in chunks:
+            for row_data in chunk:
+                for cell, column in zip(table.add_row().cells, columns):
+                    cell.text = self._document_cell(row_data.get(column))
         
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = data.title
+        if chunks.truncated:
+            doc.add_paragraph(self._truncation_note(chunks))
         
-        # Заголовок
-        ws['A1'] = data.title
-        ws['A1'].font = openpyxl.styles.Font(size=16, bold=True)
-        
-        # Метаданные
-        ws['A3'] = f"Дата экспорта: {data.metadata['export_date']}"
+        doc.save(path)
+    
+    def _export_to_xlsx(self, path: str, data: ExportData, chunks: _ChunkProgress):
+        """Экспорт в XLSX (write-only: строки сбрасываются на диск по мере добавления)"""
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(title=data.title[:31])
         
-        # Таблица данных
-        if data.data:
-            headers = list(data.data[0].keys())
-            
-            # Заголовки
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=5, column=col, value=header)
-                cell.font = openpyxl.styles.Font(bold=True)
-            
-            # Данные
-            for row, row_data in enumerate(data.data, 6):
-                for col, header in enumerate(headers, 1):
-                    ws.cell(row=row, column=col, value=row_data.get(header, ""))
+        # Заголовок и метаданные
+        title = WriteOnlyCell(ws, value=data.title)
+        title.font = Font(size=16, bold=True)
+        ws.append([title])
+        ws.append([])
+        ws.append([f"Дата экспорта: {data.metadata['export_date']}"])
+        ws.append([])
         
-        wb.save(filename)
-        return filename
-    
-    def _export_to_json(self, request: ExportRequest, data: ExportData) -> str:
-        """Экспорт в JSON"""
-        from app.core.config import settings
-        import os
-        filename = os.path.join(settings.TEMP_DIR, f"export_{request.id}.json")
-        os.makedirs(settings.TEMP_DIR, exist_ok=True)
+        header = []
+        for column in data.columns:
+            cell = WriteOnlyCell(ws, value=column)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
         
-        export_data = {
-            "title": data.title,
-            "metadata": data.metadata,
-            "data": data.data
-        }
+        for chunk in chunks:
+            for row_data in chunk:
+                ws.append([self._sheet_value(row_data.get(column)) for column in data.columns])
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(export_data, f, ensure_ascii=False, indent=2)
+        if chunks.truncated:
+            ws.append([])
+            ws.append([self._truncation_note(chunks)])
         
-        return filename
+        wb.save(path)
+    
+    def _sheet_value(self, value: Any) -> Any:
+        if value is None:
+            return ""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False, default=str)
+        return value
+    
+    def _export_to_json(self, path: str, data: ExportData, chunks: _ChunkProgress):
+        """Экспорт в JSON: массив data пишется построчно"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{\n  "title": ')
+            f.write(json.dumps(data.title, ensure_ascii=False))
+            f.write(',\n  "metadata": ')
+            f.write(json.dumps(data.metadata, ensure_ascii=False, default=str))
+            f.write(',\n  "data": [')
+            separator = "\n    "
+            for chunk in chunks:
+                for row in chunk:
+                    f.write(separator)
+                    f.write(json.dumps(row, ensure_ascii=False, default=str))
+                    separator = ",\n    "
+            f.write("\n  ]\n}\n")
     
-    def _export_to_csv(self, request: ExportRequest, data: ExportData) -> str:
+    def _export_to_jsonl(self, path: str, data: ExportData, chunks: _ChunkProgress):
+        """Экспорт в JSON Lines: одна строка на запись"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write("".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in chunk))
+    
+    def _export_to_csv(self, path: str, data: ExportData, chunks: _ChunkProgress):
         """Экспорт в CSV"""
-        from app.core.config import settings
-        import os
-        filename = os.path.join(settings.TEMP_DIR, f"export_{request.id}.csv")
-        os.makedirs(settings.TEMP_DIR, exist_ok=True)
-        
-        import csv
-        
-        with open(filename, 'w', newline='', encoding='utf-8') as f:
-            if data.data:
-                headers = list(data.data[0].keys())
-                writer = csv.DictWriter(f, fieldnames=headers)
-                writer.writeheader()
-                writer.writerows(data.data)
-        
-        return filename
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=data.columns)
+            writer.writeheader()
+            for chunk in chunks:
+                writer.writerows(chunk)
     
     def _get_file_size(self, file_path: str) -> int:
         """Получение размера файла"""
         try:
-            import os
             return os.path.getsize(file_path)
         except Exception:
             return 0
     
     def get_export_request(self, request_id: str) -> Optional[ExportRequest]:
         """Получение запроса на экспорт"""
-        return self.export_requests.get(request_id)
+        db = SessionLocal()
+        try:
+            job = db.get(ExportJob, request_id)
+            return self._to_request(job) if job else None
+        finally:
+            db.close()
     
-    def get_user_export_requests(self, user_id: int) -> List[ExportRequest]:
+    def get_user_export_requests(self, user_id: int, limit: int = 100) -> List[ExportRequest]:
         """Получение запросов на экспорт пользователя"""
-        user_requests = [req for req in self.export_requests.values() if req.user_id == user_id]
-        user_requests.sort(key=lambda x: x.created_at, reverse=True)
-        return user_requests
+        db = SessionLocal()
+        try:
+            jobs = db.execute(
+                select(ExportJob)
+                .where(ExportJob.user_id == user_id)
+                .order_by(ExportJob.created_at.desc())
+                .limit(limit)
+            ).scalars().all()
+            return [self._to_request(job) for job in jobs]
+        finally:
+            db.close()
     
     def get_export_stats(self) -> Dict[str, Any]:
         """Получение статистики экспорта"""
-        total_requests = len(self.export_requests)
-        completed_requests = len([req for req in self.export_requests.values() if req.status == "completed"])
-        failed_requests = len([req for req in self.export_requests.values() if req.status == "failed"])
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(ExportJob.status, ExportJob.export_format, ExportJob.export_type, func.count(ExportJob.id))
+                .group_by(ExportJob.status, ExportJob.export_format, ExportJob.export_type)
+            ).all()
+        finally:
+            db.close()
         
-        # Статистика по форматам
-        format_stats = {}
-        for format_type in ExportFormat:
-            count = len([req for req in self.export_requests.values() if req.export_format == format_type])
-            format_stats[format_type.value] = count
+        status_stats: Dict[str, int] = {}
+        format_stats = {format_type.value: 0 for format_type in ExportFormat}
+        type_stats = {export_type.value: 0 for export_type in ExportType}
+        for status, export_format, export_type, count in rows:
+            status_stats[status] = status_stats.get(status, 0) + count
+            format_stats[export_format] = format_stats.get(export_format, 0) + count
+            type_stats[export_type] = type_stats.get(export_type, 0) + count
         
-        # Статистика по типам
-        type_stats = {}
-        for export_type in ExportType:
-            count = len([req for req in self.export_requests.values() if req.export_type == export_type])
-            type_stats[export_type.value] = count
+        total_requests = sum(status_stats.values())
+        completed_requests = status_stats.get(ExportJobStatus.COMPLETED, 0)
         
         return {
             "total_requests": total_requests,
             "completed_requests": completed_requests,
-            "failed_requests": failed_requests,
+            "failed_requests": status_stats.get(ExportJobStatus.FAILED, 0),
+            "active_requests": status_stats.get(ExportJobStatus.PENDING, 0) + status_stats.get(ExportJobStatus.PROCESSING, 0),
             "success_rate": completed_requests / total_requests if total_requests > 0 else 0,
             "format_distribution": format_stats,
             "type_distribution": type_stats
@@ -1,19 +1,29 @@
 """
 Jaeger distributed tracing integration for Admin Panel
 Provides comprehensive request tracing and performance monitoring
+
+Span'ы сначала записываются в память (RecordedSpan), а в Jaeger уходят только
+сохраненные трассы: отобранные head sampling (вероятность и лимит трасс в
+секунду на endpoint) или, при tail sampling, завершившиеся ошибкой или
+медленнее p99 своей операции. Выгрузка идет фоновым потоком, репортер Jaeger
+отправляет span'ы пачками.
 """
 
 import os
+import queue
+import random
+import threading
 import time
-from typing import Dict, Any, Optional, Callable
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, Callable, List, Tuple
 from functools import wraps
 from contextlib import contextmanager
 import logging
 
 try:
-    from jaeger_client import Config
-    from jaeger_client.reporter import CompositeReporter
-    from jaeger_client.sampler import ConstSampler
+    from jaeger_client import Config, SpanContext
+    from jaeger_client import Span as JaegerSpan
+    from jaeger_client.constants import SAMPLED_FLAG
     from opentracing import tracer, Span
     from opentracing.ext import tags
     from opentracing.propagation import Format
@@ -25,15 +35,217 @@ except ImportError:
 
 from fastapi import Request, Response
 from app.core.config import settings
+from app.core.analytics_engine import LatencySketch
 
 logger = logging.getLogger(__name__)
 
+ERROR_TAG = "error"  # tags.ERROR
+
+# Текущий span задачи/запроса; _UNSAMPLED - трасса не записывается, вложенные вызовы ничего не делают
+_UNSAMPLED = object()
+_current_span: ContextVar[Any] = ContextVar("jaeger_current_span", default=None)
+
+
+class TraceSampler:
+    """Head sampling: вероятностный отбор и ограничение числа трасс в секунду на операцию"""
+    
+    MAX_OPERATIONS = 1000  # Предел числа token bucket (пути с ID не раздувают память)
+    
+    def __init__(self, rate: float, per_operation_limit: float):
+        self.rate = rate
+        self.per_operation_limit = per_operation_limit
+        self._buckets: Dict[str, List[float]] = {}  # operation -> [tokens, updated_at]
+        self._lock = threading.Lock()
+    
+    def should_sample(self, operation: str) -> bool:
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return False
+        limit = self.per_operation_limit
+        if limit <= 0:
+            return True
+        
+        now = time.monotonic()
+        burst = max(1.0, limit)
+        with self._lock:
+            bucket = self._buckets.get(operation)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_OPERATIONS:
+                    self._buckets.clear()
+                bucket = self._buckets[operation] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * limit)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+
+class SlowTraceDetector:
+    """Порог медленной трассы - заданный квантиль длительности корневой операции"""
+    
+    MAX_OPERATIONS = 1000
+    WINDOW = 10000  # После стольких наблюдений гистограмма начинается заново
+    REFRESH_EVERY = 100  # Порог пересчитывается раз в столько наблюдений
+    
+    def __init__(self, percentile: float, min_samples: int):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._sketches: Dict[str, LatencySketch] = {}
+        self._thresholds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, operation: str, duration: float) -> bool:
+        """Учитывает длительность; True - трасса медленнее текущего порога"""
+        with self._lock:
+            threshold = self._thresholds.get(operation)
+            sketch = self._sketches.get(operation)
+            if sketch is None:
+                if len(self._sketches) >= self.MAX_OPERATIONS:
+                    return False
+                sketch = self._sketches[operation] = LatencySketch()
+            
+            sketch.add(duration)
+            if sketch.count >= self.min_samples and sketch.count % self.REFRESH_EVERY == 0:
+                self._thresholds[operation] = sketch.quantile(self.percentile)
+            if sketch.count >= self.WINDOW:
+                self._sketches[operation] = LatencySketch()
+        
+        return threshold is not None and duration > threshold
+
+
+class RecordedSpan:
+    """Span в памяти процесса; в Jaeger уходит только вместе с сохраненной трассой"""
+    
+    __slots__ = ("trace", "span_id", "parent_id", "operation_name", "start_time", "end_time", "tags", "logs")
+    
+    def __init__(self, trace: "TraceRecord", operation_name: str, parent_id: Optional[int]):
+        self.trace = trace
+        self.span_id = random.getrandbits(64) or 1
+        self.parent_id = parent_id
+        self.operation_name = operation_name
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+        self.tags: Dict[str, Any] = {}
+        self.logs: List[Tuple[float, Dict[str, Any]]] = []
+    
+    def set_tag(self, key: str, value: Any) -> "RecordedSpan":
+        self.tags[key] = value
+        if key == ERROR_TAG and value:
+            self.trace.error = True
+        return self
+    
+    def log_kv(self, key_values: Dict[str, Any], timestamp: Optional[float] = None) -> "RecordedSpan":
+        self.logs.append((timestamp or time.time(), key_values))
+        return self
+    
+    def finish(self, finish_time: Optional[float] = None):
+        if self.end_time is None:
+            self.end_time = finish_time or time.time()
+            if self.parent_id is None:
+                self.trace.owner._finish_trace(self.trace, self)
+
+
+class TraceRecord:
+    """Span'ы одной трассы до решения, сохранять ли ее"""
+    
+    __slots__ = ("owner", "trace_id", "head_sampled", "spans", "error", "truncated")
+    
+    def __init__(self, owner: "JaegerTracing", head_sampled: bool):
+        self.owner = owner
+        self.trace_id = random.getrandbits(64) or 1
+        self.head_sampled = head_sampled
+        self.spans: List[RecordedSpan] = []
+        self.error = False
+        self.truncated = False
+    
+    def start_span(self, operation_name: str, parent_id: Optional[int] = None) -> RecordedSpan:
+        span = RecordedSpan(self, operation_name, parent_id)
+        # Span сверх лимита работает как обычно (ошибка помечает трассу), но не сохраняется
+        if self.owner._reserve_span(self):
+            self.spans.append(span)
+        else:
+            self.truncated = True
+        return span
+
+
+class SpanExporter:
+    """Фоновая выгрузка сохраненных трасс в Jaeger; при переполнении очереди трассы отбрасываются"""
+    
+    def __init__(self, jaeger_tracer, queue_size: int):
+        self.tracer = jaeger_tracer
+        self._queue: "queue.Queue[Optional[TraceRecord]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+    
+    def submit(self, trace: TraceRecord):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="jaeger-span-exporter", daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            try:
+                self._export(trace)
+                self.exported += 1
+            except Exception as e:
+                logger.debug(f"Failed to export trace: {e}")
+    
+    def _export(self, trace: TraceRecord):
+        root_end = max((span.end_time or 0.0) for span in trace.spans)
+        for recorded in trace.spans:
+            span = JaegerSpan(
+                context=SpanContext(trace.trace_id, recorded.span_id, recorded.parent_id, SAMPLED_FLAG),
+                tracer=self.tracer,
+                operation_name=recorded.operation_name,
+                tags=recorded.tags,
+                start_time=recorded.start_time
+            )
+            for timestamp, key_values in recorded.logs:
+                span.log_kv(key_values, timestamp)
+            # Репортер Jaeger копит span'ы и отправляет их пачками
+            span.finish(recorded.end_time or root_end)
+    
+    def close(self, timeout: float = 5.0):
+        """Выгружает оставшиеся трассы и останавливает поток"""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+
+
 class JaegerTracing:
     """Jaeger tracing integration for admin panel"""
     
     def __init__(self):
         self.tracer = None
         self.enabled = False
+        self.sampler = TraceSampler(settings.TRACING_SAMPLE_RATE, settings.TRACING_ENDPOINT_RATE_LIMIT)
+        self.slow_detector = SlowTraceDetector(settings.TRACING_SLOW_PERCENTILE, settings.TRACING_SLOW_MIN_SAMPLES)
+        self.tail_enabled = settings.TRACING_TAIL_ENABLED
+        self.max_buffered_spans = settings.TRACING_TAIL_MAX_SPANS
+        self.exporter: Optional[SpanExporter] = None
+        self._buffered_spans = 0  # Span'ы трасс, ожидающих решения tail sampling
+        self._buffer_lock = threading.Lock()
+        self.stats = {"head_sampled": 0, "kept_error": 0, "kept_slow": 0, "discarded": 0}
         self._initialize_tracer()
     
     def _initialize_tracer(self):
@@ -55,23 +267,31 @@ class JaegerTracing:
         try:
             config = Config(
                 config={
+                    # Отбор трасс делает JaegerTracing, до трейсера доходят только сохраненные
                     'sampler': {
                         'type': 'const',
-                        'param': 1,  # Sample all requests in development
+                        'param': 1,
                     },
                     'local_agent': {
                         'reporting_host': jaeger_host,
                         'reporting_port': jaeger_port,
                     },
-                    'logging': True,
+                    'reporter_batch_size': settings.TRACING_EXPORT_BATCH_SIZE,
+                    'reporter_queue_size': settings.TRACING_EXPORT_QUEUE_SIZE,
+                    'reporter_flush_interval': settings.TRACING_EXPORT_FLUSH_INTERVAL,
+                    'logging': False,
                 },
                 service_name=service_name,
                 validate=True,
             )
             
             self.tracer = config.initialize_tracer()
-            self.enabled = True
-            logger.info(f"Jaeger tracing initialized for service: {service_name}")
+            self.exporter = SpanExporter(self.tracer, settings.TRACING_EXPORT_QUEUE_SIZE)
+            self.enabled = self.tracer is not None
+            logger.info(
+                f"Jaeger tracing initialized for service: {service_name} "
+                f"(sample rate {settings.TRACING_SAMPLE_RATE}, tail sampling {'on' if self.tail_enabled else 'off'})"
+            )
             
         except Exception as e:
             logger.error(f"Failed to initialize Jaeger tracer: {e}")
@@ -81,25 +301,82 @@ class JaegerTracing:
         """Check if tracing is enabled"""
         return self.enabled and self.tracer is not None
     
+    def _start_trace(self, operation_name: str) -> Optional[TraceRecord]:
+        """Новая трасса или None, если она не записывается"""
+        if self.sampler.should_sample(operation_name):
+            self.stats["head_sampled"] += 1
+            return TraceRecord(self, True)
+        if self.tail_enabled and self._buffered_spans < self.max_buffered_spans:
+            return TraceRecord(self, False)
+        return None
+    
+    def _reserve_span(self, trace: TraceRecord) -> bool:
+        if len(trace.spans) >= settings.TRACING_MAX_SPANS_PER_TRACE:
+            return False
+        if trace.head_sampled:
+            return True
+        with self._buffer_lock:
+            if self._buffered_spans >= self.max_buffered_spans:
+                return False
+            self._buffered_spans += 1
+        return True
+    
+    def _finish_trace(self, trace: TraceRecord, root: RecordedSpan):
+        """Решение по трассе после завершения корневого span"""
+        slow = self.slow_detector.observe(root.operation_name, root.end_time - root.start_time)
+        if not trace.head_sampled:
+            with self._buffer_lock:
+                self._buffered_spans -= len(trace.spans)
+        
+        if trace.head_sampled:
+            reason = "head"
+        elif trace.error:
+            reason = "error"
+            self.stats["kept_error"] += 1
+        elif slow:
+            reason = "slow"
+            self.stats["kept_slow"] += 1
+        else:
+            self.stats["discarded"] += 1
+            return
+        
+        root.tags["sampling.reason"] = reason
+        if trace.truncated:
+            root.tags["trace.truncated"] = True
+        if self.exporter is not None and trace.spans:
+            self.exporter.submit(trace)
+    
     @contextmanager
     def trace_operation(self, operation_name: str, tags_dict: Optional[Dict[str, Any]] = None):
         """Context manager for tracing operations"""
-        if not self.is_enabled():
+        parent = _current_span.get()
+        if parent is _UNSAMPLED or not self.is_enabled():
             yield None
             return
         
-        span = self.tracer.start_span(operation_name)
+        if parent is None:
+            trace = self._start_trace(operation_name)
+            if trace is None:
+                # Вложенные операции этой трассы тоже не записываются
+                token = _current_span.set(_UNSAMPLED)
+                try:
+                    yield None
+                finally:
+                    _current_span.reset(token)
+                return
+            span = trace.start_span(operation_name)
+        else:
+            span = parent.trace.start_span(operation_name, parent.span_id)
+        
+        if tags_dict:
+            span.tags.update(tags_dict)
+        token = _current_span.set(span)
         
         try:
-            # Add tags
-            if tags_dict:
-                for key, value in tags_dict.items():
-                    span.set_tag(key, value)
-            
             yield span
             
         except Exception as e:
-            span.set_tag(tags.ERROR, True)
+            span.set_tag(ERROR_TAG, True)
             span.log_kv({
                 'event': 'error',
                 'error.object': e,
@@ -108,14 +385,12 @@ class JaegerTracing:
             })
             raise
         finally:
+            _current_span.reset(token)
             span.finish()
     
-    def trace_http_request(self, request: Request, response: Response, 
-                          duration: float, user_role: str = "unknown"):
-        """Trace HTTP request"""
-        if not self.is_enabled():
-            return
-        
+    @contextmanager
+    def trace_request(self, request: Request, user_role: str = "unknown"):
+        """Корневой span HTTP-запроса; span'ы, созданные при его обработке, становятся дочерними"""
         operation_name = f"{request.method} {request.url.path}"
         
         with self.trace_operation(operation_name) as span:
@@ -123,12 +398,6 @@ class JaegerTracing:
                 # HTTP tags
                 span.set_tag(tags.HTTP_METHOD, request.method)
                 span.set_tag(tags.HTTP_URL, str(request.url))
-                if response is not None:
-                    span.set_tag(tags.HTTP_STATUS_CODE, response.status_code)
-                else:
-                    span.set_tag(tags.HTTP_STATUS_CODE, 500)
-                if duration:
-                    span.set_tag("http.duration_ms", duration * 1000)
                 
                 # Admin panel specific tags
                 span.set_tag("admin.user_role", user_role)
@@ -141,15 +410,29 @@ class JaegerTracing:
                 user_agent = request.headers.get("user-agent")
                 if user_agent:
                     span.set_tag("client.user_agent", user_agent)
-                
-                # Error handling
-                if response is not None and response.status_code >= 400:
-                    span.set_tag(tags.ERROR, True)
-                    span.log_kv({
-                        'event': 'http_error',
-                        'status_code': response.status_code if response is not None else 500,
-                        'path': request.url.path
-                    })
+            
+            yield span
+    
+    def trace_http_response(self, span, request: Request, response: Optional[Response], duration: float):
+        """Записывает в span запроса статус ответа и длительность"""
+        if not span:
+            return
+        
+        status_code = response.status_code if response is not None else 500
+        span.set_tag(tags.HTTP_STATUS_CODE, status_code)
+        if duration:
+            span.set_tag("http.duration_ms", duration * 1000)
+        
+        # Ошибкой (и поводом сохранить трассу при tail sampling) считаются только 5xx:
+        # 401/403/404 - обычные ответы клиентам, исключения помечает trace_operation
+        if status_code >= 500:
+            span.set_tag(tags.ERROR, True)
+        if status_code >= 400:
+            span.log_kv({
+                'event': 'http_error',
+                'status_code': status_code,
+                'path': request.url.path
+            })
     
     def trace_database_operation(self, operation: str, table: str, 
                                duration: float, success: bool = True):
@@ -277,14 +560,11 @@ class JaegerTracing:
     
     def create_child_span(self, parent_span, operation_name: str, 
                          tags_dict: Optional[Dict[str, Any]] = None):
-        """Create a child span"""
+        """Create a child span (caller must finish it)"""
         if not self.is_enabled() or not parent_span:
             return None
         
-        child_span = self.tracer.start_span(
-            operation_name,
-            child_of=parent_span
-        )
+        child_span = parent_span.trace.start_span(operation_name, parent_span.span_id)
         
         if tags_dict:
             for key, value in tags_dict.items():
@@ -297,8 +577,10 @@ class JaegerTracing:
         if not self.is_enabled() or not span:
             return
         
+        # Нижестоящий сервис получает решение head sampling этой трассы
+        flags = SAMPLED_FLAG if span.trace.head_sampled else 0
         self.tracer.inject(
-            span_context=span.context,
+            span_context=SpanContext(span.trace.trace_id, span.span_id, span.parent_id, flags),
             format=Format.HTTP_HEADERS,
             carrier=headers
         )
@@ -317,8 +599,19 @@ class JaegerTracing:
             logger.debug(f"Failed to extract span context: {e}")
             return None
     
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики отбора трасс и состояние буфера"""
+        return {
+            **self.stats,
+            "buffered_spans": self._buffered_spans,
+            "exported": self.exporter.exported if self.exporter else 0,
+            "export_dropped": self.exporter.dropped if self.exporter else 0
+        }
+    
     def close(self):
         """Close the tracer"""
+        if self.exporter:
+            self.exporter.close()
         if self.tracer:
             self.tracer.close()
             logger.info("Jaeger tracer closed")
@@ -327,53 +620,25 @@ def trace_function(operation_name: Optional[str] = None,
                   tags: Optional[Dict[str, Any]] = None):
     """Decorator for tracing functions"""
     def decorator(func: Callable) -> Callable:
+        op_name = operation_name or f"{func.__module__}.{func.__name__}"
+        function_tags = {"function.name": func.__name__, "function.module": func.__module__, **(tags or {})}
+        
+        # Ошибки помечает trace_operation; в незаписываемой трассе вызов идет напрямую
         @wraps(func)
         async def async_wrapper(*args, **kwargs):
-            op_name = operation_name or f"{func.__module__}.{func.__name__}"
+            if _current_span.get() is _UNSAMPLED or not jaeger_tracing.enabled:
+                return await func(*args, **kwargs)
             
-            with jaeger_tracing.trace_operation(op_name, tags) as span:
-                try:
-                    if span:
-                        span.set_tag("function.name", func.__name__)
-                        span.set_tag("function.module", func.__module__)
-                    
-                    result = await func(*args, **kwargs)
-                    return result
-                    
-                except Exception as e:
-                    if span:
-                        span.set_tag(tags.ERROR, True)
-                        span.log_kv({
-                            'event': 'function_error',
-                            'error.object': e,
-                            'error.kind': type(e).__name__,
-                            'message': str(e)
-                        })
-                    raise
+            with jaeger_tracing.trace_operation(op_name, function_tags):
+                return await func(*args, **kwargs)
         
         @wraps(func)
         def sync_wrapper(*args, **kwargs):
-            op_name = operation_name or f"{func.__module__}.{func.__name__}"
+            if _current_span.get() is _UNSAMPLED or not jaeger_tracing.enabled:
+                return func(*args, **kwargs)
             
-            with jaeger_tracing.trace_operation(op_name, tags) as span:
-                try:
-                    if span:
-                        span.set_tag("function.name", func.__name__)
-                        span.set_tag("function.module", func.__module__)
-                    
-                    result = func(*args, **kwargs)
-                    return result
-                    
-                except Exception as e:
-                    if span:
-                        span.set_tag(tags.ERROR, True)
-                        span.log_kv({
-                            'event': 'function_error',
-                            'error.object': e,
-                            'error.kind': type(e).__name__,
-                            'message': str(e)
-                        })
-                    raise
+            with jaeger_tracing.trace_operation(op_name, function_tags):
+                return func(*args, **kwargs)
         
         # Return appropriate wrapper based on function type
         import asyncio
@@ -385,4 +650,4 @@ def trace_function(operation_name: Optional[str] = None,
     return decorator
 
 # Global instance
-jaeger_tracing = JaegerTracing()
\ No newline at end of file
+jaeger_tracing = JaegerTracing()
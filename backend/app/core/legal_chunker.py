@@ -8,21 +8,11 @@ import logging
 import hashlib
 from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
-from enum import Enum
 from datetime import datetime
 
-logger = logging.getLogger(__name__)
-
+from .legal_structure import LegalStructureType, LegalStructure, LegalNode, get_legal_structure
 
-class LegalStructureType(Enum):
-    """Types of legal document structures"""
-    ARTICLE = "article"
-    PART = "part"
-    PARAGRAPH = "paragraph"
-    SECTION = "section"
-    CHAPTER = "chapter"
-    ITEM = "item"
-    SUBITEM = "subitem"
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -91,15 +81,40 @@ class LegalTextChunker:
                 re.compile(pattern, re.IGNORECASE | re.MULTILINE | re.DOTALL)
                 for pattern in pattern_list
             ]
+        
+        # Code name patterns (ГК РФ, УК РФ, etc.)
+        self.code_patterns = [
+            re.compile(pattern, re.IGNORECASE)
+            for pattern in (
+                r'(ГК\s+РФ|Гражданский\s+кодекс)',
+                r'(УК\s+РФ|Уголовный\s+кодекс)',
+                r'(ТК\s+РФ|Трудовой\s+кодекс)',
+                r'(НК\s+РФ|Налоговый\s+кодекс)',
+                r'(СК\s+РФ|Семейный\s+кодекс)',
+                r'(КоАП\s+РФ|Административный\s+кодекс)',
+                r'(ФЗ\s*№?\s*\d+)',
+                r'(Закон\s+[^.\n]{5,50})'
+            )
+        ]
     
     def count_tokens(self, text: str) -> int:
         """Estimate token count (1 token ≈ 4 characters for Russian)"""
         return max(1, len(text) // 4)
     
+    def detect_code(self, text: str) -> Optional[str]:
+        """Detect code name (ГК РФ, УК РФ, etc.)"""
+        for pattern in self.code_patterns:
+            match = pattern.search(text)
+            if match:
+                return match.group(1).strip()
+        return None
+    
     def extract_legal_hierarchy(self, text: str) -> Dict[str, Any]:
         """Extract legal document hierarchy from text"""
+        structure = get_legal_structure(text)
+        
         hierarchy = {
-            "code": None,
+            "code": self.detect_code(text),
             "section": None,
             "chapter": None,
             "article": None,
@@ -108,67 +123,28 @@ class LegalTextChunker:
             "item": None
         }
         
-        # Extract code name (ГК РФ, УК РФ, etc.)
-        code_patterns = [
-            r'(ГК\s+РФ|Гражданский\s+кодекс)',
-            r'(УК\s+РФ|Уголовный\s+кодекс)',
-            r'(ТК\s+РФ|Трудовой\s+кодекс)',
-            r'(НК\s+РФ|Налоговый\s+кодекс)',
-            r'(СК\s+РФ|Семейный\s+кодекс)',
-            r'(КоАП\s+РФ|Административный\s+кодекс)',
-            r'(ФЗ\s*№?\s*\d+)',
-            r'(Закон\s+[^.\n]{5,50})'
-        ]
-        
-        for pattern in code_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                hierarchy["code"] = match.group(1).strip()
-                break
-        
-        # Extract article
-        for pattern in self.compiled_patterns['article']:
-            match = pattern.search(text)
-            if match:
-                hierarchy["article"] = match.group(1)
-                break
-        
-        # Extract part
-        for pattern in self.compiled_patterns['part']:
-            match = pattern.search(text)
-            if match:
-                hierarchy["part"] = match.group(1)
-                break
-        
-        # Extract paragraph/item
-        for pattern in self.compiled_patterns['paragraph']:
-            match = pattern.search(text)
-            if match:
-                hierarchy["paragraph"] = match.group(1)
-                break
+        # First occurrence of each structural unit (single parse, cached per document)
+        for structure_type in (LegalStructureType.SECTION, LegalStructureType.CHAPTER,
+                               LegalStructureType.ARTICLE, LegalStructureType.PART,
+                               LegalStructureType.PARAGRAPH, LegalStructureType.ITEM):
+            nodes = structure.of_type(structure_type)
+            if nodes:
+                hierarchy[structure_type.value] = nodes[0].number
         
         return hierarchy
     
+    def _node_hierarchy(self, structure: LegalStructure, node: LegalNode, code: Optional[str]) -> Dict[str, Any]:
+        """Hierarchy of a parsed node with the document code"""
+        hierarchy = {"code": code}
+        hierarchy.update(structure.hierarchy(node))
+        return hierarchy
+    
     def split_by_articles(self, text: str) -> List[Dict[str, Any]]:
         """Split text by articles (primary legal structure)"""
-        articles = []
+        structure = get_legal_structure(text)
+        article_nodes = structure.articles
         
-        # Find all article boundaries
-        article_boundaries = []
-        for pattern in self.compiled_patterns['article']:
-            for match in pattern.finditer(text):
-                article_boundaries.append({
-                    'start': match.start(),
-                    'end': match.end(),
-                    'number': match.group(1),
-                    'title': match.group(2).strip() if len(match.groups()) > 1 else '',
-                    'match': match
-                })
-        
-        # Sort by position
-        article_boundaries.sort(key=lambda x: x['start'])
-        
-        if not article_boundaries:
+        if not article_nodes:
             # No articles found, treat as single block
             return [{
                 'content': text,
@@ -178,46 +154,46 @@ class LegalTextChunker:
                 'end': len(text)
             }]
         
-        # Extract article content
-        for i, boundary in enumerate(article_boundaries):
-            start_pos = boundary['start']
-            end_pos = article_boundaries[i + 1]['start'] if i + 1 < len(article_boundaries) else len(text)
-            
-            article_content = text[start_pos:end_pos].strip()
-            hierarchy = self.extract_legal_hierarchy(article_content)
-            hierarchy['article'] = boundary['number']
-            
+        # The code is detected once per document instead of once per article
+        code = self.detect_code(text)
+        
+        articles = []
+        for node in article_nodes:
             articles.append({
-                'content': article_content,
+                'content': text[node.start:node.end].strip(),
                 'type': LegalStructureType.ARTICLE,
-                'hierarchy': hierarchy,
-                'start': start_pos,
-                'end': end_pos,
-                'article_number': boundary['number'],
-                'article_title': boundary['title']
+                'hierarchy': self._node_hierarchy(structure, node, code),
+                'start': node.start,
+                'end': node.end,
+                'article_number': node.number,
+                'article_title': node.title,
+                'node': node,
+                'structure': structure
             })
         
         return articles
     
-    def split_by_parts(self, article_content: str) -> List[Dict[str, Any]]:
-        """Split article content by parts"""
-        parts = []
-        
-        # Find part boundaries
-        part_boundaries = []
-        for pattern in self.compiled_patterns['part']:
-            for match in pattern.finditer(article_content):
-                part_boundaries.append({
-                    'start': match.start(),
-                    'end': match.end(),
-                    'number': match.group(1),
-                    'content': match.group(2).strip() if len(match.groups()) > 1 else '',
-                    'match': match
-                })
-        
-        part_boundaries.sort(key=lambda x: x['start'])
-        
-        if not part_boundaries:
+    def split_by_parts(self, article_content: str, structure: Optional[LegalStructure] = None,
+                       node: Optional[LegalNode] = None, text: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Split article content by parts
+        
+        When the article node of an already parsed document is passed, its children
+        are sliced from the document text without re-parsing. Offsets are relative
+        to the article start.
+        """
+        base = 0
+        if node is None:
+            text = article_content
+            structure = get_legal_structure(article_content)
+            article_nodes = structure.articles
+            node = article_nodes[0] if article_nodes else None
+        else:
+            base = node.start
+        
+        child_nodes = structure.children(node) if node is not None else []
+        
+        if not child_nodes:
             # No parts found, return as single part
             return [{
                 'content': article_content,
@@ -226,19 +202,19 @@ class LegalTextChunker:
                 'end': len(article_content)
             }]
         
-        # Extract parts
-        for i, boundary in enumerate(part_boundaries):
-            start_pos = boundary['start']
-            end_pos = part_boundaries[i + 1]['start'] if i + 1 < len(part_boundaries) else len(article_content)
-            
-            part_content = article_content[start_pos:end_pos].strip()
+        parts = []
+        for i, child in enumerate(child_nodes):
+            # The article heading is kept with the first part so no text is lost
+            start_pos = node.start if i == 0 else child.start
+            end_pos = child.end
             
             parts.append({
-                'content': part_content,
-                'type': LegalStructureType.PART,
-                'start': start_pos,
-                'end': end_pos,
-                'part_number': boundary['number']
+                'content': text[start_pos:end_pos].strip(),
+                'type': child.type,
+                'start': start_pos - base,
+                'end': end_pos - base,
+                'part_number': child.number,
+                'hierarchy_key': child.type.value
             })
         
         return parts
@@ -308,11 +284,19 @@ class LegalTextChunker:
             
             # Step 2: Split article by parts if too large
             if self.count_tokens(article_content) > self.max_tokens:
-                parts = self.split_by_parts(article_content)
+                parts = self.split_by_parts(
+                    article_content,
+                    structure=article.get('structure'),
+                    node=article.get('node'),
+                    text=text
+                )
                 logger.info(f"📝 Article {article_idx + 1} split into {len(parts)} parts")
                 
                 for part_idx, part in enumerate(parts):
                     part_content = part['content']
+                    part_hierarchy = article_hierarchy
+                    if part.get('part_number') is not None:
+                        part_hierarchy = {**article_hierarchy, part['hierarchy_key']: part['part_number']}
                     
                     # Step 3: Split part by sentences if still too large
                     if self.count_tokens(part_content) > self.max_tokens:
@@ -322,7 +306,7 @@ class LegalTextChunker:
                         current_chunk = ""
                         current_tokens = 0
                         
-                        for sentence in sentences:
+                        for sentence_idx, sentence in enumerate(sentences):
                             sentence_tokens = self.count_tokens(sentence)
                             
                             if current_tokens + sentence_tokens > self.max_tokens and current_chunk:
@@ -331,7 +315,7 @@ class LegalTextChunker:
                                     content=current_chunk.strip(),
                                     chunk_index=chunk_index,
                                     doc_signature=doc_signature,
-                                    hierarchy=article_hierarchy,
+                                    hierarchy=part_hierarchy,
                                     chunk_type=LegalStructureType.PARAGRAPH,
                                     start_pos=article['start'],
                                     end_pos=article['start'] + len(current_chunk)
@@ -340,7 +324,7 @@ class LegalTextChunker:
                                 chunk_index += 1
                                 
                                 # Start new chunk with overlap
-                                overlap_sentences = self._get_overlap_sentences(sentences, sentence)
+                                overlap_sentences = self._get_overlap_sentences(sentences, sentence_idx)
                                 current_chunk = " ".join(overlap_sentences + [sentence])
                                 current_tokens = self.count_tokens(current_chunk)
                             else:
@@ -353,7 +337,7 @@ class LegalTextChunker:
                                 content=current_chunk.strip(),
                                 chunk_index=chunk_index,
                                 doc_signature=doc_signature,
-                                hierarchy=article_hierarchy,
+                                hierarchy=part_hierarchy,
                                 chunk_type=LegalStructureType.PARAGRAPH,
                                 start_pos=article['start'],
                                 end_pos=article['end']
@@ -366,8 +350,8 @@ class LegalTextChunker:
                             content=part_content,
                             chunk_index=chunk_index,
                             doc_signature=doc_signature,
-                            hierarchy=article_hierarchy,
-                            chunk_type=LegalStructureType.PART,
+                            hierarchy=part_hierarchy,
+                            chunk_type=part['type'],
                             start_pos=article['start'] + part['start'],
                             end_pos=article['start'] + part['end']
                         )
@@ -417,15 +401,11 @@ class LegalTextChunker:
             }
         )
     
-    def _get_overlap_sentences(self, all_sentences: List[str], current_sentence: str) -> List[str]:
+    def _get_overlap_sentences(self, all_sentences: List[str], current_idx: int) -> List[str]:
         """Get sentences for overlap to maintain context"""
-        try:
-            current_idx = all_sentences.index(current_sentence)
-            overlap_count = max(1, self.overlap_tokens // 20)  # Rough estimate
-            start_idx = max(0, current_idx - overlap_count)
-            return all_sentences[start_idx:current_idx]
-        except ValueError:
-            return []
+        overlap_count = max(1, self.overlap_tokens // 20)  # Rough estimate
+        start_idx = max(0, current_idx - overlap_count)
+        return all_sentences[start_idx:current_idx]
 
 
 # Global instance
@@ -0,0 +1,288 @@
+"""
+Legal Document Structure Parser
+Single-pass parser for Russian legal documents: раздел / глава / статья / часть / пункт / подпункт.
+Builds a hierarchy tree with character offsets once per document (cached by content hash),
+so chunkers and extractors can slice the text instead of re-scanning it with regexes.
+"""
+
+import re
+import hashlib
+import threading
+import logging
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LegalStructureType(Enum):
+    """Types of legal document structures"""
+    ARTICLE = "article"
+    PART = "part"
+    PARAGRAPH = "paragraph"
+    SECTION = "section"
+    CHAPTER = "chapter"
+    ITEM = "item"
+    SUBITEM = "subitem"
+
+
+# Nesting level of each structural unit (lower = higher in the tree)
+STRUCTURE_LEVELS = {
+    LegalStructureType.SECTION: 0,
+    LegalStructureType.CHAPTER: 1,
+    LegalStructureType.ARTICLE: 2,
+    LegalStructureType.PART: 3,
+    LegalStructureType.PARAGRAPH: 4,
+    LegalStructureType.ITEM: 5,
+}
+
+# One combined pattern, anchored at line starts. Titles never cross a line break,
+# so the regex engine does constant work per line and the whole scan is linear.
+_HEADING_PATTERN = re.compile(
+    r'^[ \t]*(?:'
+    r'(?:Раздел|РАЗДЕЛ|Section)\s+(?P<section>[IVXLCDM]+|\d+)\b\.?[ \t]*(?P<section_title>[^\n]*)'
+    r'|(?:Глава|ГЛАВА|Chapter)\s+(?P<chapter>\d+(?:\.\d+)*)\.?[ \t]*(?P<chapter_title>[^\n]*)'
+    r'|(?:Статья|СТАТЬЯ|Ст\.?|Article)\s*№?\s*(?P<article>\d+(?:\.\d+)*)\.?[ \t]*(?P<article_title>[^\n]*)'
+    r'|(?:Часть\s+)(?P<part_explicit>\d+)\.?[ \t]*(?P<part_explicit_title>[^\n]*)'
+    r'|(?P<part>\d+)\.[ \t]+(?P<part_title>[^\n]*)'
+    r'|(?:Пункт\s+(?P<paragraph_explicit>\d+)\.|(?P<paragraph>\d+)\))[ \t]*(?P<paragraph_title>[^\n]*)'
+    r'|(?P<item>[а-яa-z])\)[ \t]*(?P<item_title>[^\n]*)'
+    r')',
+    re.MULTILINE
+)
+
+# Keys used in hierarchy dictionaries for each structural unit
+_HIERARCHY_KEYS = {
+    LegalStructureType.SECTION: "section",
+    LegalStructureType.CHAPTER: "chapter",
+    LegalStructureType.ARTICLE: "article",
+    LegalStructureType.PART: "part",
+    LegalStructureType.PARAGRAPH: "paragraph",
+    LegalStructureType.ITEM: "item",
+}
+
+
+@dataclass
+class LegalNode:
+    """Structural unit of a legal document with character offsets"""
+    type: LegalStructureType
+    number: str
+    title: str
+    start: int          # Offset of the heading line
+    end: int            # Offset where the unit ends (next sibling/ancestor heading or EOF)
+    header_end: int     # Offset of the end of the heading line
+    depth: int = 0
+    parent: Optional[int] = None  # Index of the parent node in LegalStructure.nodes
+    children: List[int] = field(default_factory=list)
+
+    @property
+    def level(self) -> int:
+        return STRUCTURE_LEVELS[self.type]
+
+
+class LegalStructure:
+    """Parsed hierarchy of a legal document (nodes are stored in document order)"""
+
+    def __init__(self, text_length: int, nodes: List[LegalNode]):
+        self.text_length = text_length
+        self.nodes = nodes
+        self.roots = [i for i, node in enumerate(nodes) if node.parent is None]
+        self._starts = [node.start for node in nodes]
+        self._by_type: Dict[LegalStructureType, List[int]] = {}
+        self._by_number: Dict[Tuple[LegalStructureType, str], int] = {}
+        for i, node in enumerate(nodes):
+            self._by_type.setdefault(node.type, []).append(i)
+            self._by_number.setdefault((node.type, node.number), i)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def of_type(self, structure_type: LegalStructureType) -> List[LegalNode]:
+        """All nodes of the given type in document order"""
+        return [self.nodes[i] for i in self._by_type.get(structure_type, [])]
+
+    @property
+    def articles(self) -> List[LegalNode]:
+        return self.of_type(LegalStructureType.ARTICLE)
+
+    def find(self, structure_type: LegalStructureType, number: str) -> Optional[LegalNode]:
+        """First node of the given type and number"""
+        index = self._by_number.get((structure_type, number))
+        return self.nodes[index] if index is not None else None
+
+    def children(self, node: LegalNode) -> List[LegalNode]:
+        return [self.nodes[i] for i in node.children]
+
+    def ancestors(self, node: LegalNode) -> List[LegalNode]:
+        """Path from the root to the node (inclusive)"""
+        path = [node]
+        while path[-1].parent is not None:
+            path.append(self.nodes[path[-1].parent])
+        path.reverse()
+        return path
+
+    def node_at(self, offset: int) -> Optional[LegalNode]:
+        """Deepest node containing the offset"""
+        index = bisect_right(self._starts, offset) - 1
+        while index is not None and index >= 0:
+            node = self.nodes[index]
+            if node.start <= offset < node.end:
+                return node
+            index = node.parent
+        return None
+
+    def hierarchy(self, node: Optional[LegalNode]) -> Dict[str, Any]:
+        """Hierarchy dictionary (section/chapter/article/part/paragraph/item) for a node"""
+        hierarchy = {key: None for key in _HIERARCHY_KEYS.values()}
+        if node is not None:
+            for ancestor in self.ancestors(node):
+                hierarchy[_HIERARCHY_KEYS[ancestor.type]] = ancestor.number
+        return hierarchy
+
+    def hierarchy_at(self, offset: int) -> Dict[str, Any]:
+        return self.hierarchy(self.node_at(offset))
+
+    def to_dict(self) -> List[Dict[str, Any]]:
+        """Serializable tree representation"""
+        def build(index: int) -> Dict[str, Any]:
+            node = self.nodes[index]
+            return {
+                "type": node.type.value,
+                "number": node.number,
+                "title": node.title,
+                "start": node.start,
+                "end": node.end,
+                "children": [build(child) for child in node.children]
+            }
+        return [build(index) for index in self.roots]
+
+
+def _heading_from_match(match: re.Match) -> Optional[Tuple[LegalStructureType, str, str]]:
+    """Converts a heading match into (type, number, title)"""
+    groups = match.groupdict()
+    if groups["section"]:
+        return LegalStructureType.SECTION, groups["section"], groups["section_title"]
+    if groups["chapter"]:
+        return LegalStructureType.CHAPTER, groups["chapter"], groups["chapter_title"]
+    if groups["article"]:
+        return LegalStructureType.ARTICLE, groups["article"], groups["article_title"]
+    if groups["part_explicit"]:
+        return LegalStructureType.PART, groups["part_explicit"], groups["part_explicit_title"]
+    if groups["part"]:
+        return LegalStructureType.PART, groups["part"], groups["part_title"]
+    if groups["paragraph_explicit"] or groups["paragraph"]:
+        number = groups["paragraph_explicit"] or groups["paragraph"]
+        return LegalStructureType.PARAGRAPH, number, groups["paragraph_title"]
+    if groups["item"]:
+        return LegalStructureType.ITEM, groups["item"], groups["item_title"]
+    return None
+
+
+def parse_structure(text: str) -> LegalStructure:
+    """Parses the document hierarchy in a single pass over the text"""
+    nodes: List[LegalNode] = []
+    stack: List[int] = []  # Indexes of currently open nodes
+
+    for match in _HEADING_PATTERN.finditer(text):
+        heading = _heading_from_match(match)
+        if heading is None:
+            continue
+        structure_type, number, title = heading
+        level = STRUCTURE_LEVELS[structure_type]
+
+        # Numbered parts ("1. ...") are only meaningful inside an article;
+        # elsewhere they are ordinary numbered lists.
+        if structure_type == LegalStructureType.PART and not match.group("part_explicit"):
+            if not any(nodes[i].type == LegalStructureType.ARTICLE for i in stack):
+                continue
+
+        start = match.start()
+        while stack and nodes[stack[-1]].level >= level:
+            nodes[stack.pop()].end = start
+
+        parent = stack[-1] if stack else None
+        node = LegalNode(
+            type=structure_type,
+            number=number,
+            title=title.strip(),
+            start=start,
+            end=len(text),
+            header_end=match.end(),
+            depth=len(stack),
+            parent=parent
+        )
+        nodes.append(node)
+        index = len(nodes) - 1
+        if parent is not None:
+            nodes[parent].children.append(index)
+        stack.append(index)
+
+    # Nodes still open at EOF already end at len(text)
+    return LegalStructure(len(text), nodes)
+
+
+class LegalStructureCache:
+    """LRU cache of parsed structures keyed by document content hash"""
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._cache: "OrderedDict[str, LegalStructure]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def document_hash(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, text: str, document_hash: Optional[str] = None) -> LegalStructure:
+        key = document_hash or self.document_hash(text)
+        with self._lock:
+            structure = self._cache.get(key)
+            if structure is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return structure
+
+        structure = parse_structure(text)
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = structure
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return structure
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+# Global instance
+legal_structure_cache = LegalStructureCache()
+
+
+def get_legal_structure(text: str, document_hash: Optional[str] = None) -> LegalStructure:
+    """
+    Returns the parsed hierarchy of a legal document (cached by content hash)
+
+    Args:
+        text: Document text
+        document_hash: Precomputed content hash, if the caller already has one
+
+    Returns:
+        LegalStructure with nodes and character offsets
+    """
+    return legal_structure_cache.get(text, document_hash)
@@ -15,6 +15,8 @@ import redis
 from datetime import datetime, timedelta
 import hashlib
 
+from .rate_limit_backend import BucketSpec, RateLimitBackend, get_rate_limit_backend
+
 logger = logging.getLogger(__name__)
 
 
@@ -47,44 +49,46 @@ class RateLimit:
     description: str = ""
 
 
-@dataclass
-class TokenBucket:
-    """Token bucket for rate limiting"""
-    capacity: int
-    tokens: float
-    refill_rate: float  # tokens per second
-    last_refill: float = field(default_factory=time.time)
+class RequestCounters:
+    """Fixed-size request history: per-endpoint totals plus a per-minute ring for the last hour"""
     
-    def refill(self):
-        """Refill tokens based on elapsed time"""
-        now = time.time()
-        elapsed = now - self.last_refill
-        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
-        self.last_refill = now
+    SLOTS = 60
     
-    def consume(self, tokens: int = 1) -> bool:
-        """Try to consume tokens"""
-        self.refill()
-        if self.tokens >= tokens:
-            self.tokens -= tokens
-            return True
-        return False
+    def __init__(self):
+        self.allowed: Dict[str, int] = defaultdict(int)
+        self.blocked: Dict[str, int] = defaultdict(int)
+        self.tokens: Dict[str, int] = defaultdict(int)
+        self._minute_counts = [0] * self.SLOTS
+        self._minute_keys = [-1] * self.SLOTS
+    
+    def record(self, endpoint: str, tokens: int, allowed: bool):
+        if not allowed:
+            self.blocked[endpoint] += 1
+            return
+        self.allowed[endpoint] += 1
+        self.tokens[endpoint] += tokens
+        minute = int(time.time() // 60)
+        slot = minute % self.SLOTS
+        if self._minute_keys[slot] != minute:
+            self._minute_keys[slot] = minute
+            self._minute_counts[slot] = 0
+        self._minute_counts[slot] += 1
     
-    def get_wait_time(self, tokens: int = 1) -> float:
-        """Get wait time until tokens are available"""
-        self.refill()
-        if self.tokens >= tokens:
-            return 0.0
-        needed_tokens = tokens - self.tokens
-        return needed_tokens / self.refill_rate
+    def per_minute(self) -> List[int]:
+        """Allowed requests per minute, oldest first"""
+        minute = int(time.time() // 60)
+        return [
+            self._minute_counts[m % self.SLOTS] if self._minute_keys[m % self.SLOTS] == m else 0
+            for m in range(minute - self.SLOTS + 1, minute + 1)
+        ]
 
 
 @dataclass
 class UserLimitState:
-    """State for a user's rate limits"""
+    """State for a user's rate limits (bucket levels live in the shared backend)"""
     user_id: str
-    buckets: Dict[str, TokenBucket] = field(default_factory=dict)
-    request_history: deque = field(default_factory=lambda: deque(maxlen=1000))
+    user_tier: str = "basic"
+    counters: RequestCounters = field(default_factory=RequestCounters)
     last_seen: float = field(default_factory=time.time)
     
     def update_last_seen(self):
@@ -96,6 +100,8 @@ class MLRateLimiter:
     
     def __init__(self, redis_client: Optional[redis.Redis] = None):
         self.redis_client = redis_client
+        # Buckets are shared by all workers; a dedicated client gets its own backend
+        self.backend = RateLimitBackend(redis_client=redis_client) if redis_client else get_rate_limit_backend()
         self.local_state: Dict[str, UserLimitState] = {}
         self.gpu_queue = asyncio.Queue(maxsize=10)  # GPU inference queue
         self.active_gpu_jobs = 0
@@ -183,6 +189,7 @@ class MLRateLimiter:
         
         for user_id in to_remove:
             del self.local_state[user_id]
+        self.backend.cleanup()
         
         if to_remove:
             logger.info(f"🧹 Cleaned up {len(to_remove)} old rate limit states")
@@ -206,12 +213,14 @@ class MLRateLimiter:
         
         return user_limits
     
-    def _get_user_state(self, user_id: str) -> UserLimitState:
+    def _get_user_state(self, user_id: str, user_tier: Optional[str] = None) -> UserLimitState:
         """Get or create user rate limit state"""
         if user_id not in self.local_state:
             self.local_state[user_id] = UserLimitState(user_id=user_id)
         
         state = self.local_state[user_id]
+        if user_tier:
+            state.user_tier = user_tier
         state.update_last_seen()
         return state
     
@@ -219,36 +228,42 @@ class MLRateLimiter:
         """Create unique bucket key"""
         return f"{endpoint_type.value}:{limit.limit_type.value}:{limit.window_seconds}"
     
-    def _get_or_create_bucket(self, user_state: UserLimitState, endpoint_type: EndpointType, 
-                             limit: RateLimit, user_tier: str = "basic") -> TokenBucket:
-        """Get or create token bucket for user and limit"""
-        bucket_key = self._create_bucket_key(endpoint_type, limit)
+    def _bucket_spec(self, user_id: str, endpoint_type: EndpointType, limit: RateLimit,
+                     user_tier: str = "basic", request_tokens: int = 1) -> BucketSpec:
+        """Shared bucket for user and limit"""
+        multiplier = self.vip_multipliers.get(user_tier, 1.0)
+        capacity = int(limit.limit * multiplier) + int(limit.burst_allowance * multiplier)
+        refill_rate = (limit.limit * multiplier) / limit.window_seconds
         
-        if bucket_key not in user_state.buckets:
-            multiplier = self.vip_multipliers.get(user_tier, 1.0)
-            capacity = int(limit.limit * multiplier) + int(limit.burst_allowance * multiplier)
-            refill_rate = (limit.limit * multiplier) / limit.window_seconds
-            
-            user_state.buckets[bucket_key] = TokenBucket(
-                capacity=capacity,
-                tokens=capacity,  # Start with full bucket
-                refill_rate=refill_rate
-            )
+        # Calculate tokens needed based on limit type
+        tokens_needed = request_tokens if limit.limit_type == LimitType.TOKENS_PER_MINUTE else 1
         
-        return user_state.buckets[bucket_key]
+        return BucketSpec(
+            key=f"ml:{user_id}:{self._create_bucket_key(endpoint_type, limit)}",
+            capacity=capacity,
+            refill_per_second=refill_rate,
+            cost=tokens_needed
+        )
     
     async def check_rate_limit(self, user_id: str, endpoint_type: EndpointType, 
                               user_tier: str = "basic", request_tokens: int = 1) -> Tuple[bool, Dict[str, Any]]:
         """
         Check if request is within rate limits
         
+        All applicable buckets are checked atomically in the shared backend:
+        either every bucket is charged or none is.
+        
         Returns:
             (allowed, limit_info)
         """
-        user_state = self._get_user_state(user_id)
+        user_state = self._get_user_state(user_id, user_tier)
         
         # Get applicable rate limits
         limits = self.rate_limits.get(endpoint_type, [])
+        buckets = [
+            self._bucket_spec(user_id, endpoint_type, limit, user_tier, request_tokens)
+            for limit in limits
+        ]
         
         limit_info = {
             "user_id": user_id,
@@ -259,37 +274,31 @@ class MLRateLimiter:
             "wait_time": 0.0
         }
         
-        max_wait_time = 0.0
-        
-        for limit in limits:
-            bucket = self._get_or_create_bucket(user_state, endpoint_type, limit, user_tier)
-            
-            # Calculate tokens needed based on limit type
-            tokens_needed = request_tokens if limit.limit_type == LimitType.TOKENS_PER_MINUTE else 1
-            
-            can_proceed = bucket.consume(tokens_needed)
-            wait_time = bucket.get_wait_time(tokens_needed) if not can_proceed else 0.0
-            
-            limit_status = {
-                "limit_type": limit.limit_type.value,
-                "limit_value": limit.limit,
-                "window_seconds": limit.window_seconds,
-                "tokens_available": bucket.tokens,
-                "tokens_needed": tokens_needed,
-                "allowed": can_proceed,
-                "wait_time": wait_time,
-                "description": limit.description
-            }
+        decision = await self.backend.check_async(buckets) if buckets else None
+        if decision is not None:
+            wait_times = decision.wait_times(buckets)
+            for i, (limit, bucket) in enumerate(zip(limits, buckets)):
+                tokens_available = decision.tokens[i] if decision.tokens else 0.0
+                can_proceed = decision.allowed or tokens_available >= bucket.cost
+                limit_info["limits_checked"].append({
+                    "limit_type": limit.limit_type.value,
+                    "limit_value": limit.limit,
+                    "window_seconds": limit.window_seconds,
+                    "tokens_available": tokens_available,
+                    "tokens_needed": bucket.cost,
+                    "allowed": can_proceed,
+                    "wait_time": wait_times[i],
+                    "description": limit.description
+                })
+                if not can_proceed and "blocked_by" not in limit_info:
+                    limit_info["blocked_by"] = limit.description
             
-            limit_info["limits_checked"].append(limit_status)
-            
-            if not can_proceed:
-                max_wait_time = max(max_wait_time, wait_time)
-                limit_info["wait_time"] = max_wait_time
-                limit_info["blocked_by"] = limit.description
+            if not decision.allowed:
+                limit_info["wait_time"] = decision.retry_after
+                user_state.counters.record(endpoint_type.value, request_tokens, allowed=False)
                 
                 # Log rate limit hit
-                logger.warning(f"🚫 Rate limit hit for user {user_id}: {limit.description}")
+                logger.warning(f"🚫 Rate limit hit for user {user_id}: {limit_info.get('blocked_by')}")
                 
                 return False, limit_info
         
@@ -305,12 +314,7 @@ class MLRateLimiter:
                 return False, limit_info
         
         # Record successful request
-        user_state.request_history.append({
-            "timestamp": time.time(),
-            "endpoint_type": endpoint_type.value,
-            "tokens": request_tokens,
-            "allowed": True
-        })
+        user_state.counters.record(endpoint_type.value, request_tokens, allowed=True)
         
         return True, limit_info
     
@@ -353,21 +357,30 @@ class MLRateLimiter:
         if not user_state:
             return {"user_id": user_id, "no_activity": True}
         
+        counters = user_state.counters
         stats = {
             "user_id": user_id,
+            "user_tier": user_state.user_tier,
             "last_seen": user_state.last_seen,
             "buckets": {},
-            "recent_requests": list(user_state.request_history)[-10:]  # Last 10 requests
+            "requests": dict(counters.allowed),
+            "blocked": dict(counters.blocked),
+            "tokens": dict(counters.tokens),
+            "requests_per_minute": counters.per_minute()
         }
         
-        for bucket_key, bucket in user_state.buckets.items():
-            bucket.refill()  # Update tokens
-            stats["buckets"][bucket_key] = {
-                "capacity": bucket.capacity,
-                "current_tokens": bucket.tokens,
-                "refill_rate": bucket.refill_rate,
-                "utilization": (bucket.capacity - bucket.tokens) / bucket.capacity
-            }
+        for endpoint_type, limits in self.rate_limits.items():
+            if endpoint_type.value not in counters.allowed and endpoint_type.value not in counters.blocked:
+                continue
+            buckets = [self._bucket_spec(user_id, endpoint_type, limit, user_state.user_tier) for limit in limits]
+            decision = self.backend.peek(buckets)
+            for limit, bucket, tokens in zip(limits, buckets, decision.tokens):
+                stats["buckets"][self._create_bucket_key(endpoint_type, limit)] = {
+                    "capacity": bucket.capacity,
+                    "current_tokens": tokens,
+                    "refill_rate": bucket.refill_per_second,
+                    "utilization": (bucket.capacity - tokens) / bucket.capacity
+                }
         
         return stats
     
@@ -378,6 +391,7 @@ class MLRateLimiter:
             "active_gpu_jobs": self.active_gpu_jobs,
             "max_gpu_concurrent": self.max_gpu_concurrent,
             "gpu_queue_size": self.gpu_queue.qsize(),
+            "backend": self.backend.get_stats(),
             "rate_limit_configurations": {
                 endpoint.value: [
                     {
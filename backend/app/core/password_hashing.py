@@ -0,0 +1,128 @@
+"""
+Хеширование и проверка паролей вне event loop
+
+bcrypt намеренно медленный (~250ms при cost 12): вызванный прямо из async
+обработчика он останавливает весь event loop. PasswordHasher выполняет
+bcrypt в отдельном ограниченном пуле потоков (bcrypt отпускает GIL), а при
+переполнении очереди сразу отказывает - обработчик отвечает 429 вместо того,
+чтобы копить ожидающие логины.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+import bcrypt
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PasswordHasherBusy(Exception):
+    """Очередь проверки паролей заполнена"""
+
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Password hashing queue is full")
+        self.retry_after = retry_after
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    """Хеширование пароля (блокирующий вызов)"""
+    salt = bcrypt.gensalt(rounds=rounds or settings.PASSWORD_BCRYPT_ROUNDS)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Проверка пароля (блокирующий вызов)"""
+    try:
+        return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+    except Exception:
+        return False
+
+
+def hash_rounds(hashed_password: str) -> Optional[int]:
+    """Cost из bcrypt-хеша вида $2b$12$..."""
+    parts = (hashed_password or "").split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Хеш создан с другим cost и должен быть пересчитан при входе"""
+    rounds = hash_rounds(hashed_password)
+    return rounds is not None and rounds != settings.PASSWORD_BCRYPT_ROUNDS
+
+
+class PasswordHasher:
+    """Ограниченный пул потоков для bcrypt"""
+
+    def __init__(self, workers: int = 0, max_pending: int = 64):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="password-hash"
+                    )
+        return self._executor
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                # Примерное время разбора очереди: пачки по workers проверок по ~0.25s
+                raise PasswordHasherBusy(retry_after=max(1, round(self._pending / self.workers * 0.25)))
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.completed += 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    def has_capacity(self) -> bool:
+        """Есть ли место для необязательной работы (например, rehash)"""
+        return self._pending < self.max_pending // 2
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "bcrypt_rounds": settings.PASSWORD_BCRYPT_ROUNDS
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# Глобальный экземпляр
+password_hasher = PasswordHasher(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_pending=settings.PASSWORD_HASH_MAX_PENDING
+)
@@ -8,6 +8,7 @@ from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 
 from .database import get_db
+from .principal_cache import principal_cache
 from ..models.user import User
 from ..services.auth_service import AuthService
 
@@ -82,7 +83,8 @@ def get_current_admin_user(
                 detail="Invalid token"
             )
         
-        user = db.query(User).filter(User.email == email).first()
+        # Пользователь из кеша (без запроса к БД) или из БД при промахе
+        user = principal_cache.resolve_user(db, payload)
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,133 @@
+"""
+Кеш пользователей для проверки токенов
+
+Каждый аутентифицированный запрос разрешает пользователя по sub из JWT.
+PrincipalCache держит отсоединенные снимки пользователей с коротким TTL:
+при попадании снимок подключается к сессии запроса через merge(load=False)
+без обращения к БД. В токен записывается auth_version пользователя; если
+версия в токене не совпадает со снимком, пользователь перечитывается из БД,
+а токен со старой версией отклоняется (смена пароля, блокировка, права).
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from .config import settings
+from ..models.user import User
+
+logger = logging.getLogger(__name__)
+
+
+class PrincipalCache:
+    """LRU снимков пользователей по email (sub токена) с TTL"""
+
+    def __init__(self, ttl: float = 15, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[User, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def _get(self, subject: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None:
+                return None
+            snapshot, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[subject]
+                return None
+            self._entries.move_to_end(subject)
+            return snapshot
+
+    def _put(self, user: User):
+        snapshot = User()
+        for attr in inspect(User).column_attrs:
+            setattr(snapshot, attr.key, getattr(user, attr.key))
+        make_transient_to_detached(snapshot)
+        with self._lock:
+            self._entries[user.email] = (snapshot, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, subject: Optional[str] = None):
+        """Сброс пользователя (или всего кеша)"""
+        with self._lock:
+            if subject is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(subject, None)
+
+    def resolve_user(self, db: Session, payload: Dict[str, Any]) -> Optional[User]:
+        """
+        Пользователь для проверенного payload токена, подключенный к сессии db
+
+        None - пользователь не найден или токен выпущен до изменения учетных данных.
+        """
+        subject = payload.get("sub")
+        if subject is None:
+            return None
+        token_version = payload.get("av", 0)
+
+        snapshot = self._get(subject) if self.ttl > 0 else None
+        if snapshot is not None:
+            cached_version = snapshot.auth_version or 0
+            if cached_version == token_version:
+                self.hits += 1
+                return db.merge(snapshot, load=False)
+            if cached_version > token_version:
+                # Версии только растут: токен отозван, БД не нужна
+                self.rejected += 1
+                return None
+
+        self.misses += 1
+        return self._load(db, subject, payload)
+
+    def _load(self, db: Session, subject: str, payload: Dict[str, Any]) -> Optional[User]:
+        user = db.query(User).filter(User.email == subject).first()
+        if user is None:
+            return None
+        if self.ttl > 0:
+            self._put(user)
+        if (user.auth_version or 0) != payload.get("av", 0):
+            self.rejected += 1
+            return None
+        return user
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+
+# Глобальный экземпляр
+principal_cache = PrincipalCache(ttl=settings.PRINCIPAL_CACHE_TTL, max_size=settings.PRINCIPAL_CACHE_SIZE)
+
+
+@event.listens_for(User, "after_update")
+def _invalidate_updated_user(mapper, connection, target):
+    # Изменения в этом процессе видны сразу; в других - после TTL или по auth_version
+    principal_cache.invalidate(target.email)
+    history = inspect(target).attrs.email.history
+    for old_email in history.deleted or ():
+        principal_cache.invalidate(old_email)
+
+
+@event.listens_for(User, "after_delete")
+def _invalidate_deleted_user(mapper, connection, target):
+    principal_cache.invalidate(target.email)
@@ -1,27 +1,122 @@
 """
 Prometheus Metrics for AI-Lawyer System
 Экспортирует метрики для мониторинга производительности и бизнес-процессов
+
+Если задан PROMETHEUS_MULTIPROC_DIR, счетчики и гистограммы всех воркеров
+пишутся в общий каталог и /metrics отдает их сумму. Системные метрики хоста
+снимаются во время scrape (с коротким кэшем), а не фоновым потоком в каждом
+процессе.
 """
 
+import os
 import time
 import logging
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, Optional, Tuple, List
 from prometheus_client import (
     Counter, Histogram, Gauge, Info, Enum,
-    CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+    CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
 )
+from prometheus_client.core import GaugeMetricFamily
 from datetime import datetime
 import psutil
-import threading
+
+from .config import settings
 
 logger = logging.getLogger(__name__)
 
 
+def multiprocess_enabled() -> bool:
+    """Включен ли multiprocess-режим prometheus_client (общий каталог для воркеров)"""
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir"))
+
+
+class SystemMetricsCollector:
+    """Метрики хоста, снимаемые во время scrape; результат кэшируется на cache_ttl секунд"""
+    
+    PARTITIONS_TTL = 300  # Список разделов меняется редко
+    
+    def __init__(self, cache_ttl: float):
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._sampled_at = 0.0
+        self._sample: Tuple[float, float, List[Tuple[str, float]]] = (0.0, 0.0, [])
+        self._partitions: List[str] = []
+        self._partitions_at = 0.0
+        # Первый вызов задает точку отсчета: дальше cpu_percent не блокирует и
+        # считает загрузку с предыдущего scrape
+        psutil.cpu_percent(interval=None)
+    
+    def _mount_points(self, now: float) -> List[str]:
+        if not self._partitions or now - self._partitions_at > self.PARTITIONS_TTL:
+            self._partitions = [partition.mountpoint for partition in psutil.disk_partitions()]
+            self._partitions_at = now
+        return self._partitions
+    
+    def _read(self, now: float) -> Tuple[float, float, List[Tuple[str, float]]]:
+        disks = []
+        for mount_point in self._mount_points(now):
+            try:
+                disks.append((mount_point, psutil.disk_usage(mount_point).used))
+            except (PermissionError, OSError):
+                continue
+        return psutil.cpu_percent(interval=None), psutil.virtual_memory().used, disks
+    
+    def _families(self, sample: Optional[Tuple[float, float, List[Tuple[str, float]]]] = None):
+        cpu = GaugeMetricFamily('system_cpu_usage_percent', 'System CPU usage percentage')
+        memory = GaugeMetricFamily('system_memory_usage_bytes', 'System memory usage in bytes')
+        disk = GaugeMetricFamily('system_disk_usage_bytes', 'System disk usage in bytes', labels=['mount_point'])
+        if sample is not None:
+            cpu.add_metric([], sample[0])
+            memory.add_metric([], sample[1])
+            for mount_point, used in sample[2]:
+                disk.add_metric([mount_point], used)
+        return [cpu, memory, disk]
+    
+    def describe(self):
+        return self._families()
+    
+    def collect(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._sampled_at > self.cache_ttl:
+                try:
+                    self._sample = self._read(now)
+                    self._sampled_at = now
+                except Exception as e:
+                    logger.error(f"Error collecting system metrics: {e}")
+            sample = self._sample
+        return self._families(sample)
+
+
+class _MergedRegistryCollector:
+    """Семейства метрик нескольких реестров; при совпадении имени берется первое"""
+    
+    def __init__(self, *registries: CollectorRegistry):
+        self.registries = registries
+    
+    def collect(self):
+        seen = set()
+        for registry in self.registries:
+            for family in registry.collect():
+                if family.name in seen:
+                    continue
+                seen.add(family.name)
+                yield family
+
+
 class PrometheusMetrics:
     """Prometheus metrics collector for AI-Lawyer system"""
     
+    MAX_BOUND_CHILDREN = 10000  # Предел кэша привязанных label-наборов (пути с ID не раздувают память)
+    
     def __init__(self, registry: Optional[CollectorRegistry] = None):
         self.registry = registry or CollectorRegistry()
+        self.multiprocess = multiprocess_enabled()
+        # Info и Enum не агрегируются между процессами, в multiprocess-режиме они отдаются отдельно
+        self._local_registry = CollectorRegistry() if self.multiprocess else self.registry
+        self._http_children: Dict[Tuple[str, str, int], Tuple[Any, Any]] = {}
+        self._cache_children: Dict[Tuple[str, str, str], Any] = {}
         
         # HTTP Request Metrics
         self.http_requests_total = Counter(
@@ -90,6 +185,7 @@ class PrometheusMetrics:
             'cache_hit_ratio',
             'Cache hit ratio',
             ['cache_type'],
+            multiprocess_mode='livemostrecent',
             registry=self.registry
         )
         
@@ -97,6 +193,7 @@ class PrometheusMetrics:
             'cache_size_items',
             'Number of items in cache',
             ['cache_type'],
+            multiprocess_mode='livesum',
             registry=self.registry
         )
         
@@ -105,6 +202,7 @@ class PrometheusMetrics:
             'database_connections_active',
             'Active database connections',
             ['database'],
+            multiprocess_mode='livesum',
             registry=self.registry
         )
         
@@ -135,6 +233,7 @@ class PrometheusMetrics:
         self.vector_documents_count = Gauge(
             'vector_store_documents_total',
             'Total documents in vector store',
+            multiprocess_mode='livemostrecent',
             registry=self.registry
         )
         
@@ -176,25 +275,8 @@ class PrometheusMetrics:
             registry=self.registry
         )
         
-        # System Metrics
-        self.system_cpu_usage = Gauge(
-            'system_cpu_usage_percent',
-            'System CPU usage percentage',
-            registry=self.registry
-        )
-        
-        self.system_memory_usage = Gauge(
-            'system_memory_usage_bytes',
-            'System memory usage in bytes',
-            registry=self.registry
-        )
-        
-        self.system_disk_usage = Gauge(
-            'system_disk_usage_bytes',
-            'System disk usage in bytes',
-            ['mount_point'],
-            registry=self.registry
-        )
+        # System Metrics (снимаются во время scrape)
+        self.system_metrics = SystemMetricsCollector(settings.METRICS_SYSTEM_CACHE_TTL)
         
         # Model Status
         self.model_status = Enum(
@@ -202,14 +284,14 @@ class PrometheusMetrics:
             'Model status',
             ['model_name'],
             states=['loading', 'ready', 'error', 'unloaded'],
-            registry=self.registry
+            registry=self._local_registry
         )
         
         self.model_info = Info(
             'model_info',
             'Model information',
             ['model_name'],
-            registry=self.registry
+            registry=self._local_registry
         )
         
         # Error Metrics
@@ -220,51 +302,36 @@ class PrometheusMetrics:
             registry=self.registry
         )
         
-        # Start system metrics collection
-        self._start_system_metrics_collection()
+        self._scrape_registry = self._build_scrape_registry()
     
-    def _start_system_metrics_collection(self):
-        """Start background thread for system metrics collection"""
-        def collect_system_metrics():
-            while True:
-                try:
-                    # CPU usage
-                    cpu_percent = psutil.cpu_percent(interval=1)
-                    self.system_cpu_usage.set(cpu_percent)
-                    
-                    # Memory usage
-                    memory = psutil.virtual_memory()
-                    self.system_memory_usage.set(memory.used)
-                    
-                    # Disk usage
-                    for partition in psutil.disk_partitions():
-                        try:
-                            usage = psutil.disk_usage(partition.mountpoint)
-                            self.system_disk_usage.labels(
-                                mount_point=partition.mountpoint
-                            ).set(usage.used)
-                        except PermissionError:
-                            continue
-                    
-                    time.sleep(15)  # Collect every 15 seconds
-                    
-                except Exception as e:
-                    logger.error(f"Error collecting system metrics: {e}")
-                    time.sleep(60)  # Wait longer on error
-        
-        thread = threading.Thread(target=collect_system_metrics, daemon=True)
-        thread.start()
-        logger.info("✅ System metrics collection started")
+    def _build_scrape_registry(self) -> CollectorRegistry:
+        """Реестр, который отдается на /metrics"""
+        scrape_registry = CollectorRegistry()
+        if self.multiprocess:
+            from prometheus_client import multiprocess
+            
+            # Счетчики, гистограммы и gauge всех воркеров (в том числе из реестра по умолчанию)
+            multiprocess.MultiProcessCollector(scrape_registry)
+            scrape_registry.register(_MergedRegistryCollector(self._local_registry))
+        else:
+            scrape_registry.register(_MergedRegistryCollector(self.registry, REGISTRY))
+        scrape_registry.register(self.system_metrics)
+        return scrape_registry
     
     # Convenience methods for common operations
     def record_http_request(self, method: str, endpoint: str, status_code: int, duration: float):
         """Record HTTP request metrics"""
-        self.http_requests_total.labels(
-            method=method, endpoint=endpoint, status_code=str(status_code)
-        ).inc()
-        self.http_request_duration.labels(
-            method=method, endpoint=endpoint
-        ).observe(duration)
+        key = (method, endpoint, status_code)
+        children = self._http_children.get(key)
+        if children is None:
+            children = (
+                self.http_requests_total.labels(method, endpoint, str(status_code)),
+                self.http_request_duration.labels(method, endpoint)
+            )
+            if len(self._http_children) < self.MAX_BOUND_CHILDREN:
+                self._http_children[key] = children
+        children[0].inc()
+        children[1].observe(duration)
     
     def record_ai_inference(self, model_type: str, endpoint: str, duration: float, 
                            tokens: int = 0, success: bool = True):
@@ -298,9 +365,13 @@ class PrometheusMetrics:
     
     def record_cache_operation(self, cache_type: str, operation: str, result: str):
         """Record cache operation"""
-        self.cache_operations.labels(
-            cache_type=cache_type, operation=operation, result=result
-        ).inc()
+        key = (cache_type, operation, result)
+        child = self._cache_children.get(key)
+        if child is None:
+            child = self.cache_operations.labels(cache_type, operation, result)
+            if len(self._cache_children) < self.MAX_BOUND_CHILDREN:
+                self._cache_children[key] = child
+        child.inc()
     
     def update_cache_stats(self, cache_type: str, hit_ratio: float, size: int):
         """Update cache statistics"""
@@ -346,9 +417,31 @@ class PrometheusMetrics:
         """Record error occurrence"""
         self.errors_total.labels(error_type=error_type, component=component).inc()
     
-    def get_metrics(self) -> str:
-        """Get metrics in Prometheus format"""
-        return generate_latest(self.registry)
+    def get_metrics(self) -> bytes:
+        """Get metrics in Prometheus format (all workers in multiprocess mode)"""
+        return generate_latest(self._scrape_registry)
+    
+    def render(self, extra_metrics: str = "") -> str:
+        """Метрики приложения и дополнительные строки, имена которых не совпадают с уже отданными"""
+        content = self.get_metrics().decode('utf-8')
+        if not extra_metrics:
+            return content
+        
+        names = {
+            line.split('{', 1)[0].split(' ', 1)[0]
+            for line in content.splitlines() if line and not line.startswith('#')
+        }
+        extra = [
+            line for line in extra_metrics.splitlines()
+            if line and line.split('{', 1)[0].split(' ', 1)[0] not in names
+        ]
+        return content + "\n".join(extra) + ("\n" if extra else "")
+    
+    def mark_process_dead(self):
+        """Удаляет live-gauge завершающегося воркера из общего каталога"""
+        if self.multiprocess:
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(os.getpid())
     
     def get_content_type(self) -> str:
         """Get content type for metrics endpoint"""
@@ -0,0 +1,252 @@
+"""
+Общие счетчики квот функций подписки
+
+Использование хранится в счетчиках с ключом периода (user:feature:2026-10-16,
+user:feature:2026-10, ...), которые истекают сами после окончания периода,
+поэтому сбрасывать их не нужно. Проверка лимита и увеличение всех счетчиков
+выполняются одним атомарным вызовом: в Redis это Lua-скрипт (один round-trip,
+общий лимит для всех воркеров), без Redis - та же логика в памяти процесса.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from .config import settings
+from .redis_scripts import LocalFallbackStore, RedisScriptClient, process_singleton
+
+
+@dataclass(frozen=True)
+class QuotaCounter:
+    """Счетчик использования за период"""
+    key: str
+    limit: int  # -1 - счетчик только учитывает использование, без проверки
+    ttl_seconds: int
+
+
+@dataclass
+class QuotaDecision:
+    """Результат атомарной проверки и увеличения счетчиков"""
+    granted: int  # Сколько единиц списано (0 - отказ)
+    usage: List[int]  # Значение каждого счетчика после проверки
+
+    @property
+    def allowed(self) -> bool:
+        return self.granted > 0
+
+
+# KEYS - счетчики; ARGV: amount, want, share, затем пары limit, ttl
+# Выдается до want единиц, но не больше share от остатка по каждому лимиту
+# (и не меньше amount); если не набирается amount - не списывается ничего.
+QUOTA_CONSUME_SCRIPT = """
+local amount = tonumber(ARGV[1])
+local grant = tonumber(ARGV[2])
+local share = tonumber(ARGV[3])
+local usage = {}
+for i = 1, #KEYS do
+    local limit = tonumber(ARGV[2 + i * 2])
+    local current = tonumber(redis.call('GET', KEYS[i]) or '0')
+    usage[i] = current
+    if limit >= 0 then
+        local room = limit - current
+        grant = math.min(grant, room, math.max(amount, math.floor(room * share)))
+    end
+end
+if grant < amount then
+    grant = 0
+end
+
+local result = {grant}
+for i = 1, #KEYS do
+    local current = usage[i]
+    if grant > 0 then
+        current = redis.call('INCRBY', KEYS[i], grant)
+        redis.call('EXPIRE', KEYS[i], tonumber(ARGV[3 + i * 2]))
+    end
+    result[#result + 1] = current
+end
+return result
+"""
+
+# KEYS - счетчики; ARGV[1] - сколько вернуть. Значение не опускается ниже нуля.
+QUOTA_RELEASE_SCRIPT = """
+local amount = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local current = tonumber(redis.call('GET', KEYS[i]) or '0')
+    if current > 0 then
+        local ttl = redis.call('PTTL', KEYS[i])
+        local value = math.max(0, current - amount)
+        if ttl > 0 then
+            redis.call('SET', KEYS[i], tostring(value), 'PX', ttl)
+        else
+            redis.call('SET', KEYS[i], tostring(value))
+        end
+    end
+end
+return 1
+"""
+
+
+class LocalQuotaStore(LocalFallbackStore):
+    """Та же логика счетчиков в памяти процесса (fallback без Redis и для тестов)"""
+
+    def __init__(self):
+        super().__init__()
+        self._counters: Dict[str, Tuple[int, float]] = {}  # key -> (value, expires_at)
+
+    def _current(self, key: str, now: float) -> int:
+        state = self._counters.get(key)
+        if state is None or state[1] <= now:
+            return 0
+        return state[0]
+
+    def consume(self, counters: List[QuotaCounter], amount: int, want: int, share: float = 1.0) -> QuotaDecision:
+        now = time.time()
+        with self._lock:
+            self._tick(now)
+
+            usage = [self._current(counter.key, now) for counter in counters]
+            grant = want
+            for counter, current in zip(counters, usage):
+                if counter.limit >= 0:
+                    room = counter.limit - current
+                    grant = min(grant, room, max(amount, int(room * share)))
+            if grant < amount:
+                grant = 0
+
+            if grant > 0:
+                for i, counter in enumerate(counters):
+                    usage[i] += grant
+                    self._counters[counter.key] = (usage[i], now + counter.ttl_seconds)
+
+        return QuotaDecision(grant, usage)
+
+    def release(self, counters: List[QuotaCounter], amount: int):
+        now = time.time()
+        with self._lock:
+            for counter in counters:
+                state = self._counters.get(counter.key)
+                if state is not None and state[1] > now:
+                    self._counters[counter.key] = (max(0, state[0] - amount), state[1])
+
+    def peek(self, keys: List[str]) -> List[int]:
+        now = time.time()
+        with self._lock:
+            return [self._current(key, now) for key in keys]
+
+    def delete(self, keys: List[str]):
+        with self._lock:
+            for key in keys:
+                self._counters.pop(key, None)
+
+    def _sweep(self, now: float) -> int:
+        expired = [key for key, state in self._counters.items() if state[1] <= now]
+        for key in expired:
+            del self._counters[key]
+        return len(expired)
+
+    def size(self) -> int:
+        return len(self._counters)
+
+
+class QuotaStore:
+    """
+    Атомарные счетчики квот в Redis с локальным fallback
+
+    Если Redis недоступен, счетчики ведутся в памяти процесса, а повторное
+    подключение пробуется не чаще раза в QUOTA_REDIS_RETRY секунд.
+    """
+
+    def __init__(self, redis_client=None, redis_url: Optional[str] = None, prefix: Optional[str] = None):
+        self.prefix = prefix or settings.QUOTA_KEY_PREFIX
+        self.local = LocalQuotaStore()
+        self.redis = RedisScriptClient(
+            {"consume": QUOTA_CONSUME_SCRIPT, "release": QUOTA_RELEASE_SCRIPT},
+            name="Subscription quotas",
+            timeout=settings.QUOTA_REDIS_TIMEOUT,
+            retry_seconds=settings.QUOTA_REDIS_RETRY,
+            redis_client=redis_client,
+            redis_url=redis_url
+        )
+        self.redis_calls = 0
+        self.fallback_calls = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def _full(self, counters: List[QuotaCounter]) -> List[QuotaCounter]:
+        return [QuotaCounter(self._key(c.key), c.limit, c.ttl_seconds) for c in counters]
+
+    def consume(
+        self,
+        counters: List[QuotaCounter],
+        amount: int,
+        want: Optional[int] = None,
+        share: float = 1.0
+    ) -> QuotaDecision:
+        """
+        Атомарно проверяет лимиты и увеличивает все счетчики
+
+        Списывается от amount до want единиц (want > amount - предвыборка
+        для локальной аренды), но не больше share от остатка по каждому лимиту.
+        """
+        want = max(amount, want or amount)
+        counters = self._full(counters)
+        scripts = self.redis.get_scripts()
+        if scripts is not None:
+            try:
+                args = [amount, want, share]
+                for counter in counters:
+                    args.extend([counter.limit, counter.ttl_seconds])
+                result = scripts["consume"](keys=[c.key for c in counters], args=args)
+                self.redis_calls += 1
+                return QuotaDecision(int(result[0]), [int(value) for value in result[1:]])
+            except Exception as e:
+                self.redis.disable(e)
+        self.fallback_calls += 1
+        return self.local.consume(counters, amount, want, share)
+
+    def release(self, counters: List[QuotaCounter], amount: int):
+        """Возвращает неиспользованные единицы (остаток аренды)"""
+        if amount <= 0:
+            return
+        counters = self._full(counters)
+        scripts = self.redis.get_scripts()
+        if scripts is not None:
+            try:
+                scripts["release"](keys=[c.key for c in counters], args=[amount])
+                return
+            except Exception as e:
+                self.redis.disable(e)
+        self.local.release(counters, amount)
+
+    def peek(self, keys: List[str]) -> List[int]:
+        """Текущие значения счетчиков без изменения"""
+        full_keys = [self._key(key) for key in keys]
+        if self.redis.get_scripts() is not None:
+            try:
+                return [int(value or 0) for value in self.redis.client.mget(full_keys)]
+            except Exception as e:
+                self.redis.disable(e)
+        return self.local.peek(full_keys)
+
+    def delete(self, keys: List[str]):
+        """Удаляет счетчики (например, при смене тарифа)"""
+        full_keys = [self._key(key) for key in keys]
+        self.local.delete(full_keys)
+        self.redis.delete(full_keys)
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            "backend": "redis" if self.redis.active else "local",
+            "redis_calls": self.redis_calls,
+            "fallback_calls": self.fallback_calls,
+            "local_counters": self.local.size()
+        }
+
+
+@process_singleton
+def get_quota_store() -> QuotaStore:
+    """Общий для процесса экземпляр хранилища квот"""
+    redis_url = settings.REDIS_URL if settings.QUOTA_BACKEND == "redis" else None
+    return QuotaStore(redis_url=redis_url)
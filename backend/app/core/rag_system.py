@@ -84,68 +84,12 @@ class DocumentProcessor:
         return [word for word, freq in sorted_words[:max_keywords]]
     
     def split_document(self, document: Document, chunk_size: int = 500, overlap: int = 50) -> List[Document]:
-        """Оригинальное разбиение документа на чанки (для не-юридических документов)"""
-        import hashlib
-        
-        content = document.content
-        chunks = []
-        
-        # Create document signature for unique parent_doc_id
-        doc_signature_data = f"{document.source}:{document.metadata.get('edition', 'v0')}:{content[:2000]}"
-        doc_sig = hashlib.md5(doc_signature_data.encode()).hexdigest()[:8]
-        parent_doc_id = f"{document.source}:{document.metadata.get('edition', 'v0')}:{doc_sig}"
-        
-        start = 0
-        chunk_index = 0
-        
-        while start < len(content):
-            end = start + chunk_size
-            
-            # Пытаемся закончить на границе предложения
-            if end < len(content):
-                # Ищем последнюю точку, восклицательный или вопросительный знак
-                for i in range(end, max(start + chunk_size - 100, start), -1):
-                    if content[i] in '.!?':
-                        end = i + 1
-                        break
-            
-            chunk_content = content[start:end].strip()
-            
-            if chunk_content:
-                # Create unique chunk ID with content hash to prevent collisions
-                content_hash = hashlib.md5(chunk_content.encode()).hexdigest()[:8]
-                chunk_id = f"{parent_doc_id}:chunk:{chunk_index}:{content_hash}"
-                
-                chunk = Document(
-                    id=chunk_id,
-                    title=f"{document.title} (часть {chunk_index + 1})",
-                    content=chunk_content,
-                    category=document.category,
-                    source=document.source,
-                    metadata={
-                        **document.metadata,
-                        "chunk_index": chunk_index,
-                        "original_doc_id": document.id,
-                        "parent_doc_id": parent_doc_id,
-                        "content_hash": content_hash,
-                        "start_pos": start,
-                        "end_pos": end,
-                        "chunk_type": "paragraph"  # Default for non-legal
-                    },
-                    created_at=document.created_at,
-                    updated_at=document.updated_at
-                )
-                chunks.append(chunk)
-                chunk_index += 1
-            
-            start = end - overlap
-        
-        return chunks
-        import hashlib
+        """Разбиение документа на чанки (по структуре для юридических документов)"""
         from ..core.legal_chunker import chunk_legal_document
+        from ..core.legal_structure import get_legal_structure
         
-        # Use enhanced legal chunking for legal documents
-        if self._is_legal_document(document):
+        # Use enhanced legal chunking for legal documents with recognizable structure
+        if self._is_legal_document(document) and get_legal_structure(document.content).articles:
             logger.info(f"🏦 Using legal chunking for document: {document.id}")
             
             legal_chunks = chunk_legal_document(
@@ -375,14 +319,157 @@ class EmbeddingService:
         dot_product = np.dot(embedding1, embedding2)
         return dot_product / (norm1 * norm2)
 
+class EmbeddingMatrix:
+    """
+    Эмбеддинги документов в одной непрерывной матрице float32
+    
+    Строки нормализуются при вставке, поэтому косинусное сходство со всеми
+    документами - одно умножение матрицы на вектор. Емкость растет удвоением,
+    удаление помечает строку (tombstone), а когда мертвых строк становится
+    много, матрица уплотняется.
+    """
+    
+    INITIAL_CAPACITY = 1024
+    COMPACT_MIN_TOMBSTONES = 256
+    COMPACT_RATIO = 0.25
+    
+    def __init__(self):
+        self.dim: Optional[int] = None
+        self.size = 0  # Занятые строки, включая удаленные
+        self.tombstones = 0
+        self.compactions = 0
+        self._vectors = np.zeros((0, 0), dtype=np.float32)  # Размерность задается первым эмбеддингом
+        self._alive = np.zeros(0, dtype=bool)
+        self._categories = np.zeros(0, dtype=np.int32)
+        self._row_ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._category_codes: Dict[str, int] = {}
+    
+    def __len__(self) -> int:
+        return len(self._rows)
+    
+    @property
+    def capacity(self) -> int:
+        return self._vectors.shape[0]
+    
+    def row_of(self, doc_id: str) -> Optional[int]:
+        return self._rows.get(doc_id)
+    
+    def doc_id_at(self, row: int) -> Optional[str]:
+        return self._row_ids[row]
+    
+    def add(self, doc_id: str, embedding: List[float], category: str):
+        """Добавляет (или заменяет) эмбеддинг документа"""
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        if self.dim is None:
+            self.dim = vector.shape[0]
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self._resize(self.INITIAL_CAPACITY)
+        elif vector.shape[0] != self.dim:
+            raise ValueError(f"Embedding dimension {vector.shape[0]} does not match index dimension {self.dim}")
+        
+        if doc_id in self._rows:
+            self.remove(doc_id)
+        if self.size == self.capacity:
+            self._resize(self.capacity * 2)
+        
+        norm = np.linalg.norm(vector)
+        row = self.size
+        self._vectors[row] = vector / norm if norm > 0 else vector
+        self._alive[row] = True
+        self._categories[row] = self._category_codes.setdefault(category, len(self._category_codes))
+        self._row_ids.append(doc_id)
+        self._rows[doc_id] = row
+        self.size += 1
+    
+    def remove(self, doc_id: str) -> bool:
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return False
+        self._alive[row] = False
+        self._row_ids[row] = None
+        self.tombstones += 1
+        if self.tombstones >= max(self.COMPACT_MIN_TOMBSTONES, self.size * self.COMPACT_RATIO):
+            self.compact()
+        return True
+    
+    def compact(self):
+        """Удаляет помеченные строки, сохраняя порядок оставшихся"""
+        keep = np.flatnonzero(self._alive[:self.size])
+        count = keep.shape[0]
+        self._vectors[:count] = self._vectors[keep]
+        self._categories[:count] = self._categories[keep]
+        self._alive[:count] = True
+        self._alive[count:] = False
+        self._row_ids = [self._row_ids[row] for row in keep]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._row_ids)}
+        self.size = count
+        self.tombstones = 0
+        self.compactions += 1
+        
+        # Не держим память под давно удаленные строки
+        capacity = self.INITIAL_CAPACITY
+        while capacity < count * 2:
+            capacity *= 2
+        if capacity < self.capacity:
+            self._resize(capacity)
+    
+    def _resize(self, capacity: int):
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        alive = np.zeros(capacity, dtype=bool)
+        categories = np.zeros(capacity, dtype=np.int32)
+        vectors[:self.size] = self._vectors[:self.size]
+        alive[:self.size] = self._alive[:self.size]
+        categories[:self.size] = self._categories[:self.size]
+        self._vectors, self._alive, self._categories = vectors, alive, categories
+    
+    def alive_mask(self) -> np.ndarray:
+        return self._alive[:self.size].copy()
+    
+    def category_mask(self, category: str) -> np.ndarray:
+        code = self._category_codes.get(category)
+        if code is None:
+            return np.zeros(self.size, dtype=bool)
+        return (self._categories[:self.size] == code) & self._alive[:self.size]
+    
+    def rows_mask(self, doc_ids: List[str]) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        rows = [self._rows[doc_id] for doc_id in doc_ids if doc_id in self._rows]
+        mask[rows] = True
+        return mask
+    
+    def similarities(self, query_embedding: List[float]) -> np.ndarray:
+        """Косинусное сходство запроса со всеми строками"""
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        if self.size == 0 or query.shape[0] != self.dim:
+            return np.zeros(self.size, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return np.zeros(self.size, dtype=np.float32)
+        return self._vectors[:self.size] @ (query / norm)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "rows": len(self._rows),
+            "tombstones": self.tombstones,
+            "capacity": self.capacity,
+            "dimension": self.dim,
+            "compactions": self.compactions,
+            "memory_mb": round(self._vectors.nbytes / (1024 * 1024), 2)
+        }
+
 class RAGSystem:
     """Улучшенная RAG система"""
     
+    MIN_CANDIDATES = 10
+    MIN_RELEVANCE = 0.1
+    
     def __init__(self):
         self.documents: Dict[str, Document] = {}
         self.document_processor = DocumentProcessor()
         self.embedding_service = EmbeddingService()
         self.search_index = {}  # Индекс для быстрого поиска
+        self.embeddings = EmbeddingMatrix()
     
     async def add_document(self, document: Document) -> str:
         """Добавление документа в базу знаний"""
@@ -399,6 +486,13 @@ class RAGSystem:
             # Создаем эмбеддинг
             embedding = await self.embedding_service.get_embedding(processed_content)
             
+            # Повторное добавление заменяет старую версию документа
+            if document.id in self.documents:
+                await self.delete_document(document.id)
+            
+            # Нормализованный эмбеддинг попадает в матрицу поиска
+            self.embeddings.add(document.id, embedding, document.category)
+            
             # Обновляем документ
             document.embedding = embedding
             document.metadata.update({
@@ -466,73 +560,74 @@ class RAGSystem:
             # Извлекаем ключевые слова из запроса
             query_keywords = self.document_processor.extract_keywords(query_context.query)
             
-            # Получаем кандидатов для поиска
+            if len(self.embeddings) == 0:
+                return []
+            
+            # Кандидаты - булева маска над строками матрицы эмбеддингов
             candidates = self._get_search_candidates(query_context, query_keywords)
             
-            # Вычисляем релевантность для каждого кандидата
+            # Семантическое сходство со всеми документами одним произведением
+            semantic_scores = self.embeddings.similarities(query_embedding)
+            keyword_scores = self._keyword_scores(query_keywords)
+            
+            # Общая релевантность с фильтром по минимальному порогу
+            relevance = (semantic_scores * 0.7) + (keyword_scores * 0.3)
+            rows = np.flatnonzero(candidates & (relevance > self.MIN_RELEVANCE))
+            
+            # Топ-k без полной сортировки
+            k = query_context.max_results
+            if rows.shape[0] > k:
+                rows = rows[np.argpartition(-relevance[rows], k - 1)[:k]]
+            rows = rows[np.argsort(-relevance[rows], kind="stable")]
+            
             results = []
-            for doc_id in candidates:
-                document = self.documents.get(doc_id)
-                if not document or not document.embedding:
-                    continue
-                
-                # Семантическое сходство
-                semantic_score = self.embedding_service.cosine_similarity(
-                    query_embedding, document.embedding
+            for row in rows:
+                document = self.documents[self.embeddings.doc_id_at(row)]
+                # Релевантные фрагменты ищем только для возвращаемых документов
+                snippets = self._extract_relevant_snippets(
+                    query_context.query, document.content
                 )
-                
-                # Ключевое слово сходство
-                keyword_score = self._calculate_keyword_score(
-                    query_keywords, document.metadata.get("keywords", [])
-                )
-                
-                # Общая релевантность
-                relevance = (semantic_score * 0.7) + (keyword_score * 0.3)
-                
-                # Фильтруем по минимальной релевантности
-                if relevance > 0.1:
-                    # Находим релевантные фрагменты
-                    snippets = self._extract_relevant_snippets(
-                        query_context.query, document.content
-                    )
-                    
-                    results.append(SearchResult(
-                        document=document,
-                        score=semantic_score,
-                        relevance=relevance,
-                        matched_snippets=snippets
-                    ))
-            
-            # Сортируем по релевантности
-            results.sort(key=lambda x: x.relevance, reverse=True)
+                results.append(SearchResult(
+                    document=document,
+                    score=float(semantic_scores[row]),
+                    relevance=float(relevance[row]),
+                    matched_snippets=snippets
+                ))
             
-            # Ограничиваем количество результатов
-            return results[:query_context.max_results]
+            return results
             
         except Exception as e:
             logger.error(f"Search error: {str(e)}")
             return []
     
-    def _get_search_candidates(self, query_context: QueryContext, query_keywords: List[str]) -> List[str]:
-        """Получение кандидатов для поиска"""
-        candidates = set()
+    def _get_search_candidates(self, query_context: QueryContext, query_keywords: List[str]) -> np.ndarray:
+        """Маска кандидатов для поиска"""
+        candidate_ids = []
         
         # Поиск по ключевым словам
         for keyword in query_keywords:
-            if keyword in self.search_index:
-                candidates.update(self.search_index[keyword])
+            candidate_ids.extend(self.search_index.get(keyword, []))
+        mask = self.embeddings.rows_mask(candidate_ids)
         
         # Поиск по категории
         if query_context.category:
-            category_key = f"category:{query_context.category}"
-            if category_key in self.search_index:
-                candidates.update(self.search_index[category_key])
+            mask |= self.embeddings.category_mask(query_context.category)
         
         # Если кандидатов мало, добавляем все документы
-        if len(candidates) < 10:
-            candidates.update(self.documents.keys())
+        if np.count_nonzero(mask) < self.MIN_CANDIDATES:
+            return self.embeddings.alive_mask()
         
-        return list(candidates)
+        return mask
+    
+    def _keyword_scores(self, query_keywords: List[str]) -> np.ndarray:
+        """Доля ключевых слов запроса среди ключевых слов каждого документа"""
+        scores = np.zeros(self.embeddings.size, dtype=np.float32)
+        query_set = set(query_keywords)
+        if not query_set:
+            return scores
+        for keyword in query_set:
+            scores += self.embeddings.rows_mask(self.search_index.get(keyword, []))
+        return scores / len(query_set)
     
     def _calculate_keyword_score(self, query_keywords: List[str], doc_keywords: List[str]) -> float:
         """Вычисление сходства по ключевым словам"""
@@ -589,6 +684,7 @@ class RAGSystem:
             
             # Удаляем из хранилища
             del self.documents[doc_id]
+            self.embeddings.remove(doc_id)
             
             logger.info(f"Document deleted: {doc_id}")
             return True
@@ -626,7 +722,8 @@ class RAGSystem:
             "total_documents": total_docs,
             "categories": categories,
             "index_size": len(self.search_index),
-            "embedding_cache_size": len(self.embedding_service.cache)
+            "embedding_cache_size": len(self.embedding_service.cache),
+            "vector_index": self.embeddings.get_stats()
         }
 
 # Глобальный экземпляр RAG системы
@@ -0,0 +1,283 @@
+"""
+Общее хранилище token bucket для всех rate limiter'ов
+
+Все ведра, которые относятся к запросу, проверяются одним атомарным вызовом:
+в Redis это Lua-скрипт (один round-trip, общий лимит для всех воркеров
+uvicorn), без Redis - такая же логика в памяти процесса. Запрос либо
+списывает токены во всех ведрах, либо не списывает нигде. Для ведер
+хранится только пара (токены, время последнего пополнения), ключи истекают
+сами, когда ведро снова заполнено.
+"""
+
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from .config import settings
+from .redis_scripts import LocalFallbackStore, RedisScriptClient, process_singleton
+
+
+@dataclass(frozen=True)
+class BucketSpec:
+    """Ведро, проверяемое для запроса"""
+    key: str
+    capacity: float
+    refill_per_second: float
+    cost: float = 1.0
+
+    def __post_init__(self):
+        # Ведро без пополнения никогда не истечет, а время ожидания в нем не определено
+        if self.refill_per_second <= 0:
+            raise ValueError(f"Bucket {self.key!r} must refill at a positive rate")
+        if self.capacity <= 0:
+            raise ValueError(f"Bucket {self.key!r} must have a positive capacity")
+
+
+@dataclass
+class RateLimitDecision:
+    """Результат атомарной проверки набора ведер"""
+    allowed: bool
+    tokens: List[float]  # Остаток в каждом ведре после проверки (пусто при штрафе)
+    retry_after: float = 0.0  # Секунды до момента, когда запрос пройдет
+    penalized: bool = False
+
+    def wait_times(self, buckets: List[BucketSpec]) -> List[float]:
+        """Ожидание по каждому ведру"""
+        if self.penalized or not self.tokens:
+            return [self.retry_after] * len(buckets)
+        return [
+            max(0.0, (bucket.cost - tokens) / bucket.refill_per_second) if tokens < bucket.cost else 0.0
+            for bucket, tokens in zip(buckets, self.tokens)
+        ]
+
+
+# KEYS[1] - ключ штрафа ('' - без штрафа), KEYS[2..] - ведра
+# ARGV: now_ms, penalty_ms, затем тройки capacity, refill_per_ms, cost
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local penalty_ms = tonumber(ARGV[2])
+if KEYS[1] ~= '' then
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl > 0 then
+        return {0, tostring(ttl)}
+    end
+end
+
+local n = #KEYS - 1
+local tokens = {}
+local allowed = 1
+for i = 1, n do
+    local base = 3 + (i - 1) * 3
+    local capacity = tonumber(ARGV[base])
+    local rate = tonumber(ARGV[base + 1])
+    local state = redis.call('HMGET', KEYS[i + 1], 't', 'ts')
+    local t = tonumber(state[1])
+    if t == nil then
+        t = capacity
+    else
+        t = math.min(capacity, t + math.max(0, now - tonumber(state[2])) * rate)
+    end
+    tokens[i] = t
+    if t < tonumber(ARGV[base + 2]) then
+        allowed = 0
+    end
+end
+
+local result = {allowed, '0'}
+for i = 1, n do
+    local base = 3 + (i - 1) * 3
+    local capacity = tonumber(ARGV[base])
+    local rate = tonumber(ARGV[base + 1])
+    local t = tokens[i]
+    if allowed == 1 then
+        t = t - tonumber(ARGV[base + 2])
+    end
+    redis.call('HSET', KEYS[i + 1], 't', tostring(t), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[i + 1], math.ceil((capacity - t) / rate) + 1000)
+    result[#result + 1] = tostring(t)
+end
+
+if allowed == 0 and penalty_ms > 0 and KEYS[1] ~= '' then
+    redis.call('SET', KEYS[1], '1', 'PX', penalty_ms)
+    result[2] = tostring(penalty_ms)
+end
+return result
+"""
+
+
+class LocalRateLimitBackend(LocalFallbackStore):
+    """Та же логика ведер в памяти процесса (fallback без Redis)"""
+
+    def __init__(self):
+        super().__init__()
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}  # key -> (tokens, ts_ms, expires_ms)
+        self._penalties: Dict[str, float] = {}  # key -> until_ms
+
+    def check(self, buckets: List[BucketSpec], penalty_key: str = "", penalty_seconds: float = 0.0) -> RateLimitDecision:
+        now = time.time() * 1000
+        with self._lock:
+            self._tick(now)
+
+            if penalty_key:
+                until = self._penalties.get(penalty_key, 0.0)
+                if until > now:
+                    return RateLimitDecision(False, [], (until - now) / 1000, penalized=True)
+
+            tokens = []
+            for bucket in buckets:
+                state = self._buckets.get(bucket.key)
+                if state is None or state[2] <= now:
+                    current = bucket.capacity
+                else:
+                    rate = bucket.refill_per_second / 1000
+                    current = min(bucket.capacity, state[0] + max(0.0, now - state[1]) * rate)
+                tokens.append(current)
+            allowed = all(current >= bucket.cost for current, bucket in zip(tokens, buckets))
+
+            for i, bucket in enumerate(buckets):
+                if allowed:
+                    tokens[i] -= bucket.cost
+                rate = bucket.refill_per_second / 1000
+                expires = now + math.ceil((bucket.capacity - tokens[i]) / rate) + 1000
+                self._buckets[bucket.key] = (tokens[i], now, expires)
+
+            retry_after = 0.0
+            if not allowed and penalty_key and penalty_seconds > 0:
+                self._penalties[penalty_key] = now + penalty_seconds * 1000
+                retry_after = penalty_seconds
+
+        decision = RateLimitDecision(allowed, tokens, retry_after, penalized=retry_after > 0)
+        if not allowed and not decision.penalized:
+            decision.retry_after = max(decision.wait_times(buckets), default=0.0)
+        return decision
+
+    def reset(self, keys: List[str]):
+        with self._lock:
+            for key in keys:
+                self._buckets.pop(key, None)
+                self._penalties.pop(key, None)
+
+    def cleanup(self) -> int:
+        with self._lock:
+            return self._sweep(time.time() * 1000)
+
+    def _sweep(self, now: float) -> int:
+        expired = [key for key, state in self._buckets.items() if state[2] <= now]
+        for key in expired:
+            del self._buckets[key]
+        for key in [key for key, until in self._penalties.items() if until <= now]:
+            del self._penalties[key]
+        return len(expired)
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+
+class RateLimitBackend:
+    """
+    Атомарная проверка ведер в Redis с локальным fallback
+
+    Если Redis недоступен, проверки идут в память процесса, а повторное
+    подключение пробуется не чаще раза в RATE_LIMIT_REDIS_RETRY секунд.
+    """
+
+    def __init__(self, redis_client=None, redis_url: Optional[str] = None, prefix: Optional[str] = None):
+        self.prefix = prefix or settings.RATE_LIMIT_KEY_PREFIX
+        self.local = LocalRateLimitBackend()
+        self.redis = RedisScriptClient(
+            {"bucket": TOKEN_BUCKET_SCRIPT},
+            name="Rate limits",
+            timeout=settings.RATE_LIMIT_REDIS_TIMEOUT,
+            retry_seconds=settings.RATE_LIMIT_REDIS_RETRY,
+            redis_client=redis_client,
+            redis_url=redis_url
+        )
+        self.redis_calls = 0
+        self.fallback_calls = 0
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}:{key}" if key else ""
+
+    def check(self, buckets: List[BucketSpec], penalty_key: str = "", penalty_seconds: float = 0.0) -> RateLimitDecision:
+        """Атомарно списывает cost во всех ведрах или не списывает нигде"""
+        scripts = self.redis.get_scripts()
+        if scripts is not None:
+            try:
+                decision = self._check_redis(scripts["bucket"], buckets, penalty_key, penalty_seconds)
+                self.redis_calls += 1
+                return decision
+            except Exception as e:
+                self.redis.disable(e)
+        self.fallback_calls += 1
+        return self.local.check(
+            [BucketSpec(self._key(b.key), b.capacity, b.refill_per_second, b.cost) for b in buckets],
+            self._key(penalty_key),
+            penalty_seconds
+        )
+
+    async def check_async(self, buckets: List[BucketSpec], penalty_key: str = "", penalty_seconds: float = 0.0) -> RateLimitDecision:
+        """check() для event loop: вызов Redis уходит в поток, локальные ведра проверяются сразу"""
+        if self.redis.get_scripts() is None:
+            self.fallback_calls += 1
+            return self.local.check(
+                [BucketSpec(self._key(b.key), b.capacity, b.refill_per_second, b.cost) for b in buckets],
+                self._key(penalty_key),
+                penalty_seconds
+            )
+        return await asyncio.to_thread(self.check, buckets, penalty_key, penalty_seconds)
+
+    def _check_redis(self, script, buckets: List[BucketSpec], penalty_key: str, penalty_seconds: float) -> RateLimitDecision:
+        keys = [self._key(penalty_key)] + [self._key(bucket.key) for bucket in buckets]
+        args = [int(time.time() * 1000), int(penalty_seconds * 1000)]
+        for bucket in buckets:
+            args.extend([bucket.capacity, bucket.refill_per_second / 1000, bucket.cost])
+        result = script(keys=keys, args=args)
+
+        allowed = int(result[0]) == 1
+        penalty_ms = float(result[1])
+        tokens = [float(value) for value in result[2:]]
+        if not tokens and buckets:
+            return RateLimitDecision(False, [], penalty_ms / 1000, penalized=True)
+
+        decision = RateLimitDecision(allowed, tokens)
+        if not allowed:
+            if penalty_ms > 0:
+                decision.retry_after = penalty_ms / 1000
+                decision.penalized = True
+            else:
+                decision.retry_after = max(decision.wait_times(buckets), default=0.0)
+        return decision
+
+    def peek(self, buckets: List[BucketSpec], penalty_key: str = "") -> RateLimitDecision:
+        """Текущее состояние ведер без списания"""
+        return self.check(
+            [BucketSpec(b.key, b.capacity, b.refill_per_second, 0.0) for b in buckets],
+            penalty_key
+        )
+
+    def reset(self, keys: List[str]):
+        """Сбрасывает ведра и штрафы"""
+        full_keys = [self._key(key) for key in keys if key]
+        self.local.reset(full_keys)
+        self.redis.delete(full_keys)
+
+    def cleanup(self) -> int:
+        """Очистка истекших локальных ведер (в Redis ключи истекают сами)"""
+        return self.local.cleanup()
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            "backend": "redis" if self.redis.active else "local",
+            "redis_calls": self.redis_calls,
+            "fallback_calls": self.fallback_calls,
+            "local_buckets": self.local.size()
+        }
+
+
+@process_singleton
+def get_rate_limit_backend() -> RateLimitBackend:
+    """Общий для процесса экземпляр хранилища лимитов"""
+    redis_url = settings.REDIS_URL if settings.RATE_LIMIT_BACKEND == "redis" else None
+    return RateLimitBackend(redis_url=redis_url)
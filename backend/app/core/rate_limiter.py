@@ -9,6 +9,8 @@ import logging
 from fastapi import HTTPException, status, Request
 from fastapi.responses import JSONResponse
 
+from .rate_limit_backend import BucketSpec, get_rate_limit_backend
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,13 +23,18 @@ class RateLimit:
 
 
 class RateLimiter:
-    """Система ограничения скорости запросов"""
+    """
+    Система ограничения скорости запросов
+    
+    Лимит - token bucket в общем хранилище (Redis), одинаковый для всех
+    воркеров: requests запросов за window плюс burst сверху. Исчерпавший
+    ведро IP или пользователь блокируется на BLOCK_SECONDS.
+    """
+    
+    BLOCK_SECONDS = 3600  # Блокировка на час
     
     def __init__(self):
-        # Хранилище для отслеживания запросов по IP
-        self.ip_requests: Dict[str, deque] = defaultdict(deque)
-        # Хранилище для отслеживания запросов по пользователю
-        self.user_requests: Dict[int, deque] = defaultdict(deque)
+        self.backend = get_rate_limit_backend()
         # Конфигурации лимитов (увеличены для разработки)
         self.limits = {
             "default": RateLimit(requests=1000, window=3600, burst=100),  # 1000 req/hour
@@ -35,50 +42,19 @@ class RateLimiter:
             "chat": RateLimit(requests=500, window=3600, burst=50),       # 500 chat req/hour
             "api": RateLimit(requests=10000, window=3600, burst=500),     # 10000 API req/hour
         }
-        # Блокированные IP
-        self.blocked_ips: Dict[str, float] = {}
-        # Блокированные пользователи
-        self.blocked_users: Dict[int, float] = {}
-        
-    def _cleanup_old_requests(self, requests_queue: deque, window: int):
-        """Очистка старых запросов из очереди"""
-        current_time = time.time()
-        while requests_queue and requests_queue[0] < current_time - window:
-            requests_queue.popleft()
     
-    def _is_rate_limited(
-        self, 
-        requests_queue: deque, 
-        limit: RateLimit
-    ) -> Tuple[bool, int, int]:
-        """
-        Проверка превышения лимита
-        
-        Returns:
-            (is_limited, remaining_requests, reset_time)
-        """
-        current_time = time.time()
-        
-        # Очищаем старые запросы
-        self._cleanup_old_requests(requests_queue, limit.window)
-        
-        # Проверяем лимит
-        if len(requests_queue) >= limit.requests:
-            # Проверяем burst
-            if len(requests_queue) >= limit.requests + limit.burst:
-                return True, 0, int(requests_queue[0] + limit.window)
-            else:
-                # В режиме burst - разрешаем, но с предупреждением
-                pass
-        
-        # Добавляем текущий запрос
-        requests_queue.append(current_time)
-        
-        # Вычисляем оставшиеся запросы
-        remaining = max(0, limit.requests - len(requests_queue))
-        reset_time = int(current_time + limit.window)
-        
-        return False, remaining, reset_time
+    def _bucket(self, identifier: str, limit_type: str, limit: RateLimit, is_user: bool) -> BucketSpec:
+        """Ведро идентификатора (IP или пользователя) для типа лимита"""
+        kind = "user" if is_user else "ip"
+        return BucketSpec(
+            key=f"req:{kind}:{identifier}:{limit_type}",
+            capacity=limit.requests + limit.burst,
+            refill_per_second=limit.requests / limit.window
+        )
+    
+    def _block_key(self, identifier: str, is_user: bool) -> str:
+        """Ключ блокировки - общий для всех типов лимитов идентификатора"""
+        return f"req:block:{'user' if is_user else 'ip'}:{identifier}"
     
     def check_rate_limit(
         self, 
@@ -98,40 +74,35 @@ class RateLimiter:
             (is_limited, remaining_requests, reset_time)
         """
         limit = self.limits.get(limit_type, self.limits["default"])
+        bucket = self._bucket(identifier, limit_type, limit, is_user)
+        decision = self.backend.check([bucket], self._block_key(identifier, is_user), self.BLOCK_SECONDS)
+        return self._result(decision, identifier, limit, is_user)
+    
+    async def check_rate_limit_async(
+        self, 
+        identifier: str, 
+        limit_type: str = "default",
+        is_user: bool = False
+    ) -> Tuple[bool, int, int]:
+        """check_rate_limit() для async-обработчиков: вызов Redis не блокирует event loop"""
+        limit = self.limits.get(limit_type, self.limits["default"])
+        bucket = self._bucket(identifier, limit_type, limit, is_user)
+        decision = await self.backend.check_async(
+            [bucket], self._block_key(identifier, is_user), self.BLOCK_SECONDS
+        )
+        return self._result(decision, identifier, limit, is_user)
+    
+    def _result(self, decision, identifier: str, limit: RateLimit, is_user: bool) -> Tuple[bool, int, int]:
+        """(is_limited, remaining_requests, reset_time) из решения хранилища"""
+        current_time = time.time()
         
-        if is_user:
-            user_id = int(identifier)
-            # Проверяем блокировку пользователя
-            if user_id in self.blocked_users:
-                if time.time() < self.blocked_users[user_id]:
-                    return True, 0, int(self.blocked_users[user_id])
-                else:
-                    del self.blocked_users[user_id]
-            
-            requests_queue = self.user_requests[user_id]
-        else:
-            # Проверяем блокировку IP
-            if identifier in self.blocked_ips:
-                if time.time() < self.blocked_ips[identifier]:
-                    return True, 0, int(self.blocked_ips[identifier])
-                else:
-                    del self.blocked_ips[identifier]
-            
-            requests_queue = self.ip_requests[identifier]
-        
-        is_limited, remaining, reset_time = self._is_rate_limited(requests_queue, limit)
-        
-        # Если превышен лимит + burst, блокируем на час
-        if is_limited and len(requests_queue) > limit.requests + limit.burst:
-            block_until = time.time() + 3600  # Блокировка на час
-            if is_user:
-                self.blocked_users[int(identifier)] = block_until
-            else:
-                self.blocked_ips[identifier] = block_until
-            
+        if not decision.allowed:
             logger.warning(f"Rate limit exceeded for {'user' if is_user else 'IP'} {identifier}")
+            return True, 0, int(current_time + decision.retry_after)
         
-        return is_limited, remaining, reset_time
+        # Burst сверх лимита разрешаем, но в оставшихся запросах не показываем
+        remaining = max(0, int(decision.tokens[0]) - limit.burst)
+        return False, remaining, int(current_time + limit.window)
     
     def get_rate_limit_info(
         self, 
@@ -141,38 +112,31 @@ class RateLimiter:
     ) -> Dict[str, any]:
         """Получение информации о текущих лимитах"""
         limit = self.limits.get(limit_type, self.limits["default"])
-        
-        if is_user:
-            requests_queue = self.user_requests.get(int(identifier), deque())
-        else:
-            requests_queue = self.ip_requests.get(identifier, deque())
-        
-        self._cleanup_old_requests(requests_queue, limit.window)
+        decision = self.backend.peek(
+            [self._bucket(identifier, limit_type, limit, is_user)],
+            self._block_key(identifier, is_user)
+        )
+        remaining = int(decision.tokens[0]) if decision.tokens else 0
         
         return {
             "limit": limit.requests,
-            "remaining": max(0, limit.requests - len(requests_queue)),
+            "remaining": max(0, remaining - limit.burst),
             "reset_time": int(time.time() + limit.window),
             "window": limit.window,
             "burst": limit.burst
         }
     
     def reset_rate_limit(self, identifier: str, is_user: bool = False):
-        """Сброс лимитов для идентификатора"""
-        if is_user:
-            user_id = int(identifier)
-            if user_id in self.user_requests:
-                del self.user_requests[user_id]
-            if user_id in self.blocked_users:
-                del self.blocked_users[user_id]
-        else:
-            if identifier in self.ip_requests:
-                del self.ip_requests[identifier]
-            if identifier in self.blocked_ips:
-                del self.blocked_ips[identifier]
+        """Сброс лимитов и блокировки для идентификатора"""
+        self.backend.reset([
+            self._bucket(identifier, limit_type, limit, is_user).key
+            for limit_type, limit in self.limits.items()
+        ] + [self._block_key(identifier, is_user)])
     
     def update_limit_config(self, limit_type: str, requests: int, window: int, burst: int):
         """Обновление конфигурации лимитов"""
+        if requests <= 0 or window <= 0:
+            raise ValueError("requests and window must be positive")
         self.limits[limit_type] = RateLimit(requests=requests, window=window, burst=burst)
         logger.info(f"Updated rate limit config for {limit_type}: {requests} requests per {window}s")
 
@@ -189,7 +153,7 @@ def rate_limit_middleware(limit_type: str = "default"):
             client_ip = request.client.host if request.client else "unknown"
             
             # Проверяем лимит по IP
-            is_limited, remaining, reset_time = rate_limiter.check_rate_limit(
+            is_limited, remaining, reset_time = await rate_limiter.check_rate_limit_async(
                 client_ip, limit_type, is_user=False
             )
             
@@ -236,7 +200,7 @@ def user_rate_limit(limit_type: str = "default"):
             
             if current_user:
                 user_id = str(current_user.id)
-                is_limited, remaining, reset_time = rate_limiter.check_rate_limit(
+                is_limited, remaining, reset_time = await rate_limiter.check_rate_limit_async(
                     user_id, limit_type, is_user=True
                 )
                 
@@ -0,0 +1,141 @@
+"""
+Общая основа хранилищ на Lua-скриптах Redis с локальным fallback
+
+RedisScriptClient лениво подключается к Redis, регистрирует набор скриптов
+и после сбоя уходит в паузу, в течение которой вызывающий код работает со
+своим хранилищем в памяти процесса. LocalFallbackStore - основа такого
+хранилища с периодической очисткой истекших ключей. Используется лимитами
+запросов (rate_limit_backend) и квотами подписок (quota_backend).
+"""
+
+import abc
+import functools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:  # pragma: no cover - redis есть в requirements
+    redis = None
+    REDIS_AVAILABLE = False
+
+T = TypeVar("T")
+
+
+class RedisScriptClient:
+    """
+    Подключение к Redis с набором зарегистрированных Lua-скриптов
+
+    Если Redis недоступен или вызов упал, get_scripts() возвращает None, а
+    повторное подключение пробуется не чаще раза в retry_seconds секунд.
+    Без клиента и URL Redis не используется вовсе.
+    """
+
+    def __init__(
+        self,
+        scripts: Dict[str, str],
+        name: str,
+        timeout: float,
+        retry_seconds: float,
+        redis_client=None,
+        redis_url: Optional[str] = None
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.client = redis_client
+        self._sources = scripts
+        self._redis_url = redis_url
+        self._scripts: Optional[Dict[str, Any]] = None
+        self._disabled_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        """Скрипты зарегистрированы и Redis сейчас используется"""
+        return self._scripts is not None
+
+    def get_scripts(self) -> Optional[Dict[str, Any]]:
+        """Зарегистрированные скрипты или None, если работаем локально"""
+        if self._scripts is not None:
+            return self._scripts
+        if time.monotonic() < self._disabled_until:
+            return None
+        with self._lock:
+            if self._scripts is not None:
+                return self._scripts
+            try:
+                if self.client is None:
+                    if not REDIS_AVAILABLE or not self._redis_url:
+                        self._disabled_until = float("inf")
+                        return None
+                    self.client = redis.Redis.from_url(
+                        self._redis_url,
+                        socket_connect_timeout=self.timeout,
+                        socket_timeout=self.timeout
+                    )
+                self.client.ping()
+                self._scripts = {
+                    key: self.client.register_script(source)
+                    for key, source in self._sources.items()
+                }
+                logger.info(f"🔗 {self.name} use shared Redis")
+            except Exception as e:
+                self.disable(e)
+        return self._scripts
+
+    def disable(self, error: Exception):
+        """Переходит на локальное хранилище до следующей попытки подключения"""
+        self._scripts = None
+        self._disabled_until = time.monotonic() + self.retry_seconds
+        logger.warning(f"⚠️ Redis for {self.name} unavailable ({error}), using in-process fallback")
+
+    def delete(self, keys):
+        """Удаляет ключи в Redis, если он сейчас используется"""
+        if self._scripts is None or not keys:
+            return
+        try:
+            self.client.delete(*keys)
+        except Exception as e:
+            self.disable(e)
+
+
+class LocalFallbackStore(abc.ABC):
+    """Основа хранилища в памяти процесса с периодической очисткой истекших ключей"""
+
+    SWEEP_EVERY = 10000  # Операций между очистками истекших ключей
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def _tick(self, now: float):
+        """Считает операцию и время от времени чистит хранилище (под self._lock)"""
+        self._calls += 1
+        if self._calls % self.SWEEP_EVERY == 0:
+            self._sweep(now)
+
+    @abc.abstractmethod
+    def _sweep(self, now: float) -> int:
+        """Удаляет истекшие ключи (под self._lock) и возвращает их число"""
+
+
+def process_singleton(factory: Callable[[], T]) -> Callable[[], T]:
+    """Декоратор фабрики: потокобезопасный ленивый экземпляр на процесс"""
+    instance: Dict[str, T] = {}
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get() -> T:
+        if "value" not in instance:
+            with lock:
+                if "value" not in instance:
+                    instance["value"] = factory()
+        return instance["value"]
+
+    return get
@@ -1,12 +1,18 @@
 import logging
+import threading
 from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from enum import Enum
 import json
 
+from .config import settings
+from .quota_backend import QuotaCounter, get_quota_store
+
 logger = logging.getLogger(__name__)
 
+USAGE_PERIODS = ("daily", "monthly", "yearly")
+
 class SubscriptionTier(Enum):
     """Уровни подписки"""
     FREE = "free"
@@ -59,13 +65,47 @@ class UserSubscription:
     trial_end_date: Optional[datetime] = None
     usage_stats: Dict[FeatureType, int] = None
 
+@dataclass
+class QuotaLease:
+    """Блок квоты, заранее списанный в общем счетчике и расходуемый локально"""
+    period: str
+    period_key: str
+    remaining: int
+
+def _period_window(period: str, now: datetime) -> Tuple[str, datetime]:
+    """Ключ периода и момент его окончания"""
+    if period == "daily":
+        return now.strftime("%Y-%m-%d"), datetime(now.year, now.month, now.day) + timedelta(days=1)
+    if period == "monthly":
+        if now.month == 12:
+            return now.strftime("%Y-%m"), datetime(now.year + 1, 1, 1)
+        return now.strftime("%Y-%m"), datetime(now.year, now.month + 1, 1)
+    return now.strftime("%Y"), datetime(now.year + 1, 1, 1)
+
 class SubscriptionManager:
-    """Менеджер подписок и ограничений"""
+    """
+    Менеджер подписок и ограничений
+    
+    Использование функций считается в общих счетчиках с ключом периода
+    (quota_backend): проверка лимита и увеличение выполняются атомарно, так что
+    лимит соблюдается при любом числе воркеров, а счетчики прошлых периодов
+    просто истекают. Для частых функций (QUOTA_LEASE_FEATURES) квота берется
+    из счетчика блоками и расходуется локально.
+    """
+    
+    COUNTER_GRACE_SECONDS = 3600  # Счетчик живет на час дольше периода (расхождение часов воркеров)
+    LEASE_SWEEP_EVERY = 1000  # Выборок блоков между очистками блоков прошлых периодов
     
     def __init__(self):
         self.plans = self._initialize_plans()
         self.user_subscriptions: Dict[int, UserSubscription] = {}
-        self.usage_tracking: Dict[int, Dict[FeatureType, Dict[str, int]]] = {}
+        self.quota_store = get_quota_store()
+        self.lease_features = {
+            feature.strip() for feature in settings.QUOTA_LEASE_FEATURES.split(",") if feature.strip()
+        }
+        self._leases: Dict[Tuple[int, FeatureType], QuotaLease] = {}
+        self._lease_lock = threading.Lock()
+        self._lease_fetches = 0
     
     def _initialize_plans(self) -> Dict[SubscriptionTier, SubscriptionPlan]:
         """Инициализация планов подписки"""
@@ -194,10 +234,6 @@ class SubscriptionManager:
         )
         
         self.user_subscriptions[user_id] = subscription
-        self.usage_tracking[user_id] = {
-            feature: {"daily": 0, "monthly": 0, "yearly": 0}
-            for feature in plan.features.keys()
-        }
         
         logger.info(f"Created subscription for user {user_id}: {tier.value}")
         return subscription
@@ -206,8 +242,8 @@ class SubscriptionManager:
         """Получение подписки пользователя"""
         return self.user_subscriptions.get(user_id)
     
-    def check_feature_access(self, user_id: int, feature_type: FeatureType) -> Tuple[bool, str]:
-        """Проверка доступа к функции"""
+    def _resolve_feature_limit(self, user_id: int, feature_type: FeatureType) -> Tuple[Optional[FeatureLimit], str]:
+        """Лимит функции по подписке пользователя; None, если доступа нет"""
         subscription = self.get_user_subscription(user_id)
         if not subscription:
             # Создаем бесплатную подписку
@@ -215,26 +251,62 @@ class SubscriptionManager:
         
         # Проверяем активность подписки
         if not subscription.is_active:
-            return False, "Подписка неактивна"
+            return None, "Подписка неактивна"
         
         # Проверяем срок действия
         if datetime.now() > subscription.end_date:
-            return False, "Подписка истекла"
+            return None, "Подписка истекла"
         
         # Проверяем триал
         if subscription.trial_end_date and datetime.now() > subscription.trial_end_date:
             if subscription.plan.tier == SubscriptionTier.FREE:
-                return False, "Триал истек"
+                return None, "Триал истек"
         
         # Получаем лимит функции
         feature_limit = subscription.plan.features.get(feature_type)
         if not feature_limit:
-            return False, "Функция недоступна в вашем тарифе"
+            return None, "Функция недоступна в вашем тарифе"
+        
+        return feature_limit, "Доступ разрешен"
+    
+    def _counters(
+        self,
+        user_id: int,
+        feature_type: FeatureType,
+        feature_limit: Optional[FeatureLimit] = None,
+        now: Optional[datetime] = None
+    ) -> List[QuotaCounter]:
+        """Счетчики всех периодов; лимит проверяется только для периода тарифа"""
+        now = now or datetime.now()
+        counters = []
+        for period in USAGE_PERIODS:
+            period_key, period_end = _period_window(period, now)
+            limit = -1
+            if feature_limit is not None and feature_limit.period == period:
+                limit = feature_limit.limit
+            counters.append(QuotaCounter(
+                key=f"{user_id}:{feature_type.value}:{period_key}",
+                limit=limit,
+                ttl_seconds=int((period_end - now).total_seconds()) + self.COUNTER_GRACE_SECONDS
+            ))
+        return counters
+    
+    def _usage_key(self, user_id: int, feature_type: FeatureType, period: str) -> str:
+        return f"{user_id}:{feature_type.value}:{_period_window(period, datetime.now())[0]}"
+    
+    def check_feature_access(self, user_id: int, feature_type: FeatureType) -> Tuple[bool, str]:
+        """Проверка доступа к функции (без списания)"""
+        feature_limit, message = self._resolve_feature_limit(user_id, feature_type)
+        if feature_limit is None:
+            return False, message
         
         # Проверяем лимит
         if feature_limit.limit == -1:  # безлимит
             return True, "Доступ разрешен"
         
+        if self._lease_remaining(user_id, feature_type, feature_limit.period) > 0:
+            return True, "Доступ разрешен"
+        
         # Получаем текущее использование
         current_usage = self.get_feature_usage(user_id, feature_type, feature_limit.period)
         
@@ -243,33 +315,119 @@ class SubscriptionManager:
         
         return True, "Доступ разрешен"
     
-    def increment_feature_usage(self, user_id: int, feature_type: FeatureType, amount: int = 1):
-        """Увеличение счетчика использования функции"""
-        if user_id not in self.usage_tracking:
-            self.usage_tracking[user_id] = {}
+    def consume_feature(self, user_id: int, feature_type: FeatureType, amount: int = 1) -> Tuple[bool, str]:
+        """Атомарная проверка лимита и списание использования функции"""
+        feature_limit, message = self._resolve_feature_limit(user_id, feature_type)
+        if feature_limit is None:
+            return False, message
+        
+        if feature_limit.limit == -1:  # безлимит
+            self.increment_feature_usage(user_id, feature_type, amount)
+            return True, "Доступ разрешен"
+        
+        if feature_type.value in self.lease_features and amount <= settings.QUOTA_LEASE_SIZE:
+            allowed = self._consume_from_lease(user_id, feature_type, feature_limit, amount)
+            usage = None
+        else:
+            decision = self.quota_store.consume(self._counters(user_id, feature_type, feature_limit), amount)
+            allowed = decision.allowed
+            usage = decision.usage[USAGE_PERIODS.index(feature_limit.period)]
+        
+        if not allowed:
+            if usage is None:
+                usage = self.get_feature_usage(user_id, feature_type, feature_limit.period)
+            return False, f"Превышен лимит использования ({usage}/{feature_limit.limit})"
+        
+        self._record_usage_stats(user_id, feature_type, amount)
+        return True, "Доступ разрешен"
+    
+    def _consume_from_lease(
+        self,
+        user_id: int,
+        feature_type: FeatureType,
+        feature_limit: FeatureLimit,
+        amount: int
+    ) -> bool:
+        """Списание из локального блока; при нехватке из общего счетчика берется новый блок"""
+        lease_key = (user_id, feature_type)
+        now = datetime.now()
+        period_key = _period_window(feature_limit.period, now)[0]
         
-        if feature_type not in self.usage_tracking[user_id]:
-            self.usage_tracking[user_id][feature_type] = {"daily": 0, "monthly": 0, "yearly": 0}
+        with self._lease_lock:
+            lease = self._leases.get(lease_key)
+            if lease is not None and lease.period_key == period_key and lease.remaining >= amount:
+                lease.remaining -= amount
+                return True
         
-        # Увеличиваем счетчики
-        self.usage_tracking[user_id][feature_type]["daily"] += amount
-        self.usage_tracking[user_id][feature_type]["monthly"] += amount
-        self.usage_tracking[user_id][feature_type]["yearly"] += amount
+        # Блок не больше доли остатка лимита, чтобы воркеры не разбирали его целиком
+        decision = self.quota_store.consume(
+            self._counters(user_id, feature_type, feature_limit, now),
+            amount,
+            want=amount + settings.QUOTA_LEASE_SIZE,
+            share=settings.QUOTA_LEASE_SHARE
+        )
+        if not decision.allowed:
+            return False
         
+        with self._lease_lock:
+            lease = self._leases.get(lease_key)
+            if lease is None or lease.period_key != period_key:
+                # Остаток блока прошлого периода не возвращаем: его счетчик уже не действует
+                lease = QuotaLease(feature_limit.period, period_key, 0)
+                self._leases[lease_key] = lease
+            lease.remaining += decision.granted - amount
+            
+            self._lease_fetches += 1
+            if self._lease_fetches % self.LEASE_SWEEP_EVERY == 0:
+                self._sweep_leases(now)
+        return True
+    
+    def _lease_remaining(self, user_id: int, feature_type: FeatureType, period: str) -> int:
+        with self._lease_lock:
+            lease = self._leases.get((user_id, feature_type))
+            if lease is None or lease.period_key != _period_window(period, datetime.now())[0]:
+                return 0
+            return lease.remaining
+    
+    def _sweep_leases(self, now: datetime):
+        stale = [
+            key for key, lease in self._leases.items()
+            if lease.remaining <= 0 or lease.period_key != _period_window(lease.period, now)[0]
+        ]
+        for key in stale:
+            del self._leases[key]
+    
+    def release_leases(self):
+        """Возврат неизрасходованных блоков в общие счетчики (при остановке приложения)"""
+        now = datetime.now()
+        with self._lease_lock:
+            leases = list(self._leases.items())
+            self._leases.clear()
+        for (user_id, feature_type), lease in leases:
+            if lease.remaining > 0 and lease.period_key == _period_window(lease.period, now)[0]:
+                try:
+                    self.quota_store.release(self._counters(user_id, feature_type, now=now), lease.remaining)
+                except Exception as e:
+                    logger.warning(f"Failed to release quota lease for user {user_id}: {e}")
+    
+    def increment_feature_usage(self, user_id: int, feature_type: FeatureType, amount: int = 1):
+        """Увеличение счетчика использования функции (без проверки лимита)"""
+        self.quota_store.consume(self._counters(user_id, feature_type), amount)
+        self._record_usage_stats(user_id, feature_type, amount)
+    
+    def _record_usage_stats(self, user_id: int, feature_type: FeatureType, amount: int):
         # Обновляем статистику в подписке
         subscription = self.get_user_subscription(user_id)
         if subscription and feature_type in subscription.usage_stats:
             subscription.usage_stats[feature_type] += amount
     
     def get_feature_usage(self, user_id: int, feature_type: FeatureType, period: str) -> int:
-        """Получение текущего использования функции"""
-        if user_id not in self.usage_tracking:
-            return 0
-        
-        if feature_type not in self.usage_tracking[user_id]:
-            return 0
+        """
+        Получение текущего использования функции
         
-        return self.usage_tracking[user_id][feature_type].get(period, 0)
+        Включает блоки, выбранные воркерами для локального расхода.
+        """
+        return self.quota_store.peek([self._usage_key(user_id, feature_type, period)])[0]
     
     def get_usage_summary(self, user_id: int) -> Dict[str, Any]:
         """Получение сводки по использованию"""
@@ -288,9 +446,13 @@ class SubscriptionManager:
             "features": {}
         }
         
-        for feature_type, limit in subscription.plan.features.items():
-            current_usage = self.get_feature_usage(user_id, feature_type, limit.period)
-            
+        # Все счетчики одним запросом
+        features = list(subscription.plan.features.items())
+        usage = self.quota_store.peek([
+            self._usage_key(user_id, feature_type, limit.period) for feature_type, limit in features
+        ])
+        
+        for (feature_type, limit), current_usage in zip(features, usage):
             usage_summary["features"][feature_type.value] = {
                 "limit": limit.limit,
                 "current_usage": current_usage,
@@ -344,16 +506,10 @@ class SubscriptionManager:
             return False
     
     def reset_daily_usage(self):
-        """Сброс ежедневного использования (вызывается по расписанию)"""
-        for user_id in self.usage_tracking:
-            for feature_type in self.usage_tracking[user_id]:
-                self.usage_tracking[user_id][feature_type]["daily"] = 0
+        """Сброс ежедневного использования (счетчики с ключом дня истекают сами, оставлено для расписания)"""
     
     def reset_monthly_usage(self):
-        """Сброс месячного использования (вызывается по расписанию)"""
-        for user_id in self.usage_tracking:
-            for feature_type in self.usage_tracking[user_id]:
-                self.usage_tracking[user_id][feature_type]["monthly"] = 0
+        """Сброс месячного использования (счетчики с ключом месяца истекают сами, оставлено для расписания)"""
     
     def get_subscription_stats(self) -> Dict[str, Any]:
         """Получение статистики подписок"""
@@ -4,10 +4,21 @@ import json
 import hmac
 import hashlib
 import logging
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+import random
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Any, Optional, Set, Tuple
+from datetime import datetime, timedelta
 from dataclasses import dataclass
 from enum import Enum
+from urllib.parse import urlsplit
+
+from sqlalchemy import func, insert, or_, update
+
+from .config import settings
+from .database import SessionLocal
+from ..models.notification import OutboxStatus, WebhookDelivery
+from ..services.external_notification_service import shared_http_session
 
 logger = logging.getLogger(__name__)
 
@@ -48,140 +59,415 @@ class WebhookSubscription:
     failure_count: int = 0
 
 class WebhookManager:
-    """Менеджер webhook уведомлений"""
+    """
+    Менеджер webhook уведомлений
+
+    События сохраняются в таблицу webhook_deliveries (очередь переживает
+    перезапуск). Диспетчер забирает готовые строки и раздает их пулу воркеров
+    с ограничением параллельных запросов на каждый endpoint: медленный
+    получатель занимает только свои слоты. Повторы не ждут в воркере -
+    строка возвращается в очередь с next_attempt_at (экспоненциальная
+    задержка), и диспетчер заберет ее, когда она станет готовой. Забранные
+    строки арендуются (claimed_at): в очередь возвращаются только доставки с
+    истекшей арендой, брошенные упавшим процессом.
+    """
     
     def __init__(self):
         self.subscriptions: Dict[str, WebhookSubscription] = {}
-        self.event_queue: asyncio.Queue = asyncio.Queue()
-        self.max_retries = 3
-        self.retry_delay = 5  # секунды
-        self.timeout = 10  # секунды
+        # Индексы подписок: (user_id, event_type) -> подписки и user_id -> подписки
+        self._index: Dict[Tuple[int, WebhookEventType], Dict[str, WebhookSubscription]] = defaultdict(dict)
+        self._user_index: Dict[int, Dict[str, WebhookSubscription]] = defaultdict(dict)
+        self._removed: Set[str] = set()
+        
+        self.enabled = settings.WEBHOOK_DELIVERY_ENABLED
+        self.workers = settings.WEBHOOK_WORKERS
+        self.endpoint_concurrency = settings.WEBHOOK_ENDPOINT_CONCURRENCY
+        self.batch_size = settings.WEBHOOK_BATCH_SIZE
+        self.poll_interval = settings.WEBHOOK_POLL_INTERVAL
+        self.max_retries = settings.WEBHOOK_MAX_ATTEMPTS
+        self.retry_delay = settings.WEBHOOK_RETRY_BASE_DELAY  # секунды
+        self.retry_max_delay = settings.WEBHOOK_RETRY_MAX_DELAY
+        self.timeout = settings.WEBHOOK_TIMEOUT  # секунды
+        self.lease_seconds = settings.WEBHOOK_LEASE_SECONDS
+        
+        self._running = False
+        self._ready: Optional[asyncio.Queue] = None
+        self._waiting: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)  # Сверх лимита endpoint
+        self._inflight: Dict[str, int] = defaultdict(int)
+        self._outcomes: List[Dict[str, Any]] = []
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._next_requeue = 0.0
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
         
     def add_subscription(self, subscription: WebhookSubscription):
         """Добавление webhook подписки"""
+        if subscription.id in self.subscriptions:
+            self._unindex(self.subscriptions[subscription.id])
         self.subscriptions[subscription.id] = subscription
+        self._removed.discard(subscription.id)
+        self._reindex(subscription)
         logger.info(f"Added webhook subscription: {subscription.id}")
     
+    def update_subscription(
+        self,
+        subscription: WebhookSubscription,
+        url: str,
+        events: List[WebhookEventType],
+        secret: Optional[str]
+    ):
+        """Изменение подписки с обновлением индекса"""
+        self._unindex(subscription)
+        subscription.url = url
+        subscription.events = events
+        subscription.secret = secret
+        subscription.failure_count = 0
+        self._reindex(subscription)
+    
     def remove_subscription(self, subscription_id: str):
         """Удаление webhook подписки"""
         if subscription_id in self.subscriptions:
-            del self.subscriptions[subscription_id]
+            self._unindex(self.subscriptions.pop(subscription_id))
+            # Уже поставленные в очередь доставки этой подписке не отправляются
+            self._removed.add(subscription_id)
             logger.info(f"Removed webhook subscription: {subscription_id}")
     
+    def _reindex(self, subscription: WebhookSubscription):
+        self._user_index[subscription.user_id][subscription.id] = subscription
+        for event_type in subscription.events:
+            self._index[(subscription.user_id, event_type)][subscription.id] = subscription
+    
+    def _unindex(self, subscription: WebhookSubscription):
+        user_subs = self._user_index.get(subscription.user_id)
+        if user_subs is not None:
+            user_subs.pop(subscription.id, None)
+            if not user_subs:
+                del self._user_index[subscription.user_id]
+        for event_type in subscription.events:
+            key = (subscription.user_id, event_type)
+            subs = self._index.get(key)
+            if subs is not None:
+                subs.pop(subscription.id, None)
+                if not subs:
+                    del self._index[key]
+    
     def get_user_subscriptions(self, user_id: int) -> List[WebhookSubscription]:
         """Получение подписок пользователя"""
-        return [
-            sub for sub in self.subscriptions.values()
-            if sub.user_id == user_id and sub.is_active
-        ]
+        return [sub for sub in self._user_index.get(user_id, {}).values() if sub.is_active]
     
     async def trigger_event(self, event: WebhookEvent):
-        """Триггер webhook события"""
+        """Триггер webhook события: доставки сохраняются в очередь"""
         logger.info(f"Triggering webhook event: {event.event_type.value}")
         
-        # Находим подходящие подписки
         matching_subscriptions = [
-            sub for sub in self.subscriptions.values()
-            if (sub.is_active and 
-                event.event_type in sub.events and
-                sub.user_id == event.user_id)
+            sub for sub in self._index.get((event.user_id, event.event_type), {}).values()
+            if sub.is_active
         ]
         
         if not matching_subscriptions:
             logger.info(f"No matching subscriptions for event: {event.event_type.value}")
             return
         
-        # Отправляем события в очередь
-        for subscription in matching_subscriptions:
-            await self.event_queue.put((event, subscription))
-    
-    async def process_webhook_queue(self):
-        """Обработка очереди webhook событий"""
-        logger.info("Starting webhook queue processor")
+        payload = {
+            "event_type": event.event_type.value,
+            "data": event.data,
+            "timestamp": event.timestamp.isoformat(),
+            "event_id": event.event_id
+        }
+        # Подписывается ровно то тело, которое будет отправлено
+        body = json.dumps(payload, sort_keys=True, default=str)
+        rows = [self._build_delivery(event, subscription, body) for subscription in matching_subscriptions]
         
-        while True:
+        await asyncio.to_thread(self._enqueue, rows)
+        self._wakeup.set()
+    
+    def _build_delivery(self, event: WebhookEvent, subscription: WebhookSubscription, body: str) -> Dict[str, Any]:
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "AI-Lawyer-Webhook/1.0.0"
+        }
+        if subscription.secret:
+            headers["X-Webhook-Signature"] = f"sha256={self._create_signature(body, subscription.secret)}"
+        return {
+            "event_id": event.event_id,
+            "event_type": event.event_type.value,
+            "subscription_id": subscription.id,
+            "user_id": subscription.user_id,
+            "url": subscription.url,
+            "endpoint": (urlsplit(subscription.url).netloc or subscription.url)[:255].lower(),
+            "body": body,
+            "headers": headers,
+            "status": OutboxStatus.PENDING,
+            "attempts": 0,
+            "max_attempts": self.max_retries,
+            "next_attempt_at": datetime.utcnow()
+        }
+    
+    def _enqueue(self, rows: List[Dict[str, Any]]):
+        db = SessionLocal()
+        try:
+            db.execute(insert(WebhookDelivery), rows)
+            db.commit()
+        finally:
+            db.close()
+    
+    async def start(self):
+        """Запуск диспетчера и пула воркеров доставки"""
+        if self._running or not self.enabled:
+            return
+        await asyncio.to_thread(self._requeue_interrupted)
+        self._next_requeue = time.monotonic() + self.lease_seconds / 2
+        self._running = True
+        self._ready = asyncio.Queue()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        self._worker_tasks = [asyncio.create_task(self._worker_loop()) for _ in range(self.workers)]
+        logger.info(f"🪝 Webhook delivery started ({self.workers} workers)")
+    
+    async def stop(self):
+        """Остановка доставки; незавершенные строки вернутся в очередь по истечении аренды"""
+        if not self._running:
+            return
+        self._running = False
+        tasks = [self._dispatcher] + self._worker_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._worker_tasks = []
+        await self._flush_outcomes()
+        self._waiting.clear()
+        self._inflight.clear()
+        logger.info("🪝 Webhook delivery stopped")
+    
+    def _requeue_interrupted(self):
+        """Доставки, застрявшие в sending после падения процесса (аренда истекла), возвращаются в очередь"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        db = SessionLocal()
+        try:
+            count = db.query(WebhookDelivery).filter(
+                WebhookDelivery.status == OutboxStatus.SENDING,
+                or_(WebhookDelivery.claimed_at.is_(None), WebhookDelivery.claimed_at < cutoff)
+            ).update({
+                WebhookDelivery.status: OutboxStatus.PENDING,
+                WebhookDelivery.claimed_at: None
+            }, synchronize_session=False)
+            db.commit()
+            if count:
+                logger.info(f"🪝 Requeued {count} interrupted webhook deliveries")
+        finally:
+            db.close()
+    
+    async def _dispatch_loop(self):
+        while self._running:
+            claimed = 0
             try:
-                # Получаем событие из очереди
-                event, subscription = await self.event_queue.get()
-                
-                # Отправляем webhook
-                await self._send_webhook(event, subscription)
-                
-                # Отмечаем задачу как выполненную
-                self.event_queue.task_done()
-                
+                await self._flush_outcomes()
+                # Доставки упавших процессов подбираются без перезапуска
+                if time.monotonic() >= self._next_requeue:
+                    self._next_requeue = time.monotonic() + self.lease_seconds / 2
+                    await asyncio.to_thread(self._requeue_interrupted)
+                limit = self.batch_size - self._backlog()
+                if limit > 0:
+                    items = await asyncio.to_thread(self._claim_batch, limit, self._saturated_endpoints())
+                    for item in items:
+                        self._schedule(item)
+                    claimed = len(items)
+                    if claimed == limit:
+                        continue
             except Exception as e:
-                logger.error(f"Error processing webhook queue: {str(e)}")
-                await asyncio.sleep(1)
+                logger.error(f"❌ Webhook dispatch error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _backlog(self) -> int:
+        """Доставки, забранные из БД и еще не завершенные"""
+        return sum(self._inflight.values()) + sum(len(queue) for queue in self._waiting.values())
+    
+    def _saturated_endpoints(self) -> List[str]:
+        """Endpoint'ы, для которых в памяти уже достаточно работы - их строки не забираем"""
+        limit = self.endpoint_concurrency * 2
+        return [
+            endpoint for endpoint, inflight in self._inflight.items()
+            if inflight + len(self._waiting.get(endpoint, ())) >= limit
+        ]
     
-    async def _send_webhook(self, event: WebhookEvent, subscription: WebhookSubscription):
-        """Отправка webhook уведомления"""
+    def _claim_batch(self, limit: int, saturated: List[str]) -> List[Dict[str, Any]]:
+        """Забирает готовые доставки (строки помечаются sending)"""
+        db = SessionLocal()
         try:
-            # Подготавливаем payload
-            payload = {
-                "event_type": event.event_type.value,
-                "data": event.data,
-                "timestamp": event.timestamp.isoformat(),
-                "event_id": event.event_id
-            }
+            query = db.query(WebhookDelivery).filter(
+                WebhookDelivery.status == OutboxStatus.PENDING,
+                WebhookDelivery.next_attempt_at <= datetime.utcnow()
+            )
+            if saturated:
+                query = query.filter(WebhookDelivery.endpoint.notin_(saturated))
+            rows = query.order_by(WebhookDelivery.next_attempt_at, WebhookDelivery.id).limit(
+                limit
+            ).with_for_update(skip_locked=True).all()
+            if not rows:
+                db.rollback()
+                return []
             
-            # Создаем подпись если есть секрет
-            headers = {
-                "Content-Type": "application/json",
-                "User-Agent": "AI-Lawyer-Webhook/1.0.0"
-            }
-            
-            if subscription.secret:
-                signature = self._create_signature(
-                    json.dumps(payload, sort_keys=True),
-                    subscription.secret
+            db.execute(
+                update(WebhookDelivery)
+                .where(WebhookDelivery.id.in_([row.id for row in rows]))
+                .values(
+                    status=OutboxStatus.SENDING,
+                    attempts=WebhookDelivery.attempts + 1,
+                    claimed_at=datetime.utcnow()
                 )
-                headers["X-Webhook-Signature"] = f"sha256={signature}"
-            
-            # Отправляем запрос
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    subscription.url,
-                    json=payload,
-                    headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout)
-                ) as response:
-                    
-                    if response.status >= 200 and response.status < 300:
-                        # Успешная отправка
+            )
+            items = [{
+                "id": row.id,
+                "subscription_id": row.subscription_id,
+                "url": row.url,
+                "endpoint": row.endpoint,
+                "body": row.body,
+                "headers": row.headers or {},
+                "attempts": (row.attempts or 0) + 1,
+                "max_attempts": row.max_attempts
+            } for row in rows]
+            db.commit()
+            return items
+        finally:
+            db.close()
+    
+    def _schedule(self, item: Dict[str, Any]):
+        """Передает доставку воркерам или ставит в ожидание свободного слота endpoint"""
+        endpoint = item["endpoint"]
+        if self._inflight[endpoint] < self.endpoint_concurrency:
+            self._inflight[endpoint] += 1
+            self._ready.put_nowait(item)
+        else:
+            self._waiting[endpoint].append(item)
+    
+    def _release(self, endpoint: str):
+        waiting = self._waiting.get(endpoint)
+        if waiting:
+            self._ready.put_nowait(waiting.popleft())
+            if not waiting:
+                del self._waiting[endpoint]
+            return
+        self._inflight[endpoint] -= 1
+        if self._inflight[endpoint] <= 0:
+            del self._inflight[endpoint]
+            # Освободился endpoint, который диспетчер мог пропускать
+            self._wakeup.set()
+    
+    async def _worker_loop(self):
+        while True:
+            item = await self._ready.get()
+            try:
+                outcome = await self._send_webhook(item)
+            except Exception as e:
+                outcome = self._failure(item, str(e), retryable=True)
+            finally:
+                self._release(item["endpoint"])
+            self._outcomes.append(outcome)
+            if len(self._outcomes) >= self.batch_size:
+                self._wakeup.set()
+    
+    async def _send_webhook(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """Одна попытка доставки через общий пул соединений"""
+        subscription = self.subscriptions.get(item["subscription_id"])
+        if item["subscription_id"] in self._removed or (subscription is not None and not subscription.is_active):
+            return {"id": item["id"], "status": OutboxStatus.FAILED, "error": "Subscription removed or inactive"}
+        
+        session = await shared_http_session.get()
+        try:
+            async with session.post(
+                item["url"],
+                data=item["body"].encode(),
+                headers=item["headers"],
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as response:
+                if 200 <= response.status < 300:
+                    self.delivered += 1
+                    if subscription is not None:
                         subscription.last_triggered = datetime.now()
                         subscription.failure_count = 0
-                        logger.info(f"Webhook sent successfully to {subscription.url}")
-                    else:
-                        # Ошибка отправки
-                        subscription.failure_count += 1
-                        logger.error(f"Webhook failed: {response.status} - {subscription.url}")
-                        
-                        # Если слишком много ошибок, деактивируем подписку
-                        if subscription.failure_count >= self.max_retries:
-                            subscription.is_active = False
-                            logger.warning(f"Deactivated webhook subscription due to failures: {subscription.id}")
-                        
-                        # Повторная попытка
-                        if subscription.failure_count < self.max_retries:
-                            await asyncio.sleep(self.retry_delay * subscription.failure_count)
-                            await self.event_queue.put((event, subscription))
-                    
+                    return {"id": item["id"], "status": OutboxStatus.SENT}
+                
+                # 4xx, кроме 408 и 429, повторять бессмысленно
+                retryable = response.status >= 500 or response.status in (408, 429)
+                retry_after = response.headers.get("Retry-After")
+                outcome = self._failure(item, f"HTTP {response.status}", retryable)
+                if retryable and retry_after and retry_after.isdigit() and outcome["status"] == OutboxStatus.PENDING:
+                    outcome["delay"] = min(self.retry_max_delay, max(outcome["delay"], int(retry_after)))
+                return outcome
         except asyncio.TimeoutError:
+            return self._failure(item, "Timeout", retryable=True)
+        except aiohttp.ClientError as e:
+            return self._failure(item, str(e) or e.__class__.__name__, retryable=True)
+    
+    def _failure(self, item: Dict[str, Any], error: str, retryable: bool) -> Dict[str, Any]:
+        subscription = self.subscriptions.get(item["subscription_id"])
+        if subscription is not None:
             subscription.failure_count += 1
-            logger.error(f"Webhook timeout: {subscription.url}")
-            
-            if subscription.failure_count < self.max_retries:
-                await asyncio.sleep(self.retry_delay * subscription.failure_count)
-                await self.event_queue.put((event, subscription))
-                
+        logger.error(f"Webhook failed: {error} - {item['url']}")
+        
+        if retryable and item["attempts"] < item["max_attempts"]:
+            self.retried += 1
+            return {"id": item["id"], "status": OutboxStatus.PENDING, "delay": self._backoff(item["attempts"]), "error": error}
+        
+        self.failed += 1
+        # Если слишком много ошибок подряд, деактивируем подписку
+        if subscription is not None and subscription.is_active and subscription.failure_count >= self.max_retries:
+            subscription.is_active = False
+            logger.warning(f"Deactivated webhook subscription due to failures: {subscription.id}")
+        return {"id": item["id"], "status": OutboxStatus.FAILED, "error": error}
+    
+    def _backoff(self, attempts: int) -> float:
+        """Экспоненциальная задержка с джиттером"""
+        delay = min(self.retry_max_delay, self.retry_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+    
+    async def _flush_outcomes(self):
+        if not self._outcomes:
+            return
+        outcomes, self._outcomes = self._outcomes, []
+        await asyncio.to_thread(self._store_outcomes, outcomes)
+    
+    def _store_outcomes(self, outcomes: List[Dict[str, Any]]):
+        """Сохраняет результаты доставок массовыми UPDATE"""
+        now = datetime.utcnow()
+        sent_ids = [o["id"] for o in outcomes if o["status"] == OutboxStatus.SENT]
+        mappings = []
+        for outcome in outcomes:
+            if outcome["status"] == OutboxStatus.SENT:
+                continue
+            mapping = {
+                "id": outcome["id"],
+                "status": outcome["status"],
+                "last_error": outcome.get("error"),
+                "claimed_at": None
+            }
+            if outcome["status"] == OutboxStatus.PENDING:
+                mapping["next_attempt_at"] = now + timedelta(seconds=outcome.get("delay", self.retry_delay))
+            mappings.append(mapping)
+        
+        db = SessionLocal()
+        try:
+            if sent_ids:
+                db.execute(
+                    update(WebhookDelivery)
+                    .where(WebhookDelivery.id.in_(sent_ids))
+                    .values(status=OutboxStatus.SENT, sent_at=now, last_error=None, claimed_at=None)
+                )
+            if mappings:
+                db.execute(update(WebhookDelivery), mappings)
+            db.commit()
         except Exception as e:
-            subscription.failure_count += 1
-            logger.error(f"Webhook error: {str(e)} - {subscription.url}")
-            
-            if subscription.failure_count < self.max_retries:
-                await asyncio.sleep(self.retry_delay * subscription.failure_count)
-                await self.event_queue.put((event, subscription))
+            db.rollback()
+            logger.error(f"❌ Failed to store webhook outcomes: {e}")
+        finally:
+            db.close()
     
     def _create_signature(self, payload: str, secret: str) -> str:
         """Создание подписи для webhook"""
@@ -196,25 +482,41 @@ class WebhookManager:
         expected_signature = self._create_signature(payload, secret)
         return hmac.compare_digest(signature, expected_signature)
     
+    def _count_queued(self) -> int:
+        db = SessionLocal()
+        try:
+            return db.query(func.count(WebhookDelivery.id)).filter(
+                WebhookDelivery.status.in_([OutboxStatus.PENDING, OutboxStatus.SENDING])
+            ).scalar() or 0
+        finally:
+            db.close()
+    
     async def get_webhook_stats(self) -> Dict[str, Any]:
         """Получение статистики webhook"""
         total_subscriptions = len(self.subscriptions)
         active_subscriptions = len([s for s in self.subscriptions.values() if s.is_active])
         
         event_counts = {}
-        for subscription in self.subscriptions.values():
-            for event_type in subscription.events:
-                event_counts[event_type.value] = event_counts.get(event_type.value, 0) + 1
+        for (_, event_type), subs in self._index.items():
+            event_counts[event_type.value] = event_counts.get(event_type.value, 0) + len(subs)
         
         return {
             "total_subscriptions": total_subscriptions,
             "active_subscriptions": active_subscriptions,
             "inactive_subscriptions": total_subscriptions - active_subscriptions,
-            "queue_size": self.event_queue.qsize(),
+            "queue_size": await asyncio.to_thread(self._count_queued),
             "event_counts": event_counts,
             "subscriptions_by_user": {
-                str(user_id): len([s for s in self.subscriptions.values() if s.user_id == user_id])
-                for user_id in set(s.user_id for s in self.subscriptions.values())
+                str(user_id): len(subs) for user_id, subs in self._user_index.items()
+            },
+            "delivery": {
+                "running": self._running,
+                "workers": self.workers,
+                "in_flight": sum(self._inflight.values()),
+                "waiting_for_endpoint": sum(len(queue) for queue in self._waiting.values()),
+                "delivered": self.delivered,
+                "retried": self.retried,
+                "failed": self.failed
             }
         }
 
@@ -280,4 +582,4 @@ def create_payment_completed_event(user_id: int, payment_data: Dict[str, Any]) -
 async def start_webhook_processor():
     """Запуск обработчика webhook событий"""
     logger.info("Starting webhook processor")
-    await webhook_manager.process_webhook_queue()
+    await webhook_manager.start()
@@ -46,76 +46,75 @@ class AdminPanelMonitoringMiddleware(BaseHTTPMiddleware):
         endpoint = self._extract_endpoint(request.url.path)
         user_role = self._extract_user_role(request)
         
-        # Start Jaeger tracing
-        jaeger_tracing.trace_http_request(request, None, 0, user_role)
-        
-        try:
-            # Process request
-            response = await call_next(request)
-            duration = time.time() - start_time
-            
-            # Record metrics
-            admin_panel_metrics.record_http_request(
-                module=module,
-                endpoint=endpoint,
-                method=request.method,
-                status_code=response.status_code,
-                duration=duration,
-                user_role=user_role
-            )
-            
-            # Update Jaeger trace
-            jaeger_tracing.trace_http_request(request, response, duration, user_role)
-            
-            # Log successful request
-            logger.info(
-                f"Admin panel request completed",
-                extra={
-                    "admin_module": module,
-                    "endpoint": endpoint,
-                    "method": request.method,
-                    "status_code": response.status_code,
-                    "duration": duration,
-                    "user_role": user_role
-                }
-            )
-            
-            return response
-            
-        except Exception as e:
-            duration = time.time() - start_time
-            
-            # Record error metrics
-            admin_panel_metrics.record_error(
-                module=module,
-                error_type=type(e).__name__,
-                severity="error"
-            )
-            
-            # Record failed request metrics
-            admin_panel_metrics.record_http_request(
-                module=module,
-                endpoint=endpoint,
-                method=request.method,
-                status_code=500,
-                duration=duration,
-                user_role=user_role
-            )
-            
-            # Log error
-            logger.error(
-                f"Admin panel request failed: {str(e)}",
-                extra={
-                    "admin_module": module,
-                    "endpoint": endpoint,
-                    "method": request.method,
-                    "duration": duration,
-                    "user_role": user_role,
-                    "error": str(e)
-                }
-            )
-            
-            raise
+        # Корневой span запроса; span'ы, созданные при обработке, становятся его дочерними
+        with jaeger_tracing.trace_request(request, user_role) as span:
+            try:
+                # Process request
+                response = await call_next(request)
+                duration = time.time() - start_time
+                
+                # Record metrics
+                admin_panel_metrics.record_http_request(
+                    module=module,
+                    endpoint=endpoint,
+                    method=request.method,
+                    status_code=response.status_code,
+                    duration=duration,
+                    user_role=user_role
+                )
+                
+                # Update Jaeger trace
+                jaeger_tracing.trace_http_response(span, request, response, duration)
+                
+                # Log successful request
+                logger.info(
+                    f"Admin panel request completed",
+                    extra={
+                        "admin_module": module,
+                        "endpoint": endpoint,
+                        "method": request.method,
+                        "status_code": response.status_code,
+                        "duration": duration,
+                        "user_role": user_role
+                    }
+                )
+                
+                return response
+                
+            except Exception as e:
+                duration = time.time() - start_time
+                
+                # Record error metrics
+                admin_panel_metrics.record_error(
+                    module=module,
+                    error_type=type(e).__name__,
+                    severity="error"
+                )
+                
+                # Record failed request metrics
+                admin_panel_metrics.record_http_request(
+                    module=module,
+                    endpoint=endpoint,
+                    method=request.method,
+                    status_code=500,
+                    duration=duration,
+                    user_role=user_role
+                )
+                
+                # Log error
+                logger.error(
+                    f"Admin panel request failed: {str(e)}",
+                    extra={
+                        "admin_module": module,
+                        "endpoint": endpoint,
+                        "method": request.method,
+                        "duration": duration,
+                        "user_role": user_role,
+                        "error": str(e)
+                    }
+                )
+                
+                raise
     
     def _is_admin_request(self, request: Request) -> bool:
         """Check if request is for admin panel"""
@@ -12,7 +12,7 @@ from typing import Dict, Any, Optional
 import re
 from datetime import datetime
 
-from ..core.ml_rate_limiter import MLRateLimiter, EndpointType
+from ..core.ml_rate_limiter import MLRateLimiter, EndpointType, get_rate_limiter
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +22,7 @@ class MLRateLimitMiddleware(BaseHTTPMiddleware):
     
     def __init__(self, app, rate_limiter: Optional[MLRateLimiter] = None):
         super().__init__(app)
-        self.rate_limiter = rate_limiter or MLRateLimiter()
+        self.rate_limiter = rate_limiter or get_rate_limiter()
         
         # Endpoint pattern matching
         self.endpoint_patterns = {
@@ -237,8 +237,8 @@ class RateLimitDependency:
     async def __call__(self, request: Request, rate_limiter: MLRateLimiter = None):
         """Check rate limits as a dependency"""
         if rate_limiter is None:
-            # Get rate limiter from middleware or create new instance
-            rate_limiter = MLRateLimiter()
+            # Shared instance: buckets must not start full on every request
+            rate_limiter = get_rate_limiter()
         
         # Extract user info
         middleware = MLRateLimitMiddleware(None)
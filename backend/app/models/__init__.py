@@ -22,7 +22,8 @@ from .rbac import (
     SYSTEM_ROLES, SYSTEM_PERMISSIONS, ROLE_PERMISSIONS_MAPPING
 )
 from .notification import (
-    AdminNotification, NotificationTemplate, NotificationHistory
+    AdminNotification, NotificationTemplate, NotificationHistory,
+    NotificationChannel, ChannelType, NotificationOutbox, OutboxStatus, WebhookDelivery
 )
 from .encryption import EncryptionKey, EncryptedMessage
 from .training_data import (
@@ -32,6 +33,10 @@ from .backup import (
     BackupRecord, BackupSchedule, RestoreRecord, BackupIntegrityCheck,
     BackupStatus, BackupType, RestoreStatus
 )
+from .rollup import MetricRollup, RollupWatermark, RollupGranularity
+from .analysis_job import AnalysisJob, AnalysisJobStatus, AnalysisJobType
+from .export_job import ExportJob, ExportJobStatus
+from .annotation import DocumentAnnotation, DocumentAnnotationReply, AnnotationTag, AnnotationTerm
 from ..core.database import Base
 
 __all__ = [
@@ -62,6 +67,7 @@ __all__ = [
     
     # Notification models
     "AdminNotification", "NotificationTemplate", "NotificationHistory",
+    "NotificationChannel", "ChannelType", "NotificationOutbox", "OutboxStatus", "WebhookDelivery",
     
     # Encryption models
     "EncryptionKey", "EncryptedMessage",
@@ -71,5 +77,17 @@ __all__ = [
     
     # Backup models
     "BackupRecord", "BackupSchedule", "RestoreRecord", "BackupIntegrityCheck",
-    "BackupStatus", "BackupType", "RestoreStatus"
+    "BackupStatus", "BackupType", "RestoreStatus",
+    
+    # Rollup models
+    "MetricRollup", "RollupWatermark", "RollupGranularity",
+    
+    # Background analysis models
+    "AnalysisJob", "AnalysisJobStatus", "AnalysisJobType",
+    
+    # Export models
+    "ExportJob", "ExportJobStatus",
+    
+    # Annotation models
+    "DocumentAnnotation", "DocumentAnnotationReply", "AnnotationTag", "AnnotationTerm"
 ]
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, JSON, ForeignKey, Enum
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, JSON, ForeignKey, Enum, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from enum import Enum as PyEnum
@@ -125,6 +125,7 @@ class ABTestParticipant(Base):
     
     # Participant identification
     session_id = Column(String(255), nullable=True)  # For anonymous users
+    participant_key = Column(String(300), nullable=True)  # "u:<user_id>" or "s:<session_id>", unique per test
     user_agent = Column(Text)
     ip_address = Column(String(45))  # IPv6 compatible
     
@@ -143,6 +144,10 @@ class ABTestParticipant(Base):
     page_views = Column(Integer, nullable=False, default=0)
     bounce = Column(Boolean, nullable=False, default=False)
     
+    __table_args__ = (
+        UniqueConstraint("test_id", "participant_key", name="uq_ab_test_participants_test_key"),
+    )
+    
     # Relationships
     test = relationship("ABTest", back_populates="participants")
     variant = relationship("ABTestVariant", back_populates="participants")
@@ -0,0 +1,67 @@
+"""
+Модель фоновых задач AI-анализа документов (низкоприоритетная очередь LLM)
+"""
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Index
+from datetime import datetime
+
+from ..core.database import Base
+
+
+class AnalysisJobStatus:
+    """Статусы задачи анализа"""
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class AnalysisJobType:
+    """Типы задач анализа"""
+    DOCUMENT_ANALYSIS = "document_analysis"              # Извлечение ключевой информации
+    DOCUMENT_VALIDATION = "document_validation"          # AI-валидация тематики
+    DOCUMENT_CLASSIFICATION = "document_classification"  # AI-классификация типа документа
+
+
+class AnalysisJob(Base):
+    """Задача фонового AI-анализа документа"""
+    __tablename__ = "analysis_jobs"
+
+    id = Column(String(36), primary_key=True)  # UUID, возвращается клиенту при загрузке
+    job_type = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default=AnalysisJobStatus.PENDING)
+    priority = Column(Integer, nullable=False, default=0)  # Больше - раньше
+    dedup_key = Column(String(255), nullable=True, index=True)  # Защита от дублей незавершенных задач
+
+    payload = Column(JSON, nullable=False, default=dict)  # Входные данные (образец текста, имя файла)
+    target = Column(JSON, nullable=True)  # Куда вливать результат: {"where": {...}} или {"ids": [...]}
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)  # Время захвата воркером, он же идентификатор аренды
+    heartbeat_at = Column(DateTime, nullable=True)  # Последнее продление аренды выполняющим воркером
+    next_attempt_at = Column(DateTime, nullable=True)  # Повторная попытка не раньше этого времени
+    completed_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_analysis_jobs_queue", "status", "priority", "created_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "job_type": self.job_type,
+            "status": self.status,
+            "priority": self.priority,
+            "attempts": self.attempts,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "next_attempt_at": self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None
+        }
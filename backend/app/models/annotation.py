@@ -0,0 +1,90 @@
+"""
+Модели аннотаций документов и их индексов (диапазоны текста, теги, термины поиска)
+"""
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Boolean, Index, PrimaryKeyConstraint
+from datetime import datetime
+
+from ..core.database import Base
+
+
+class DocumentAnnotation(Base):
+    """Аннотация фрагмента документа"""
+    __tablename__ = "document_annotations"
+
+    id = Column(String(64), primary_key=True)
+    document_id = Column(String(255), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    annotation_type = Column(String(30), nullable=False)
+    status = Column(String(20), nullable=False, default="active")
+    is_public = Column(Boolean, nullable=False, default=False)
+
+    # Диапазон текста; span_bin - ячейка иерархической сетки, целиком покрывающая диапазон
+    start_offset = Column(Integer, nullable=False)
+    end_offset = Column(Integer, nullable=False)
+    start_line = Column(Integer, nullable=False)
+    end_line = Column(Integer, nullable=False)
+    span_bin = Column(Integer, nullable=False)
+    selected_text = Column(Text, nullable=False, default="")
+
+    content = Column(Text, nullable=False, default="")
+    color = Column(String(50), nullable=True)
+    style = Column(JSON, nullable=False, default=dict)
+    tags = Column(JSON, nullable=False, default=list)  # Для чтения; поиск идет по annotation_tags
+    annotation_metadata = Column("metadata", JSON, nullable=False, default=dict)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_document_annotations_span", "document_id", "span_bin", "start_offset"),
+        Index("ix_document_annotations_document", "document_id", "status", "start_offset"),
+        Index("ix_document_annotations_user", "user_id", "status", "created_at"),
+    )
+
+
+class DocumentAnnotationReply(Base):
+    """Ответ на аннотацию"""
+    __tablename__ = "document_annotation_replies"
+
+    id = Column(String(64), primary_key=True)
+    annotation_id = Column(String(64), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="active")
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_document_annotation_replies_annotation", "annotation_id", "created_at"),
+        Index("ix_document_annotation_replies_user", "user_id", "status"),
+    )
+
+
+class AnnotationTag(Base):
+    """Индекс тегов аннотаций"""
+    __tablename__ = "annotation_tags"
+
+    tag = Column(String(100), nullable=False)
+    annotation_id = Column(String(64), nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("tag", "annotation_id"),
+        Index("ix_annotation_tags_annotation", "annotation_id"),
+    )
+
+
+class AnnotationTerm(Base):
+    """Обратный индекс слов содержимого и выделенного текста аннотаций"""
+    __tablename__ = "annotation_terms"
+
+    term = Column(String(64), nullable=False)
+    annotation_id = Column(String(64), nullable=False)
+    field = Column(String(10), nullable=False)  # content или text
+
+    __table_args__ = (
+        PrimaryKeyConstraint("term", "annotation_id", "field"),
+        # text_pattern_ops позволяет PostgreSQL использовать индекс для поиска по префиксу (LIKE 'abc%')
+        Index("ix_annotation_terms_prefix", "term", postgresql_ops={"term": "text_pattern_ops"}),
+        Index("ix_annotation_terms_annotation", "annotation_id"),
+    )
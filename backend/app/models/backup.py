@@ -97,6 +97,7 @@ class BackupSchedule(Base):
     retention_days = Column(Integer, default=30)
     compression_enabled = Column(Boolean, default=True)
     encryption_enabled = Column(Boolean, default=False)
+    incremental = Column(Boolean, default=False, nullable=False)  # Копия через хранилище блоков
     
     # Уведомления
     notify_on_success = Column(Boolean, default=False)
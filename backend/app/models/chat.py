@@ -13,6 +13,11 @@ class ChatSession(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
+    # Скользящее резюме старых сообщений (то, что не помещается в контекст модели)
+    context_summary = Column(Text, nullable=True)
+    summary_message_id = Column(Integer, nullable=True)  # Последнее сообщение, вошедшее в резюме
+    summary_updated_at = Column(DateTime(timezone=True), nullable=True)
+    
     # Связь с пользователем
     user = relationship("User")
     # Связь с сообщениями
@@ -0,0 +1,45 @@
+"""
+Модель фоновых задач экспорта данных
+"""
+
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, JSON, Index
+from datetime import datetime
+
+from ..core.database import Base
+
+
+class ExportJobStatus:
+    """Статусы задачи экспорта"""
+    PENDING = "pending"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class ExportJob(Base):
+    """Задача экспорта: параметры, прогресс и итоговый файл"""
+    __tablename__ = "export_jobs"
+
+    id = Column(String(64), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    export_type = Column(String(50), nullable=False)
+    export_format = Column(String(10), nullable=False)
+    filters = Column(JSON, nullable=False, default=dict)
+    status = Column(String(20), nullable=False, default=ExportJobStatus.PENDING)
+
+    rows_total = Column(Integer, nullable=True)  # Оценка по COUNT до начала выгрузки
+    rows_written = Column(Integer, nullable=False, default=0)
+    file_path = Column(String(500), nullable=True)
+    file_size = Column(BigInteger, nullable=True)
+    error_message = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)  # Время захвата задачи - идентифицирует владельца аренды
+    heartbeat_at = Column(DateTime, nullable=True)  # Обновляется выполняющим воркером; устаревшая аренда - задача брошена
+    completed_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_export_jobs_user", "user_id", "created_at"),
+        Index("ix_export_jobs_status", "status"),
+    )
@@ -2,7 +2,7 @@
 Модели для системы обратной связи и модерации
 """
 
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, JSON, Float
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, JSON, Float, Index, case
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..core.database import Base
@@ -223,6 +223,20 @@ class ModerationQueue(Base):
         return f"<ModerationQueue(id={self.id}, message_id={self.message_id}, priority={self.priority})>"
 
 
+# Порядок очереди: high, medium, low; затем старые раньше
+MODERATION_PRIORITY_RANK = case(
+    (ModerationQueue.priority == 'high', 0),
+    (ModerationQueue.priority == 'medium', 1),
+    else_=2
+)
+
+# Индекс под keyset-пагинацию по (ранг приоритета, created_at, id)
+Index(
+    'ix_moderation_queue_keyset',
+    MODERATION_PRIORITY_RANK, ModerationQueue.created_at, ModerationQueue.id
+)
+
+
 # Предустановленные категории проблем
 DEFAULT_PROBLEM_CATEGORIES = [
     {
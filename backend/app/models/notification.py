@@ -1,12 +1,24 @@
 """
 Модели для системы уведомлений админ-панели
 """
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON
+import enum
+
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON, Float, Enum, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..core.database import Base
 
 
+class ChannelType(enum.Enum):
+    """Типы внешних каналов доставки"""
+    EMAIL = "email"
+    PUSH = "push"
+    SMS = "sms"
+    SLACK = "slack"
+    TELEGRAM = "telegram"
+    WEBHOOK = "webhook"
+
+
 class AdminNotification(Base):
     """Модель уведомлений для админ-панели"""
     __tablename__ = "admin_notifications"
@@ -131,4 +143,108 @@ class NotificationHistory(Base):
     notification = relationship("AdminNotification")
     
     def __repr__(self):
-        return f"<NotificationHistory(id={self.id}, channel={self.channel}, status={self.status})>"
\ No newline at end of file
+        return f"<NotificationHistory(id={self.id}, channel={self.channel}, status={self.status})>"
+
+
+class NotificationChannel(Base):
+    """Внешний канал доставки уведомлений (SMTP, Slack, Telegram, webhook)"""
+    __tablename__ = "notification_channels"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(255), nullable=False)
+    type = Column(
+        Enum(ChannelType, name="channeltype", values_callable=lambda e: [m.value for m in e]),
+        nullable=False
+    )
+    is_active = Column(Boolean, default=True)
+    configuration = Column(JSON, nullable=False)
+    
+    # Ограничения провайдера
+    rate_limit_per_minute = Column(Integer, nullable=True)
+    rate_limit_per_hour = Column(Integer, nullable=True)
+    rate_limit_per_day = Column(Integer, nullable=True)
+    max_retries = Column(Integer, default=3)
+    retry_delay_seconds = Column(Integer, default=60)
+    
+    # Статистика доставки
+    total_sent = Column(Integer, default=0)
+    total_failed = Column(Integer, default=0)
+    success_rate = Column(Float, default=0.0)
+    
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, nullable=True)
+    last_used_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<NotificationChannel(id={self.id}, name={self.name}, type={self.type})>"
+
+
+class OutboxStatus:
+    """Статусы исходящего сообщения"""
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class NotificationOutbox(Base):
+    """Персистентная очередь исходящих сообщений во внешние каналы"""
+    __tablename__ = "notification_outbox"
+    
+    id = Column(Integer, primary_key=True)
+    notification_id = Column(Integer, ForeignKey("admin_notifications.id"), nullable=True, index=True)
+    channel_id = Column(Integer, ForeignKey("notification_channels.id"), nullable=False)
+    channel_type = Column(String(20), nullable=False)
+    recipient = Column(String(255), nullable=True)  # email для SMTP; для чатов/webhook адрес в конфигурации канала
+    
+    payload = Column(JSON, nullable=False)  # title, content, priority, category, action_url, metadata
+    
+    status = Column(String(20), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    claimed_at = Column(DateTime, nullable=True)  # Начало аренды строки воркером (status=sending)
+    last_error = Column(Text, nullable=True)
+    
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_notification_outbox_due", "status", "next_attempt_at"),
+    )
+    
+    def __repr__(self):
+        return f"<NotificationOutbox(id={self.id}, channel={self.channel_type}, status={self.status})>"
+
+
+class WebhookDelivery(Base):
+    """Персистентная очередь доставки webhook-событий подписчикам"""
+    __tablename__ = "webhook_deliveries"
+    
+    id = Column(Integer, primary_key=True)
+    event_id = Column(String(100), nullable=False)
+    event_type = Column(String(100), nullable=False)
+    subscription_id = Column(String(100), nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    
+    url = Column(Text, nullable=False)
+    endpoint = Column(String(255), nullable=False)  # Хост получателя - ключ лимита параллельных запросов
+    body = Column(Text, nullable=False)  # Сериализованный payload (подпись считается по нему)
+    headers = Column(JSON, nullable=False)
+    
+    status = Column(String(20), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    claimed_at = Column(DateTime, nullable=True)  # Начало аренды строки диспетчером (status=sending)
+    last_error = Column(Text, nullable=True)
+    
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_webhook_deliveries_due", "status", "next_attempt_at"),
+    )
+    
+    def __repr__(self):
+        return f"<WebhookDelivery(id={self.id}, event={self.event_type}, status={self.status})>"
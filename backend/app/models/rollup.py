@@ -0,0 +1,49 @@
+"""
+Модели предагрегированных счетчиков (rollup) для дашбордов и аналитики
+"""
+
+from sqlalchemy import Column, Integer, String, DateTime, Float, UniqueConstraint, Index
+from datetime import datetime
+
+from ..core.database import Base
+
+
+# Условное начало "бакета" для накопительных итогов (granularity = total/snapshot)
+TOTAL_BUCKET_START = datetime(1970, 1, 1)
+
+
+class RollupGranularity:
+    """Гранулярность бакетов"""
+    HOUR = "hour"
+    DAY = "day"
+    TOTAL = "total"        # Накопительный итог за все время
+    SNAPSHOT = "snapshot"  # Текущее значение (пересчитывается целиком)
+
+
+class MetricRollup(Base):
+    """Счетчик метрики за временной бакет"""
+    __tablename__ = "metric_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    metric = Column(String(100), nullable=False)  # users.created, messages.created, tokens.spent ...
+    granularity = Column(String(20), nullable=False)  # hour, day, total, snapshot
+    bucket_start = Column(DateTime, nullable=False)  # Начало бакета (UTC, без tz)
+    dimension = Column(String(100), nullable=False, default="")  # Доп. разрез, например user_id
+    value = Column(Float, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("metric", "granularity", "bucket_start", "dimension", name="uq_metric_rollup_bucket"),
+        Index("ix_metric_rollups_lookup", "metric", "granularity", "bucket_start"),
+        Index("ix_metric_rollups_top", "metric", "granularity", "value"),
+    )
+
+
+class RollupWatermark(Base):
+    """Водяной знак инкрементальной обработки источника"""
+    __tablename__ = "rollup_watermarks"
+
+    source = Column(String(100), primary_key=True)  # users, chat_sessions, chat_messages ...
+    last_id = Column(Integer, nullable=False, default=0)  # Последний обработанный id
+    rows_processed = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, event, inspect
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..core.database import Base
@@ -31,6 +31,9 @@ class User(Base):
     two_factor_secret = Column(String(32), nullable=True)
     backup_codes = Column(Text, nullable=True)  # JSON строка с резервными кодами
     
+    # Версия учетных данных: попадает в токен, изменение отзывает выданные токены
+    auth_version = Column(Integer, nullable=False, default=0, server_default="0")
+    
     # Связи (временно отключены для исправления ошибки 500)
     # Все relationships закомментированы до полной настройки моделей
     pass
@@ -62,3 +65,17 @@ class User(Base):
         """Получает все права пользователя (временно упрощено)"""
         # Временно возвращаем пустой список до настройки RBAC
         return []
+
+
+# Поля, изменение которых отзывает выданные токены (смена пароля, блокировка, права).
+# two_factor_enabled сюда не входит: 2FA включает и отключает сам пользователь из
+# текущей сессии, и отзыв токена разлогинивал бы его; снимки в других процессах
+# обновятся по TTL кеша
+AUTH_VERSION_FIELDS = ("email", "hashed_password", "is_active", "is_admin")
+
+
+@event.listens_for(User, "before_update")
+def _bump_auth_version(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in AUTH_VERSION_FIELDS):
+        target.auth_version = (target.auth_version or 0) + 1
@@ -124,7 +124,7 @@ class ABTestParticipantCreate(ABTestParticipantBase):
 
 
 class ABTestParticipantResponse(ABTestParticipantBase):
-    id: int
+    id: Optional[int] = None  # None until the buffered assignment is persisted
     test_id: int
     variant_id: int
     assigned_at: datetime
@@ -152,14 +152,23 @@ class ABTestEventBase(BaseModel):
 class ABTestEventCreate(ABTestEventBase):
     test_id: int
     variant_id: int
-    participant_id: int
+    participant_id: Optional[int] = None
+    # Alternative participant identification while the assignment is not persisted yet
+    user_id: Optional[int] = None
+    session_id: Optional[str] = None
+
+    @validator('session_id', always=True)
+    def participant_must_be_identified(cls, v, values):
+        if values.get('participant_id') is None and values.get('user_id') is None and not v:
+            raise ValueError('participant_id, user_id or session_id is required')
+        return v
 
 
 class ABTestEventResponse(ABTestEventBase):
-    id: int
+    id: Optional[int] = None  # Events are written in batches
     test_id: int
     variant_id: int
-    participant_id: int
+    participant_id: Optional[int] = None
     created_at: datetime
 
     class Config:
@@ -52,6 +52,7 @@ class BackupCreate(BaseModel):
     retention_days: int = Field(default=30, ge=1, le=365, description="Количество дней для хранения")
     compression_enabled: bool = Field(default=True, description="Включить сжатие")
     encryption_enabled: bool = Field(default=False, description="Включить шифрование")
+    incremental: bool = Field(default=False, description="Инкрементальная копия с дедупликацией блоков")
 
     @validator('tags')
     def validate_tags(cls, v):
@@ -70,6 +71,7 @@ class BackupScheduleCreate(BaseModel):
     retention_days: int = Field(default=30, ge=1, le=365)
     compression_enabled: bool = Field(default=True)
     encryption_enabled: bool = Field(default=False)
+    incremental: bool = Field(default=False, description="Инкрементальная копия с дедупликацией блоков")
     notify_on_success: bool = Field(default=False)
     notify_on_failure: bool = Field(default=True)
     notification_channels: Optional[List[str]] = Field(default=["email"])
@@ -105,6 +107,7 @@ class BackupScheduleUpdate(BaseModel):
     retention_days: Optional[int] = Field(None, ge=1, le=365)
     compression_enabled: Optional[bool] = None
     encryption_enabled: Optional[bool] = None
+    incremental: Optional[bool] = None
     notify_on_success: Optional[bool] = None
     notify_on_failure: Optional[bool] = None
     notification_channels: Optional[List[str]] = None
@@ -152,6 +155,7 @@ class BackupScheduleResponse(BaseModel):
     retention_days: int
     compression_enabled: bool
     encryption_enabled: bool
+    incremental: bool
     notify_on_success: bool
     notify_on_failure: bool
     notification_channels: Optional[List[str]]
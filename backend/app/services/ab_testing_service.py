@@ -1,10 +1,13 @@
 import asyncio
 import hashlib
 import random
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict, Any, Tuple
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, func, desc
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import and_, or_, func, desc, insert, update
 from sqlalchemy.exc import IntegrityError
 import numpy as np
 from scipy import stats
@@ -20,16 +23,53 @@ from ..schemas.ab_testing import (
     ABTestParticipantCreate, ABTestEventCreate,
     ABTestSummaryStats, ABTestAnalysisResponse
 )
-from ..core.database import get_db
+from ..models.rollup import RollupWatermark
+from .rollup_service import to_utc_naive
+from ..core.config import settings
+from ..core.database import get_db, SessionLocal
 
 logger = logging.getLogger(__name__)
 
+ParticipantKey = Tuple[int, str]
+
+
+@dataclass
+class _TestConfig:
+    """Snapshot of a test needed to assign variants without touching the database"""
+    test_id: int
+    running: bool
+    traffic_allocation: float
+    variants: List[Tuple[int, float]]  # (variant_id, cumulative traffic upper bound), ordered by id
+    variant_ids: frozenset
+
 
 class ABTestingService:
     """Service for managing A/B tests and statistical analysis"""
 
     def __init__(self):
         self.logger = logger
+        self.config_ttl = settings.AB_TEST_CONFIG_TTL
+        self.flush_interval = settings.AB_TEST_FLUSH_INTERVAL
+        self.flush_batch = settings.AB_TEST_FLUSH_BATCH
+        self.buffer_max = settings.AB_TEST_BUFFER_MAX
+        self.rollup_interval = settings.AB_TEST_ROLLUP_INTERVAL
+        self.rollup_batch = settings.AB_TEST_ROLLUP_BATCH
+        self.commit_lag = timedelta(seconds=settings.ROLLUP_COMMIT_LAG)
+
+        # test_id -> config (None for missing tests), refreshed after config_ttl
+        self._test_configs: Dict[int, Tuple[Optional[_TestConfig], float]] = {}
+        # Persisted assignments: (test_id, participant_key) -> (participant_id, variant_id)
+        self._known_participants: "OrderedDict[ParticipantKey, Tuple[int, int]]" = OrderedDict()
+        self._known_max = settings.AB_TEST_PARTICIPANT_CACHE_SIZE
+
+        # Write buffers, drained by the background worker
+        self._pending_participants: Dict[ParticipantKey, Dict[str, Any]] = {}
+        self._pending_events: List[Dict[str, Any]] = []
+        self.dropped_events = 0
+
+        self._running = False
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
 
     # Test Management
     async def create_test(self, db: Session, test_data: ABTestCreate, creator_id: int) -> ABTest:
@@ -120,6 +160,7 @@ class ABTestingService:
         test.updated_at = datetime.utcnow()
         db.commit()
         db.refresh(test)
+        self.invalidate_test_config(test.id)
         
         self.logger.info(f"Updated A/B test: {test.name} (ID: {test.id})")
         return test
@@ -148,6 +189,7 @@ class ABTestingService:
         
         db.commit()
         db.refresh(test)
+        self.invalidate_test_config(test.id)
         
         self.logger.info(f"Updated test {test.id} status from {old_status} to {new_status}")
         return test
@@ -164,6 +206,7 @@ class ABTestingService:
         
         db.delete(test)
         db.commit()
+        self.invalidate_test_config(test_id)
         
         self.logger.info(f"Deleted A/B test: {test.name} (ID: {test.id})")
         return True
@@ -178,109 +221,458 @@ class ABTestingService:
         user_agent: Optional[str] = None,
         ip_address: Optional[str] = None
     ) -> Optional[ABTestParticipant]:
-        """Assign a user to a test variant"""
-        test = db.query(ABTest).filter(
-            and_(ABTest.id == test_id, ABTest.status == ABTestStatus.RUNNING)
-        ).first()
-        
-        if not test:
+        """Assign a user to a test variant
+
+        A stored assignment always wins: on a cache miss it is read by the unique
+        (test_id, participant_key) index, since weights may have changed since the
+        participant was assigned. Only new participants get the variant from the
+        identity hash and the cached test configuration. The participant row is
+        written by the background flush; until then the returned object has no id.
+        Interaction metrics of the returned object are not loaded.
+        """
+        key = self._participant_key(user_id, session_id)
+        if key is None:
             return None
         
-        # Check if user is already participating
-        existing_participant = db.query(ABTestParticipant).filter(
-            and_(
-                ABTestParticipant.test_id == test_id,
-                or_(
-                    ABTestParticipant.user_id == user_id if user_id else False,
-                    ABTestParticipant.session_id == session_id if session_id else False
-                )
-            )
-        ).first()
-        
-        if existing_participant:
-            return existing_participant
-        
-        # Determine if user should be included based on traffic allocation
-        if not self._should_include_in_test(test.traffic_allocation, user_id, session_id):
+        config = self._get_test_config(db, test_id)
+        if config is None or not config.running:
             return None
         
-        # Select variant based on traffic distribution
-        variant = self._select_variant(test.variants, user_id, session_id)
-        if not variant:
-            return None
+        cache_key = (test_id, key)
+        known = self._known_participants.get(cache_key)
+        pending = self._pending_participants.get(cache_key)
+        if known is None and pending is None:
+            known = self._lookup_participants(db, {cache_key}).get(cache_key)
+            if known is not None:
+                self._remember_participants({cache_key: known})
+        
+        if known is not None:
+            self._known_participants.move_to_end(cache_key)
+            participant_id, variant_id = known
+        elif pending is not None:
+            participant_id, variant_id = None, pending['variant_id']
+        else:
+            # Determine if user should be included based on traffic allocation
+            if not self._should_include_in_test(config.traffic_allocation, user_id, session_id):
+                return None
+            
+            variant_id = self._select_variant(config, user_id, session_id)
+            if variant_id is None:
+                return None
+            
+            participant_id = None
+            self._pending_participants[cache_key] = {
+                'test_id': test_id,
+                'variant_id': variant_id,
+                'user_id': user_id,
+                'session_id': session_id,
+                'participant_key': key,
+                'user_agent': user_agent,
+                'ip_address': ip_address
+            }
+            if len(self._pending_participants) >= self.flush_batch:
+                self._wakeup.set()
         
-        # Create participant
-        participant = ABTestParticipant(
+        return ABTestParticipant(
+            id=participant_id,
             test_id=test_id,
-            variant_id=variant.id,
+            variant_id=variant_id,
             user_id=user_id,
             session_id=session_id,
+            participant_key=key,
             user_agent=user_agent,
-            ip_address=ip_address
+            ip_address=ip_address,
+            assigned_at=datetime.utcnow(),
+            converted=False,
+            page_views=0,
+            bounce=False
         )
-        
-        db.add(participant)
-        
-        # Update variant participant count
-        variant.participants_count += 1
-        
-        db.commit()
-        db.refresh(participant)
-        
-        self.logger.info(f"Assigned participant to test {test_id}, variant {variant.id}")
-        return participant
 
     async def record_event(
         self, 
         db: Session, 
         event_data: ABTestEventCreate
     ) -> Optional[ABTestEvent]:
-        """Record an event for a test participant"""
-        participant = db.query(ABTestParticipant).filter(
-            ABTestParticipant.id == event_data.participant_id
-        ).first()
+        """Record an event for a test participant
+
+        Events are appended to a buffer and inserted in batches; participant
+        metrics and variant aggregates are updated by the periodic rollup.
+        """
+        config = self._get_test_config(db, event_data.test_id)
+        if config is None or event_data.variant_id not in config.variant_ids:
+            return None
         
-        if not participant:
+        if len(self._pending_events) >= self.buffer_max:
+            self.dropped_events += 1
+            self.logger.warning("A/B event buffer is full, dropping event")
             return None
         
-        # Create event
-        event = ABTestEvent(
+        participant_key = None
+        if event_data.participant_id is None:
+            participant_key = self._participant_key(event_data.user_id, event_data.session_id)
+        
+        created_at = datetime.utcnow()
+        self._pending_events.append({
+            'test_id': event_data.test_id,
+            'variant_id': event_data.variant_id,
+            'participant_id': event_data.participant_id,
+            'participant_key': participant_key,
+            'event_type': event_data.event_type,
+            'event_name': event_data.event_name,
+            'event_data': event_data.event_data or {},
+            'event_value': event_data.event_value,
+            'created_at': created_at
+        })
+        if len(self._pending_events) >= self.flush_batch:
+            self._wakeup.set()
+        
+        return ABTestEvent(
             test_id=event_data.test_id,
             variant_id=event_data.variant_id,
             participant_id=event_data.participant_id,
             event_type=event_data.event_type,
             event_name=event_data.event_name,
             event_data=event_data.event_data or {},
-            event_value=event_data.event_value
+            event_value=event_data.event_value,
+            created_at=created_at
         )
+
+    # Test configuration cache
+    def _get_test_config(self, db: Session, test_id: int) -> Optional[_TestConfig]:
+        cached = self._test_configs.get(test_id)
+        now = time.monotonic()
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        
+        test = db.query(ABTest).options(selectinload(ABTest.variants)).filter(ABTest.id == test_id).first()
+        config = None
+        if test is not None:
+            cumulative = 0.0
+            variants = []
+            for variant in sorted(test.variants, key=lambda v: v.id):  # Ensure consistent ordering
+                cumulative += variant.traffic_percentage
+                variants.append((variant.id, cumulative))
+            config = _TestConfig(
+                test_id=test.id,
+                running=test.status == ABTestStatus.RUNNING,
+                traffic_allocation=test.traffic_allocation,
+                variants=variants,
+                variant_ids=frozenset(variant_id for variant_id, _ in variants)
+            )
+        self._test_configs[test_id] = (config, now + self.config_ttl)
+        return config
+
+    def invalidate_test_config(self, test_id: int):
+        """Drop the cached configuration (other workers pick up changes after config_ttl)"""
+        self._test_configs.pop(test_id, None)
+
+    # Background persistence
+    async def start(self):
+        """Start flushing buffered assignments/events and rolling up variant aggregates"""
+        if self._running:
+            return
+        self._running = True
+        self._task = asyncio.create_task(self._worker_loop())
+        self.logger.info("A/B testing writer started")
+
+    async def stop(self):
+        """Stop the worker and flush what is left in the buffers"""
+        self._running = False
+        self._wakeup.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_buffers()
+        self.logger.info("A/B testing writer stopped")
+
+    async def _worker_loop(self):
+        last_rollup = 0.0
+        while self._running:
+            try:
+                await self.flush_buffers()
+                if time.monotonic() - last_rollup >= self.rollup_interval:
+                    await asyncio.to_thread(self.rollup)
+                    last_rollup = time.monotonic()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                self.logger.error(f"Error in A/B testing writer loop: {e}")
+            
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush_buffers(self):
+        """Write buffered participants and events in batches"""
+        participants, self._pending_participants = self._pending_participants, {}
+        events, self._pending_events = self._pending_events, []
+        if not participants and not events:
+            return
+        
+        # Events identified by user/session resolve from the cache when possible
+        for event in events:
+            if event['participant_id'] is None and event['participant_key'] is not None:
+                known = self._known_participants.get((event['test_id'], event['participant_key']))
+                if known is not None:
+                    event['participant_id'] = known[0]
         
-        db.add(event)
-        
-        # Update participant metrics
-        participant.last_interaction_at = datetime.utcnow()
-        if not participant.first_interaction_at:
-            participant.first_interaction_at = datetime.utcnow()
-        
-        if event_data.event_type == ABTestEventType.VIEW:
-            participant.page_views += 1
-        elif event_data.event_type == ABTestEventType.CONVERSION:
-            if not participant.converted:
-                participant.converted = True
-                participant.conversion_at = datetime.utcnow()
-                participant.conversion_value = event_data.event_value or 0
-                
-                # Update variant conversion count
-                variant = db.query(ABTestVariant).filter(
-                    ABTestVariant.id == event_data.variant_id
-                ).first()
-                if variant:
-                    variant.conversions_count += 1
-                    variant.total_revenue += event_data.event_value or 0
-        
-        db.commit()
-        db.refresh(event)
+        try:
+            resolved = await asyncio.to_thread(self._write_batches, participants, events)
+        except Exception as e:
+            self.logger.error(f"Failed to flush A/B testing buffers: {e}")
+            for cache_key, row in participants.items():
+                self._pending_participants.setdefault(cache_key, row)
+            room = max(0, self.buffer_max - len(self._pending_events))
+            self.dropped_events += max(0, len(events) - room)
+            self._pending_events[:0] = events[:room]
+            return
+        
+        # Lookup after insert returns the stored variant even if another worker won the race
+        self._remember_participants(resolved)
+    
+    def _remember_participants(self, resolved: Dict[ParticipantKey, Tuple[int, int]]):
+        for cache_key, value in resolved.items():
+            self._known_participants[cache_key] = value
+            self._known_participants.move_to_end(cache_key)
+        while len(self._known_participants) > self._known_max:
+            self._known_participants.popitem(last=False)
+
+    def _write_batches(
+        self,
+        participants: Dict[ParticipantKey, Dict[str, Any]],
+        events: List[Dict[str, Any]]
+    ) -> Dict[ParticipantKey, Tuple[int, int]]:
+        with SessionLocal() as db:
+            if participants:
+                self._insert_participants(db, list(participants.values()))
+                db.commit()
+            
+            wanted = set(participants.keys())
+            wanted.update(
+                (event['test_id'], event['participant_key']) for event in events
+                if event['participant_id'] is None and event['participant_key'] is not None
+            )
+            resolved = self._lookup_participants(db, wanted)
+            
+            rows = []
+            for event in events:
+                participant_id = event['participant_id']
+                if participant_id is None and event['participant_key'] is not None:
+                    participant_id = resolved.get((event['test_id'], event['participant_key']), (None,))[0]
+                if participant_id is None:
+                    self.dropped_events += 1
+                    continue
+                row = {k: v for k, v in event.items() if k != 'participant_key'}
+                row['participant_id'] = participant_id
+                rows.append(row)
+            
+            if rows:
+                # Events for unknown participants would fail the whole batch on the foreign key
+                ids = {row['participant_id'] for row in rows}
+                existing = {
+                    participant_id for (participant_id,) in
+                    db.query(ABTestParticipant.id).filter(ABTestParticipant.id.in_(ids)).all()
+                }
+                valid = [row for row in rows if row['participant_id'] in existing]
+                self.dropped_events += len(rows) - len(valid)
+                if valid:
+                    db.execute(insert(ABTestEvent), valid)
+                    db.commit()
+            return resolved
+
+    def _insert_participants(self, db: Session, rows: List[Dict[str, Any]]):
+        """Insert participants, ignoring ones already written by another worker"""
+        dialect = db.bind.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            dialect_insert = None
         
-        return event
+        if dialect_insert is not None:
+            statement = dialect_insert(ABTestParticipant).on_conflict_do_nothing(
+                index_elements=['test_id', 'participant_key']
+            )
+            db.execute(statement, rows)
+            return
+        
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(ABTestParticipant), [row])
+            except IntegrityError:
+                pass
+
+    def _lookup_participants(
+        self,
+        db: Session,
+        keys: set
+    ) -> Dict[ParticipantKey, Tuple[int, int]]:
+        if not keys:
+            return {}
+        rows = db.query(
+            ABTestParticipant.id, ABTestParticipant.test_id,
+            ABTestParticipant.participant_key, ABTestParticipant.variant_id
+        ).filter(
+            ABTestParticipant.test_id.in_({test_id for test_id, _ in keys}),
+            ABTestParticipant.participant_key.in_({key for _, key in keys})
+        ).all()
+        return {
+            (row.test_id, row.participant_key): (row.id, row.variant_id)
+            for row in rows if (row.test_id, row.participant_key) in keys
+        }
+
+    # Rollup of variant aggregates
+    def rollup(self) -> Dict[str, int]:
+        """Fold new participants and events into participant metrics and variant counters"""
+        with SessionLocal() as db:
+            return {
+                'participants': self._rollup_participants(db),
+                'events': self._rollup_events(db)
+            }
+
+    def _rollup_participants(self, db: Session) -> int:
+        cutoff = datetime.utcnow() - self.commit_lag
+        total = 0
+        while True:
+            watermark = self._lock_watermark(db, 'ab_test_participants')
+            if watermark is None:
+                return total
+            
+            rows = db.query(
+                ABTestParticipant.id, ABTestParticipant.variant_id,
+                ABTestParticipant.assigned_at.label('created_at')
+            ).filter(ABTestParticipant.id > watermark.last_id).order_by(ABTestParticipant.id).limit(
+                self.rollup_batch
+            ).all()
+            fetched = len(rows)
+            rows = self._committed_prefix(rows, cutoff)
+            if not rows:
+                db.commit()
+                return total
+            
+            counts: Dict[int, int] = defaultdict(int)
+            for row in rows:
+                counts[row.variant_id] += 1
+            for variant_id, count in counts.items():
+                db.execute(
+                    update(ABTestVariant)
+                    .where(ABTestVariant.id == variant_id)
+                    .values(participants_count=ABTestVariant.participants_count + count)
+                )
+            
+            watermark.last_id = rows[-1].id
+            watermark.rows_processed = (watermark.rows_processed or 0) + len(rows)
+            db.commit()
+            
+            total += len(rows)
+            if fetched < self.rollup_batch or len(rows) < fetched:
+                return total
+
+    def _rollup_events(self, db: Session) -> int:
+        cutoff = datetime.utcnow() - self.commit_lag
+        total = 0
+        while True:
+            watermark = self._lock_watermark(db, 'ab_test_events')
+            if watermark is None:
+                return total
+            
+            rows = db.query(
+                ABTestEvent.id, ABTestEvent.participant_id, ABTestEvent.event_type,
+                ABTestEvent.event_value, ABTestEvent.created_at
+            ).filter(ABTestEvent.id > watermark.last_id).order_by(ABTestEvent.id).limit(self.rollup_batch).all()
+            fetched = len(rows)
+            rows = self._committed_prefix(rows, cutoff)
+            if not rows:
+                db.commit()
+                return total
+            
+            # Events are processed in id order: the first one seen is the earliest
+            activity: Dict[int, Dict[str, Any]] = {}
+            for row in rows:
+                entry = activity.setdefault(
+                    row.participant_id, {'views': 0, 'first': row.created_at, 'last': None, 'conversion': None}
+                )
+                entry['last'] = row.created_at
+                if row.event_type == ABTestEventType.VIEW:
+                    entry['views'] += 1
+                elif row.event_type == ABTestEventType.CONVERSION and entry['conversion'] is None:
+                    entry['conversion'] = (row.created_at, row.event_value or 0)
+            
+            variant_totals: Dict[int, List[float]] = defaultdict(lambda: [0, 0.0])
+            participants = db.query(ABTestParticipant).filter(ABTestParticipant.id.in_(activity.keys())).all()
+            for participant in participants:
+                entry = activity[participant.id]
+                participant.page_views = (participant.page_views or 0) + entry['views']
+                participant.last_interaction_at = entry['last']
+                if not participant.first_interaction_at:
+                    participant.first_interaction_at = entry['first']
+                if entry['conversion'] is not None and not participant.converted:
+                    participant.converted = True
+                    participant.conversion_at, participant.conversion_value = entry['conversion']
+                    variant_totals[participant.variant_id][0] += 1
+                    variant_totals[participant.variant_id][1] += entry['conversion'][1]
+            
+            for variant_id, (conversions, revenue) in variant_totals.items():
+                db.execute(
+                    update(ABTestVariant)
+                    .where(ABTestVariant.id == variant_id)
+                    .values(
+                        conversions_count=ABTestVariant.conversions_count + conversions,
+                        total_revenue=ABTestVariant.total_revenue + revenue
+                    )
+                )
+            
+            watermark.last_id = rows[-1].id
+            watermark.rows_processed = (watermark.rows_processed or 0) + len(rows)
+            db.commit()
+            
+            total += len(rows)
+            if fetched < self.rollup_batch or len(rows) < fetched:
+                return total
+
+    @staticmethod
+    def _committed_prefix(rows: List[Any], cutoff: datetime) -> List[Any]:
+        """Rows up to the first one newer than cutoff
+
+        Ids are allocated before commit, so a lower id may still be in an open
+        transaction; the watermark only moves past rows older than the commit lag.
+        """
+        for index, row in enumerate(rows):
+            if to_utc_naive(row.created_at) > cutoff:
+                return rows[:index]
+        return rows
+
+    def _lock_watermark(self, db: Session, source: str) -> Optional[RollupWatermark]:
+        """Watermark row under lock so that several workers never count twice"""
+        watermark = db.query(RollupWatermark).filter(RollupWatermark.source == source).with_for_update().first()
+        if watermark is not None:
+            return watermark
+        try:
+            watermark = RollupWatermark(source=source, last_id=0, rows_processed=0)
+            db.add(watermark)
+            db.flush()
+            return watermark
+        except IntegrityError:
+            db.rollback()
+            return None
+
+    def get_buffer_stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running,
+            'pending_participants': len(self._pending_participants),
+            'pending_events': len(self._pending_events),
+            'known_participants': len(self._known_participants),
+            'cached_tests': len(self._test_configs),
+            'dropped_events': self.dropped_events
+        }
 
     # Analytics and Statistics
     async def get_test_statistics(self, db: Session, test_id: int) -> Optional[Dict[str, Any]]:
@@ -444,9 +836,17 @@ class ABTestingService:
         
         return percentage <= traffic_allocation
 
-    def _select_variant(self, variants: List[ABTestVariant], user_id: Optional[int], session_id: Optional[str]) -> Optional[ABTestVariant]:
+    def _participant_key(self, user_id: Optional[int], session_id: Optional[str]) -> Optional[str]:
+        """Stable participant identity within a test"""
+        if user_id:
+            return f"u:{user_id}"
+        if session_id:
+            return f"s:{session_id}"
+        return None
+
+    def _select_variant(self, config: _TestConfig, user_id: Optional[int], session_id: Optional[str]) -> Optional[int]:
         """Select a variant for a user based on traffic distribution"""
-        if not variants:
+        if not config.variants:
             return None
         
         # Use consistent hashing for variant selection
@@ -455,14 +855,12 @@ class ABTestingService:
         percentage = hash_value % 100
         
         # Select variant based on cumulative traffic percentages
-        cumulative = 0
-        for variant in sorted(variants, key=lambda v: v.id):  # Ensure consistent ordering
-            cumulative += variant.traffic_percentage
-            if percentage < cumulative:
-                return variant
+        for variant_id, upper_bound in config.variants:
+            if percentage < upper_bound:
+                return variant_id
         
         # Fallback to first variant
-        return variants[0]
+        return config.variants[0][0]
 
     async def _perform_statistical_analysis(self, variant_stats: List[Dict], confidence_level: float) -> Dict[str, Any]:
         """Perform statistical analysis on variant data"""
@@ -1,16 +1,57 @@
 """
 AI-классификатор типов документов
 Использует LLM для более точного определения типа документа
+
+Пакетная классификация (classify_batch): сначала правила по шапке документа,
+затем кеш результатов по хешу текста (Redis через cache_service), и только
+оставшиеся неоднозначные документы упаковываются по несколько штук в один
+промпт; пакеты выполняются параллельно.
 """
 
+import asyncio
+import hashlib
 import logging
 import json
-from typing import Dict, Any, Optional
-from .unified_llm_service import unified_llm_service
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+from ..core.cache import cache_service
+from ..core.config import settings
+from .unified_llm_service import unified_llm_service, RequestPriority
 from .vector_store_service import determine_document_type
 
 logger = logging.getLogger(__name__)
 
+VALID_TYPES = (
+    'codex', 'federal_law', 'supreme_court_resolution',
+    'resolution', 'decree', 'order', 'other'
+)
+
+DOCUMENT_TYPES_DESCRIPTION = """Типы документов:
+- codex: Кодекс (Гражданский кодекс РФ, Уголовный кодекс РФ, Трудовой кодекс РФ и т.д.)
+- federal_law: Федеральный закон (ФЗ, например "О защите прав потребителей")
+- supreme_court_resolution: Постановление Верховного Суда РФ или Пленума ВС РФ
+- resolution: Постановление (Правительства РФ, министерств, ведомств)
+- decree: Указ Президента РФ
+- order: Приказ (министерств, ведомств, федеральных служб)
+- other: Другое (не подходит ни к одной категории)"""
+
+# Вид документа и издавший орган стоят в первых строках официального текста
+HEADER_CHARS = 600
+HEADER_PATTERNS = {
+    "codex": re.compile(r"кодекс\s+российской\s+федерации"),
+    "federal_law": re.compile(r"федеральный\s+закон\b"),
+    "supreme_court_resolution": re.compile(r"пленума?\s+верховного\s+суда|верховный\s+суд\s+российской\s+федерации"),
+    "decree": re.compile(r"указ\s+президента"),
+    "resolution": re.compile(r"правительство\s+российской\s+федерации\s+постановление|постановление\s+правительства"),
+    "order": re.compile(r"\bприказ\b")
+}
+
+CLASSIFICATION_TEXT_CHARS = 2000
+BATCH_ITEM_PATTERN = re.compile(r"\{[^{}]*\}")
+BATCH_LINE_PATTERN = re.compile(r"(\d+)\s*[:.)\-]\s*\"?(" + "|".join(VALID_TYPES) + r")\b")
+
 
 class AIDocumentClassifier:
     """AI-классификатор документов с использованием LLM"""
@@ -18,16 +59,27 @@ class AIDocumentClassifier:
     def __init__(self):
         self.llm_service = unified_llm_service
         self.use_ai = True  # Можно отключить для быстрой работы
+        self.batch_size = settings.CLASSIFIER_BATCH_SIZE
+        self.batch_chars = settings.CLASSIFIER_BATCH_CHARS
+        self.concurrency = settings.CLASSIFIER_CONCURRENCY
+        self.cache_ttl = settings.CLASSIFIER_CACHE_TTL
+        self.local_cache_size = settings.CLASSIFIER_LOCAL_CACHE_SIZE
+        self._local_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.stats = {"rule": 0, "cache": 0, "llm_documents": 0, "llm_requests": 0}
         
     async def classify_document_ai(
         self, 
         text_content: str,
         file_name: str = "",
-        document_id: str = ""
+        document_id: str = "",
+        priority: RequestPriority = RequestPriority.NORMAL
     ) -> Dict[str, Any]:
         """
         Классифицирует документ с помощью AI
         
+        priority=LOW используется фоновой очередью анализа (генерация уступает чату)
+        
         Returns:
             {
                 "type": "codex|federal_law|...",
@@ -61,18 +113,19 @@ class AIDocumentClassifier:
                 "method": "rule"
             }
         
+        cache_key = self._content_key(text_content)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
-            prompt = self._create_classification_prompt(text_content[:2000])
-            
-            response = await self.llm_service.generate_async(
-                prompt=prompt,
-                max_tokens=100,
-                temperature=0.1,  # Низкая температура для точности
-                stream=False
-            )
+            prompt = self._create_classification_prompt(text_content[:CLASSIFICATION_TEXT_CHARS])
+            response = await self._generate(prompt, max_tokens=100, priority=priority)
             
             # Парсим ответ
             result = self._parse_ai_response(response, rule_type)
+            if str(result.get("method", "")).startswith("ai"):
+                await self._cache_set(cache_key, result)
             return result
             
         except Exception as e:
@@ -91,14 +144,7 @@ class AIDocumentClassifier:
 Документ (первые 2000 символов):
 {text_content}
 
-Типы документов:
-- codex: Кодекс (Гражданский кодекс РФ, Уголовный кодекс РФ, Трудовой кодекс РФ и т.д.)
-- federal_law: Федеральный закон (ФЗ, например "О защите прав потребителей")
-- supreme_court_resolution: Постановление Верховного Суда РФ или Пленума ВС РФ
-- resolution: Постановление (Правительства РФ, министерств, ведомств)
-- decree: Указ Президента РФ
-- order: Приказ (министерств, ведомств, федеральных служб)
-- other: Другое (не подходит ни к одной категории)
+{DOCUMENT_TYPES_DESCRIPTION}
 
 Верни ТОЛЬКО JSON в формате:
 {{
@@ -124,12 +170,7 @@ class AIDocumentClassifier:
             result = json.loads(response)
             
             # Валидация
-            valid_types = [
-                'codex', 'federal_law', 'supreme_court_resolution',
-                'resolution', 'decree', 'order', 'other'
-            ]
-            
-            if result.get('type') not in valid_types:
+            if result.get('type') not in VALID_TYPES:
                 result['type'] = fallback_type
             
             result['method'] = 'ai'
@@ -156,25 +197,286 @@ class AIDocumentClassifier:
                 "method": "rule_fallback"
             }
     
+    async def _generate(self, prompt: str, max_tokens: int, priority: RequestPriority) -> str:
+        response = ""
+        async for chunk in self.llm_service.generate_response(
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=0.1,  # Низкая температура для точности
+            stream=True,
+            priority=priority
+        ):
+            response += chunk
+        return response
+    
+    def _classify_by_rules(self, text_content: str, file_name: str, document_id: str) -> Optional[Dict[str, Any]]:
+        """Уверенная классификация без LLM: None, если документ неоднозначен"""
+        if document_id.startswith('codex_') or 'кодекс' in file_name.lower():
+            return {
+                "type": "codex",
+                "confidence": 0.95,
+                "reason": "Определено по правилам (кодекс)",
+                "method": "rule"
+            }
+        
+        header = (text_content or "")[:HEADER_CHARS].lower().replace('ё', 'е')
+        matched = [doc_type for doc_type, pattern in HEADER_PATTERNS.items() if pattern.search(header)]
+        if len(matched) == 1:
+            return {
+                "type": matched[0],
+                "confidence": 0.9,
+                "reason": "Определено по правилам (шапка документа)",
+                "method": "rule"
+            }
+        return None
+    
+    def _content_key(self, text_content: str) -> str:
+        """Ключ кеша: хеш текста, который видит модель"""
+        digest = hashlib.sha256(text_content[:CLASSIFICATION_TEXT_CHARS].strip().encode('utf-8')).hexdigest()
+        return f"doc_classification:{digest}"
+    
+    async def _cache_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._cache_lock:
+            result = self._local_cache.get(key)
+            if result is not None:
+                self._local_cache.move_to_end(key)
+        if result is None:
+            try:
+                result = await cache_service.get(key)
+            except Exception as e:
+                logger.warning(f"Кеш классификации недоступен: {e}")
+            if result is None:
+                return None
+            self._remember(key, result)
+        self.stats["cache"] += 1
+        return dict(result)
+    
+    async def _cache_set(self, key: str, result: Dict[str, Any]):
+        self._remember(key, result)
+        try:
+            await cache_service.set(key, result, ttl=self.cache_ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить классификацию в кеш: {e}")
+    
+    def _remember(self, key: str, result: Dict[str, Any]):
+        with self._cache_lock:
+            self._local_cache[key] = dict(result)
+            self._local_cache.move_to_end(key)
+            while len(self._local_cache) > self.local_cache_size:
+                self._local_cache.popitem(last=False)
+    
     async def classify_batch(
         self, 
-        documents: List[Dict[str, str]]
+        documents: List[Dict[str, str]],
+        priority: RequestPriority = RequestPriority.NORMAL
     ) -> List[Dict[str, Any]]:
         """
         Классифицирует несколько документов за раз (батчинг)
-        Эффективнее чем по одному
+        
+        Документы, тип которых ясен по правилам или уже есть в кеше, до LLM
+        не доходят; одинаковые тексты классифицируются один раз; остальные
+        отправляются пакетами по batch_size в одном промпте.
         """
-        results = []
+        results: List[Optional[Dict[str, Any]]] = [None] * len(documents)
+        pending: Dict[str, List[int]] = {}  # ключ кеша -> индексы документов с этим текстом
         
-        for doc in documents:
-            result = await self.classify_document_ai(
+        for i, doc in enumerate(documents):
+            text_content = doc.get('text', '') or ''
+            file_name = doc.get('file_name', '') or ''
+            document_id = doc.get('document_id', '') or ''
+            
+            result = self._classify_by_rules(text_content, file_name, document_id)
+            if result is None and (not self.use_ai or not text_content):
+                result = {
+                    "type": determine_document_type(file_name, document_id, text_content),
+                    "confidence": 0.7,
+                    "reason": "Определено по правилам",
+                    "method": "rule"
+                }
+            if result is not None:
+                self.stats["rule"] += 1
+                results[i] = result
+                continue
+            pending.setdefault(self._content_key(text_content), []).append(i)
+        
+        for key in list(pending):
+            cached = await self._cache_get(key)
+            if cached is not None:
+                for i in pending.pop(key):
+                    results[i] = dict(cached)
+        
+        if pending:
+            keys = list(pending)
+            chunks = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+            semaphore = asyncio.Semaphore(self.concurrency)
+            
+            async def run(chunk: List[str]) -> Dict[str, Dict[str, Any]]:
+                async with semaphore:
+                    return await self._classify_chunk(
+                        [(key, documents[pending[key][0]]) for key in chunk], priority
+                    )
+            
+            for chunk_results in await asyncio.gather(*(run(chunk) for chunk in chunks)):
+                for key, result in chunk_results.items():
+                    for i in pending[key]:
+                        results[i] = dict(result)
+        
+        return results
+    
+    async def _classify_chunk(
+        self,
+        items: List[Tuple[str, Dict[str, str]]],
+        priority: RequestPriority
+    ) -> Dict[str, Dict[str, Any]]:
+        """Один запрос к LLM для нескольких документов"""
+        if len(items) == 1:
+            key, doc = items[0]
+            self.stats["llm_documents"] += 1
+            self.stats["llm_requests"] += 1
+            return {key: await self.classify_document_ai(
                 text_content=doc.get('text', ''),
                 file_name=doc.get('file_name', ''),
-                document_id=doc.get('document_id', '')
-            )
-            results.append(result)
+                document_id=doc.get('document_id', ''),
+                priority=priority
+            )}
+        
+        fallbacks = {
+            key: determine_document_type(doc.get('file_name', ''), doc.get('document_id', ''), doc.get('text', ''))
+            for key, doc in items
+        }
+        prompt = self._create_batch_prompt([doc.get('text', '')[:self.batch_chars] for _, doc in items])
+        self.stats["llm_documents"] += len(items)
+        self.stats["llm_requests"] += 1
         
+        try:
+            response = await self._generate(prompt, max_tokens=60 * len(items) + 50, priority=priority)
+        except Exception as e:
+            logger.error(f"Ошибка пакетной AI-классификации: {e}")
+            return {
+                key: {
+                    "type": fallbacks[key],
+                    "confidence": 0.6,
+                    "reason": f"Ошибка AI, использованы правила: {str(e)}",
+                    "method": "rule_fallback"
+                }
+                for key, _ in items
+            }
+        
+        parsed = self._parse_batch_response(response, len(items))
+        results = {}
+        missing = []
+        for number, (key, doc) in enumerate(items, 1):
+            item = parsed.get(number)
+            if item is None:
+                missing.append((key, doc))
+                continue
+            result = self._normalize_batch_item(item, fallbacks[key])
+            if result["method"].startswith("ai"):
+                await self._cache_set(key, result)
+            results[key] = result
+        
+        # Документы, пропущенные моделью, классифицируются отдельными запросами
+        if missing:
+            logger.warning(f"Пакетный ответ AI без {len(missing)} из {len(items)} документов")
+            singles = await asyncio.gather(*(
+                self.classify_document_ai(
+                    text_content=doc.get('text', ''),
+                    file_name=doc.get('file_name', ''),
+                    document_id=doc.get('document_id', ''),
+                    priority=priority
+                )
+                for _, doc in missing
+            ))
+            self.stats["llm_requests"] += len(missing)
+            for (key, _), result in zip(missing, singles):
+                results[key] = result
         return results
+    
+    def _create_batch_prompt(self, texts: List[str]) -> str:
+        """Промпт для нескольких документов с ответом в виде JSON-массива"""
+        documents = "\n\n".join(
+            f"### Документ {number}\n{text}" for number, text in enumerate(texts, 1)
+        )
+        return f"""Ты - эксперт по российскому праву. Определи тип каждого документа.
+
+{DOCUMENT_TYPES_DESCRIPTION}
+
+Документы (начало текста каждого):
+{documents}
+
+Верни ТОЛЬКО JSON-массив из {len(texts)} объектов, по одному на документ, в формате:
+[
+    {{"id": номер документа, "type": "один из типов выше", "confidence": число от 0.0 до 1.0, "reason": "краткое объяснение"}}
+]
+
+Ответ (только JSON, без дополнительного текста):"""
+    
+    def _parse_batch_response(self, response: str, count: int) -> Dict[int, Dict[str, Any]]:
+        """
+        Разбирает пакетный ответ в {номер документа: объект}
+        
+        Модель может обрезать массив, добавить текст вокруг или потерять id:
+        сначала пробуем весь JSON, затем отдельные объекты, затем строки вида "1: order".
+        """
+        response = response.strip()
+        if response.startswith('```'):
+            lines = response.split('\n')
+            response = '\n'.join(lines[1:-1]) if len(lines) > 2 else response
+        
+        items: List[Any] = []
+        try:
+            data = json.loads(response)
+            if isinstance(data, dict):
+                data = data.get('results') or data.get('documents') or [data]
+            if isinstance(data, list):
+                items = [item for item in data if isinstance(item, dict)]
+        except json.JSONDecodeError:
+            for match in BATCH_ITEM_PATTERN.finditer(response):
+                try:
+                    item = json.loads(match.group(0))
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(item, dict):
+                    items.append(item)
+        
+        parsed: Dict[int, Dict[str, Any]] = {}
+        positional = len(items) == count and not any('id' in item for item in items)
+        for position, item in enumerate(items, 1):
+            number = position if positional else self._item_number(item.get('id'))
+            if number is not None and 1 <= number <= count and number not in parsed:
+                parsed[number] = item
+        
+        if not parsed:
+            for match in BATCH_LINE_PATTERN.finditer(response.lower()):
+                number = int(match.group(1))
+                if 1 <= number <= count and number not in parsed:
+                    parsed[number] = {"type": match.group(2), "confidence": 0.7, "reason": "Извлечено из текстового ответа AI"}
+        return parsed
+    
+    @staticmethod
+    def _item_number(value: Any) -> Optional[int]:
+        match = re.search(r"\d+", str(value)) if value is not None else None
+        return int(match.group(0)) if match else None
+    
+    def _normalize_batch_item(self, item: Dict[str, Any], fallback_type: str) -> Dict[str, Any]:
+        doc_type = str(item.get('type', '')).strip().lower()
+        if doc_type not in VALID_TYPES:
+            return {
+                "type": fallback_type,
+                "confidence": 0.6,
+                "reason": "Не удалось распарсить ответ AI",
+                "method": "rule_fallback"
+            }
+        try:
+            confidence = min(1.0, max(0.0, float(item.get('confidence', 0.7))))
+        except (TypeError, ValueError):
+            confidence = 0.7
+        return {
+            "type": doc_type,
+            "confidence": confidence,
+            "reason": str(item.get('reason', '')),
+            "method": "ai_batch"
+        }
 
 
 # Глобальный экземпляр
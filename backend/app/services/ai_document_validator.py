@@ -8,7 +8,7 @@ import json
 from typing import Dict, Any, List, Optional
 from enum import Enum
 
-from .unified_llm_service import unified_llm_service
+from .unified_llm_service import unified_llm_service, RequestPriority
 
 logger = logging.getLogger(__name__)
 
@@ -69,13 +69,15 @@ class AIDocumentValidator:
 ДОКУМЕНТ ДЛЯ АНАЛИЗА:
 """
 
-    async def validate_document(self, text: str, filename: str = None) -> Dict[str, Any]:
+    async def validate_document(self, text: str, filename: str = None,
+                                priority: RequestPriority = RequestPriority.NORMAL) -> Dict[str, Any]:
         """
         Валидирует документ с помощью AI модели
         
         Args:
             text: Текст документа
             filename: Имя файла (опционально)
+            priority: Приоритет LLM-запроса (LOW - фоновая очередь, уступает чату)
             
         Returns:
             Dict с результатами валидации
@@ -102,7 +104,8 @@ class AIDocumentValidator:
                 prompt=full_prompt,
                 max_tokens=500,
                 temperature=0.1,  # Низкая температура для более детерминированного ответа
-                stream=True
+                stream=True,
+                priority=priority
             ):
                 response += chunk
             
@@ -16,6 +16,7 @@ from ..models.analytics import (
     CohortAnalysis, UserSegment, MLPrediction, ReportTemplate, ReportExecution
 )
 from ..models.user import User
+from ..models.rollup import TOTAL_BUCKET_START
 from ..schemas.analytics import (
     DashboardCreate, DashboardUpdate, DashboardWidgetCreate, DashboardWidgetUpdate,
     CustomMetricCreate, CustomMetricUpdate, MetricAlertCreate, MetricAlertUpdate,
@@ -23,6 +24,7 @@ from ..schemas.analytics import (
     DataSourceInfo, WidgetData
 )
 from ..core.database import get_db
+from .rollup_service import rollup_service
 
 logger = logging.getLogger(__name__)
 
@@ -394,6 +396,10 @@ class AnalyticsService:
             filters = config.get('filters', {})
             group_by = config.get('group_by')
             
+            # Без дополнительных фильтров данные берутся из rollup-таблиц
+            if not filters:
+                return self._get_users_data_from_rollups(db, time_range, group_by)
+            
             # Базовый запрос
             query = db.query(User)
             
@@ -409,10 +415,10 @@ class AnalyticsService:
             
             if group_by == 'hour':
                 # Группировка по часам
-                results = query.all()
+                results = query.with_entities(User.created_at).all()
                 hourly_data = {}
-                for user in results:
-                    hour = user.created_at.strftime('%H:00')
+                for (created_at,) in results:
+                    hour = created_at.strftime('%H:00')
                     hourly_data[hour] = hourly_data.get(hour, 0) + 1
                 
                 return WidgetData(
@@ -440,6 +446,37 @@ class AnalyticsService:
             logger.error(f"Error getting users data: {e}")
             return WidgetData(labels=[], datasets=[])
     
+    def _get_users_data_from_rollups(self, db: Session, time_range: Optional[str], group_by: Optional[str]) -> WidgetData:
+        """Данные пользователей из rollup-бакетов (суточных и почасовых)"""
+        start_time = self._parse_time_range(time_range) if time_range else TOTAL_BUCKET_START
+        
+        if group_by == 'hour':
+            series = rollup_service.get_series(db, "users.created", start_time)
+            hourly_data = {}
+            for bucket_start, value in series:
+                hour = bucket_start.strftime('%H:00')
+                hourly_data[hour] = hourly_data.get(hour, 0) + int(value)
+            
+            return WidgetData(
+                labels=list(hourly_data.keys()),
+                datasets=[{
+                    'label': 'Пользователи',
+                    'data': list(hourly_data.values()),
+                    'backgroundColor': 'rgba(59, 130, 246, 0.5)',
+                    'borderColor': 'rgb(59, 130, 246)'
+                }]
+            )
+        
+        count = int(rollup_service.get_sums_since(db, ["users.created"], start_time)["users.created"])
+        return WidgetData(
+            labels=['Всего'],
+            datasets=[{
+                'label': 'Пользователи',
+                'data': [count],
+                'backgroundColor': 'rgba(59, 130, 246, 0.5)'
+            }]
+        )
+    
     async def _get_queries_data(self, db: Session, config: Dict[str, Any]) -> WidgetData:
         """Получение данных запросов (заглушка)"""
         # Здесь должна быть логика получения данных из таблицы запросов
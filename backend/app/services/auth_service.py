@@ -1,53 +1,123 @@
+import asyncio
+import logging
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import case, or_, update
 from sqlalchemy.orm import Session
 
-from ..core.database import get_db
+from ..core.database import get_db, SessionLocal
 from ..core.config import settings
+from ..core.principal_cache import principal_cache
+from ..core.password_hashing import (
+    PasswordHasherBusy,
+    hash_password,
+    needs_rehash,
+    password_hasher,
+    verify_password as bcrypt_verify_password
+)
 from ..models.user import User
 
+logger = logging.getLogger(__name__)
+
 # OAuth2 схема
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
 class AuthService:
     def __init__(self):
-        pass
+        self._rehash_tasks = set()  # Ссылки на фоновые задачи, чтобы их не собрал GC
     
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
-        """Проверка пароля"""
-        try:
-            # Используем bcrypt напрямую для избежания проблем с passlib
-            return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
-        except Exception as e:
-            return False
+        """Проверка пароля (блокирующая, для синхронного кода)"""
+        return bcrypt_verify_password(plain_password, hashed_password)
     
     def get_password_hash(self, password: str) -> str:
-        """Хеширование пароля"""
-        # Используем bcrypt напрямую
-        salt = bcrypt.gensalt()
-        hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-        return hashed.decode('utf-8')
+        """Хеширование пароля (блокирующее, для синхронного кода)"""
+        return hash_password(password)
+    
+    async def get_password_hash_async(self, password: str) -> str:
+        """Хеширование пароля в пуле bcrypt"""
+        try:
+            return await password_hasher.hash(password)
+        except PasswordHasherBusy as e:
+            raise self._busy_exception(e)
+    
+    def _find_user_for_login(self, db: Session, login: str) -> Optional[User]:
+        """Пользователь по email или username одним запросом (совпадение по email приоритетнее)"""
+        return db.query(User).filter(
+            or_(User.email == login, User.username == login)
+        ).order_by(
+            case((User.email == login, 0), else_=1)
+        ).first()
     
     def authenticate_user(self, db: Session, email: str, password: str) -> Optional[User]:
-        """Аутентификация пользователя по email или username"""
-        # Сначала пробуем найти по email
-        user = db.query(User).filter(User.email == email).first()
-        
-        # Если не найден по email, пробуем по username
+        """Аутентификация пользователя по email или username (блокирующая)"""
+        user = self._find_user_for_login(db, email)
         if not user:
-            user = db.query(User).filter(User.username == email).first()
+            return None
+        if not self.verify_password(password, user.hashed_password):
+            return None
+        return user
+    
+    async def authenticate_user_async(self, db: Session, email: str, password: str) -> Optional[User]:
+        """
+        Аутентификация пользователя по email или username
         
+        bcrypt выполняется в пуле вне event loop; при переполнении очереди
+        возвращается 429. Хеши со старым cost пересчитываются в фоне.
+        """
+        user = self._find_user_for_login(db, email)
         if not user:
             return None
-        if not self.verify_password(password, user.hashed_password):
+        try:
+            valid = await password_hasher.verify(password, user.hashed_password)
+        except PasswordHasherBusy as e:
+            raise self._busy_exception(e)
+        if not valid:
             return None
+        
+        if needs_rehash(user.hashed_password) and password_hasher.has_capacity():
+            task = asyncio.create_task(self._rehash_password(user.id, user.hashed_password, password))
+            self._rehash_tasks.add(task)
+            task.add_done_callback(self._rehash_tasks.discard)
         return user
     
+    async def _rehash_password(self, user_id: int, old_hash: str, password: str):
+        """Пересчет хеша с текущим cost; не перезаписывает пароль, смененный за это время"""
+        try:
+            new_hash = await password_hasher.hash(password)
+            await asyncio.to_thread(self._store_rehashed_password, user_id, old_hash, new_hash)
+        except PasswordHasherBusy:
+            pass  # Пересчитаем при следующем входе
+        except Exception as e:
+            logger.warning(f"Password rehash failed for user {user_id}: {e}")
+    
+    def _store_rehashed_password(self, user_id: int, old_hash: str, new_hash: str):
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(User)
+                .where(User.id == user_id, User.hashed_password == old_hash)
+                .values(hashed_password=new_hash)
+            )
+            db.commit()
+        finally:
+            db.close()
+    
+    def _busy_exception(self, error: PasswordHasherBusy) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Слишком много попыток входа. Попробуйте позже.",
+            headers={"Retry-After": str(error.retry_after)}
+        )
+    
+    def token_claims(self, user: User) -> dict:
+        """Claims токена пользователя: sub и версия учетных данных"""
+        return {"sub": user.email, "av": user.auth_version or 0}
+    
     def create_access_token(self, data: dict, expires_delta: Optional[timedelta] = None, is_admin: bool = False):
         """Создание JWT токена с разными сроками для админов и пользователей"""
         to_encode = data.copy()
@@ -98,7 +168,8 @@ class AuthService:
         except JWTError:
             raise credentials_exception
         
-        user = db.query(User).filter(User.email == email).first()
+        # Пользователь из кеша (без запроса к БД) или из БД при промахе
+        user = principal_cache.resolve_user(db, payload)
         if user is None:
             raise credentials_exception
         
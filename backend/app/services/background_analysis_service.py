@@ -0,0 +1,444 @@
+"""
+Фоновая полоса AI-анализа документов
+
+Загрузка документа не ждет LLM: анализ, AI-валидация и AI-классификация ставятся
+в персистентную очередь (таблица analysis_jobs), а клиент сразу получает job_id.
+Воркер берет задачи только когда интерактивная очередь (чат) простаивает и
+генерирует с приоритетом LOW - UnifiedLLMService прерывает такую генерацию между
+токенами, как только приходит запрос пользователя, и повторяет ее после него
+(состояние модели к тому времени уже чужое). Результаты сохраняются
+в задаче и вливаются в метаданные чанков векторной базы.
+"""
+
+import asyncio
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import func, or_, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from ..core.config import settings
+from ..core.database import SessionLocal
+from ..models.analysis_job import AnalysisJob, AnalysisJobStatus, AnalysisJobType
+from .unified_llm_service import unified_llm_service, RequestPriority
+from .vector_store_service import vector_store_service
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер образца текста, сохраняемого в задаче (анализаторы используют первые 2000 символов)
+MAX_TEXT_SAMPLE = 2000
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+MetadataMerger = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+def _join(values: Any, limit: int = 20) -> str:
+    """Списки в метаданных ChromaDB хранятся строкой"""
+    if not values:
+        return ""
+    if isinstance(values, (list, tuple, set)):
+        return ", ".join(str(value) for value in list(values)[:limit])
+    return str(values)
+
+
+class _JobLease:
+    """Heartbeat выполняемой задачи; lost - задачу перехватил другой воркер"""
+
+    def __init__(self, service: "BackgroundAnalysisService", job_id: str, claimed_at: datetime):
+        self._service = service
+        self._job_id = job_id
+        self._claimed_at = claimed_at
+        self._interval = max(1.0, service.lease_seconds / 4)
+        self._task: Optional[asyncio.Task] = None
+        self.lost = False
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                if not await asyncio.to_thread(self._service._heartbeat, self._job_id, self._claimed_at):
+                    self.lost = True
+                    return
+            except Exception as e:
+                # Пропущенный heartbeat не страшен, пока аренда не истекла
+                logger.warning(f"Analysis job heartbeat for {self._job_id} failed: {e}")
+
+    async def __aenter__(self) -> "_JobLease":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+
+
+class BackgroundAnalysisService:
+    """Персистентная низкоприоритетная очередь LLM-анализа"""
+
+    def __init__(self):
+        self.enabled = settings.BACKGROUND_ANALYSIS_ENABLED
+        self.poll_interval = settings.BACKGROUND_ANALYSIS_POLL_INTERVAL
+        self.idle_grace = settings.BACKGROUND_ANALYSIS_IDLE_GRACE
+        self.max_attempts = settings.BACKGROUND_ANALYSIS_MAX_ATTEMPTS
+        self.lease_seconds = settings.BACKGROUND_ANALYSIS_LEASE_SECONDS
+        self.retry_delay = settings.BACKGROUND_ANALYSIS_RETRY_BASE_DELAY  # секунды
+        self.retry_max_delay = settings.BACKGROUND_ANALYSIS_RETRY_MAX_DELAY
+        self.llm_service = unified_llm_service
+
+        self._running = False
+        self._task: Optional[asyncio.Task] = None
+        self._current_job_id: Optional[str] = None
+        self._last_requeue_check = time.monotonic()
+
+        self._handlers: Dict[str, JobHandler] = {
+            AnalysisJobType.DOCUMENT_ANALYSIS: self._run_document_analysis,
+            AnalysisJobType.DOCUMENT_VALIDATION: self._run_document_validation,
+            AnalysisJobType.DOCUMENT_CLASSIFICATION: self._run_document_classification,
+        }
+        self._mergers: Dict[str, MetadataMerger] = {
+            AnalysisJobType.DOCUMENT_ANALYSIS: self._merge_document_analysis,
+            AnalysisJobType.DOCUMENT_VALIDATION: self._merge_document_validation,
+            AnalysisJobType.DOCUMENT_CLASSIFICATION: self._merge_document_classification,
+        }
+
+    async def start(self):
+        """Запуск воркера фоновой очереди"""
+        if self._running or not self.enabled:
+            return
+
+        await asyncio.to_thread(self._requeue_interrupted_jobs)
+        self._running = True
+        self._task = asyncio.create_task(self._worker_loop())
+        logger.info("Background analysis service started")
+
+    async def stop(self):
+        """Остановка воркера (выполняемая задача сразу возвращается в очередь)"""
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logger.info("Background analysis service stopped")
+
+    # ---- Постановка в очередь ----
+
+    def enqueue(
+        self,
+        job_type: str,
+        payload: Dict[str, Any],
+        target: Optional[Dict[str, Any]] = None,
+        priority: int = 0,
+        dedup_key: Optional[str] = None
+    ) -> str:
+        """Ставит задачу в очередь и возвращает job_id (незавершенный дубль по dedup_key переиспользуется)"""
+        if job_type not in self._handlers:
+            raise ValueError(f"Unknown analysis job type: {job_type}")
+
+        payload = dict(payload)
+        if isinstance(payload.get("text"), str):
+            payload["text"] = payload["text"][:MAX_TEXT_SAMPLE]
+
+        with SessionLocal() as db:
+            if dedup_key:
+                existing = db.query(AnalysisJob.id).filter(
+                    AnalysisJob.dedup_key == dedup_key,
+                    AnalysisJob.status.in_([AnalysisJobStatus.PENDING, AnalysisJobStatus.RUNNING])
+                ).first()
+                if existing:
+                    return existing.id
+
+            job = AnalysisJob(
+                id=str(uuid.uuid4()),
+                job_type=job_type,
+                status=AnalysisJobStatus.PENDING,
+                priority=priority,
+                dedup_key=dedup_key,
+                payload=payload,
+                target=target
+            )
+            db.add(job)
+            db.commit()
+            logger.info(f"🗂️ Analysis job queued: {job.id} ({job_type})")
+            return job.id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Статус и результат задачи"""
+        with SessionLocal() as db:
+            job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+            return job.to_dict() if job else None
+
+    def cancel_job(self, job_id: str) -> bool:
+        """Отменяет задачу, если она еще не начата"""
+        with SessionLocal() as db:
+            updated = db.query(AnalysisJob).filter(
+                AnalysisJob.id == job_id,
+                AnalysisJob.status == AnalysisJobStatus.PENDING
+            ).update({"status": AnalysisJobStatus.CANCELLED, "completed_at": datetime.utcnow()},
+                     synchronize_session=False)
+            db.commit()
+            return updated > 0
+
+    def get_queue_stats(self) -> Dict[str, Any]:
+        """Размер очереди по статусам"""
+        with SessionLocal() as db:
+            rows = db.query(AnalysisJob.status, func.count(AnalysisJob.id)).group_by(AnalysisJob.status).all()
+        return {
+            "enabled": self.enabled,
+            "running": self._running,
+            "current_job_id": self._current_job_id,
+            "interactive_idle": self.llm_service.is_interactive_idle(self.idle_grace),
+            "jobs": {status: count for status, count in rows}
+        }
+
+    # ---- Воркер ----
+
+    async def _worker_loop(self):
+        while self._running:
+            try:
+                # Задачи упавших воркеров возвращаются в очередь и пока чат занят
+                if time.monotonic() - self._last_requeue_check > self.lease_seconds / 2:
+                    self._last_requeue_check = time.monotonic()
+                    await asyncio.to_thread(self._requeue_interrupted_jobs)
+
+                # Фоновые задачи стартуют только при простое интерактивной очереди
+                if not self.llm_service.is_interactive_idle(self.idle_grace):
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                job = await asyncio.to_thread(self._claim_next_job)
+                if job is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in background analysis loop: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    def _requeue_interrupted_jobs(self) -> int:
+        """Возвращает в очередь задачи с истекшей арендой (воркер упал или завис)"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        try:
+            with SessionLocal() as db:
+                # Задачи живых воркеров продлевают heartbeat и не трогаются
+                count = db.execute(
+                    update(AnalysisJob).where(
+                        AnalysisJob.status == AnalysisJobStatus.RUNNING,
+                        AnalysisJob.heartbeat_at.is_(None) | (AnalysisJob.heartbeat_at < cutoff)
+                    ).values(status=AnalysisJobStatus.PENDING, heartbeat_at=None)
+                ).rowcount
+                db.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to requeue interrupted analysis jobs: {e}")
+            return 0
+        if count:
+            logger.info(f"Requeued {count} interrupted analysis jobs")
+        return count
+
+    def _claim_next_job(self) -> Optional[Dict[str, Any]]:
+        """Атомарно забирает следующую задачу (приоритет, затем FIFO), отложенные повторы ждут своего времени"""
+        now = datetime.utcnow()
+        # Секунды: значение сравнивается на равенство и в БД без дробных секунд
+        claimed_at = now.replace(microsecond=0)
+        with SessionLocal() as db:
+            job = db.query(AnalysisJob).filter(
+                AnalysisJob.status == AnalysisJobStatus.PENDING,
+                or_(AnalysisJob.next_attempt_at.is_(None), AnalysisJob.next_attempt_at <= now)
+            ).order_by(
+                AnalysisJob.priority.desc(), AnalysisJob.created_at
+            ).with_for_update(skip_locked=True).first()
+
+            if job is None:
+                return None
+
+            job.status = AnalysisJobStatus.RUNNING
+            job.started_at = claimed_at
+            job.heartbeat_at = claimed_at
+            job.next_attempt_at = None
+            job.attempts = (job.attempts or 0) + 1
+            db.commit()
+
+            return {
+                "id": job.id,
+                "job_type": job.job_type,
+                "payload": job.payload or {},
+                "target": job.target,
+                "attempts": job.attempts,
+                "claimed_at": claimed_at
+            }
+
+    async def _run_job(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        claimed_at = job["claimed_at"]
+        self._current_job_id = job_id
+        finished = False
+        try:
+            async with _JobLease(self, job_id, claimed_at) as lease:
+                result = await self._handlers[job["job_type"]](job["payload"])
+            if lease.lost:
+                logger.warning(f"⚠️ Analysis job {job_id} was taken over by another worker, result dropped")
+                return
+
+            updates = self._mergers[job["job_type"]](result)
+            merged = 0
+            if updates and job["target"]:
+                merged = await asyncio.to_thread(self._merge_into_chunks, job["target"], updates)
+
+            completed = await asyncio.to_thread(
+                self._finish_job, job_id, claimed_at,
+                status=AnalysisJobStatus.COMPLETED, result=result, error=None, completed_at=datetime.utcnow()
+            )
+            if not completed:
+                logger.warning(f"⚠️ Analysis job {job_id} lost its lease before completion")
+                return
+            logger.info(f"✅ Analysis job {job_id} completed ({merged} chunks updated)")
+            finished = True
+
+        except asyncio.CancelledError:
+            # Остановка сервиса: задача сразу возвращается в очередь, попытка не засчитывается
+            self._finish_job(
+                job_id, claimed_at,
+                status=AnalysisJobStatus.PENDING, attempts=AnalysisJob.attempts - 1
+            )
+            raise
+        except Exception as e:
+            retry = job["attempts"] < self.max_attempts
+            values: Dict[str, Any] = {"result": None, "error": str(e)}
+            if retry:
+                values["status"] = AnalysisJobStatus.PENDING
+                values["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=self._backoff(job["attempts"]))
+            else:
+                values["status"] = AnalysisJobStatus.FAILED
+                values["completed_at"] = datetime.utcnow()
+            if not await asyncio.to_thread(self._finish_job, job_id, claimed_at, **values):
+                logger.warning(f"⚠️ Analysis job {job_id} failed after its lease was lost: {e}")
+                return
+            if not retry and job["target"]:
+                await asyncio.to_thread(self._merge_into_chunks, job["target"], self._failure_updates(job["job_type"]))
+            logger.warning(f"⚠️ Analysis job {job_id} failed (attempt {job['attempts']}): {e}")
+            finished = not retry
+        finally:
+            self._current_job_id = None
+
+        if finished and job["job_type"] == AnalysisJobType.DOCUMENT_CLASSIFICATION:
+            vector_store_service.finish_ai_classification((job["payload"] or {}).get("document_id"))
+
+    def _backoff(self, attempts: int) -> float:
+        """Экспоненциальная задержка с джиттером"""
+        delay = min(self.retry_max_delay, self.retry_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _owned(self, job_id: str, claimed_at: datetime):
+        """Условие: задача все еще выполняется этим захватом"""
+        return (
+            (AnalysisJob.id == job_id)
+            & (AnalysisJob.status == AnalysisJobStatus.RUNNING)
+            & (AnalysisJob.started_at == claimed_at)
+        )
+
+    def _update_owned(self, job_id: str, claimed_at: datetime, **values) -> bool:
+        """Обновление задачи, только пока аренда принадлежит этому захвату"""
+        with SessionLocal() as db:
+            updated = db.execute(update(AnalysisJob).where(self._owned(job_id, claimed_at)).values(**values)).rowcount
+            db.commit()
+            return bool(updated)
+
+    def _heartbeat(self, job_id: str, claimed_at: datetime) -> bool:
+        """Продлевает аренду; False - задача возвращена в очередь и перехвачена"""
+        return self._update_owned(job_id, claimed_at, heartbeat_at=datetime.utcnow())
+
+    def _finish_job(self, job_id: str, claimed_at: datetime, **values) -> bool:
+        """Итоговое обновление задачи с освобождением аренды"""
+        return self._update_owned(job_id, claimed_at, heartbeat_at=None, **values)
+
+    def _merge_into_chunks(self, target: Dict[str, Any], updates: Dict[str, Any]) -> int:
+        """Вливает результат в метаданные чанков; target: {"ids": [...]} или {"where": {...}}"""
+        where = target.get("where")
+        if where and len(where) > 1:
+            where = {"$and": [{key: value} for key, value in where.items()]}
+        return vector_store_service.update_documents_metadata(
+            updates,
+            ids=target.get("ids"),
+            where=where
+        )
+
+    def _failure_updates(self, job_type: str) -> Dict[str, Any]:
+        if job_type == AnalysisJobType.DOCUMENT_VALIDATION:
+            return {"validation_status": AnalysisJobStatus.FAILED}
+        if job_type == AnalysisJobType.DOCUMENT_ANALYSIS:
+            return {"analysis_status": AnalysisJobStatus.FAILED}
+        return {}
+
+    # ---- Обработчики задач ----
+
+    async def _run_document_analysis(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        from .smart_document_processor import smart_document_processor
+
+        result = await smart_document_processor._extract_key_information(
+            payload.get("text", ""),
+            None,
+            priority=RequestPriority.LOW
+        )
+        if result.get("skipped"):
+            raise RuntimeError(result.get("error", "AI analysis skipped"))
+        return result
+
+    def _merge_document_analysis(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "analysis_status": AnalysisJobStatus.COMPLETED,
+            "ai_legal_concepts": _join(result.get("legal_concepts")),
+            "ai_procedures": _join(result.get("procedures")),
+            "ai_entities": _join(result.get("entities")),
+            "ai_responsibilities": _join(result.get("responsibilities")),
+            "ai_terms": _join(result.get("terms"))
+        }
+
+    async def _run_document_validation(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        from .ai_document_validator import ai_document_validator
+
+        result = await ai_document_validator.validate_document(
+            payload.get("text", ""),
+            payload.get("filename"),
+            priority=RequestPriority.LOW
+        )
+        result["document_type"] = str(getattr(result.get("document_type"), "value", result.get("document_type")))
+        return result
+
+    def _merge_document_validation(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "validation_status": AnalysisJobStatus.COMPLETED,
+            "ai_validation_is_valid": bool(result.get("is_valid")),
+            "ai_validation_confidence": float(result.get("confidence") or 0.0),
+            "ai_validation_reason": result.get("reason") or ""
+        }
+
+    async def _run_document_classification(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        from .ai_document_classifier import ai_document_classifier
+
+        return await ai_document_classifier.classify_document_ai(
+            text_content=payload.get("text", ""),
+            file_name=payload.get("file_name", ""),
+            document_id=payload.get("document_id", ""),
+            priority=RequestPriority.LOW
+        )
+
+    def _merge_document_classification(self, result: Dict[str, Any]) -> Dict[str, Any]:
+        updates = {
+            "ai_document_type": result.get("type"),
+            "ai_classification_confidence": float(result.get("confidence") or 0.0)
+        }
+        # Тип документа переопределяется только ответом модели, а не правилами-фоллбэком
+        if str(result.get("method", "")).startswith("ai") and result.get("type") and result.get("type") != "other":
+            updates["document_type"] = result["type"]
+        return updates
+
+
+# Глобальный экземпляр сервиса
+background_analysis_service = BackgroundAnalysisService()
@@ -23,6 +23,7 @@ from ..core.database import get_db
 from ..models.backup import BackupRecord, BackupSchedule, RestoreRecord, BackupIntegrityCheck
 from ..models.backup import BackupStatus, BackupType, RestoreStatus
 from ..services.notification_service import notification_service
+from ..services.backup_block_store import IncrementalBackupEngine, BlockStoreError, INDEX_FILENAME
 
 logger = logging.getLogger(__name__)
 
@@ -36,10 +37,23 @@ class EnhancedBackupService:
         self.backup_interval_hours = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))  # Каждые 6 часов
         self.compression_level = int(os.getenv("BACKUP_COMPRESSION_LEVEL", "6"))  # Уровень сжатия
         self.encryption_key = os.getenv("BACKUP_ENCRYPTION_KEY")  # Ключ шифрования
+        self.block_workers = int(os.getenv("BACKUP_BLOCK_WORKERS", str(os.cpu_count() or 4)))  # Потоки сжатия блоков
+        self.zstd_level = int(os.getenv("BACKUP_ZSTD_LEVEL", "3"))  # Уровень сжатия блоков
+        # Автоматические копии без расписаний: инкрементальные через хранилище блоков
+        self.automatic_incremental = os.getenv("BACKUP_INCREMENTAL", "false").lower() == "true"
+        self.schedule_poll_seconds = int(os.getenv("BACKUP_SCHEDULE_POLL_SECONDS", "60"))
         
         # Создаем директории
         os.makedirs(self.backup_dir, exist_ok=True)
         os.makedirs(os.path.join(self.backup_dir, "temp"), exist_ok=True)
+        
+        # Хранилище блоков для инкрементальных копий
+        self.block_engine = IncrementalBackupEngine(
+            os.path.join(self.backup_dir, "block_store"),
+            workers=self.block_workers,
+            compression_level=self.zstd_level,
+            encryption_key=self.encryption_key
+        )
     
     async def create_backup_with_record(
         self, 
@@ -51,7 +65,8 @@ class EnhancedBackupService:
         backup_type: BackupType = BackupType.MANUAL,
         compression_enabled: bool = True,
         encryption_enabled: bool = False,
-        retention_days: int = 30
+        retention_days: int = 30,
+        incremental: bool = False
     ) -> Dict[str, Any]:
         """Создает резервную копию с записью в базе данных"""
         
@@ -80,7 +95,9 @@ class EnhancedBackupService:
             db.commit()
             
             # Выполняем резервное копирование
-            result = await self._perform_backup(backup_record.id, components, compression_enabled, encryption_enabled)
+            result = await self._perform_backup(
+                backup_record.id, components, compression_enabled, encryption_enabled, incremental
+            )
             
             # Обновляем запись результатами
             backup_record.status = BackupStatus.COMPLETED if result["success"] else BackupStatus.FAILED
@@ -92,6 +109,9 @@ class EnhancedBackupService:
             backup_record.error_message = result.get("error")
             backup_record.warnings = result.get("warnings", [])
             backup_record.files_count = result.get("files_count", 0)
+            # Фактические настройки копии (инкрементальная сжимает блоки всегда, шифрует только с ключом)
+            backup_record.compression_enabled = result.get("compression_enabled", compression_enabled)
+            backup_record.encryption_enabled = result.get("encryption_enabled", encryption_enabled)
             
             if backup_record.started_at and backup_record.completed_at:
                 backup_record.duration_seconds = (backup_record.completed_at - backup_record.started_at).total_seconds()
@@ -180,18 +200,36 @@ class EnhancedBackupService:
                 "timestamp": datetime.now().isoformat()
             }
     
+    def _get_sqlite_path(self) -> str:
+        """Путь к файлу SQLite из DATABASE_URL"""
+        db_path = settings.DATABASE_URL.replace("sqlite:///", "").replace("sqlite://", "")
+        if db_path.startswith("./"):
+            db_path = os.path.join("backend", db_path[2:])
+        return db_path
+    
+    @staticmethod
+    def _sqlite_online_backup(source_db: str, backup_db_path: str):
+        """Согласованный снимок SQLite через online backup API (без остановки записи)"""
+        source = sqlite3.connect(f"file:{source_db}?mode=ro", uri=True)
+        target = sqlite3.connect(backup_db_path)
+        try:
+            with target:
+                # Копируем порциями страниц, чтобы не держать блокировку долго
+                source.backup(target, pages=1024)
+        finally:
+            target.close()
+            source.close()
+    
     async def _backup_main_database(self, backup_path: str) -> Dict[str, Any]:
         """Бэкап основной базы данных"""
         try:
             if settings.DATABASE_URL.startswith("sqlite"):
                 # SQLite бэкап
-                source_db = settings.DATABASE_URL.replace("sqlite:///", "").replace("sqlite://", "")
-                if source_db.startswith("./"):
-                    source_db = os.path.join("backend", source_db[2:])
+                source_db = self._get_sqlite_path()
                 
                 if os.path.exists(source_db):
                     backup_db_path = os.path.join(backup_path, "main_database.db")
-                    shutil.copy2(source_db, backup_db_path)
+                    await asyncio.to_thread(self._sqlite_online_backup, source_db, backup_db_path)
                     
                     # Проверяем целостность
                     conn = sqlite3.connect(backup_db_path)
@@ -221,7 +259,7 @@ class EnhancedBackupService:
                     "--no-acl",
                     "--no-owner",
                     "-f", backup_file,
-                    settings.DATABASE_URL
+                    self._libpq_url()
                 ]
                 
                 process = await asyncio.create_subprocess_exec(
@@ -312,36 +350,56 @@ class EnhancedBackupService:
             return {"status": "error", "error": str(e)}
     
     async def _cleanup_old_backups(self):
-        """Удаляет старые резервные копии"""
+        """Удаляет старые резервные копии (полные и инкрементальные) и неиспользуемые блоки"""
         try:
             if not os.path.exists(self.backup_dir):
                 return
             
-            # Получаем список всех бэкапов
-            backups = []
+            # Получаем список всех бэкапов: advakod_backup_{дата} и инкрементальные backup_{id}_{дата}
+            full_backups = []
+            incremental_backups = []
             for item in os.listdir(self.backup_dir):
                 item_path = os.path.join(self.backup_dir, item)
-                if os.path.isdir(item_path) and item.startswith("advakod_backup_"):
-                    try:
-                        # Извлекаем дату из имени
+                if not os.path.isdir(item_path):
+                    continue
+                try:
+                    # Извлекаем дату из имени
+                    if item.startswith("advakod_backup_"):
                         date_str = item.replace("advakod_backup_", "")
-                        backup_date = datetime.strptime(date_str, "%Y%m%d_%H%M%S")
-                        backups.append((backup_date, item_path))
-                    except ValueError:
-                        continue
-            
-            # Сортируем по дате (новые первыми)
-            backups.sort(key=lambda x: x[0], reverse=True)
-            
-            # Удаляем старые бэкапы
-            if len(backups) > self.max_backups:
+                        full_backups.append((datetime.strptime(date_str, "%Y%m%d_%H%M%S"), item_path))
+                    elif item.startswith("backup_") and os.path.exists(os.path.join(item_path, INDEX_FILENAME)):
+                        date_str = "_".join(item.split("_")[-2:])
+                        incremental_backups.append((datetime.strptime(date_str, "%Y%m%d_%H%M%S"), item_path))
+                except ValueError:
+                    continue
+            
+            for backups in (full_backups, incremental_backups):
+                # Сортируем по дате (новые первыми)
+                backups.sort(key=lambda x: x[0], reverse=True)
+                
+                # Удаляем старые бэкапы (у инкрементальных - вместе с индексом блоков)
                 for _, old_backup_path in backups[self.max_backups:]:
                     shutil.rmtree(old_backup_path)
                     logger.info(f"🗑️ Удален старый бэкап: {old_backup_path}")
+            
+            # Удаляем блоки, на которые больше не ссылается ни одна копия. Список индексов
+            # читается под блокировкой хранилища вместе со сборкой, чтобы не пропустить
+            # копию, которая завершится между этими шагами
+            gc_result = await asyncio.to_thread(self.block_engine.collect_garbage, self._live_indexes)
+            if gc_result["blocks_removed"]:
+                logger.info(f"🗑️ Удалено неиспользуемых блоков: {gc_result['blocks_removed']}")
                     
         except Exception as e:
             logger.error(f"❌ Ошибка очистки старых бэкапов: {e}")
     
+    def _live_indexes(self) -> List[str]:
+        """Индексы всех инкрементальных копий в каталоге бэкапов"""
+        return [
+            os.path.join(self.backup_dir, item, INDEX_FILENAME)
+            for item in os.listdir(self.backup_dir)
+            if os.path.exists(os.path.join(self.backup_dir, item, INDEX_FILENAME))
+        ]
+    
     async def _create_backup_manifest(self, backup_path: str, backup_info: Dict[str, Any]):
         """Создает манифест резервной копии"""
         try:
@@ -384,15 +442,17 @@ class EnhancedBackupService:
                     manifest = json.load(f)
                 logger.info(f"📋 Манифест загружен: {manifest['created_at']}")
             
+            # Инкрементальная копия собирается из хранилища блоков
+            if os.path.exists(os.path.join(backup_path, INDEX_FILENAME)):
+                return await self._restore_incremental_backup(backup_path)
+            
             result = {"status": "success", "restored": []}
             
             # Восстанавливаем основную БД
             main_db_path = os.path.join(backup_path, "main_database.db")
             if os.path.exists(main_db_path):
                 if settings.DATABASE_URL.startswith("sqlite"):
-                    target_db = settings.DATABASE_URL.replace("sqlite:///", "").replace("sqlite://", "")
-                    if target_db.startswith("./"):
-                        target_db = os.path.join("backend", target_db[2:])
+                    target_db = self._get_sqlite_path()
                     
                     shutil.copy2(main_db_path, target_db)
                     result["restored"].append("main_database")
@@ -477,9 +537,13 @@ class EnhancedBackupService:
         backup_id: int, 
         components: List[str], 
         compression_enabled: bool = True,
-        encryption_enabled: bool = False
+        encryption_enabled: bool = False,
+        incremental: bool = False
     ) -> Dict[str, Any]:
         """Выполняет резервное копирование компонентов"""
+        if incremental:
+            return await self._perform_incremental_backup(backup_id, components, encryption_enabled)
+        
         try:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             backup_name = f"backup_{backup_id}_{timestamp}"
@@ -559,6 +623,205 @@ class EnhancedBackupService:
                 "error": str(e)
             }
     
+    async def _perform_incremental_backup(
+        self,
+        backup_id: int,
+        components: List[str],
+        encryption_enabled: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Инкрементальное резервное копирование через хранилище блоков.
+        
+        В каталоге копии лежат только манифест и индекс файлов; данные
+        сохраняются в общем хранилище блоков без повторов. Блоки всегда
+        сжаты; с encryption_enabled они шифруются ключом BACKUP_ENCRYPTION_KEY.
+        """
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup_path = os.path.join(self.backup_dir, f"backup_{backup_id}_{timestamp}")
+        snapshot_dir = tempfile.mkdtemp(prefix=f"snapshot_{backup_id}_", dir=os.path.join(self.backup_dir, "temp"))
+        os.makedirs(backup_path, exist_ok=True)
+        
+        encrypted = encryption_enabled and self.block_engine.encrypted_store is not None
+        result = {
+            "backup_path": backup_path,
+            "components": {},
+            "success": True,
+            "warnings": [],
+            "files_count": 0,
+            "total_size": 0,
+            "compression_enabled": True,
+            "encryption_enabled": encrypted
+        }
+        if encryption_enabled and not encrypted:
+            result["warnings"].append("encryption: BACKUP_ENCRYPTION_KEY не задан, блоки не зашифрованы")
+        
+        try:
+            sources = []
+            for component in components:
+                component_sources = await self._get_incremental_sources(component, snapshot_dir)
+                if isinstance(component_sources, dict):
+                    # Компонент пропущен или завершился ошибкой
+                    result["components"][component] = component_sources
+                    if component_sources.get("status") == "error":
+                        result["success"] = False
+                    continue
+                sources.extend(component_sources)
+            
+            stats = await asyncio.to_thread(
+                self.block_engine.backup, sources, os.path.join(backup_path, INDEX_FILENAME), encrypted
+            )
+            
+            for component, component_stats in stats["components"].items():
+                result["components"][component] = {
+                    "status": "success",
+                    "type": "incremental",
+                    "size": component_stats["logical_bytes"],
+                    "stored_size": component_stats["stored_bytes"],
+                    "files_count": component_stats["files"]
+                }
+            
+            # В размер копии входят только новые блоки - то, что она добавила на диск
+            result["total_size"] = stats["stored_bytes"]
+            result["files_count"] = stats["files"]
+            result["incremental"] = {
+                key: stats[key] for key in (
+                    "files", "files_reused", "logical_bytes", "stored_bytes",
+                    "blocks", "new_blocks", "dedup_ratio"
+                )
+            }
+            
+            await self._create_backup_manifest(backup_path, result)
+            await self._cleanup_old_backups()
+            
+            logger.info(
+                f"✅ Инкрементальная копия создана: {backup_path} "
+                f"({stats['stored_bytes']} новых байт из {stats['logical_bytes']})"
+            )
+            return result
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка инкрементального резервного копирования: {e}")
+            shutil.rmtree(backup_path, ignore_errors=True)
+            return {
+                "success": False,
+                "error": str(e)
+            }
+        finally:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+    
+    async def _get_incremental_sources(self, component: str, snapshot_dir: str):
+        """Источники компонента для хранилища блоков: [(компонент, путь, имя в копии)]"""
+        if component == "main_db":
+            snapshot = await self._backup_main_database(snapshot_dir)
+            if snapshot.get("status") != "success":
+                return snapshot
+            arcname = "main_database.db" if snapshot["type"] == "sqlite" else "main_database.sql"
+            return [(component, snapshot["file_path"], arcname)]
+        
+        paths = {
+            "vector_db": [os.path.join("backend", "data", "chroma_db")],
+            "uploads": [os.path.join("backend", "uploads")],
+            "config": [
+                "backend/app/core/config.py",
+                "backend/alembic.ini",
+                "backend/requirements.txt",
+                ".env"
+            ],
+            "logs": [
+                "backend/logs",
+                "backend/backend.log",
+                "frontend/frontend.log"
+            ]
+        }.get(component)
+        
+        if paths is None:
+            return {"status": "skipped", "reason": f"Unknown component: {component}"}
+        
+        existing = [path for path in paths if os.path.exists(path)]
+        if not existing:
+            return {"status": "skipped", "reason": f"No data found for component: {component}"}
+        
+        if len(existing) == 1 and os.path.isdir(existing[0]):
+            return [(component, existing[0], None)]
+        
+        # Набор отдельных файлов/каталогов - каждый под своим именем
+        sources = []
+        for path in existing:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for filename in filenames:
+                        file_path = os.path.join(dirpath, filename)
+                        sources.append((component, file_path, os.path.relpath(file_path, os.path.dirname(path))))
+            else:
+                sources.append((component, path, os.path.basename(path)))
+        return sources
+    
+    async def _restore_incremental_backup(self, backup_path: str) -> Dict[str, Any]:
+        """
+        Восстановление инкрементальной копии сборкой файлов из блоков
+        
+        SQLite подменяется файлом целиком; дамп PostgreSQL собирается во
+        временный файл и применяется через psql, ошибка psql - ошибка восстановления.
+        """
+        staging_dir = None
+        try:
+            targets = {
+                "vector_db": os.path.join("backend", "data", "chroma_db")
+            }
+            sql_dump = None
+            if settings.DATABASE_URL.startswith("sqlite"):
+                targets["main_db"] = self._get_sqlite_path()
+            else:
+                staging_dir = tempfile.mkdtemp(prefix="restore_", dir=os.path.join(self.backup_dir, "temp"))
+                sql_dump = os.path.join(staging_dir, "main_database.sql")
+                targets["main_db"] = sql_dump
+            
+            restored = await asyncio.to_thread(
+                self.block_engine.restore, os.path.join(backup_path, INDEX_FILENAME), targets
+            )
+            if "main_db" in restored and sql_dump is not None:
+                await self._restore_postgres_dump(sql_dump)
+            names = {"main_db": "main_database", "vector_db": "vector_database"}
+            result = {"status": "success", "restored": [names.get(c, c) for c in restored]}
+            
+            logger.info(f"✅ Восстановление завершено: {result['restored']}")
+            return result
+            
+        except (BlockStoreError, OSError, RuntimeError) as e:
+            logger.error(f"❌ Ошибка восстановления инкрементальной копии: {e}")
+            return {"status": "error", "error": str(e)}
+        finally:
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _libpq_url() -> str:
+        """DATABASE_URL без драйвера SQLAlchemy (postgresql+psycopg2:// -> postgresql://) для pg_dump/psql"""
+        scheme, sep, rest = settings.DATABASE_URL.partition("://")
+        return f"{scheme.split('+')[0]}{sep}{rest}"
+    
+    async def _restore_postgres_dump(self, dump_path: str):
+        """Применяет SQL-дамп (pg_dump --clean) к базе одной транзакцией"""
+        cmd = [
+            "psql",
+            "--no-password",
+            "--set", "ON_ERROR_STOP=1",
+            "--single-transaction",
+            "-f", dump_path,
+            self._libpq_url()
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(
+                f"psql завершился с кодом {process.returncode}: "
+                f"{stderr.decode(errors='replace').strip() if stderr else 'нет вывода'}"
+            )
+    
     async def _backup_uploads(self, backup_path: str) -> Dict[str, Any]:
         """Резервное копирование загруженных файлов"""
         try:
@@ -719,11 +982,19 @@ class EnhancedBackupService:
             checks = []
             overall_passed = True
             
-            # Проверка размера файла
-            file_size_check = await self._check_file_size(backup_record)
-            checks.append(file_size_check)
-            if not file_size_check["passed"]:
-                overall_passed = False
+            index_path = os.path.join(backup_record.backup_path, INDEX_FILENAME)
+            if os.path.exists(index_path):
+                # Инкрементальная копия: потоковая сверка индекса с блоками
+                block_check = await self._check_block_manifest(index_path)
+                checks.append(block_check)
+                if not block_check["passed"]:
+                    overall_passed = False
+            else:
+                # Проверка размера файла
+                file_size_check = await self._check_file_size(backup_record)
+                checks.append(file_size_check)
+                if not file_size_check["passed"]:
+                    overall_passed = False
             
             # Проверка структуры архива (если сжато)
             if backup_record.backup_path.endswith('.zip'):
@@ -804,6 +1075,36 @@ class EnhancedBackupService:
                 "duration": (datetime.utcnow() - start_time).total_seconds()
             }
     
+    async def _check_block_manifest(self, index_path: str) -> Dict[str, Any]:
+        """Проверяет наличие и контрольные суммы всех блоков инкрементальной копии"""
+        start_time = datetime.utcnow()
+        
+        try:
+            verification = await asyncio.to_thread(self.block_engine.verify, index_path, True)
+            passed = not verification["errors"]
+            
+            return {
+                "check_type": "block_manifest",
+                "passed": passed,
+                "error": "; ".join(verification["errors"][:10]) if not passed else None,
+                "files_checked": verification["files_checked"],
+                "size_verified": verification["size_verified"],
+                "checksum_verified": passed,
+                "details": {
+                    "blocks_checked": verification["blocks_checked"],
+                    "errors_count": len(verification["errors"])
+                },
+                "duration": (datetime.utcnow() - start_time).total_seconds()
+            }
+            
+        except Exception as e:
+            return {
+                "check_type": "block_manifest",
+                "passed": False,
+                "error": str(e),
+                "duration": (datetime.utcnow() - start_time).total_seconds()
+            }
+    
     async def _check_archive_integrity(self, backup_record: BackupRecord) -> Dict[str, Any]:
         """Проверяет целостность архива"""
         start_time = datetime.utcnow()
@@ -981,6 +1282,38 @@ class EnhancedBackupService:
         finally:
             db.close()
     
+    async def run_scheduled_backup(self, schedule: BackupSchedule) -> Dict[str, Any]:
+        """Выполняет копию по расписанию (полную или инкрементальную) и обновляет его статистику"""
+        started_at = datetime.utcnow()
+        result = await self.create_backup_with_record(
+            name=f"{schedule.name} {started_at.strftime('%Y-%m-%d %H:%M')}",
+            components=list(schedule.backup_components or []),
+            description=schedule.description,
+            created_by=schedule.created_by,
+            backup_type=BackupType.SCHEDULED,
+            compression_enabled=schedule.compression_enabled,
+            encryption_enabled=schedule.encryption_enabled,
+            retention_days=schedule.retention_days,
+            incremental=bool(schedule.incremental)
+        )
+        
+        db = next(get_db())
+        try:
+            record = db.query(BackupSchedule).filter(BackupSchedule.id == schedule.id).first()
+            if record is not None:
+                record.last_run_at = started_at
+                record.last_run_status = (BackupStatus.COMPLETED if result["success"] else BackupStatus.FAILED).value
+                record.total_runs = (record.total_runs or 0) + 1
+                if result["success"]:
+                    record.successful_runs = (record.successful_runs or 0) + 1
+                else:
+                    record.failed_runs = (record.failed_runs or 0) + 1
+                record.next_run_at = croniter(record.cron_expression, datetime.utcnow()).get_next(datetime)
+                db.commit()
+        finally:
+            db.close()
+        return result
+    
     async def restore_backup_with_record(
         self,
         restore_id: int,
@@ -1264,11 +1597,34 @@ backup_service = EnhancedBackupService()
 
 
 async def schedule_automatic_backups():
-    """Планировщик автоматических бэкапов"""
+    """
+    Планировщик автоматических бэкапов
+    
+    Если есть включенные расписания, выполняет наступившие - полные или
+    инкрементальные по флагу расписания. Без расписаний делает копию каждые
+    BACKUP_INTERVAL_HOURS часов (инкрементальную при BACKUP_INCREMENTAL=true).
+    """
     while True:
         try:
+            if await backup_service.get_backup_schedules(enabled_only=True):
+                for schedule in await backup_service.get_due_schedules():
+                    logger.info(f"🔄 Резервное копирование по расписанию: {schedule.name}")
+                    result = await backup_service.run_scheduled_backup(schedule)
+                    if not result["success"]:
+                        logger.error(f"❌ Ошибка бэкапа по расписанию {schedule.name}: {result.get('error')}")
+                await asyncio.sleep(backup_service.schedule_poll_seconds)
+                continue
+            
             logger.info("🔄 Запуск автоматического резервного копирования...")
-            result = await backup_service.create_backup()
+            if backup_service.automatic_incremental:
+                result = await backup_service.create_backup_with_record(
+                    name=f"Automatic {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}",
+                    components=["main_db", "vector_db", "config"],
+                    backup_type=BackupType.AUTOMATIC,
+                    incremental=True
+                )
+            else:
+                result = await backup_service.create_backup()
             
             if result["success"]:
                 logger.info(f"✅ Автоматический бэкап завершен: {result['backup_path']}")
@@ -5,7 +5,7 @@
 import logging
 import hashlib
 import json
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 from datetime import datetime, timedelta
 from dataclasses import dataclass
 from enum import Enum
@@ -32,6 +32,7 @@ class ModelVersion:
     rollback_threshold: float = 0.7
     min_requests: int = 100
     evaluation_period_hours: int = 24
+    adapter_path: Optional[str] = None  # LoRA-адаптер поверх базовой модели (GGUF)
 
 @dataclass
 class CanaryMetrics:
@@ -89,13 +90,19 @@ class CanaryService:
         version: str,
         canary_percentage: float = 10.0,
         rollback_threshold: float = 0.7,
-        evaluation_period_hours: int = 24
+        evaluation_period_hours: int = 24,
+        adapter_path: Optional[str] = None
     ) -> str:
         """Развертывание Canary-версии модели"""
         try:
             if not self.initialized:
                 await self.initialize()
             
+            if adapter_path:
+                # Проверяем адаптер до того, как на него пойдет трафик
+                from .lora_adapter_manager import resolve_adapter_file
+                adapter_path = resolve_adapter_file(adapter_path)
+            
             # Создаем новую версию модели
             model_id = f"{model_name}_{version}_{int(datetime.now().timestamp())}"
             
@@ -108,7 +115,8 @@ class CanaryService:
                 performance_metrics={},
                 canary_percentage=canary_percentage,
                 rollback_threshold=rollback_threshold,
-                evaluation_period_hours=evaluation_period_hours
+                evaluation_period_hours=evaluation_period_hours,
+                adapter_path=adapter_path
             )
             
             self.models[model_id] = canary_model
@@ -329,6 +337,14 @@ class CanaryService:
             logger.error(f"❌ Ошибка выбора модели: {e}")
             return None
     
+    async def get_adapter_for_request(self, user_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Версия модели для пользователя и путь к ее LoRA-адаптеру (None - базовые веса)"""
+        model_id = await self.get_model_for_request(user_id)
+        if model_id is None:
+            return None
+        model = self.models.get(model_id)
+        return model_id, (model.adapter_path if model else None)
+    
     def get_status(self) -> Dict[str, Any]:
         """Получение статуса Canary-системы"""
         return {
@@ -340,6 +356,7 @@ class CanaryService:
                     "version": model.version,
                     "status": model.status.value,
                     "canary_percentage": model.canary_percentage,
+                    "adapter_path": model.adapter_path,
                     "created_at": model.created_at.isoformat(),
                     "performance_metrics": model.performance_metrics
                 }
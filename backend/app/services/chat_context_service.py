@@ -0,0 +1,356 @@
+"""
+Сборка контекста чата в фиксированном бюджете токенов
+
+Промпт упаковывается по приоритету: шаблон + вопрос, резюме старой части
+диалога, последние сообщения (от новых к старым) - пока хватает бюджета
+n_ctx минус резерв под ответ. Токены считаются токенизатором модели, счетчики
+сообщений кешируются. Сообщения, вытесненные из окна, постепенно сворачиваются
+в скользящее резюме сессии (ChatSession.context_summary) фоновой LOW-генерацией,
+поэтому размер промпта не растет вместе с длиной сессии.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..core.config import settings
+from ..core.database import SessionLocal
+from ..models.chat import ChatSession, ChatMessage
+from .unified_llm_service import unified_llm_service, RequestPriority
+
+logger = logging.getLogger(__name__)
+
+ROLE_PREFIXES = {"user": "Пользователь", "assistant": "Ассистент"}
+
+SUMMARY_HEADER = "Краткое содержание предыдущей беседы:"
+HISTORY_HEADER = "История диалога:"
+
+# Максимальная длина одной реплики во входе суммаризатора, символов
+SUMMARY_INPUT_MESSAGE_CHARS = 1500
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@dataclass
+class AssembledContext:
+    """Результат упаковки контекста"""
+    prompt: str
+    prompt_tokens: int
+    budget: int
+    history_messages: int = 0
+    summary_used: bool = False
+    session_id: Optional[int] = None
+    # Последнее сообщение, не поместившееся в окно и еще не вошедшее в резюме
+    dropped_until_message_id: Optional[int] = None
+
+    @property
+    def context_used(self) -> bool:
+        return self.history_messages > 0 or self.summary_used
+
+
+class ChatContextService:
+    """Упаковщик контекста чата и поддержка скользящего резюме сессий"""
+
+    def __init__(self, llm_service=unified_llm_service, cache_size: int = 20000):
+        self.llm_service = llm_service
+        self._cache_size = cache_size
+        self._token_cache: "OrderedDict[int, Tuple[int, int]]" = OrderedDict()  # id -> (длина текста, токены)
+        self._cache_lock = threading.Lock()
+        self._overhead_cache: Dict[Tuple[str, bool], int] = {}
+        self._summarizing: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    # ------------------------------------------------------------------
+    # Подсчет токенов
+    # ------------------------------------------------------------------
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm_service.count_tokens(text)
+
+    def message_tokens(self, message: ChatMessage) -> int:
+        """Токены строки истории для сообщения (кешируются, пока доступен токенизатор)"""
+        content = message.content or ""
+        exact = self.llm_service.has_tokenizer()
+        if exact and message.id is not None:
+            with self._cache_lock:
+                cached = self._token_cache.get(message.id)
+                if cached is not None and cached[0] == len(content):
+                    self._token_cache.move_to_end(message.id)
+                    return cached[1]
+
+        tokens = self.count_tokens(content) + self._overhead(f"{ROLE_PREFIXES.get(message.role, 'Система')}: \n")
+        if exact and message.id is not None:
+            with self._cache_lock:
+                self._token_cache[message.id] = (len(content), tokens)
+                self._token_cache.move_to_end(message.id)
+                while len(self._token_cache) > self._cache_size:
+                    self._token_cache.popitem(last=False)
+        return tokens
+
+    def _overhead(self, text: str) -> int:
+        """Токены служебных фрагментов (заголовки, префиксы ролей, шаблон промпта)"""
+        key = (text, self.llm_service.has_tokenizer())
+        tokens = self._overhead_cache.get(key)
+        if tokens is None:
+            tokens = self.count_tokens(text)
+            self._overhead_cache[key] = tokens
+        return tokens
+
+    def _truncate(self, text: str, max_tokens: int, keep_tail: bool = False) -> str:
+        """Обрезает текст до max_tokens (по символам пропорционально, с проверкой токенизатором)"""
+        if max_tokens <= 0:
+            return ""
+        tokens = self.count_tokens(text)
+        while tokens > max_tokens and text:
+            keep = max(1, int(len(text) * max_tokens / tokens * 0.95))
+            text = ("…" + text[-keep:]) if keep_tail else (text[:keep] + "…")
+            tokens = self.count_tokens(text)
+        return text
+
+    def prompt_budget(self, max_tokens: int) -> int:
+        """Бюджет промпта: n_ctx минус резерв под ответ и запас модели"""
+        n_ctx = settings.VISTRAL_N_CTX
+        reserve = min(max_tokens, settings.CHAT_CONTEXT_RESPONSE_RESERVE)
+        return max(256, n_ctx - reserve - settings.VISTRAL_TOKEN_MARGIN)
+
+    # ------------------------------------------------------------------
+    # Упаковка
+    # ------------------------------------------------------------------
+
+    def build_prompt(
+        self,
+        db: Session,
+        session: ChatSession,
+        question: str,
+        max_tokens: int,
+        exclude_message_id: Optional[int] = None
+    ) -> AssembledContext:
+        """
+        Собирает промпт: шаблон + вопрос, резюме, история
+
+        Args:
+            db: Сессия БД
+            session: Сессия чата
+            question: Текущий вопрос пользователя
+            max_tokens: Запрошенная длина ответа (определяет резерв)
+            exclude_message_id: Id уже сохраненного текущего сообщения (вопрос передается отдельно)
+
+        Returns:
+            AssembledContext с промптом и статистикой упаковки
+        """
+        budget = self.prompt_budget(max_tokens)
+        frame_tokens = self._overhead(self.llm_service.create_legal_prompt("", context=" "))
+        question = self._truncate(question, max(64, budget // 2 - frame_tokens))
+        remaining = budget - frame_tokens - self.count_tokens(question)
+
+        # 1. Резюме старой части диалога
+        summary = (session.context_summary or "").strip()
+        if summary:
+            remaining -= self.count_tokens(summary) + self._overhead(SUMMARY_HEADER + "\n")
+
+        # 2. Несжатые сообщения - от новых к старым
+        query = db.query(ChatMessage).filter(
+            ChatMessage.session_id == session.id,
+            ChatMessage.id > (session.summary_message_id or 0)
+        )
+        if exclude_message_id is not None:
+            query = query.filter(ChatMessage.id != exclude_message_id)
+        # Лишняя строка показывает, что окно обрезано лимитом числа сообщений
+        recent = query.order_by(ChatMessage.id.desc()).limit(settings.CHAT_CONTEXT_MAX_MESSAGES + 1).all()
+        beyond_window = recent[settings.CHAT_CONTEXT_MAX_MESSAGES:]
+        recent = recent[:settings.CHAT_CONTEXT_MAX_MESSAGES]
+
+        remaining -= self._overhead(HISTORY_HEADER + "\n")
+        history: List[str] = []
+        kept: List[ChatMessage] = []
+        dropped: List[ChatMessage] = []
+        for index, message in enumerate(recent):
+            prefix = ROLE_PREFIXES.get(message.role)
+            if prefix is None:
+                continue
+            tokens = self.message_tokens(message)
+            if tokens <= remaining:
+                history.append(f"{prefix}: {message.content}")
+                kept.append(message)
+                remaining -= tokens
+                continue
+            if not history and remaining > 64:
+                # Последняя реплика длиннее бюджета - берем ее начало
+                history.append(f"{prefix}: {self._truncate(message.content, remaining - 8)}")
+                kept.append(message)
+                remaining = 0
+                dropped = recent[index + 1:]
+            else:
+                dropped = recent[index:]
+            break
+
+        # Пока фоновое резюме не догнало окно, вытесненные реплики представлены выжимкой.
+        # Сообщения старше окна (обрезанного по числу) тоже уходят в резюме, иначе они потеряются
+        if dropped:
+            dropped_until_id = dropped[0].id
+        elif beyond_window:
+            dropped_until_id = beyond_window[0].id
+        else:
+            dropped_until_id = None
+        if dropped:
+            gist = self._extractive_gist(list(reversed(dropped)))
+            gist_budget = min(remaining, settings.CHAT_SUMMARY_MAX_TOKENS)
+            if gist and gist_budget > 32:
+                gist = self._truncate(gist, gist_budget, keep_tail=True)
+                summary = f"{summary}\n{gist}".strip()
+
+        history.reverse()
+        kept.reverse()
+        prompt = self._render(question, summary, history)
+        prompt_tokens = self.count_tokens(prompt)
+
+        # Разница токенизации на стыках фрагментов - выбрасываем самые старые реплики
+        while prompt_tokens > budget and history:
+            history.pop(0)
+            dropped_until_id = kept.pop(0).id
+            prompt = self._render(question, summary, history)
+            prompt_tokens = self.count_tokens(prompt)
+
+        return AssembledContext(
+            prompt=prompt,
+            prompt_tokens=prompt_tokens,
+            budget=budget,
+            history_messages=len(history),
+            summary_used=bool(summary),
+            session_id=session.id,
+            dropped_until_message_id=dropped_until_id
+        )
+
+    def _render(self, question: str, summary: str, history: List[str]) -> str:
+        sections = []
+        if summary:
+            sections.append(f"{SUMMARY_HEADER}\n{summary}")
+        if history:
+            sections.append(HISTORY_HEADER + "\n" + "\n".join(history))
+        context = "\n\n".join(sections) if sections else None
+        return self.llm_service.create_legal_prompt(question, context=context)
+
+    @staticmethod
+    def _extractive_gist(messages: List[ChatMessage], max_chars: int = 200) -> str:
+        """Первое предложение каждой реплики - дешевая замена резюме"""
+        lines = []
+        for message in messages:
+            prefix = ROLE_PREFIXES.get(message.role)
+            text = " ".join((message.content or "").split())
+            if prefix is None or not text:
+                continue
+            sentence = _SENTENCE_END.split(text, 1)[0][:max_chars]
+            lines.append(f"{prefix}: {sentence}")
+        return "\n".join(lines)
+
+    # ------------------------------------------------------------------
+    # Скользящее резюме
+    # ------------------------------------------------------------------
+
+    def schedule_summary_update(self, assembled: AssembledContext):
+        """Запускает фоновое сворачивание вытесненных сообщений в резюме сессии"""
+        if assembled.session_id is None or assembled.dropped_until_message_id is None:
+            return
+        if assembled.session_id in self._summarizing:
+            return
+        self._summarizing.add(assembled.session_id)
+        task = asyncio.create_task(
+            self._update_summary(assembled.session_id, assembled.dropped_until_message_id)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update_summary(self, session_id: int, up_to_message_id: int):
+        try:
+            session_data = await asyncio.to_thread(self._load_unsummarized, session_id, up_to_message_id)
+            if session_data is None:
+                return
+            previous_summary, lines = session_data
+            summary = await self._summarize(previous_summary, lines)
+            await asyncio.to_thread(self._store_summary, session_id, summary, up_to_message_id)
+            logger.info(f"📝 Резюме сессии {session_id} обновлено до сообщения {up_to_message_id}")
+        except Exception as e:
+            logger.warning(f"Ошибка обновления резюме сессии {session_id}: {e}")
+        finally:
+            self._summarizing.discard(session_id)
+
+    def _load_unsummarized(self, session_id: int, up_to_message_id: int) -> Optional[Tuple[str, List[ChatMessage]]]:
+        db = SessionLocal()
+        try:
+            session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+            if session is None:
+                return None
+            start_id = session.summary_message_id or 0
+            if up_to_message_id <= start_id:
+                return None
+            messages = db.query(ChatMessage).filter(
+                ChatMessage.session_id == session_id,
+                ChatMessage.id > start_id,
+                ChatMessage.id <= up_to_message_id
+            ).order_by(ChatMessage.id).all()
+            db.expunge_all()
+            return session.context_summary or "", messages
+        finally:
+            db.close()
+
+    def _store_summary(self, session_id: int, summary: str, up_to_message_id: int):
+        db = SessionLocal()
+        try:
+            db.query(ChatSession).filter(ChatSession.id == session_id).update({
+                ChatSession.context_summary: summary,
+                ChatSession.summary_message_id: up_to_message_id,
+                ChatSession.summary_updated_at: datetime.utcnow()
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    async def _summarize(self, previous_summary: str, messages: List[ChatMessage]) -> str:
+        """Обновляет резюме моделью (LOW-приоритет), при недоступности - выжимкой"""
+        max_tokens = settings.CHAT_SUMMARY_MAX_TOKENS
+        if settings.CHAT_SUMMARY_ENABLED and self.llm_service.is_model_ready():
+            turns = "\n".join(
+                f"{ROLE_PREFIXES[m.role]}: {m.content[:SUMMARY_INPUT_MESSAGE_CHARS]}"
+                for m in messages if m.role in ROLE_PREFIXES and m.content
+            )
+            prompt = (
+                "Обнови краткое содержание юридической консультации. Сохрани факты о ситуации "
+                "пользователя, упомянутые нормы права и сделанные выводы. Пиши сжато, без вступлений.\n\n"
+                f"Текущее содержание:\n{previous_summary or '(пусто)'}\n\n"
+                f"Новые реплики:\n{turns}\n\n"
+                "Обновленное краткое содержание:"
+            )
+            parts = []
+            async for chunk in self.llm_service.generate_response(
+                prompt=prompt,
+                stream=True,
+                max_tokens=max_tokens,
+                temperature=0.2,
+                priority=RequestPriority.LOW
+            ):
+                if chunk.startswith("[ERROR]") or chunk.startswith("[TIMEOUT]"):
+                    parts = []
+                    break
+                parts.append(chunk)
+            summary = "".join(parts).strip()
+            if summary:
+                return self._truncate(summary, max_tokens)
+
+        merged = f"{previous_summary}\n{self._extractive_gist(messages)}".strip()
+        return self._truncate(merged, max_tokens, keep_tail=True)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._cache_lock:
+            cached = len(self._token_cache)
+        return {"cached_messages": cached, "summaries_in_progress": len(self._summarizing)}
+
+
+# Глобальный экземпляр
+chat_context_service = ChatContextService()
@@ -5,16 +5,17 @@
 import asyncio
 import logging
 from typing import Dict, Any, List, Optional, Tuple
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from sqlalchemy.orm import Session
 from sqlalchemy import func, and_, or_, desc, asc, extract
 from sqlalchemy.exc import SQLAlchemyError
-from collections import defaultdict
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 
 from ..models.analytics import CohortAnalysis, UserSegment
 from ..models.user import User
+from ..models.chat import ChatSession, ChatMessage
 from ..schemas.analytics import CohortAnalysisCreate, UserSegmentCreate, UserSegmentUpdate
 from ..core.database import get_db
 
@@ -37,6 +38,10 @@ class CohortAnalysisService:
             'weekly': 'Еженедельно',
             'monthly': 'Ежемесячно'
         }
+        
+        # Кэш счетчиков retention: (cohort_type, period_type, start, end) -> {watermark, sizes, counts}
+        self._retention_cache: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+        self.retention_cache_size = 32
     
     async def create_cohort_analysis(self, db: Session, cohort_data: CohortAnalysisCreate, user_id: int) -> CohortAnalysis:
         """Создание когортного анализа"""
@@ -169,47 +174,7 @@ class CohortAnalysisService:
                                             start_date: datetime, end_date: datetime) -> Dict[str, Any]:
         """Вычисление когорт по регистрации"""
         try:
-            # Получаем всех пользователей в указанном диапазоне
-            users_query = db.query(User).filter(
-                and_(
-                    User.created_at >= start_date,
-                    User.created_at <= end_date
-                )
-            )
-            
-            users = users_query.all()
-            
-            if not users:
-                return {
-                    'cohorts': [],
-                    'periods': [],
-                    'retention_matrix': [],
-                    'summary': {
-                        'total_users': 0,
-                        'total_cohorts': 0,
-                        'avg_retention': 0
-                    }
-                }
-            
-            # Группируем пользователей по когортам
-            cohorts = self._group_users_by_period(users, period_type, 'created_at')
-            
-            # Вычисляем retention для каждой когорты
-            retention_data = await self._calculate_retention_matrix(db, cohorts, period_type)
-            
-            return {
-                'cohorts': list(cohorts.keys()),
-                'periods': retention_data['periods'],
-                'retention_matrix': retention_data['matrix'],
-                'cohort_sizes': retention_data['sizes'],
-                'summary': {
-                    'total_users': len(users),
-                    'total_cohorts': len(cohorts),
-                    'avg_retention': retention_data['avg_retention']
-                },
-                'cohort_type': 'registration',
-                'period_type': period_type
-            }
+            return await self._calculate_activity_cohorts(db, 'registration', period_type, start_date, end_date)
             
         except Exception as e:
             logger.error(f"Error calculating registration cohorts: {e}")
@@ -217,24 +182,44 @@ class CohortAnalysisService:
     
     async def _calculate_query_cohorts(self, db: Session, period_type: str, 
                                      start_date: datetime, end_date: datetime) -> Dict[str, Any]:
-        """Вычисление когорт по первому запросу (заглушка)"""
-        # Здесь должна быть логика анализа первых запросов пользователей
-        # Пока возвращаем тестовые данные
+        """Вычисление когорт по первому запросу"""
+        try:
+            return await self._calculate_activity_cohorts(db, 'first_query', period_type, start_date, end_date)
+            
+        except Exception as e:
+            logger.error(f"Error calculating first query cohorts: {e}")
+            raise
+    
+    async def _calculate_activity_cohorts(self, db: Session, cohort_type: str, period_type: str,
+                                        start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+        """Когорты с retention по реальной активности пользователей в чате"""
+        state = self._get_retention_state(db, cohort_type, period_type, start_date, end_date)
+        
+        if not state['sizes']:
+            return {
+                'cohorts': [],
+                'periods': [],
+                'retention_matrix': [],
+                'summary': {
+                    'total_users': 0,
+                    'total_cohorts': 0,
+                    'avg_retention': 0
+                }
+            }
+        
+        retention_data = self._calculate_retention_matrix(state, period_type)
+        
         return {
-            'cohorts': ['2024-01', '2024-02', '2024-03'],
-            'periods': ['Period 0', 'Period 1', 'Period 2', 'Period 3'],
-            'retention_matrix': [
-                [100, 85, 70, 60],  # Когорта 2024-01
-                [100, 80, 65, 55],  # Когорта 2024-02
-                [100, 90, 75, 0]    # Когорта 2024-03 (неполные данные)
-            ],
-            'cohort_sizes': [150, 200, 180],
+            'cohorts': retention_data['cohorts'],
+            'periods': retention_data['periods'],
+            'retention_matrix': retention_data['matrix'],
+            'cohort_sizes': retention_data['sizes'],
             'summary': {
-                'total_users': 530,
-                'total_cohorts': 3,
-                'avg_retention': 68.5
+                'total_users': int(sum(retention_data['sizes'])),
+                'total_cohorts': len(retention_data['cohorts']),
+                'avg_retention': retention_data['avg_retention']
             },
-            'cohort_type': 'first_query',
+            'cohort_type': cohort_type,
             'period_type': period_type
         }
     
@@ -261,70 +246,226 @@ class CohortAnalysisService:
             'period_type': period_type
         }
     
-    def _group_users_by_period(self, users: List[User], period_type: str, date_field: str) -> Dict[str, List[User]]:
-        """Группировка пользователей по периодам"""
-        cohorts = defaultdict(list)
+    def _period_expr(self, db: Session, column, period_type: str):
+        """SQL-выражение начала периода для даты (зависит от диалекта БД)"""
+        if db.bind is not None and db.bind.dialect.name == 'postgresql':
+            unit = {'daily': 'day', 'weekly': 'week'}.get(period_type, 'month')
+            return func.date_trunc(unit, column)
         
-        for user in users:
-            date_value = getattr(user, date_field)
-            if not date_value:
+        # SQLite
+        if period_type == 'daily':
+            return func.date(column)
+        if period_type == 'weekly':
+            # Понедельник текущей недели
+            return func.date(column, 'weekday 0', '-6 days')
+        return func.strftime('%Y-%m-01', column)
+    
+    @staticmethod
+    def _to_period_date(value) -> Optional[date]:
+        """Нормализация начала периода из результата запроса"""
+        if value is None:
+            return None
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return date.fromisoformat(str(value)[:10])
+    
+    @staticmethod
+    def _floor_period(value: date, period_type: str) -> date:
+        """Начало периода для даты (то же, что _period_expr, на стороне Python)"""
+        if period_type == 'daily':
+            return value
+        if period_type == 'weekly':
+            return value - timedelta(days=value.weekday())
+        return value.replace(day=1)
+    
+    @staticmethod
+    def _period_index(cohort_start: date, activity_start: date, period_type: str) -> int:
+        """Номер периода активности относительно начала когорты"""
+        if period_type == 'daily':
+            return (activity_start - cohort_start).days
+        if period_type == 'weekly':
+            return (activity_start - cohort_start).days // 7
+        return (activity_start.year - cohort_start.year) * 12 + activity_start.month - cohort_start.month
+    
+    @staticmethod
+    def _cohort_label(cohort_start: date, period_type: str) -> str:
+        if period_type == 'daily':
+            return cohort_start.strftime('%Y-%m-%d')
+        if period_type == 'weekly':
+            return cohort_start.strftime('%Y-W%U')
+        return cohort_start.strftime('%Y-%m')
+    
+    def _cohort_subquery(self, db: Session, cohort_type: str, start_date: datetime, end_date: datetime):
+        """Подзапрос (user_id, cohort_at) - момент входа пользователя в когорту"""
+        if cohort_type == 'first_query':
+            cohort_at = func.min(ChatMessage.created_at)
+            return (
+                db.query(ChatSession.user_id.label('user_id'), cohort_at.label('cohort_at'))
+                .join(ChatMessage, ChatMessage.session_id == ChatSession.id)
+                .filter(ChatMessage.role == 'user')
+                .group_by(ChatSession.user_id)
+                .having(and_(cohort_at >= start_date, cohort_at <= end_date))
+                .subquery()
+            )
+        
+        return (
+            db.query(User.id.label('user_id'), User.created_at.label('cohort_at'))
+            .filter(and_(User.created_at >= start_date, User.created_at <= end_date))
+            .subquery()
+        )
+    
+    def _query_cohort_sizes(self, db: Session, cohort_type: str, period_type: str,
+                            start_date: datetime, end_date: datetime) -> Dict[date, int]:
+        """Размеры когорт одним сгруппированным запросом"""
+        cohorts = self._cohort_subquery(db, cohort_type, start_date, end_date)
+        cohort_period = self._period_expr(db, cohorts.c.cohort_at, period_type)
+        rows = (
+            db.query(cohort_period.label('cohort_period'), func.count(cohorts.c.user_id))
+            .group_by(cohort_period)
+            .all()
+        )
+        return {self._to_period_date(period): count for period, count in rows if period is not None}
+    
+    def _query_retention_counts(self, db: Session, cohort_type: str, period_type: str,
+                                start_date: datetime, end_date: datetime,
+                                activity_since: Optional[datetime] = None) -> Dict[Tuple[date, date], int]:
+        """Число уникальных активных пользователей по (период когорты, период активности)"""
+        cohorts = self._cohort_subquery(db, cohort_type, start_date, end_date)
+        
+        activity_period = self._period_expr(db, ChatMessage.created_at, period_type)
+        activity_query = (
+            db.query(ChatSession.user_id.label('user_id'), activity_period.label('activity_period'))
+            .join(ChatMessage, ChatMessage.session_id == ChatSession.id)
+            .filter(ChatMessage.role == 'user')
+        )
+        if activity_since is not None:
+            activity_query = activity_query.filter(ChatMessage.created_at >= activity_since)
+        activity = activity_query.distinct().subquery()
+        
+        cohort_period = self._period_expr(db, cohorts.c.cohort_at, period_type)
+        rows = (
+            db.query(
+                cohort_period.label('cohort_period'),
+                activity.c.activity_period,
+                func.count(func.distinct(activity.c.user_id))
+            )
+            .join(activity, activity.c.user_id == cohorts.c.user_id)
+            .group_by(cohort_period, activity.c.activity_period)
+            .all()
+        )
+        
+        counts = {}
+        for cohort_value, activity_value, count in rows:
+            cohort_start = self._to_period_date(cohort_value)
+            activity_start = self._to_period_date(activity_value)
+            if cohort_start is None or activity_start is None or activity_start < cohort_start:
                 continue
-            
-            if period_type == 'daily':
-                period_key = date_value.strftime('%Y-%m-%d')
-            elif period_type == 'weekly':
-                # Начало недели (понедельник)
-                start_of_week = date_value - timedelta(days=date_value.weekday())
-                period_key = start_of_week.strftime('%Y-W%U')
-            elif period_type == 'monthly':
-                period_key = date_value.strftime('%Y-%m')
-            else:
-                period_key = date_value.strftime('%Y-%m')
-            
-            cohorts[period_key].append(user)
+            counts[(cohort_start, activity_start)] = count
+        return counts
+    
+    def _get_watermark(self, db: Session) -> Tuple[int, int]:
+        """Водяной знак данных: последние id пользователей и сообщений"""
+        max_user_id = db.query(func.max(User.id)).scalar() or 0
+        max_message_id = db.query(func.max(ChatMessage.id)).scalar() or 0
+        return max_user_id, max_message_id
+    
+    def _get_retention_state(self, db: Session, cohort_type: str, period_type: str,
+                             start_date: datetime, end_date: datetime) -> Dict[str, Any]:
+        """Счетчики retention из кэша с инкрементальным пересчетом последних периодов"""
+        cache_key = (cohort_type, period_type, start_date, end_date)
+        watermark = self._get_watermark(db)
         
-        return dict(cohorts)
+        cached = self._retention_cache.get(cache_key)
+        if cached is not None and cached['watermark'] == watermark:
+            self._retention_cache.move_to_end(cache_key)
+            return cached
+        
+        if cached is not None and all(new >= old for new, old in zip(watermark, cached['watermark'])):
+            # Новые строки влияют только на периоды начиная с самой ранней новой записи
+            old_user_id, old_message_id = cached['watermark']
+            earliest = [
+                value for value in (
+                    db.query(func.min(User.created_at)).filter(User.id > old_user_id).scalar(),
+                    db.query(func.min(ChatMessage.created_at)).filter(ChatMessage.id > old_message_id).scalar(),
+                ) if value is not None
+            ]
+            if earliest:
+                recompute_from = self._floor_period(self._to_period_date(min(earliest)), period_type)
+                recompute_since = datetime.combine(recompute_from, datetime.min.time())
+                
+                sizes = {k: v for k, v in cached['sizes'].items() if k < recompute_from}
+                sizes.update({
+                    k: v for k, v in self._query_cohort_sizes(
+                        db, cohort_type, period_type, start_date, end_date
+                    ).items() if k >= recompute_from
+                })
+                counts = {k: v for k, v in cached['counts'].items() if k[1] < recompute_from}
+                counts.update(self._query_retention_counts(
+                    db, cohort_type, period_type, start_date, end_date, activity_since=recompute_since
+                ))
+                state = {'watermark': watermark, 'sizes': sizes, 'counts': counts}
+                self._store_retention_state(cache_key, state)
+                return state
+        
+        state = {
+            'watermark': watermark,
+            'sizes': self._query_cohort_sizes(db, cohort_type, period_type, start_date, end_date),
+            'counts': self._query_retention_counts(db, cohort_type, period_type, start_date, end_date),
+        }
+        self._store_retention_state(cache_key, state)
+        return state
+    
+    def _store_retention_state(self, cache_key: Tuple, state: Dict[str, Any]):
+        self._retention_cache[cache_key] = state
+        self._retention_cache.move_to_end(cache_key)
+        while len(self._retention_cache) > self.retention_cache_size:
+            self._retention_cache.popitem(last=False)
     
-    async def _calculate_retention_matrix(self, db: Session, cohorts: Dict[str, List[User]], 
-                                        period_type: str) -> Dict[str, Any]:
+    def _calculate_retention_matrix(self, state: Dict[str, Any], period_type: str) -> Dict[str, Any]:
         """Вычисление матрицы retention"""
         try:
             # Определяем количество периодов для анализа
             max_periods = 12 if period_type == 'monthly' else 8
             
             periods = [f"Period {i}" for i in range(max_periods)]
-            matrix = []
-            sizes = []
+            cohort_starts = sorted(state['sizes'])
+            row_index = {cohort_start: i for i, cohort_start in enumerate(cohort_starts)}
+            sizes = np.array([state['sizes'][c] for c in cohort_starts], dtype=np.float64)
+            
+            active = np.zeros((len(cohort_starts), max_periods), dtype=np.float64)
+            for (cohort_start, activity_start), count in state['counts'].items():
+                row = row_index.get(cohort_start)
+                if row is None:
+                    continue
+                period_idx = self._period_index(cohort_start, activity_start, period_type)
+                if 0 <= period_idx < max_periods:
+                    active[row, period_idx] = count
             
-            for cohort_name, cohort_users in cohorts.items():
-                cohort_size = len(cohort_users)
-                sizes.append(cohort_size)
-                
-                retention_row = []
-                
-                for period_idx in range(max_periods):
-                    if period_idx == 0:
-                        # Первый период всегда 100%
-                        retention_row.append(100.0)
-                    else:
-                        # Для упрощения используем убывающую функцию
-                        # В реальной реализации здесь должен быть запрос к БД
-                        # для подсчета активных пользователей в каждом периоде
-                        retention_rate = max(0, 100 - (period_idx * 15) + np.random.normal(0, 5))
-                        retention_row.append(round(retention_rate, 1))
-                
-                matrix.append(retention_row)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                matrix = np.where(sizes[:, None] > 0, active / sizes[:, None] * 100, 0.0)
             
-            # Вычисляем средний retention
-            if matrix:
-                avg_retention = np.mean([row[1] if len(row) > 1 else 0 for row in matrix])
-            else:
-                avg_retention = 0
+            # Периоды, которые еще не наступили, помечаются как отсутствующие данные
+            current_period = self._floor_period(datetime.utcnow().date(), period_type)
+            for row, cohort_start in enumerate(cohort_starts):
+                elapsed = self._period_index(cohort_start, current_period, period_type)
+                if elapsed + 1 < max_periods:
+                    matrix[row, max(elapsed + 1, 0):] = np.nan
+            
+            # Вычисляем средний retention по первому периоду после входа в когорту
+            second_period = matrix[:, 1] if max_periods > 1 else np.array([])
+            second_period = second_period[~np.isnan(second_period)]
+            avg_retention = float(np.mean(second_period)) if second_period.size else 0.0
             
             return {
+                'cohorts': [self._cohort_label(c, period_type) for c in cohort_starts],
                 'periods': periods,
-                'matrix': matrix,
-                'sizes': sizes,
+                'matrix': [
+                    [None if np.isnan(value) else round(float(value), 1) for value in row]
+                    for row in matrix
+                ],
+                'sizes': [int(size) for size in sizes],
                 'avg_retention': round(avg_retention, 1)
             }
             
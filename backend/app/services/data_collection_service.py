@@ -2,9 +2,11 @@
 Сервис сбора данных для LoRA обучения
 """
 import logging
-from typing import List, Dict, Any, Tuple
+import re
+from typing import List, Dict, Any, Tuple, Iterator, NamedTuple, Set
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, desc
+from sqlalchemy import and_, desc, func, select
 from datetime import datetime, timedelta
 
 from ..models.chat import ChatMessage, ChatSession
@@ -13,6 +15,29 @@ from ..models.user import User
 
 logger = logging.getLogger(__name__)
 
+PAIR_BATCH_SIZE = 1000
+
+LEGAL_TERMS = [
+    'закон', 'суд', 'договор', 'право', 'обязательство', 
+    'ответственность', 'статья', 'кодекс', 'федеральный',
+    'гражданский', 'трудовой', 'уголовный', 'административный'
+]
+# Lookahead находит каждое вхождение, в том числе перекрывающиеся (ни один термин не префикс другого)
+LEGAL_TERMS_PATTERN = re.compile('(?=(' + '|'.join(map(re.escape, LEGAL_TERMS)) + '))')
+LAW_REFERENCE_PATTERN = re.compile('|'.join(map(re.escape, ['ст.', 'ФЗ', 'ГК РФ', 'ТК РФ', 'УК РФ', 'КоАП РФ'])))
+CORE_LEGAL_TERMS_PATTERN = re.compile('закон|право|договор')
+COMPLEX_WORDS_PATTERN = re.compile(
+    'сложный|запутанный|спорный|неоднозначный|противоречивый|конфликт|диспут'
+)
+
+
+class ChatPair(NamedTuple):
+    """Вопрос пользователя и следующий за ним ответ ИИ"""
+    user_message_id: int
+    session_id: int
+    instruction: str
+    output: str
+
 
 class DataCollectionService:
     """Сервис сбора данных для обучения LoRA"""
@@ -52,75 +77,69 @@ class DataCollectionService:
             # Получаем диалоги за последние N дней
             start_date = datetime.utcnow() - timedelta(days=days_back)
             
-            # Находим пары сообщений пользователь-ИИ
-            chat_pairs = self._get_chat_pairs(start_date, limit)
-            
-            total_found = len(chat_pairs)
+            total_found = 0
             total_processed = 0
             total_approved = 0
             total_rejected = 0
+            seen_pairs = set()
             
-            logger.info(f"📊 Найдено {total_found} диалогов для обработки")
-            
-            for user_msg, assistant_msg in chat_pairs:
+            # Пары сообщений пользователь-ИИ читаются потоком и обрабатываются пачками
+            for batch in self._iter_chat_pair_batches(start_date, limit):
+                total_found += len(batch)
                 try:
-                    # Проверяем, не существует ли уже такая пара
-                    existing = self.db.query(TrainingData).filter(
-                        and_(
-                            TrainingData.instruction == user_msg.content,
-                            TrainingData.output == assistant_msg.content
-                        )
-                    ).first()
-                    
-                    if existing:
-                        logger.debug(f"Диалог уже существует, пропускаем")
+                    # Пропускаем пары, которые уже есть в обучающих данных или встретились раньше
+                    existing = self._get_existing_pairs(batch)
+                    new_pairs = []
+                    for pair in batch:
+                        key = (pair.instruction, pair.output)
+                        if key in existing or key in seen_pairs:
+                            continue
+                        seen_pairs.add(key)
+                        new_pairs.append(pair)
+                    if not new_pairs:
                         continue
                     
-                    # Создаем запись для обучения
-                    training_data = TrainingData(
-                        instruction=user_msg.content,
-                        input="",  # Контекст можно добавить позже
-                        output=assistant_msg.content,
-                        source="chat",
-                        quality_score=None,  # Будет оценено ИИ
-                        complexity=None,     # Будет определена ИИ
-                        is_approved=False,
-                        is_used_for_training=False
-                    )
-                    
-                    self.db.add(training_data)
-                    self.db.flush()
+                    instructions = [pair.instruction for pair in new_pairs]
+                    outputs = [pair.output for pair in new_pairs]
                     
-                    # Автоматическая оценка качества
-                    quality_score = self._evaluate_quality_auto(
-                        training_data.instruction, 
-                        training_data.output
-                    )
-                    training_data.quality_score = quality_score
-                    
-                    # Автоматическая категоризация по сложности
-                    complexity = self._categorize_complexity(
-                        training_data.instruction, 
-                        training_data.output
-                    )
-                    training_data.complexity = complexity
+                    # Автоматическая оценка качества и категоризация по сложности
+                    quality_scores = self._evaluate_quality_batch(instructions, outputs)
+                    complexities = self._categorize_complexity_batch(instructions, outputs)
                     
-                    # Автоматическое одобрение простых случаев
-                    if complexity == "simple" and quality_score >= 4.0:
-                        training_data.is_approved = True
-                        training_data.approved_at = datetime.utcnow()
-                        total_approved += 1
-                        logger.debug(f"Автоматически одобрен простой случай (качество: {quality_score})")
-                    elif complexity == "complex" or quality_score < 3.0:
-                        total_rejected += 1
-                        logger.debug(f"Требует ручной проверки (сложность: {complexity}, качество: {quality_score})")
+                    now = datetime.utcnow()
+                    records = []
+                    for pair, quality_score, complexity in zip(new_pairs, quality_scores, complexities):
+                        training_data = TrainingData(
+                            instruction=pair.instruction,
+                            input="",  # Контекст можно добавить позже
+                            output=pair.output,
+                            source="chat",
+                            quality_score=quality_score,
+                            complexity=complexity,
+                            is_approved=False,
+                            is_used_for_training=False
+                        )
+                        
+                        # Автоматическое одобрение простых случаев
+                        if complexity == "simple" and quality_score >= 4.0:
+                            training_data.is_approved = True
+                            training_data.approved_at = now
+                            total_approved += 1
+                        elif complexity == "complex" or quality_score < 3.0:
+                            total_rejected += 1
+                        
+                        records.append(training_data)
                     
-                    total_processed += 1
+                    self.db.add_all(records)
+                    self.db.flush()
+                    total_processed += len(records)
                     
                 except Exception as e:
-                    logger.error(f"Ошибка обработки диалога: {e}")
+                    logger.error(f"Ошибка обработки пачки диалогов: {e}")
                     continue
             
+            logger.info(f"📊 Найдено {total_found} диалогов")
+            
             # Обновляем лог сбора
             collection_log.total_found = total_found
             collection_log.total_processed = total_processed
@@ -151,40 +170,59 @@ class DataCollectionService:
                 "total_rejected": 0
             }
     
-    def _get_chat_pairs(self, start_date: datetime, limit: int) -> List[Tuple[ChatMessage, ChatMessage]]:
-        """Получение пар сообщений пользователь-ИИ"""
+    def _iter_chat_pair_batches(self, start_date: datetime, limit: int) -> Iterator[List[ChatPair]]:
+        """
+        Пары сообщений пользователь-ИИ пачками
+        
+        Один запрос: LEAD() по сообщениям сессии дает следующее сообщение, берутся
+        переходы user -> assistant, самые свежие первыми. Результат читается
+        серверным курсором (yield_per), без загрузки всей истории в память.
+        """
+        order = (ChatMessage.created_at, ChatMessage.id)
+        messages = select(
+            ChatMessage.id,
+            ChatMessage.session_id,
+            ChatMessage.role,
+            ChatMessage.content,
+            ChatMessage.created_at,
+            func.lead(ChatMessage.role).over(partition_by=ChatMessage.session_id, order_by=order).label("next_role"),
+            func.lead(ChatMessage.content).over(partition_by=ChatMessage.session_id, order_by=order).label("next_content")
+        ).join(ChatSession, ChatSession.id == ChatMessage.session_id).where(
+            ChatSession.created_at >= start_date
+        ).subquery()
+        
+        statement = select(
+            messages.c.id, messages.c.session_id, messages.c.content, messages.c.next_content
+        ).where(
+            and_(messages.c.role == "user", messages.c.next_role == "assistant")
+        ).order_by(desc(messages.c.created_at), desc(messages.c.id)).limit(limit)
+        
         try:
-            # Получаем сообщения пользователей
-            user_messages = self.db.query(ChatMessage).join(ChatSession).filter(
-                and_(
-                    ChatMessage.role == "user",
-                    ChatSession.created_at >= start_date
-                )
-            ).order_by(desc(ChatMessage.created_at)).limit(limit * 2).all()
-            
-            pairs = []
-            
-            for user_msg in user_messages:
-                # Ищем следующий ответ ИИ в той же сессии
-                assistant_msg = self.db.query(ChatMessage).filter(
-                    and_(
-                        ChatMessage.session_id == user_msg.session_id,
-                        ChatMessage.role == "assistant",
-                        ChatMessage.created_at > user_msg.created_at
+            result = self.db.execute(statement.execution_options(yield_per=PAIR_BATCH_SIZE))
+            for rows in result.partitions():
+                yield [
+                    ChatPair(
+                        user_message_id=row.id,
+                        session_id=row.session_id,
+                        instruction=row.content or "",
+                        output=row.next_content or ""
                     )
-                ).order_by(ChatMessage.created_at).first()
-                
-                if assistant_msg:
-                    pairs.append((user_msg, assistant_msg))
-                    
-                    if len(pairs) >= limit:
-                        break
-            
-            return pairs
-            
+                    for row in rows
+                ]
         except Exception as e:
             logger.error(f"Ошибка получения пар сообщений: {e}")
-            return []
+    
+    def _get_chat_pairs(self, start_date: datetime, limit: int) -> List[ChatPair]:
+        """Получение пар сообщений пользователь-ИИ"""
+        return [pair for batch in self._iter_chat_pair_batches(start_date, limit) for pair in batch]
+    
+    def _get_existing_pairs(self, pairs: List[ChatPair]) -> Set[Tuple[str, str]]:
+        """Пары (instruction, output), уже сохраненные в обучающих данных, одним запросом"""
+        instructions = {pair.instruction for pair in pairs}
+        rows = self.db.query(TrainingData.instruction, TrainingData.output).filter(
+            TrainingData.instruction.in_(instructions)
+        ).all()
+        return {(row.instruction, row.output) for row in rows}
     
     def _evaluate_quality_auto(self, instruction: str, output: str) -> float:
         """
@@ -197,50 +235,56 @@ class DataCollectionService:
         Returns:
             Оценка от 1 до 5
         """
+        return self._evaluate_quality_batch([instruction], [output])[0]
+    
+    def _evaluate_quality_batch(self, instructions: List[str], outputs: List[str]) -> List[float]:
+        """
+        Оценка качества для пачки пар
+        
+        Текстовые признаки считаются одним проходом регулярных выражений по
+        каждому тексту, баллы - векторно по всей пачке.
+        """
         try:
-            score = 0.0
+            output_length = np.fromiter((len(output) for output in outputs), dtype=np.int64, count=len(outputs))
+            question_length = np.fromiter((len(q) for q in instructions), dtype=np.int64, count=len(instructions))
+            legal_count = np.fromiter(
+                (len(set(LEGAL_TERMS_PATTERN.findall(output.lower()))) for output in outputs),
+                dtype=np.float64, count=len(outputs)
+            )
+            has_reference = np.fromiter(
+                (LAW_REFERENCE_PATTERN.search(output) is not None for output in outputs),
+                dtype=bool, count=len(outputs)
+            )
+            # Минимум 4 уникальных слова в вопросе
+            varied_question = np.fromiter(
+                (len(set(q.split())) > 3 for q in instructions), dtype=bool, count=len(instructions)
+            )
             
             # 1. Длина ответа (ваши данные в среднем 1,425 символов)
-            output_length = len(output)
-            if 50 <= output_length <= 2000:  # Расширенный диапазон для ваших данных
-                score += 2.0
-            elif 20 <= output_length <= 3000:
-                score += 1.0
-            else:
-                score += 0.5
-            
+            score = np.select(
+                [(output_length >= 50) & (output_length <= 2000), (output_length >= 20) & (output_length <= 3000)],
+                [2.0, 1.0],
+                0.5
+            )
             # 2. Юридические термины (ваши данные имеют 38-61%)
-            legal_terms = [
-                'закон', 'суд', 'договор', 'право', 'обязательство', 
-                'ответственность', 'статья', 'кодекс', 'федеральный',
-                'гражданский', 'трудовой', 'уголовный', 'административный'
-            ]
-            legal_count = sum(1 for term in legal_terms if term in output.lower())
-            score += min(2.0, legal_count * 0.3)
-            
-            # 3. Ссылки на законы (добавить в обучение)
-            if any(ref in output for ref in ['ст.', 'ФЗ', 'ГК РФ', 'ТК РФ', 'УК РФ', 'КоАП РФ']):
-                score += 1.5
-            
+            score = score + np.minimum(2.0, legal_count * 0.3)
+            # 3. Ссылки на законы
+            score = score + np.where(has_reference, 1.5, 0.0)
             # 4. Качество вопроса
-            question_length = len(instruction)
-            if 10 <= question_length <= 500:
-                score += 1.0
-            elif 5 <= question_length <= 1000:
-                score += 0.5
-            
+            score = score + np.select(
+                [(question_length >= 10) & (question_length <= 500), (question_length >= 5) & (question_length <= 1000)],
+                [1.0, 0.5],
+                0.0
+            )
             # 5. Отсутствие повторений
-            if len(set(instruction.split())) > 3:  # Минимум 4 уникальных слова
-                score += 0.5
+            score = score + np.where(varied_question, 0.5, 0.0)
             
             # Нормализация до 1-5
-            final_score = min(5.0, max(1.0, score))
-            
-            return round(final_score, 2)
+            return [round(float(value), 2) for value in np.clip(score, 1.0, 5.0)]
             
         except Exception as e:
             logger.error(f"Ошибка оценки качества: {e}")
-            return 3.0  # Средняя оценка по умолчанию
+            return [3.0] * len(outputs)  # Средняя оценка по умолчанию
     
     def _categorize_complexity(self, instruction: str, output: str) -> str:
         """
@@ -253,32 +297,37 @@ class DataCollectionService:
         Returns:
             simple, medium, complex
         """
+        return self._categorize_complexity_batch([instruction], [output])[0]
+    
+    def _categorize_complexity_batch(self, instructions: List[str], outputs: List[str]) -> List[str]:
+        """Категоризация по сложности для пачки пар: simple, medium, complex"""
         try:
+            output_length = np.fromiter((len(output) for output in outputs), dtype=np.int64, count=len(outputs))
+            question_length = np.fromiter((len(q) for q in instructions), dtype=np.int64, count=len(instructions))
+            has_core_term = np.fromiter(
+                (CORE_LEGAL_TERMS_PATTERN.search(output.lower()) is not None for output in outputs),
+                dtype=bool, count=len(outputs)
+            )
+            has_complex_word = np.fromiter(
+                (COMPLEX_WORDS_PATTERN.search(q.lower()) is not None for q in instructions),
+                dtype=bool, count=len(instructions)
+            )
+            many_questions = np.fromiter((q.count('?') > 2 for q in instructions), dtype=bool, count=len(instructions))
+            
             # Простые (автоматически в обучение)
-            if (len(output) >= 100 and 
-                len(output) <= 1500 and
-                any(term in output.lower() for term in ['закон', 'право', 'договор']) and
-                len(instruction) >= 20 and
-                len(instruction) <= 200):
-                return "simple"
-            
-            # Сложные (требуют проверки)
-            elif (len(output) > 2000 or 
-                  len(instruction) > 500 or
-                  any(complex_word in instruction.lower() for complex_word in [
-                      'сложный', 'запутанный', 'спорный', 'неоднозначный',
-                      'противоречивый', 'конфликт', 'диспут'
-                  ]) or
-                  instruction.count('?') > 2):  # Множественные вопросы
-                return "complex"
+            simple = (
+                (output_length >= 100) & (output_length <= 1500) & has_core_term &
+                (question_length >= 20) & (question_length <= 200)
+            )
+            # Сложные (требуют проверки): длинные, спорные или множественные вопросы
+            complex_ = (output_length > 2000) | (question_length > 500) | has_complex_word | many_questions
             
             # Средние (быстрая проверка)
-            else:
-                return "medium"
+            return np.select([simple, complex_], ["simple", "complex"], "medium").tolist()
                 
         except Exception as e:
             logger.error(f"Ошибка категоризации: {e}")
-            return "medium"  # По умолчанию средняя сложность
+            return ["medium"] * len(outputs)  # По умолчанию средняя сложность
     
     def get_pending_review_data(self, limit: int = 50) -> List[TrainingData]:
         """Получение данных, требующих ручной проверки"""
@@ -25,7 +25,6 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from .embeddings_service import embeddings_service
 from .vector_store_service import vector_store_service
 from .document_validator import document_validator
-from .ai_document_validator import ai_document_validator
 from .hybrid_document_validator import hybrid_document_validator
 from .document_versioning import document_versioning_service
 from .simple_expert_rag import simple_expert_rag
@@ -282,8 +281,9 @@ class DocumentService:
                 # Используем гибридную валидацию
                 validation_result = await hybrid_document_validator.validate_document(text, file_info.name)
             elif self.validation_method == "ai":
-                # Используем AI валидацию
-                validation_result = await ai_document_validator.validate_document(text, file_info.name)
+                # Предварительная проверка правилами, AI-валидация - в фоновой очереди (не блокирует чат)
+                validation_result = document_validator.validate_document(text, file_info.name)
+                validation_result["validation_status"] = "pending"
             else:  # rules
                 # Используем обычную валидацию
                 validation_result = document_validator.validate_document(text, file_info.name)
@@ -346,7 +346,8 @@ class DocumentService:
                 "version": str(version.version),
                 "status": str(version.status),
                 "is_draft": version.status == "draft",
-                "pages": int(pages_count) if pages_count > 0 else None
+                "pages": int(pages_count) if pages_count > 0 else None,
+                "validation_status": validation_result.get("validation_status")
             }
             
             # Фильтруем None значения из базовых метаданных
@@ -421,6 +422,8 @@ class DocumentService:
             except Exception as e:
                 logger.error(f"❌ Ошибка интеграции с simple_expert_rag: {e}")
             
+            validation_job_id = self._enqueue_ai_validation(validation_result, text, file_info.name, document_id)
+            
             return {
                 "success": True,
                 "file_path": file_path,
@@ -428,13 +431,33 @@ class DocumentService:
                 "total_chunks": len(chunks),
                 "file_hash": file_hash,
                 "text_length": len(text),
-                "document_id": document_id
+                "document_id": document_id,
+                "validation_job_id": validation_job_id
             }
             
         except Exception as e:
             logger.error(f"❌ Ошибка обработки файла {file_path}: {e}")
             return {"success": False, "error": str(e)}
     
+    def _enqueue_ai_validation(self, validation_result: Dict[str, Any], text: str,
+                               filename: str, document_id: str) -> Optional[str]:
+        """Ставит AI-валидацию документа в фоновую очередь, результат вольется в метаданные чанков"""
+        if validation_result.get("validation_status") != "pending":
+            return None
+        
+        try:
+            from .background_analysis_service import background_analysis_service
+            from ..models.analysis_job import AnalysisJobType
+            return background_analysis_service.enqueue(
+                AnalysisJobType.DOCUMENT_VALIDATION,
+                payload={"text": text, "filename": filename, "document_id": document_id},
+                target={"where": {"document_id": document_id}},
+                dedup_key=f"validate:{document_id}"
+            )
+        except Exception as e:
+            logger.error(f"❌ Не удалось поставить AI-валидацию в очередь: {e}")
+            return None
+    
     async def process_directory(self, directory_path: str, recursive: bool = True) -> Dict[str, Any]:
         """Обрабатывает все поддерживаемые файлы в директории"""
         if not os.path.exists(directory_path):
@@ -502,8 +525,9 @@ class DocumentService:
                 # Используем гибридную валидацию
                 validation_result = await hybrid_document_validator.validate_document(content, title)
             elif self.validation_method == "ai":
-                # Используем AI валидацию
-                validation_result = await ai_document_validator.validate_document(content, title)
+                # Предварительная проверка правилами, AI-валидация - в фоновой очереди (не блокирует чат)
+                validation_result = document_validator.validate_document(content, title)
+                validation_result["validation_status"] = "pending"
             else:  # rules
                 # Используем обычную валидацию
                 validation_result = document_validator.validate_document(content, title)
@@ -539,6 +563,8 @@ class DocumentService:
                 "legal_score": validation_result.get("legal_score", 0.0),
                 "is_validated": True
             }
+            if validation_result.get("validation_status"):
+                base_metadata["validation_status"] = validation_result["validation_status"]
             
             if metadata:
                 base_metadata.update(metadata)
@@ -570,13 +596,16 @@ class DocumentService:
             
             logger.info(f"✅ Текстовый документ добавлен: {title} ({added_count}/{len(chunks)} чанков)")
             
+            validation_job_id = self._enqueue_ai_validation(validation_result, content, title, doc_id)
+            
             return {
                 "success": True,
                 "title": title,
                 "document_id": doc_id,
                 "chunks_added": added_count,
                 "total_chunks": len(chunks),
-                "content_hash": content_hash
+                "content_hash": content_hash,
+                "validation_job_id": validation_job_id
             }
             
         except Exception as e:
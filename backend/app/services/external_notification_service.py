@@ -1,13 +1,15 @@
 import smtplib
 import ssl
 import json
+import time
 import aiohttp
 import asyncio
+from collections import defaultdict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import logging
 from datetime import datetime
 import os
@@ -16,8 +18,252 @@ from jinja2 import Template
 from ..models.notification import NotificationChannel, ChannelType
 from ..core.config import settings
 
+try:
+    import aiosmtplib
+    AIOSMTPLIB_AVAILABLE = True
+except ImportError:
+    aiosmtplib = None
+    AIOSMTPLIB_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# Connection is recycled after this many messages (providers drop very long sessions)
+SMTP_MESSAGES_PER_CONNECTION = 500
+
+_SMTP_DISCONNECT_ERRORS: Tuple[type, ...] = (smtplib.SMTPServerDisconnected, ConnectionError, asyncio.TimeoutError)
+if AIOSMTPLIB_AVAILABLE:
+    _SMTP_DISCONNECT_ERRORS += (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError)
+
+# Recipient rejected by the server - retrying will not help
+_SMTP_RECIPIENT_ERRORS: Tuple[type, ...] = (smtplib.SMTPRecipientsRefused,)
+if AIOSMTPLIB_AVAILABLE:
+    _SMTP_RECIPIENT_ERRORS += (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPRecipientRefused)
+
+
+class DeliveryError(Exception):
+    """Delivery failure with retry hint"""
+    
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def _error_result(error: Exception, **extra) -> Dict[str, Any]:
+    """Standard failure result; ValueError means bad configuration and is not retried"""
+    result = {
+        'success': False,
+        'error': str(error),
+        'retryable': getattr(error, 'retryable', not isinstance(error, ValueError)),
+        'timestamp': datetime.utcnow().isoformat()
+    }
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        result['retry_after'] = retry_after
+    result.update(extra)
+    return result
+
+
+def _http_error(service: str, status: int, text: str, retry_after: Optional[str] = None) -> DeliveryError:
+    """HTTP error -> DeliveryError (429 and 5xx are retried)"""
+    delay = None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            delay = None
+    return DeliveryError(
+        f"{service} error: {status} - {text[:500]}",
+        retryable=status == 429 or status >= 500,
+        retry_after=delay
+    )
+
+
+class SharedHTTPSession:
+    """One aiohttp session (connection pool) shared by Slack, Telegram and webhook senders"""
+    
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+    
+    async def get(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    connector = aiohttp.TCPConnector(
+                        limit=settings.NOTIFICATION_HTTP_POOL_SIZE,
+                        limit_per_host=settings.NOTIFICATION_HTTP_POOL_PER_HOST,
+                        ttl_dns_cache=300
+                    )
+                    self._session = aiohttp.ClientSession(
+                        connector=connector,
+                        timeout=aiohttp.ClientTimeout(total=30)
+                    )
+        return self._session
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+shared_http_session = SharedHTTPSession()
+
+
+class _SMTPConnection:
+    """Long-lived authenticated SMTP connection"""
+    
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self._client = None
+        self.sent = 0
+    
+    @property
+    def _implicit_tls(self) -> bool:
+        return int(self.config['smtp_port']) == 465
+    
+    async def _connect(self):
+        config = self.config
+        use_tls = config.get('use_tls', True)
+        context = ssl.create_default_context()
+        if AIOSMTPLIB_AVAILABLE:
+            client = aiosmtplib.SMTP(
+                hostname=config['smtp_host'],
+                port=int(config['smtp_port']),
+                use_tls=self._implicit_tls,
+                start_tls=use_tls and not self._implicit_tls,
+                tls_context=context,
+                timeout=30
+            )
+            await client.connect()
+            await client.login(config['smtp_username'], config['smtp_password'])
+        else:
+            def connect_sync():
+                if self._implicit_tls:
+                    server = smtplib.SMTP_SSL(config['smtp_host'], int(config['smtp_port']), context=context, timeout=30)
+                else:
+                    server = smtplib.SMTP(config['smtp_host'], int(config['smtp_port']), timeout=30)
+                    if use_tls:
+                        server.starttls(context=context)
+                server.login(config['smtp_username'], config['smtp_password'])
+                return server
+            client = await asyncio.to_thread(connect_sync)
+        self._client = client
+        self.sent = 0
+    
+    async def send(self, message: MIMEMultipart):
+        for attempt in range(2):
+            try:
+                if self._client is None:
+                    await self._connect()
+                if AIOSMTPLIB_AVAILABLE:
+                    await self._client.send_message(message)
+                else:
+                    await asyncio.to_thread(self._client.send_message, message)
+                self.sent += 1
+                if self.sent >= SMTP_MESSAGES_PER_CONNECTION:
+                    await self.close()
+                return
+            except _SMTP_DISCONNECT_ERRORS:
+                # Server dropped the idle connection - reconnect once
+                await self.close()
+                if attempt:
+                    raise
+    
+    async def close(self):
+        client, self._client = self._client, None
+        if client is None:
+            return
+        try:
+            if AIOSMTPLIB_AVAILABLE:
+                await client.quit()
+            else:
+                await asyncio.to_thread(client.quit)
+        except Exception:
+            pass
+
+
+class SMTPConnectionPool:
+    """Pool of long-lived SMTP connections for one provider account"""
+    
+    def __init__(self, config: Dict[str, Any], size: int):
+        self.config = config
+        self.size = max(1, size)
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._created = 0
+    
+    async def send(self, message: MIMEMultipart):
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            connection = _SMTPConnection(self.config)
+        else:
+            connection = await self._idle.get()
+        try:
+            await connection.send(message)
+        except Exception:
+            await connection.close()
+            raise
+        finally:
+            self._idle.put_nowait(connection)
+    
+    async def close(self):
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+        self._created = 0
+
+
+class ProviderRateLimiter:
+    """Per-channel provider limits (fixed minute/hour/day windows)"""
+    
+    PERIODS = (('rate_limit_per_minute', 60), ('rate_limit_per_hour', 3600), ('rate_limit_per_day', 86400))
+    
+    def __init__(self):
+        self._counters: Dict[Tuple[int, int], Tuple[int, int]] = {}  # (channel_id, period) -> (window, count)
+    
+    def acquire(self, channel: NotificationChannel) -> float:
+        """Reserves one send; returns 0 if allowed, otherwise seconds to wait"""
+        now = time.time()
+        limits = [(period, getattr(channel, attr, None)) for attr, period in self.PERIODS]
+        limits = [(period, limit) for period, limit in limits if limit]
+        wait = 0.0
+        for period, limit in limits:
+            window = int(now // period)
+            current_window, count = self._counters.get((channel.id, period), (window, 0))
+            if current_window != window:
+                count = 0
+            if count >= limit:
+                wait = max(wait, (window + 1) * period - now)
+        if wait > 0:
+            return wait
+        for period, limit in limits:
+            window = int(now // period)
+            current_window, count = self._counters.get((channel.id, period), (window, 0))
+            self._counters[(channel.id, period)] = (window, (count if current_window == window else 0) + 1)
+        return 0.0
+
+
+class DeliveryMetrics:
+    """Delivery counters per channel type"""
+    
+    def __init__(self):
+        self._counters: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    
+    def record(self, channel_type: str, outcome: str, latency: Optional[float] = None):
+        counters = self._counters[channel_type]
+        counters[outcome] += 1
+        if latency is not None:
+            counters['latency_total'] += latency
+            counters['latency_max'] = max(counters['latency_max'], latency)
+    
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for channel_type, counters in self._counters.items():
+            data = dict(counters)
+            sent = data.get('sent', 0)
+            data['latency_avg'] = data.get('latency_total', 0.0) / sent if sent else 0.0
+            result[channel_type] = data
+        return result
+
 
 class EmailNotificationService:
     """Service for sending email notifications"""
@@ -25,6 +271,21 @@ class EmailNotificationService:
     def __init__(self):
         self.smtp_configs = {}
         self.templates = {}
+        self._pools: Dict[Tuple[str, int, str], SMTPConnectionPool] = {}
+    
+    def _get_pool(self, config: Dict[str, Any]) -> SMTPConnectionPool:
+        key = (config['smtp_host'], int(config['smtp_port']), config['smtp_username'])
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(config, config.get('pool_size', settings.NOTIFICATION_SMTP_POOL_SIZE))
+            self._pools[key] = pool
+        return pool
+    
+    async def close(self):
+        """Close pooled SMTP connections"""
+        for pool in self._pools.values():
+            await pool.close()
+        self._pools.clear()
         
     async def send_email(
         self,
@@ -72,15 +333,8 @@ class EmailNotificationService:
                     )
                     message.attach(part)
             
-            # Send email
-            context = ssl.create_default_context()
-            
-            with smtplib.SMTP(config['smtp_host'], config['smtp_port']) as server:
-                if config.get('use_tls', True):
-                    server.starttls(context=context)
-                
-                server.login(config['smtp_username'], config['smtp_password'])
-                server.send_message(message)
+            # Send over a pooled connection (no TLS handshake/login per message)
+            await self._get_pool(config).send(message)
             
             logger.info(f"Email sent successfully to {recipient_email}")
             
@@ -91,14 +345,12 @@ class EmailNotificationService:
                 'timestamp': datetime.utcnow().isoformat()
             }
             
+        except _SMTP_RECIPIENT_ERRORS as e:
+            logger.error(f"Recipient refused {recipient_email}: {e}")
+            return _error_result(DeliveryError(str(e), retryable=False), recipient=recipient_email)
         except Exception as e:
             logger.error(f"Error sending email to {recipient_email}: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'recipient': recipient_email,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+            return _error_result(e, recipient=recipient_email)
     
     def render_template(self, template_content: str, variables: Dict[str, Any]) -> str:
         """Render email template with variables"""
@@ -113,14 +365,9 @@ class EmailNotificationService:
 class SlackNotificationService:
     """Service for sending Slack notifications"""
     
-    def __init__(self):
-        self.session = None
-        
     async def get_session(self):
-        """Get or create aiohttp session"""
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-        return self.session
+        """Shared aiohttp session"""
+        return await shared_http_session.get()
     
     async def send_slack_message(
         self,
@@ -154,11 +401,7 @@ class SlackNotificationService:
                 
         except Exception as e:
             logger.error(f"Error sending Slack message: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'timestamp': datetime.utcnow().isoformat()
-            }
+            return _error_result(e)
     
     async def _send_webhook_message(
         self,
@@ -205,7 +448,7 @@ class SlackNotificationService:
                 }
             else:
                 error_text = await response.text()
-                raise Exception(f"Slack webhook error: {response.status} - {error_text}")
+                raise _http_error("Slack webhook", response.status, error_text, response.headers.get('Retry-After'))
     
     async def _send_bot_message(
         self,
@@ -267,6 +510,8 @@ class SlackNotificationService:
             headers=headers,
             json=payload
         ) as response:
+            if response.status == 429 or response.status >= 500:
+                raise _http_error("Slack API", response.status, await response.text(), response.headers.get('Retry-After'))
             result = await response.json()
             
             if result.get('ok'):
@@ -280,23 +525,15 @@ class SlackNotificationService:
                 raise Exception(f"Slack API error: {result.get('error', 'Unknown error')}")
     
     async def close(self):
-        """Close aiohttp session"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Shared session is closed by ExternalNotificationService.close"""
 
 
 class TelegramNotificationService:
     """Service for sending Telegram notifications"""
     
-    def __init__(self):
-        self.session = None
-        
     async def get_session(self):
-        """Get or create aiohttp session"""
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-        return self.session
+        """Shared aiohttp session"""
+        return await shared_http_session.get()
     
     async def send_telegram_message(
         self,
@@ -331,7 +568,12 @@ class TelegramNotificationService:
                 payload['reply_markup'] = json.dumps(reply_markup)
             
             async with session.post(url, json=payload) as response:
-                result = await response.json()
+                result = await response.json(content_type=None)
+                
+                if response.status == 429 or response.status >= 500:
+                    retry_after = (result.get('parameters') or {}).get('retry_after')
+                    raise _http_error("Telegram API", response.status, result.get('description', ''),
+                                      str(retry_after) if retry_after else None)
                 
                 if result.get('ok'):
                     logger.info(f"Telegram message sent successfully to chat {config['chat_id']}")
@@ -342,15 +584,13 @@ class TelegramNotificationService:
                         'timestamp': datetime.utcnow().isoformat()
                     }
                 else:
-                    raise Exception(f"Telegram API error: {result.get('description', 'Unknown error')}")
+                    raise DeliveryError(
+                        f"Telegram API error: {result.get('description', 'Unknown error')}", retryable=False
+                    )
                     
         except Exception as e:
             logger.error(f"Error sending Telegram message: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'timestamp': datetime.utcnow().isoformat()
-            }
+            return _error_result(e)
     
     async def send_telegram_photo(
         self,
@@ -439,23 +679,15 @@ class TelegramNotificationService:
         return message
     
     async def close(self):
-        """Close aiohttp session"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Shared session is closed by ExternalNotificationService.close"""
 
 
 class WebhookNotificationService:
     """Service for sending webhook notifications"""
     
-    def __init__(self):
-        self.session = None
-        
     async def get_session(self):
-        """Get or create aiohttp session"""
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-        return self.session
+        """Shared aiohttp session"""
+        return await shared_http_session.get()
     
     async def send_webhook(
         self,
@@ -528,15 +760,11 @@ class WebhookNotificationService:
                         'timestamp': datetime.utcnow().isoformat()
                     }
                 else:
-                    raise Exception(f"Webhook error: {response.status} - {response_text}")
+                    raise _http_error("Webhook", response.status, response_text, response.headers.get('Retry-After'))
                     
         except Exception as e:
             logger.error(f"Error sending webhook: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'timestamp': datetime.utcnow().isoformat()
-            }
+            return _error_result(e)
     
     def create_standard_payload(
         self,
@@ -567,10 +795,7 @@ class WebhookNotificationService:
         return payload
     
     async def close(self):
-        """Close aiohttp session"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Shared session is closed by ExternalNotificationService.close"""
 
 
 class ExternalNotificationService:
@@ -581,6 +806,8 @@ class ExternalNotificationService:
         self.slack_service = SlackNotificationService()
         self.telegram_service = TelegramNotificationService()
         self.webhook_service = WebhookNotificationService()
+        self.rate_limiter = ProviderRateLimiter()
+        self.metrics = DeliveryMetrics()
         
     async def send_notification(
         self,
@@ -672,12 +899,7 @@ class ExternalNotificationService:
                 
         except Exception as e:
             logger.error(f"Error sending external notification: {e}")
-            return {
-                'success': False,
-                'error': str(e),
-                'channel_type': channel.type.value,
-                'timestamp': datetime.utcnow().isoformat()
-            }
+            return _error_result(e, channel_type=channel.type.value)
     
     def _render_html_email(
         self,
@@ -744,9 +966,8 @@ class ExternalNotificationService:
     
     async def close(self):
         """Close all external services"""
-        await self.slack_service.close()
-        await self.telegram_service.close()
-        await self.webhook_service.close()
+        await self.email_service.close()
+        await shared_http_session.close()
 
 
 # Create service instance
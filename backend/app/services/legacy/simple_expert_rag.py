@@ -9,11 +9,16 @@ import json
 import os
 from typing import List, Dict, Any, Optional
 from datetime import datetime, date
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
 import re
 
+from ...core.legal_structure import LegalStructure, LegalNode, get_legal_structure
+
 logger = logging.getLogger(__name__)
 
+# Конец предложения: ! ? или точка, не следующая за цифрой (номера статей/пунктов)
+SENTENCE_END_PATTERN = re.compile(r'[!?]|(?<!\d)\.')
+
 @dataclass
 class LegalMetadata:
     """Метаданные для юридических документов"""
@@ -167,62 +172,96 @@ class SimpleExpertRAG:
         """Разбивка текста на токено-ориентированные чанки"""
         chunks = []
         
-        # Нормализация текста
-        normalized_text = self._normalize_text(text)
+        # Структура документа разбирается один раз (кэшируется по хэшу содержимого)
+        structure = get_legal_structure(text)
         
-        # Извлечение иерархии
-        hierarchy = self.extract_hierarchy(normalized_text)
+        # Иерархия уровня документа (кодекс, первые ссылки)
+        document_hierarchy = self.extract_hierarchy(text)
         
-        # Разбивка на предложения
-        sentences = self._split_into_sentences(normalized_text)
+        # Чанки не пересекают границы статей
+        segments = []
+        articles = structure.articles
+        if articles:
+            if articles[0].start > 0:
+                segments.append((0, articles[0].start, document_hierarchy))
+            for node in articles:
+                segments.append((node.start, node.end, self._node_hierarchy(structure, node, document_hierarchy)))
+        else:
+            segments.append((0, len(text), document_hierarchy))
         
-        current_chunk = ""
-        current_tokens = 0
         chunk_index = 0
         chunk_size = 500  # токенов
         overlap_size = 75  # 15% от 500
         
-        for i, sentence in enumerate(sentences):
-            sentence_tokens = self.count_tokens(sentence)
-            
-            # Если добавление предложения превысит лимит
-            if current_tokens + sentence_tokens > chunk_size:
-                # Сохраняем текущий чанк
-                if current_chunk.strip():
-                    chunk = self._create_chunk(
-                        current_chunk.strip(),
-                        metadata,
-                        hierarchy,
-                        chunk_index,
-                        len(chunks)
-                    )
-                    chunks.append(chunk)
-                    chunk_index += 1
+        for start, end, hierarchy in segments:
+            # Нормализация текста
+            normalized_text = self._normalize_text(text[start:end])
+            if not normalized_text:
+                continue
+            
+            # Разбивка на предложения
+            sentences = self._split_into_sentences(normalized_text)
+            
+            current_chunk = ""
+            current_tokens = 0
+            
+            for sentence in sentences:
+                sentence_tokens = self.count_tokens(sentence)
                 
-                # Начинаем новый чанк с перекрытием
-                overlap_text = self._get_overlap_text(current_chunk, overlap_size)
-                current_chunk = overlap_text + " " + sentence
-                current_tokens = self.count_tokens(current_chunk)
-            else:
-                current_chunk += " " + sentence if current_chunk else sentence
-                current_tokens += sentence_tokens
-        
-        # Добавляем последний чанк
-        if current_chunk.strip():
-            chunk = self._create_chunk(
-                current_chunk.strip(),
-                metadata,
-                hierarchy,
-                chunk_index,
-                len(chunks)
-            )
-            chunks.append(chunk)
+                # Если добавление предложения превысит лимит
+                if current_tokens + sentence_tokens > chunk_size:
+                    # Сохраняем текущий чанк
+                    if current_chunk.strip():
+                        chunk = self._create_chunk(
+                            current_chunk.strip(),
+                            metadata,
+                            hierarchy,
+                            chunk_index,
+                            len(chunks)
+                        )
+                        chunks.append(chunk)
+                        chunk_index += 1
+                    
+                    # Начинаем новый чанк с перекрытием
+                    overlap_text = self._get_overlap_text(current_chunk, overlap_size)
+                    current_chunk = overlap_text + " " + sentence
+                    current_tokens = self.count_tokens(current_chunk)
+                else:
+                    current_chunk += " " + sentence if current_chunk else sentence
+                    current_tokens += sentence_tokens
+            
+            # Добавляем последний чанк статьи
+            if current_chunk.strip():
+                chunk = self._create_chunk(
+                    current_chunk.strip(),
+                    metadata,
+                    hierarchy,
+                    chunk_index,
+                    len(chunks)
+                )
+                chunks.append(chunk)
+                chunk_index += 1
         
         # Устанавливаем связи между соседними чанками
         self._set_neighbors(chunks)
         
         return chunks
     
+    def _node_hierarchy(self, structure: LegalStructure, node: LegalNode,
+                        document_hierarchy: Dict[str, Any]) -> Dict[str, Any]:
+        """Иерархия статьи из разобранной структуры документа"""
+        node_hierarchy = structure.hierarchy(node)
+        hierarchy = dict(document_hierarchy)
+        hierarchy.update({
+            "section": node_hierarchy["section"],
+            "chapter": node_hierarchy["chapter"],
+            "article": f"ст. {node.number}",
+            "part": None,
+            "item": None,
+            "paragraph": None
+        })
+        return hierarchy
+    
     def _normalize_text(self, text: str) -> str:
         """Нормализация текста для юридических документов"""
         # Приведение кавычек к единому виду
@@ -242,20 +281,20 @@ class SimpleExpertRAG:
     def _split_into_sentences(self, text: str) -> List[str]:
         """Разбивка на предложения с учетом юридической структуры"""
         sentences = []
-        current = ""
+        start = 0
         
-        for char in text:
-            current += char
-            if char in '.!?':
-                # Проверяем, не является ли это частью номера статьи/пункта
-                if not re.search(r'\d+\.\d*$', current.strip()):
-                    sentences.append(current.strip())
-                    current = ""
+        # Точка после цифры - часть номера статьи/пункта, а не конец предложения
+        for match in SENTENCE_END_PATTERN.finditer(text):
+            sentence = text[start:match.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
         
-        if current.strip():
-            sentences.append(current.strip())
+        tail = text[start:].strip()
+        if tail:
+            sentences.append(tail)
         
-        return [s for s in sentences if s.strip()]
+        return sentences
     
     def _get_overlap_text(self, text: str, overlap_tokens: int) -> str:
         """Получение текста для перекрытия"""
@@ -270,10 +309,18 @@ class SimpleExpertRAG:
         """Создание чанка с метаданными"""
         chunk_id = f"{metadata.source}_{chunk_index}_{hashlib.md5(content.encode()).hexdigest()[:8]}"
         
+        # Статья/часть/пункт чанка берутся из иерархии, если не заданы явно
+        chunk_metadata = replace(
+            metadata,
+            article=metadata.article or hierarchy.get("article"),
+            part=metadata.part or hierarchy.get("part"),
+            item=metadata.item or hierarchy.get("item")
+        )
+        
         return LegalChunk(
             id=chunk_id,
             content=content,
-            metadata=metadata,
+            metadata=chunk_metadata,
             token_count=self.count_tokens(content),
             chunk_index=chunk_index,
             parent_doc_id=f"{metadata.source}_doc"
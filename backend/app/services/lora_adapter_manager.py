@@ -0,0 +1,330 @@
+"""
+Обслуживание LoRA-адаптеров поверх одной базовой модели
+
+Базовая модель Vistral загружается один раз (mmap), адаптеры canary-версий
+подключаются к ее контексту на лету через низкоуровневый API llama.cpp.
+LoRAAdapterCache держит загруженные адаптеры в LRU с бюджетом памяти,
+AdapterScheduler выдает модель запросам группами по адаптеру, чтобы
+переключений было как можно меньше.
+"""
+
+import asyncio
+import glob
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+try:
+    import llama_cpp as _llama_cpp
+except ImportError:  # pragma: no cover - llama_cpp обязателен для UnifiedLLMService
+    _llama_cpp = None
+
+
+def _llama_fn(*names: str) -> Optional[Callable]:
+    """Функция низкоуровневого API llama.cpp (имена менялись между версиями)"""
+    for name in names:
+        fn = getattr(_llama_cpp, name, None) if _llama_cpp is not None else None
+        if fn is not None:
+            return fn
+    return None
+
+
+_adapter_init = _llama_fn("llama_adapter_lora_init", "llama_lora_adapter_init")
+_adapter_free = _llama_fn("llama_adapter_lora_free", "llama_lora_adapter_free")
+_adapter_set = _llama_fn("llama_set_adapter_lora", "llama_lora_adapter_set")
+_adapter_clear = _llama_fn("llama_clear_adapter_lora", "llama_lora_adapter_clear")
+
+
+def adapters_supported() -> bool:
+    """Поддерживает ли установленный llama_cpp подключение адаптеров к контексту"""
+    return all(fn is not None for fn in (_adapter_init, _adapter_set, _adapter_clear))
+
+
+def resolve_adapter_file(adapter_path: str) -> str:
+    """
+    Путь к GGUF-файлу адаптера
+
+    LoRATrainingService сохраняет адаптер в формате PEFT; для llama.cpp его нужно
+    сконвертировать (convert_lora_to_gguf.py) и положить .gguf рядом или указать файл.
+    """
+    if os.path.isdir(adapter_path):
+        candidates = sorted(glob.glob(os.path.join(adapter_path, "*.gguf")))
+        if not candidates:
+            raise FileNotFoundError(
+                f"В {adapter_path} нет GGUF-адаптера. Сконвертируйте PEFT-адаптер через convert_lora_to_gguf.py"
+            )
+        return candidates[0]
+    if not os.path.exists(adapter_path):
+        raise FileNotFoundError(f"Файл адаптера не найден: {adapter_path}")
+    return adapter_path
+
+
+@dataclass
+class LoadedAdapter:
+    """Загруженный в память адаптер"""
+    adapter_id: str
+    path: str
+    handle: Any
+    size_bytes: int
+    loaded_at: float
+    last_used: float
+    uses: int = 0
+
+
+class LoRAAdapterCache:
+    """LRU-кеш адаптеров с бюджетом памяти"""
+
+    def __init__(self, memory_budget_mb: int = 1024):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._adapters: "OrderedDict[str, LoadedAdapter]" = OrderedDict()
+        self._failed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(adapter.size_bytes for adapter in self._adapters.values())
+
+    def is_failed(self, adapter_id: str) -> bool:
+        return adapter_id in self._failed
+
+    def get(self, base_model: Any, adapter_id: str, adapter_path: str, pinned: Set[str]) -> LoadedAdapter:
+        """Возвращает адаптер, загружая его при необходимости (блокирующий вызов)"""
+        with self._lock:
+            adapter = self._adapters.get(adapter_id)
+            if adapter is not None:
+                self._adapters.move_to_end(adapter_id)
+                adapter.last_used = time.time()
+                adapter.uses += 1
+                self.hits += 1
+                return adapter
+
+        if not adapters_supported():
+            raise RuntimeError("Установленная версия llama_cpp не поддерживает LoRA-адаптеры во время работы")
+
+        try:
+            path = resolve_adapter_file(adapter_path)
+            size = os.path.getsize(path)
+            if size > self.memory_budget:
+                raise MemoryError(f"Адаптер {adapter_id} ({size // (1024 * 1024)} MB) больше бюджета кеша")
+
+            with self._lock:
+                self._evict_for(size, pinned)
+
+            started = time.time()
+            handle = _adapter_init(base_model.model, path.encode("utf-8"))
+            if not handle:
+                raise RuntimeError(f"llama.cpp не смог загрузить адаптер {path}")
+        except Exception as e:
+            self._failed[adapter_id] = str(e)
+            raise
+
+        now = time.time()
+        adapter = LoadedAdapter(
+            adapter_id=adapter_id,
+            path=path,
+            handle=handle,
+            size_bytes=size,
+            loaded_at=now,
+            last_used=now,
+            uses=1
+        )
+        with self._lock:
+            self._adapters[adapter_id] = adapter
+            self.loads += 1
+        logger.info(f"🧩 LoRA-адаптер {adapter_id} загружен за {now - started:.2f}s ({size // (1024 * 1024)} MB)")
+        return adapter
+
+    def _evict_for(self, size: int, pinned: Set[str]):
+        """Освобождает место под адаптер размера size (вызывается под self._lock)"""
+        for adapter_id in list(self._adapters.keys()):
+            if self.used_bytes + size <= self.memory_budget:
+                break
+            if adapter_id in pinned:
+                continue
+            adapter = self._adapters.pop(adapter_id)
+            if _adapter_free is not None:
+                _adapter_free(adapter.handle)
+            self.evictions += 1
+            logger.info(f"♻️ LoRA-адаптер {adapter_id} выгружен из кеша")
+
+    def clear(self):
+        with self._lock:
+            for adapter in self._adapters.values():
+                if _adapter_free is not None:
+                    _adapter_free(adapter.handle)
+            self._adapters.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": list(self._adapters.keys()),
+                "used_mb": round(self.used_bytes / (1024 * 1024), 1),
+                "budget_mb": round(self.memory_budget / (1024 * 1024), 1),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "failed": dict(self._failed)
+            }
+
+
+class AdapterLease:
+    """Право использовать модель с активным адаптером; освобождается ровно один раз"""
+
+    def __init__(self, scheduler: "AdapterScheduler", adapter_id: Optional[str]):
+        self._scheduler = scheduler
+        self._loop = asyncio.get_running_loop()
+        self._released = False
+        self.adapter_id = adapter_id
+        self.transferred = False  # Освобождение передано потоку генерации
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._scheduler._release()
+
+    def release_threadsafe(self):
+        """Освобождение из рабочего потока генерации"""
+        self._loop.call_soon_threadsafe(self.release)
+
+
+class AdapterScheduler:
+    """
+    Выдача модели запросам с группировкой по адаптеру
+
+    Запросы к активному адаптеру проходят сразу; запросы к другому ждут в очереди
+    своего адаптера. Когда текущая группа завершилась, переключаемся на адаптер
+    с самой длинной очередью. Чтобы не было голодания, активный адаптер принимает
+    новые запросы без переключения не больше max_batch раз, пока ждут другие.
+    """
+
+    def __init__(self, activate: Callable[[Optional[str]], Awaitable[None]], max_batch: int = 8):
+        self._activate = activate
+        self.max_batch = max_batch
+        self.active: Optional[str] = None  # None - базовая модель без адаптера
+        self.switches = 0
+        self._in_flight = 0
+        self._served_in_batch = 0
+        self._switching = False
+        self._waiters: "OrderedDict[Optional[str], Deque[asyncio.Future]]" = OrderedDict()
+
+    def _others_waiting(self) -> bool:
+        return any(queue for adapter_id, queue in self._waiters.items() if adapter_id != self.active)
+
+    def _can_join_active(self) -> bool:
+        return not self._switching and (self._served_in_batch < self.max_batch or not self._others_waiting())
+
+    async def acquire(self, adapter_id: Optional[str]) -> AdapterLease:
+        if adapter_id == self.active and self._can_join_active() and not self._waiters.get(adapter_id):
+            self._in_flight += 1
+            self._served_in_batch += 1
+            return AdapterLease(self, adapter_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(adapter_id, deque()).append(future)
+        self._dispatch()
+        try:
+            granted = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Доступ уже выдан, но ждущий отменен - возвращаем слот
+                lease = AdapterLease(self, future.result())
+                lease.release()
+            else:
+                queue = self._waiters.get(adapter_id)
+                if queue and future in queue:
+                    queue.remove(future)
+            raise
+        return AdapterLease(self, granted)
+
+    def _release(self):
+        self._in_flight = max(0, self._in_flight - 1)
+        self._dispatch()
+
+    def _grant_active(self):
+        """Пропускает ждущих активного адаптера в пределах группы"""
+        queue = self._waiters.get(self.active)
+        while queue and self._can_join_active():
+            future = queue.popleft()
+            if future.done():
+                continue
+            self._in_flight += 1
+            self._served_in_batch += 1
+            future.set_result(self.active)
+        if queue is not None and not queue:
+            self._waiters.pop(self.active, None)
+
+    def _pick_next(self) -> Optional[str]:
+        candidates = [(adapter_id, queue) for adapter_id, queue in self._waiters.items() if queue]
+        if not candidates:
+            return self.active
+        if self.active in self._waiters and self._waiters[self.active] and not self._others_waiting():
+            return self.active
+        # Самая длинная очередь, при равенстве - та, что ждет дольше (порядок OrderedDict)
+        others = [(adapter_id, queue) for adapter_id, queue in candidates if adapter_id != self.active] or candidates
+        return max(others, key=lambda item: len(item[1]))[0]
+
+    def _dispatch(self):
+        if self._switching:
+            return
+        self._grant_active()
+        if self._in_flight > 0:
+            return
+        target = self._pick_next()
+        if target == self.active:
+            self._served_in_batch = 0
+            self._grant_active()
+            return
+        self._switching = True
+        asyncio.get_running_loop().create_task(self._switch(target))
+
+    async def _switch(self, adapter_id: Optional[str]):
+        try:
+            await self._activate(adapter_id)
+            self.active = adapter_id
+            self.switches += 1
+        except Exception as e:
+            logger.error(f"❌ Не удалось активировать LoRA-адаптер {adapter_id}: {e}. Обслуживаем базовой моделью")
+            # Ждущие неисправного адаптера переходят в очередь базовой модели
+            failed = self._waiters.pop(adapter_id, deque())
+            self._waiters.setdefault(None, deque()).extend(failed)
+            if self.active is not None:
+                try:
+                    await self._activate(None)
+                    self.active = None
+                    self.switches += 1
+                except Exception as reset_err:
+                    logger.error(f"❌ Ошибка сброса адаптеров: {reset_err}")
+        finally:
+            self._served_in_batch = 0
+            self._switching = False
+            self._dispatch()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "active_adapter": self.active,
+            "in_flight": self._in_flight,
+            "switching": self._switching,
+            "switches": self.switches,
+            "waiting": {str(adapter_id): len(queue) for adapter_id, queue in self._waiters.items() if queue}
+        }
+
+
+def apply_adapter(base_model: Any, adapter: Optional[LoadedAdapter], scale: float = 1.0):
+    """Подключает адаптер к контексту базовой модели (None - чистая базовая модель)"""
+    _adapter_clear(base_model.ctx)
+    if adapter is not None:
+        result = _adapter_set(base_model.ctx, adapter.handle, scale)
+        if result != 0:
+            raise RuntimeError(f"llama.cpp вернул {result} при подключении адаптера {adapter.adapter_id}")
+    # KV-кеш посчитан с другими весами - префикс переиспользовать нельзя
+    base_model.reset()
@@ -2,18 +2,22 @@
 Сервис для модерации ответов ИИ
 """
 
+import base64
+import json
 import logging
+import time
 from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_, desc
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, and_, or_, desc, case, select
 
 from ..models.feedback import (
     ModerationReview, ModerationQueue, ModeratorStats,
-    ProblemCategory, ResponseFeedback
+    ProblemCategory, ResponseFeedback, MODERATION_PRIORITY_RANK
 )
 from ..models.chat import ChatMessage, ChatSession
 from ..models.user import User
+from ..core.config import settings
 from ..schemas.feedback import (
     ModerationReviewCreate, ModerationReviewUpdate,
     QueueFilters, MessageWithReview
@@ -25,119 +29,195 @@ logger = logging.getLogger(__name__)
 class ModerationService:
     """Сервис для управления модерацией"""
     
+    def __init__(self):
+        # (фильтры, модератор) -> (count, момент устаревания)
+        self._count_cache: Dict[Tuple[str, Optional[int]], Tuple[int, float]] = {}
+    
     async def get_moderation_queue(
         self,
         db: Session,
         moderator_id: int,
         filters: Optional[QueueFilters] = None,
         page: int = 1,
-        page_size: int = 20
-    ) -> Tuple[List[Dict[str, Any]], int]:
-        """Получение очереди модерации с фильтрами"""
+        page_size: int = 20,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], int, Optional[str]]:
+        """
+        Получение очереди модерации с фильтрами
+        
+        С cursor используется keyset-пагинация по (приоритет, created_at, id) -
+        стоимость страницы не зависит от ее номера. Без cursor работает
+        постраничный режим через offset. Возвращает элементы, общее число
+        (кешируется на MODERATION_QUEUE_COUNT_TTL секунд) и курсор следующей страницы.
+        """
         try:
-            query = db.query(ModerationQueue).join(
-                ChatMessage, ModerationQueue.message_id == ChatMessage.id
-            )
-            
-            # Применяем фильтры
-            if filters:
-                if filters.priority:
-                    query = query.filter(ModerationQueue.priority == filters.priority.value)
-                
-                if filters.status:
-                    query = query.filter(ModerationQueue.status == filters.status.value)
-                
-                if filters.assigned_to_me:
-                    query = query.filter(ModerationQueue.assigned_to == moderator_id)
-                
-                if filters.date_from:
-                    query = query.filter(ModerationQueue.created_at >= filters.date_from)
-                
-                if filters.date_to:
-                    query = query.filter(ModerationQueue.created_at <= filters.date_to)
-                
-                if filters.min_confidence is not None:
-                    query = query.filter(ModerationQueue.confidence_score >= filters.min_confidence)
-                
-                if filters.max_confidence is not None:
-                    query = query.filter(ModerationQueue.confidence_score <= filters.max_confidence)
+            query = self._apply_queue_filters(db.query(ModerationQueue), moderator_id, filters)
+            total = self._get_cached_queue_count(query, moderator_id, filters)
             
             # Сортировка: сначала high priority, потом по дате
             query = query.order_by(
-                desc(ModerationQueue.priority == 'high'),
-                desc(ModerationQueue.priority == 'medium'),
-                ModerationQueue.created_at.asc()
+                MODERATION_PRIORITY_RANK,
+                ModerationQueue.created_at.asc(),
+                ModerationQueue.id.asc()
             )
             
-            # Подсчет total
-            total = query.count()
+            if cursor:
+                rank, created_at, item_id = self._decode_cursor(cursor)
+                query = query.filter(or_(
+                    MODERATION_PRIORITY_RANK > rank,
+                    and_(MODERATION_PRIORITY_RANK == rank, ModerationQueue.created_at > created_at),
+                    and_(
+                        MODERATION_PRIORITY_RANK == rank,
+                        ModerationQueue.created_at == created_at,
+                        ModerationQueue.id > item_id
+                    )
+                ))
+            else:
+                query = query.offset((page - 1) * page_size)
             
-            # Пагинация
-            offset = (page - 1) * page_size
-            queue_items = query.offset(offset).limit(page_size).all()
+            # Лишний элемент показывает, есть ли следующая страница
+            queue_items = query.limit(page_size + 1).all()
+            has_more = len(queue_items) > page_size
+            queue_items = queue_items[:page_size]
             
-            # Формируем детальную информацию
-            result = []
-            for item in queue_items:
-                message_data = await self._get_message_with_context(db, item.message_id)
-                result.append({
+            # Контекст всех сообщений страницы - пакетно
+            messages = self._load_messages_with_context(db, [item.message_id for item in queue_items])
+            result = [
+                {
                     "queue_item": item,
-                    "message": message_data
-                })
+                    "message": messages.get(item.message_id)
+                }
+                for item in queue_items
+            ]
             
-            return result, total
+            next_cursor = self._encode_cursor(queue_items[-1]) if has_more else None
+            return result, total, next_cursor
             
         except Exception as e:
             logger.error(f"Error getting moderation queue: {e}")
             raise
     
-    async def _get_message_with_context(
-        self,
-        db: Session,
-        message_id: int
-    ) -> Dict[str, Any]:
-        """Получение сообщения с полным контекстом"""
-        # Получаем сообщение
-        message = db.query(ChatMessage).filter(
-            ChatMessage.id == message_id
-        ).first()
+    def _apply_queue_filters(self, query, moderator_id: int, filters: Optional[QueueFilters]):
+        """Фильтры очереди модерации"""
+        if not filters:
+            return query
         
-        if not message:
-            return None
+        if filters.priority:
+            query = query.filter(ModerationQueue.priority == filters.priority.value)
         
-        # Получаем сессию для контекста
-        session = db.query(ChatSession).filter(
-            ChatSession.id == message.session_id
-        ).first()
+        if filters.status:
+            query = query.filter(ModerationQueue.status == filters.status.value)
         
-        # Получаем предыдущее сообщение (вопрос пользователя)
-        user_question = db.query(ChatMessage).filter(
-            and_(
-                ChatMessage.session_id == message.session_id,
-                ChatMessage.id < message.id,
-                ChatMessage.role == 'user'
-            )
-        ).order_by(desc(ChatMessage.id)).first()
+        if filters.assigned_to_me:
+            query = query.filter(ModerationQueue.assigned_to == moderator_id)
         
-        # Получаем feedback пользователя
-        user_feedback = db.query(ResponseFeedback).filter(
-            ResponseFeedback.message_id == message_id
-        ).first()
+        if filters.date_from:
+            query = query.filter(ModerationQueue.created_at >= filters.date_from)
         
-        # Получаем существующую оценку модератора
-        existing_review = db.query(ModerationReview).filter(
-            ModerationReview.message_id == message_id
-        ).first()
+        if filters.date_to:
+            query = query.filter(ModerationQueue.created_at <= filters.date_to)
+        
+        if filters.min_confidence is not None:
+            query = query.filter(ModerationQueue.confidence_score >= filters.min_confidence)
+        
+        if filters.max_confidence is not None:
+            query = query.filter(ModerationQueue.confidence_score <= filters.max_confidence)
+        
+        return query
+    
+    def _get_cached_queue_count(self, query, moderator_id: int, filters: Optional[QueueFilters]) -> int:
+        """Размер очереди с кешем: точный count при каждом листании не нужен"""
+        key = (
+            filters.model_dump_json() if filters else "",
+            moderator_id if filters and filters.assigned_to_me else None
+        )
+        now = time.monotonic()
+        cached = self._count_cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        
+        total = query.order_by(None).with_entities(func.count(ModerationQueue.id)).scalar() or 0
+        if len(self._count_cache) >= 256:
+            self._count_cache.clear()
+        self._count_cache[key] = (total, now + settings.MODERATION_QUEUE_COUNT_TTL)
+        return total
+    
+    def invalidate_queue_count(self):
+        """Сброс кеша размеров очереди (после изменения статусов)"""
+        self._count_cache.clear()
+    
+    @staticmethod
+    def _encode_cursor(item: ModerationQueue) -> str:
+        rank = {"high": 0, "medium": 1}.get(item.priority, 2)
+        payload = json.dumps([rank, item.created_at.isoformat(), item.id])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+    
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[int, datetime, int]:
+        try:
+            rank, created_at, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return int(rank), datetime.fromisoformat(created_at), int(item_id)
+        except Exception:
+            raise ValueError("Некорректный курсор очереди модерации")
+    
+    def _load_messages_with_context(
+        self,
+        db: Session,
+        message_ids: List[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Сообщения с контекстом для набора элементов очереди
+        
+        Вопрос пользователя (последнее сообщение role='user' перед ответом в той же
+        сессии) находится оконной функцией за один запрос; отзывы и оценки
+        модераторов загружаются еще двумя запросами на всю страницу.
+        """
+        if not message_ids:
+            return {}
+        
+        sessions = select(ChatMessage.session_id).where(ChatMessage.id.in_(message_ids))
+        ranked = select(
+            ChatMessage.id,
+            ChatMessage.session_id,
+            ChatMessage.content,
+            ChatMessage.created_at,
+            ChatMessage.message_metadata,
+            func.max(case((ChatMessage.role == 'user', ChatMessage.id))).over(
+                partition_by=ChatMessage.session_id,
+                order_by=ChatMessage.id,
+                rows=(None, -1)
+            ).label("question_id")
+        ).where(ChatMessage.session_id.in_(sessions)).subquery()
+        
+        question = aliased(ChatMessage)
+        rows = db.query(ranked, question.content.label("question_content")).outerjoin(
+            question, question.id == ranked.c.question_id
+        ).filter(ranked.c.id.in_(message_ids)).all()
+        
+        feedback_by_message: Dict[int, ResponseFeedback] = {}
+        for feedback in db.query(ResponseFeedback).filter(
+            ResponseFeedback.message_id.in_(message_ids)
+        ).order_by(ResponseFeedback.id).all():
+            feedback_by_message.setdefault(feedback.message_id, feedback)
+        
+        review_by_message: Dict[int, ModerationReview] = {}
+        for review in db.query(ModerationReview).filter(
+            ModerationReview.message_id.in_(message_ids)
+        ).order_by(ModerationReview.id).all():
+            review_by_message.setdefault(review.message_id, review)
         
         return {
-            "message_id": message.id,
-            "session_id": message.session_id,
-            "user_question": user_question.content if user_question else "N/A",
-            "ai_response": message.content,
-            "created_at": message.created_at,
-            "metadata": message.message_metadata,
-            "user_feedback": user_feedback,
-            "existing_review": existing_review
+            row.id: {
+                "message_id": row.id,
+                "session_id": row.session_id,
+                "user_question": row.question_content if row.question_content is not None else "N/A",
+                "ai_response": row.content,
+                "created_at": row.created_at,
+                "metadata": row.message_metadata,
+                "user_feedback": feedback_by_message.get(row.id),
+                "existing_review": review_by_message.get(row.id)
+            }
+            for row in rows
         }
     
     async def submit_review(
@@ -270,6 +350,7 @@ class ModerationService:
             if status == "completed":
                 queue_item.completed_at = datetime.utcnow()
             db.commit()
+            self.invalidate_queue_count()
     
     async def _update_moderator_stats(
         self,
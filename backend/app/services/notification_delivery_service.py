@@ -0,0 +1,296 @@
+"""
+Доставка уведомлений во внешние каналы через персистентную очередь
+
+NotificationService кладет исходящие сообщения в notification_outbox одной
+вставкой; воркер забирает пачки готовых к отправке строк, рассылает их
+параллельно через пулы соединений ExternalNotificationService (SMTP, общий
+aiohttp), соблюдает лимиты провайдеров и повторяет временные ошибки с
+экспоненциальной задержкой. Забранные строки арендуются (claimed_at): в очередь
+возвращаются только строки с истекшей арендой, а не пачки живых воркеров.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_, update
+
+from ..core.config import settings
+from ..core.database import SessionLocal
+from ..models.notification import NotificationChannel, NotificationOutbox, OutboxStatus
+from .external_notification_service import external_notification_service
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDeliveryService:
+    """Воркер очереди исходящих уведомлений"""
+
+    def __init__(self):
+        self.enabled = settings.NOTIFICATION_DELIVERY_ENABLED
+        self.batch_size = settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+        self.poll_interval = settings.NOTIFICATION_DELIVERY_POLL_INTERVAL
+        self.concurrency = settings.NOTIFICATION_DELIVERY_CONCURRENCY
+        self.retry_base_delay = settings.NOTIFICATION_RETRY_BASE_DELAY
+        self.retry_max_delay = settings.NOTIFICATION_RETRY_MAX_DELAY
+        self.lease_seconds = settings.NOTIFICATION_DELIVERY_LEASE_SECONDS
+        self.external = external_notification_service
+
+        self._running = False
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._next_requeue = 0.0
+
+    async def start(self):
+        """Запуск воркера доставки"""
+        if self._running or not self.enabled:
+            return
+        await asyncio.to_thread(self._requeue_interrupted)
+        self._next_requeue = time.monotonic() + self.lease_seconds / 2
+        self._running = True
+        self._task = asyncio.create_task(self._worker_loop())
+        logger.info("📮 Notification delivery worker started")
+
+    async def stop(self):
+        """Остановка воркера и закрытие пулов соединений"""
+        self._running = False
+        self._wakeup.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.external.close()
+        logger.info("📮 Notification delivery worker stopped")
+
+    def notify(self):
+        """Разбудить воркер после постановки новых сообщений"""
+        self._wakeup.set()
+
+    def _requeue_interrupted(self):
+        """Сообщения, застрявшие в sending после падения воркера (аренда истекла), возвращаются в очередь"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lease_seconds)
+        db = SessionLocal()
+        try:
+            count = db.query(NotificationOutbox).filter(
+                NotificationOutbox.status == OutboxStatus.SENDING,
+                or_(NotificationOutbox.claimed_at.is_(None), NotificationOutbox.claimed_at < cutoff)
+            ).update({
+                NotificationOutbox.status: OutboxStatus.PENDING,
+                NotificationOutbox.claimed_at: None
+            }, synchronize_session=False)
+            db.commit()
+            if count:
+                logger.info(f"📮 Requeued {count} interrupted outbound notifications")
+        finally:
+            db.close()
+
+    async def _worker_loop(self):
+        while self._running:
+            try:
+                # Пачки упавших воркеров других процессов подбираются без перезапуска
+                if time.monotonic() >= self._next_requeue:
+                    self._next_requeue = time.monotonic() + self.lease_seconds / 2
+                    await asyncio.to_thread(self._requeue_interrupted)
+                delivered = await self.process_batch()
+                if delivered:
+                    continue
+            except Exception as e:
+                logger.error(f"❌ Notification delivery loop error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim_batch(self) -> Tuple[List[Dict[str, Any]], Dict[int, NotificationChannel]]:
+        """Забирает пачку готовых сообщений (строки помечаются sending)"""
+        db = SessionLocal()
+        try:
+            rows = db.query(NotificationOutbox).filter(
+                NotificationOutbox.status == OutboxStatus.PENDING,
+                NotificationOutbox.next_attempt_at <= datetime.utcnow()
+            ).order_by(NotificationOutbox.next_attempt_at, NotificationOutbox.id).limit(
+                self.batch_size
+            ).with_for_update(skip_locked=True).all()
+            if not rows:
+                db.rollback()
+                return [], {}
+
+            ids = [row.id for row in rows]
+            db.execute(
+                update(NotificationOutbox)
+                .where(NotificationOutbox.id.in_(ids))
+                .values(
+                    status=OutboxStatus.SENDING,
+                    attempts=NotificationOutbox.attempts + 1,
+                    claimed_at=datetime.utcnow()
+                )
+            )
+            items = [{
+                "id": row.id,
+                "channel_id": row.channel_id,
+                "channel_type": row.channel_type,
+                "recipient": row.recipient,
+                "payload": row.payload or {},
+                "attempts": (row.attempts or 0) + 1,
+                "max_attempts": row.max_attempts
+            } for row in rows]
+
+            channel_ids = {row.channel_id for row in rows}
+            channels = db.query(NotificationChannel).filter(NotificationChannel.id.in_(channel_ids)).all()
+            for channel in channels:
+                db.expunge(channel)
+            db.commit()
+            return items, {channel.id: channel for channel in channels}
+        finally:
+            db.close()
+
+    async def process_batch(self) -> int:
+        """Отправляет одну пачку; возвращает число обработанных сообщений"""
+        items, channels = await asyncio.to_thread(self._claim_batch)
+        if not items:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(item: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._deliver(item, channels.get(item["channel_id"]))
+
+        outcomes = await asyncio.gather(*(deliver(item) for item in items))
+        await asyncio.to_thread(self._store_outcomes, outcomes)
+        return len(items)
+
+    async def _deliver(self, item: Dict[str, Any], channel: Optional[NotificationChannel]) -> Dict[str, Any]:
+        channel_type = item["channel_type"]
+        if channel is None or not channel.is_active:
+            self.external.metrics.record(channel_type, "failed")
+            return {"id": item["id"], "status": OutboxStatus.FAILED, "error": "Channel not found or inactive"}
+
+        # Лимит провайдера: откладываем без траты попытки
+        wait = self.external.rate_limiter.acquire(channel)
+        if wait > 0:
+            self.external.metrics.record(channel_type, "rate_limited")
+            return {"id": item["id"], "status": OutboxStatus.PENDING, "delay": wait, "refund_attempt": True}
+
+        payload = item["payload"]
+        started = time.monotonic()
+        result = await self.external.send_notification(
+            channel=channel,
+            title=payload.get("title", ""),
+            content=payload.get("content", ""),
+            priority=payload.get("priority", "medium"),
+            category=payload.get("category", "system"),
+            action_url=payload.get("action_url"),
+            recipient=item["recipient"],
+            metadata=payload.get("metadata")
+        )
+        latency = time.monotonic() - started
+
+        if result.get("success"):
+            self.external.metrics.record(channel_type, "sent", latency)
+            return {"id": item["id"], "status": OutboxStatus.SENT, "channel_id": channel.id}
+
+        error = result.get("error", "Unknown error")
+        if result.get("retryable", True) and item["attempts"] < item["max_attempts"]:
+            self.external.metrics.record(channel_type, "retried")
+            return {
+                "id": item["id"],
+                "status": OutboxStatus.PENDING,
+                "delay": result.get("retry_after") or self._backoff(item["attempts"]),
+                "error": error
+            }
+
+        self.external.metrics.record(channel_type, "failed")
+        return {"id": item["id"], "status": OutboxStatus.FAILED, "error": error, "channel_id": channel.id}
+
+    def _backoff(self, attempts: int) -> float:
+        """Экспоненциальная задержка с джиттером"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _store_outcomes(self, outcomes: List[Dict[str, Any]]):
+        """Сохраняет результаты пачки: массовые UPDATE вместо построчных коммитов"""
+        now = datetime.utcnow()
+        sent_ids = [o["id"] for o in outcomes if o["status"] == OutboxStatus.SENT]
+        mappings = []
+        channel_stats: Dict[int, Dict[str, int]] = defaultdict(lambda: {"sent": 0, "failed": 0})
+
+        for outcome in outcomes:
+            if outcome["status"] == OutboxStatus.SENT:
+                channel_stats[outcome["channel_id"]]["sent"] += 1
+                continue
+            mapping = {
+                "id": outcome["id"],
+                "status": outcome["status"],
+                "last_error": outcome.get("error"),
+                "claimed_at": None
+            }
+            if outcome["status"] == OutboxStatus.PENDING:
+                mapping["next_attempt_at"] = now + timedelta(seconds=outcome.get("delay", self.retry_base_delay))
+            elif outcome.get("channel_id") is not None:
+                channel_stats[outcome["channel_id"]]["failed"] += 1
+            mappings.append(mapping)
+
+        refunded = [o["id"] for o in outcomes if o.get("refund_attempt")]
+
+        db = SessionLocal()
+        try:
+            if sent_ids:
+                db.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id.in_(sent_ids))
+                    .values(status=OutboxStatus.SENT, sent_at=now, last_error=None, claimed_at=None)
+                )
+            if mappings:
+                db.execute(update(NotificationOutbox), mappings)
+            if refunded:
+                db.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id.in_(refunded))
+                    .values(attempts=NotificationOutbox.attempts - 1)
+                )
+            for channel_id, stats in channel_stats.items():
+                db.execute(
+                    update(NotificationChannel)
+                    .where(NotificationChannel.id == channel_id)
+                    .values(
+                        total_sent=func.coalesce(NotificationChannel.total_sent, 0) + stats["sent"],
+                        total_failed=func.coalesce(NotificationChannel.total_failed, 0) + stats["failed"],
+                        last_used_at=now,
+                        updated_at=now
+                    )
+                )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"❌ Failed to store delivery outcomes: {e}")
+        finally:
+            db.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики доставки и состояние очереди"""
+        db = SessionLocal()
+        try:
+            rows = db.query(NotificationOutbox.status, func.count(NotificationOutbox.id)).group_by(
+                NotificationOutbox.status
+            ).all()
+            queue = {status: count for status, count in rows}
+        finally:
+            db.close()
+        return {
+            "running": self._running,
+            "queue": queue,
+            "delivery": self.external.metrics.snapshot()
+        }
+
+
+# Глобальный экземпляр
+notification_delivery_service = NotificationDeliveryService()
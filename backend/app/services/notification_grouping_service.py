@@ -1,6 +1,6 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func, desc
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Optional, Set, Tuple
 import logging
 from datetime import datetime, timedelta
 import hashlib
@@ -15,12 +15,71 @@ from ..models.user import User
 
 logger = logging.getLogger(__name__)
 
+# MinHash/LSH parameters for the fuzzy title rule (Jaccard > 0.7).
+# 12 bands of 3 rows make a pair with similarity 0.7 a candidate with
+# probability ~0.99, while pairs below 0.3 rarely collide; candidates are
+# verified with the exact Jaccard similarity.
+MINHASH_BANDS = 12
+MINHASH_ROWS = 3
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), 'big') % _MERSENNE_PRIME or 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), 'big') % _MERSENNE_PRIME
+    )
+    for i in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+TITLE_SIMILARITY_WINDOW_SECONDS = 3600
+
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def _minhash(tokens: frozenset) -> Tuple[int, ...]:
+    """MinHash signature of a token set"""
+    hashes = [_token_hash(token) for token in tokens]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _MINHASH_SEEDS
+    )
+
+
+class _UnionFind:
+    """Disjoint sets over notification positions"""
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, first: int, second: int):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            # The smaller position (newer notification) stays the root
+            if second < first:
+                first, second = second, first
+            self.parent[second] = first
+
 
 class NotificationGroupingService:
     """Service for smart notification grouping and filtering"""
     
     def __init__(self):
         self.grouping_rules = self._load_grouping_rules()
+        self._compiled_grouping_rules = {
+            category: {
+                'title_pattern': re.compile(rules['group_by_title_pattern']) if rules.get('group_by_title_pattern') else None,
+                'content_keywords': rules.get('group_by_content_keywords', [])
+            }
+            for category, rules in self.grouping_rules.items()
+        }
         self.spam_detection_rules = self._load_spam_detection_rules()
         self.auto_dismiss_rules = self._load_auto_dismiss_rules()
     
@@ -67,81 +126,142 @@ class NotificationGroupingService:
         self,
         notifications: List[Notification]
     ) -> List[Dict[str, Any]]:
-        """Create notification groups based on similarity"""
+        """Create notification groups based on similarity
+
+        Every notification gets its features computed once and is dropped into
+        buckets, one per grouping rule; notifications sharing a bucket are
+        merged. Only the fuzzy title rule needs pairwise checks, and those are
+        limited to LSH candidates.
+        """
+        union_find = _UnionFind(len(notifications))
+        partitions: Dict[Tuple[Any, Any], List[int]] = defaultdict(list)
+        for position, notification in enumerate(notifications):
+            partitions[(notification.category, notification.type)].append(position)
+        
+        for (category, _), positions in partitions.items():
+            rules = self._compiled_grouping_rules.get(category.value, {})
+            pattern = rules.get('title_pattern')
+            keywords = rules.get('content_keywords', [])
+            buckets: Dict[Any, int] = {}
+            titles: List[Tuple[int, frozenset]] = []
+            
+            for position in positions:
+                notification = notifications[position]
+                
+                # Titles matching the category pattern form one group
+                if pattern is not None and pattern.search(notification.title):
+                    self._join_bucket(union_find, buckets, ('pattern',), position)
+                
+                # Notifications sharing a content keyword
+                if keywords:
+                    content_lower = notification.content.lower()
+                    for keyword in keywords:
+                        if keyword in content_lower:
+                            self._join_bucket(union_find, buckets, ('keyword', keyword), position)
+                
+                titles.append((position, frozenset(notification.title.lower().split())))
+            
+            self._group_similar_titles(notifications, titles, union_find)
         
-        groups = []
-        processed_notifications = set()
+        # Collect components in the original order (newest first)
+        components: Dict[int, List[Notification]] = {}
+        for position, notification in enumerate(notifications):
+            components.setdefault(union_find.find(position), []).append(notification)
         
-        for notification in notifications:
-            if notification.id in processed_notifications:
-                continue
-            
-            # Find similar notifications
-            similar_notifications = [notification]
-            processed_notifications.add(notification.id)
-            
-            for other_notification in notifications:
-                if (other_notification.id != notification.id and 
-                    other_notification.id not in processed_notifications):
-                    
-                    if self._are_notifications_similar(notification, other_notification):
-                        similar_notifications.append(other_notification)
-                        processed_notifications.add(other_notification.id)
-            
+        groups = []
+        for members in components.values():
             # Create group if there are multiple similar notifications
-            if len(similar_notifications) > 1:
-                group = self._create_group_from_notifications(similar_notifications)
-                groups.append(group)
+            if len(members) > 1:
+                groups.append(self._create_group_from_notifications(members))
             else:
                 # Single notification - add as individual item
                 groups.append({
                     'type': 'individual',
-                    'notification': self._notification_to_dict(notification),
+                    'notification': self._notification_to_dict(members[0]),
                     'count': 1
                 })
         
         return groups
     
-    def _are_notifications_similar(
+    @staticmethod
+    def _join_bucket(union_find: _UnionFind, buckets: Dict[Any, int], key: Any, position: int):
+        first = buckets.setdefault(key, position)
+        if first != position:
+            union_find.union(first, position)
+    
+    def _group_similar_titles(
         self,
-        notification1: Notification,
-        notification2: Notification
-    ) -> bool:
-        """Check if two notifications are similar enough to group"""
-        
-        # Same category and type
-        if (notification1.category != notification2.category or
-            notification1.type != notification2.type):
-            return False
-        
-        # Apply category-specific grouping rules
-        category_rules = self.grouping_rules.get(notification1.category.value, {})
-        
-        # Check title similarity
-        if category_rules.get('group_by_title_pattern'):
-            pattern = category_rules['group_by_title_pattern']
-            if (re.search(pattern, notification1.title) and 
-                re.search(pattern, notification2.title)):
-                return True
+        notifications: List[Notification],
+        titles: List[Tuple[int, frozenset]],
+        union_find: _UnionFind
+    ):
+        """Merge notifications with similar titles created within an hour of each other"""
         
-        # Check content similarity
-        if category_rules.get('group_by_content_keywords'):
-            keywords = category_rules['group_by_content_keywords']
-            content1_lower = notification1.content.lower()
-            content2_lower = notification2.content.lower()
-            
-            for keyword in keywords:
-                if keyword in content1_lower and keyword in content2_lower:
-                    return True
+        # Identical titles: one representative per token set, members ordered by time
+        by_tokens: Dict[frozenset, List[int]] = defaultdict(list)
+        for position, tokens in titles:
+            by_tokens[tokens].append(position)
         
-        # Check time proximity (within same hour)
+        for tokens, members in by_tokens.items():
+            members.sort(key=lambda p: notifications[p].created_at)
+            # Empty titles have nothing in common (Jaccard similarity 0)
+            if not tokens:
+                continue
+            for previous, current in zip(members, members[1:]):
+                if self._within_window(notifications[previous], notifications[current]):
+                    union_find.union(previous, current)
+        
+        # Different titles: LSH over MinHash signatures yields candidate pairs
+        distinct = [tokens for tokens in by_tokens if tokens]
+        if len(distinct) < 2:
+            return
+        
+        lsh_buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = defaultdict(list)
+        for index, tokens in enumerate(distinct):
+            signature = _minhash(tokens)
+            for band in range(MINHASH_BANDS):
+                band_key = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+                lsh_buckets[(band, band_key)].append(index)
+        
+        checked: Set[Tuple[int, int]] = set()
+        for candidates in lsh_buckets.values():
+            for i, first in enumerate(candidates):
+                for second in candidates[i + 1:]:
+                    if (first, second) in checked:
+                        continue
+                    checked.add((first, second))
+                    if self._jaccard(distinct[first], distinct[second]) > 0.7:
+                        self._union_closest_in_time(
+                            notifications, by_tokens[distinct[first]], by_tokens[distinct[second]], union_find
+                        )
+    
+    def _union_closest_in_time(
+        self,
+        notifications: List[Notification],
+        first: List[int],
+        second: List[int],
+        union_find: _UnionFind
+    ):
+        """Union members of two time-sorted lists whose creation times are within the window"""
+        i = j = 0
+        while i < len(first) and j < len(second):
+            a, b = notifications[first[i]], notifications[second[j]]
+            if self._within_window(a, b):
+                union_find.union(first[i], second[j])
+            if a.created_at <= b.created_at:
+                i += 1
+            else:
+                j += 1
+    
+    @staticmethod
+    def _within_window(notification1: Notification, notification2: Notification) -> bool:
         time_diff = abs((notification1.created_at - notification2.created_at).total_seconds())
-        if time_diff < 3600:  # 1 hour
-            # Check if titles are similar (Levenshtein distance)
-            if self._calculate_similarity(notification1.title, notification2.title) > 0.7:
-                return True
-        
-        return False
+        return time_diff < TITLE_SIMILARITY_WINDOW_SECONDS
+    
+    @staticmethod
+    def _jaccard(words1: frozenset, words2: frozenset) -> float:
+        union = len(words1 | words2)
+        return len(words1 & words2) / union if union else 0.0
     
     def _create_group_from_notifications(
         self,
@@ -264,22 +384,6 @@ class NotificationGroupingService:
             'data': notification.data
         }
     
-    def _calculate_similarity(self, text1: str, text2: str) -> float:
-        """Calculate similarity between two texts (simple implementation)"""
-        
-        # Convert to lowercase and split into words
-        words1 = set(text1.lower().split())
-        words2 = set(text2.lower().split())
-        
-        # Calculate Jaccard similarity
-        intersection = len(words1.intersection(words2))
-        union = len(words1.union(words2))
-        
-        if union == 0:
-            return 0.0
-        
-        return intersection / union
-    
     async def _update_database_groups(
         self,
         db: Session,
@@ -288,16 +392,22 @@ class NotificationGroupingService:
     ):
         """Update notification groups in database"""
         try:
+            group_keys = [g['group_key'] for g in groups if g['type'] == 'group']
+            if not group_keys:
+                return
+            
+            # Existing groups in one query
+            existing_groups = {
+                group.group_key: group
+                for group in db.query(NotificationGroup).filter(NotificationGroup.group_key.in_(group_keys)).all()
+            }
+            
             for group_data in groups:
                 if group_data['type'] != 'group':
                     continue
                 
                 group_key = group_data['group_key']
-                
-                # Check if group already exists
-                existing_group = db.query(NotificationGroup).filter(
-                    NotificationGroup.group_key == group_key
-                ).first()
+                existing_group = existing_groups.get(group_key)
                 
                 if existing_group:
                     # Update existing group
@@ -354,7 +464,11 @@ class NotificationGroupingService:
         try:
             time_threshold = datetime.utcnow() - timedelta(minutes=time_window_minutes)
             
-            notifications = db.query(Notification).filter(
+            # Only the columns the rules look at
+            notifications = db.query(
+                Notification.id, Notification.title, Notification.content,
+                Notification.category, Notification.created_at
+            ).filter(
                 and_(
                     Notification.user_id == user_id,
                     Notification.created_at >= time_threshold,
@@ -362,63 +476,49 @@ class NotificationGroupingService:
                 )
             ).all()
             
-            spam_notification_ids = []
-            
-            # Apply spam detection rules
-            for rule in self.spam_detection_rules:
-                spam_ids = self._apply_spam_rule(notifications, rule)
-                spam_notification_ids.extend(spam_ids)
-            
-            return list(set(spam_notification_ids))
+            return self._find_spam(notifications)
             
         except Exception as e:
             logger.error(f"Error detecting spam notifications: {e}")
             return []
     
-    def _apply_spam_rule(
-        self,
-        notifications: List[Notification],
-        rule: Dict[str, Any]
-    ) -> List[int]:
-        """Apply a spam detection rule"""
-        
-        spam_ids = []
+    def _find_spam(self, notifications: List[Any]) -> List[int]:
+        """Apply all spam detection rules in a single pass over the notifications"""
+        
+        frequency_rules = [r for r in self.spam_detection_rules if r['type'] == 'frequency']
+        burst_rules = [r for r in self.spam_detection_rules if r['type'] == 'burst']
+        pattern_rules = [
+            re.compile(r['pattern'], re.IGNORECASE)
+            for r in self.spam_detection_rules if r['type'] == 'pattern'
+        ]
         
-        if rule['type'] == 'frequency':
-            # Detect notifications with same title/content appearing too frequently
-            content_counts = defaultdict(list)
-            
-            for notification in notifications:
-                key = f"{notification.title}:{notification.content[:100]}"
-                content_counts[key].append(notification)
-            
-            for content, notifs in content_counts.items():
-                if len(notifs) > rule['max_count']:
-                    # Mark all but the first as spam
-                    spam_ids.extend([n.id for n in notifs[1:]])
+        spam_ids: Set[int] = set()
+        content_buckets: Dict[Tuple[str, str], List[Any]] = defaultdict(list)
+        category_buckets: Dict[Any, List[Any]] = defaultdict(list)
         
-        elif rule['type'] == 'pattern':
+        for notification in notifications:
+            if frequency_rules:
+                content_buckets[(notification.title, notification.content[:100])].append(notification)
+            if burst_rules:
+                category_buckets[notification.category].append(notification)
             # Detect notifications matching spam patterns
-            pattern = rule['pattern']
-            
-            for notification in notifications:
-                if re.search(pattern, notification.content, re.IGNORECASE):
-                    spam_ids.append(notification.id)
+            if any(pattern.search(notification.content) for pattern in pattern_rules):
+                spam_ids.add(notification.id)
         
-        elif rule['type'] == 'burst':
-            # Detect burst of notifications from same source
-            category_counts = defaultdict(list)
-            
-            for notification in notifications:
-                category_counts[notification.category].append(notification)
-            
-            for category, notifs in category_counts.items():
+        # Same title/content appearing too frequently: all but the first are spam
+        for rule in frequency_rules:
+            for notifs in content_buckets.values():
+                if len(notifs) > rule['max_count']:
+                    spam_ids.update(n.id for n in notifs[1:])
+        
+        # Burst of notifications from the same source: excess by creation time is spam
+        for rule in burst_rules:
+            for notifs in category_buckets.values():
                 if len(notifs) > rule['max_burst']:
-                    # Sort by creation time and mark excess as spam
-                    notifs.sort(key=lambda n: n.created_at)
-                    spam_ids.extend([n.id for n in notifs[rule['max_burst']:]])
+                    ordered = sorted(notifs, key=lambda n: n.created_at)
+                    spam_ids.update(n.id for n in ordered[rule['max_burst']:])
         
-        return spam_ids
+        return list(spam_ids)
     
     # Auto-dismiss expired notifications
     async def auto_dismiss_expired_notifications(
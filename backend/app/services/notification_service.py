@@ -1,12 +1,15 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, desc, func
+from sqlalchemy import and_, or_, desc, func, insert
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 import json
 import logging
 from fastapi import HTTPException
 
-from ..models.notification import AdminNotification, NotificationTemplate, NotificationHistory
+from ..models.notification import (
+    AdminNotification, NotificationTemplate, NotificationHistory,
+    NotificationChannel, ChannelType, NotificationOutbox
+)
 from ..models.user import User
 from ..schemas.notification import (
     NotificationCreate, NotificationUpdate, NotificationFilters,
@@ -17,6 +20,16 @@ from ..schemas.notification import (
 
 logger = logging.getLogger(__name__)
 
+# Request channel names delivered through external providers
+EXTERNAL_CHANNEL_TYPES = {
+    "email": ChannelType.EMAIL,
+    "slack": ChannelType.SLACK,
+    "telegram": ChannelType.TELEGRAM,
+    "webhook": ChannelType.WEBHOOK,
+    "sms": ChannelType.SMS,
+    "push": ChannelType.PUSH
+}
+
 
 class NotificationService:
     """Service for managing notifications and notification system"""
@@ -157,32 +170,122 @@ class NotificationService:
         db: Session,
         request: SendNotificationRequest
     ) -> List[AdminNotification]:
-        """Send notification to multiple users"""
-        notifications = []
-        
+        """Send notification to multiple users
+
+        All notifications are inserted in a single statement and external
+        deliveries (email, Slack, ...) are queued in the outbox for the
+        delivery worker, so the request never waits on SMTP or HTTP.
+        """
+        user_ids = list(dict.fromkeys(request.user_ids or []))
+        if not user_ids:
+            return []
+
         try:
-            user_ids = request.user_ids or []
-            
-            for user_id in user_ids:
-                notification_data = NotificationCreate(
-                    user_id=user_id,
-                    title=request.title,
-                    message=request.message,
-                    type=request.type,
-                    priority=request.priority,
-                    channels=request.channels,
-                    data=request.data
-                )
-                
-                notification = await self.create_notification(db, notification_data)
-                notifications.append(notification)
-            
+            external_types = [
+                EXTERNAL_CHANNEL_TYPES[name] for name in (request.channels or [])
+                if name in EXTERNAL_CHANNEL_TYPES
+            ]
+            channels = self._resolve_channels(db, external_types)
+
+            delivery_status = {
+                name: ("pending" if name in EXTERNAL_CHANNEL_TYPES else "delivered")
+                for name in (request.channels or [])
+            }
+            for name in request.channels or []:
+                if name in EXTERNAL_CHANNEL_TYPES and EXTERNAL_CHANNEL_TYPES[name] not in channels:
+                    delivery_status[name] = "unavailable"
+
+            notifications = db.scalars(
+                insert(AdminNotification).returning(AdminNotification),
+                [{
+                    "user_id": user_id,
+                    "title": request.title,
+                    "message": request.message,
+                    "type": request.type,
+                    "priority": request.priority,
+                    "channels": request.channels,
+                    "data": request.data,
+                    "delivery_status": delivery_status
+                } for user_id in user_ids]
+            ).all()
+
+            outbox_rows = self._build_outbox_rows(db, request, notifications, channels)
+            if outbox_rows:
+                db.execute(insert(NotificationOutbox), outbox_rows)
+            db.commit()
+
+            logger.info(
+                f"Created {len(notifications)} notifications, queued {len(outbox_rows)} external deliveries"
+            )
+            if outbox_rows:
+                from .notification_delivery_service import notification_delivery_service
+                notification_delivery_service.notify()
             return notifications
-            
+
         except Exception as e:
+            db.rollback()
             logger.error(f"Error sending notifications: {e}")
             raise HTTPException(status_code=500, detail="Failed to send notifications")
 
+    def _resolve_channels(self, db: Session, channel_types: List[ChannelType]) -> Dict[ChannelType, NotificationChannel]:
+        """First active channel of each requested type, in one query"""
+        if not channel_types:
+            return {}
+        channels = {}
+        rows = db.query(NotificationChannel).filter(
+            NotificationChannel.type.in_(channel_types),
+            NotificationChannel.is_active == True
+        ).order_by(NotificationChannel.id).all()
+        for channel in rows:
+            channels.setdefault(channel.type, channel)
+        return channels
+
+    def _build_outbox_rows(
+        self,
+        db: Session,
+        request: SendNotificationRequest,
+        notifications: List[AdminNotification],
+        channels: Dict[ChannelType, NotificationChannel]
+    ) -> List[Dict[str, Any]]:
+        """Outbox rows for every notification and external channel"""
+        if not channels:
+            return []
+
+        emails = {}
+        if ChannelType.EMAIL in channels:
+            emails = dict(
+                db.query(User.id, User.email).filter(
+                    User.id.in_([n.user_id for n in notifications])
+                ).all()
+            )
+
+        action_url = (request.data or {}).get("action_url")
+        rows = []
+        for notification in notifications:
+            payload = {
+                "title": request.title,
+                "content": request.message,
+                "priority": request.priority,
+                "category": request.type,
+                "action_url": action_url,
+                "metadata": {"notification_id": notification.id, "user_id": notification.user_id}
+            }
+            for channel_type, channel in channels.items():
+                recipient = None
+                if channel_type == ChannelType.EMAIL:
+                    recipient = emails.get(notification.user_id)
+                    if not recipient:
+                        continue
+                rows.append({
+                    "notification_id": notification.id,
+                    "channel_id": channel.id,
+                    "channel_type": channel_type.value,
+                    "recipient": recipient,
+                    "payload": payload,
+                    "max_attempts": channel.max_retries or 3
+                })
+        return rows
+
     # Template operations
     async def create_template(
         self,
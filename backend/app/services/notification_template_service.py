@@ -1,6 +1,8 @@
 from sqlalchemy.orm import Session
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from collections import OrderedDict
 import logging
+import threading
 from datetime import datetime
 from jinja2 import Template, Environment, BaseLoader
 import json
@@ -12,6 +14,7 @@ from ..models.notification import (
 from ..schemas.notification import (
     NotificationTemplateCreate, NotificationTemplateUpdate
 )
+from ..core.config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +25,13 @@ class NotificationTemplateService:
     def __init__(self):
         self.jinja_env = Environment(loader=BaseLoader())
         self.default_templates = self._load_default_templates()
+        
+        # Compiled templates keyed by (template id, updated_at, field)
+        self._compiled: "OrderedDict[Any, Tuple[str, Template]]" = OrderedDict()
+        self._cache_size = settings.NOTIFICATION_TEMPLATE_CACHE_SIZE
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
     
     # Template CRUD operations
     async def create_template(
@@ -136,6 +146,7 @@ class NotificationTemplateService:
             
             db.commit()
             db.refresh(template)
+            self.invalidate_template(template_id)
             
             logger.info(f"Updated notification template {template_id}")
             return template
@@ -154,6 +165,7 @@ class NotificationTemplateService:
             
             db.delete(template)
             db.commit()
+            self.invalidate_template(template_id)
             
             logger.info(f"Deleted notification template {template_id}")
             return True
@@ -172,39 +184,76 @@ class NotificationTemplateService:
     ) -> Dict[str, str]:
         """Render notification template with variables"""
         try:
-            # Render title
-            title = self._render_string_template(template.title_template, variables)
-            
-            # Render content
-            content = self._render_string_template(template.content_template, variables)
-            
-            # Render subject if available
-            subject = None
-            if template.subject_template:
-                subject = self._render_string_template(template.subject_template, variables)
-            
-            # Apply channel-specific formatting
-            if channel_type:
-                content = self._format_for_channel(content, channel_type, variables)
-            
-            result = {
-                'title': title,
-                'content': content
-            }
-            
-            if subject:
-                result['subject'] = subject
-            
-            return result
+            return self._render_fields(self._template_sources(template), variables, channel_type)
             
         except Exception as e:
             logger.error(f"Error rendering template {template.id}: {e}")
             raise
     
-    def _render_string_template(self, template_string: str, variables: Dict[str, Any]) -> str:
+    def _template_sources(self, template: NotificationTemplate) -> Dict[str, Tuple[Any, str]]:
+        """Cache keys and sources of the template fields"""
+        sources = {}
+        for field, attr in (('title', 'title_template'), ('content', 'content_template'), ('subject', 'subject_template')):
+            source = getattr(template, attr, None)
+            if source:
+                key = (template.id, template.updated_at, field) if template.id is not None else None
+                sources[field] = (key, source)
+        return sources
+    
+    def _render_fields(
+        self,
+        sources: Dict[str, Tuple[Any, str]],
+        variables: Dict[str, Any],
+        channel_type: Optional[ChannelType] = None
+    ) -> Dict[str, str]:
+        result = {}
+        for field, (key, source) in sources.items():
+            result[field] = self._render_string_template(source, variables, key)
+        
+        # Apply channel-specific formatting
+        if channel_type and 'content' in result:
+            result['content'] = self._format_for_channel(result['content'], channel_type, variables)
+        return result
+    
+    def _get_compiled(self, template_string: str, cache_key: Any = None) -> Template:
+        """Compiled template from the LRU cache"""
+        key = cache_key if cache_key is not None else (None, None, template_string)
+        with self._cache_lock:
+            cached = self._compiled.get(key)
+            # The source check guards against in-memory edits that did not bump updated_at
+            if cached is not None and cached[0] == template_string:
+                self._compiled.move_to_end(key)
+                self.cache_hits += 1
+                return cached[1]
+        
+        compiled = self.jinja_env.from_string(template_string)
+        with self._cache_lock:
+            self.cache_misses += 1
+            self._compiled[key] = (template_string, compiled)
+            self._compiled.move_to_end(key)
+            while len(self._compiled) > self._cache_size:
+                self._compiled.popitem(last=False)
+        return compiled
+    
+    def invalidate_template(self, template_id: int):
+        """Drop compiled versions of a template"""
+        with self._cache_lock:
+            for key in [key for key in self._compiled if key[0] == template_id]:
+                del self._compiled[key]
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        with self._cache_lock:
+            return {
+                'size': len(self._compiled),
+                'max_size': self._cache_size,
+                'hits': self.cache_hits,
+                'misses': self.cache_misses
+            }
+    
+    def _render_string_template(self, template_string: str, variables: Dict[str, Any], cache_key: Any = None) -> str:
         """Render a string template with variables"""
         try:
-            template = self.jinja_env.from_string(template_string)
+            template = self._get_compiled(template_string, cache_key)
             return template.render(**variables)
         except Exception as e:
             logger.error(f"Error rendering string template: {e}")
@@ -0,0 +1,475 @@
+"""
+Сервис инкрементальных rollup-счетчиков для админ-дашборда и виджетов аналитики
+
+Фоновая задача обрабатывает только новые строки (id > водяного знака) и
+накапливает почасовые/суточные/итоговые счетчики в таблице metric_rollups.
+Строки моложе ROLLUP_COMMIT_LAG секунд ждут следующего прохода: транзакция с
+меньшим id могла еще не закоммититься, а после сдвига водяного знака она
+была бы пропущена. Эндпоинты читают готовые бакеты, поэтому их время ответа
+не зависит от размера исходных таблиц.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, case, or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from ..core.config import settings
+from ..core.database import SessionLocal
+from ..models.audit_log import SecurityEvent
+from ..models.chat import ChatSession, ChatMessage
+from ..models.rollup import MetricRollup, RollupWatermark, RollupGranularity, TOTAL_BUCKET_START
+from ..models.token_balance import TokenTransaction
+from ..models.user import User
+
+logger = logging.getLogger(__name__)
+
+# Ключ счетчика: (metric, granularity, bucket_start, dimension)
+RollupKey = Tuple[str, str, datetime, str]
+
+
+@dataclass
+class RollupSource:
+    """Описание источника событий для rollup"""
+    name: str
+    model: Any
+    columns: Tuple[Any, ...]
+    extract: Callable[[Any], List[Tuple[str, float, str]]]  # row -> [(metric, value, dimension)]
+    metrics: Tuple[str, ...]  # Метрики, которые дает extract
+
+
+def to_utc_naive(value: Optional[datetime]) -> datetime:
+    """Приведение времени к naive UTC"""
+    if value is None:
+        return datetime.utcnow()
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(value: datetime) -> datetime:
+    floored = floor_hour(value)
+    return floored if floored == value else floored + timedelta(hours=1)
+
+
+def ceil_day(value: datetime) -> datetime:
+    floored = floor_day(value)
+    return floored if floored == value else floored + timedelta(days=1)
+
+
+class RollupService:
+    """Инкрементальный агрегатор счетчиков"""
+
+    def __init__(self):
+        self.refresh_interval = settings.ROLLUP_REFRESH_INTERVAL
+        self.snapshot_interval = settings.ROLLUP_SNAPSHOT_INTERVAL
+        self.batch_size = settings.ROLLUP_BATCH_SIZE
+        self.commit_lag = timedelta(seconds=settings.ROLLUP_COMMIT_LAG)
+        self.sources = self._initialize_sources()
+        self._last_snapshot_at: Optional[datetime] = None
+        self._running = False
+        self._task = None
+
+    def _initialize_sources(self) -> List[RollupSource]:
+        """Источники событий и извлекаемые из них метрики"""
+        return [
+            RollupSource(
+                name="users",
+                model=User,
+                columns=(User.id, User.created_at),
+                extract=lambda row: [("users.created", 1, "")],
+                metrics=("users.created",),
+            ),
+            RollupSource(
+                name="chat_sessions",
+                model=ChatSession,
+                columns=(ChatSession.id, ChatSession.created_at, ChatSession.user_id),
+                extract=lambda row: [
+                    ("sessions.created", 1, ""),
+                    ("sessions.by_user", 1, str(row.user_id)),
+                ],
+                metrics=("sessions.created", "sessions.by_user"),
+            ),
+            RollupSource(
+                name="chat_messages",
+                model=ChatMessage,
+                columns=(ChatMessage.id, ChatMessage.created_at),
+                extract=lambda row: [("messages.created", 1, "")],
+                metrics=("messages.created",),
+            ),
+            RollupSource(
+                name="token_transactions",
+                model=TokenTransaction,
+                columns=(TokenTransaction.id, TokenTransaction.created_at, TokenTransaction.amount),
+                extract=lambda row: [("tokens.spent", -row.amount, "")] if row.amount < 0 else [],
+                metrics=("tokens.spent",),
+            ),
+            RollupSource(
+                name="security_events",
+                model=SecurityEvent,
+                columns=(SecurityEvent.id, SecurityEvent.created_at),
+                extract=lambda row: [("security.events", 1, "")],
+                metrics=("security.events",),
+            ),
+        ]
+
+    # ------------------------------------------------------------------
+    # Фоновая задача
+    # ------------------------------------------------------------------
+
+    async def start(self):
+        """Запуск фонового обновления rollup-таблиц"""
+        if self._running:
+            return
+
+        self._running = True
+        self._task = asyncio.create_task(self._refresh_loop())
+        logger.info("Rollup service started")
+
+    async def stop(self):
+        """Остановка фонового обновления"""
+        self._running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        logger.info("Rollup service stopped")
+
+    async def _refresh_loop(self):
+        while self._running:
+            try:
+                await asyncio.to_thread(self.refresh)
+                await asyncio.sleep(self.refresh_interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in rollup refresh loop: {e}")
+                await asyncio.sleep(self.refresh_interval)
+
+    def refresh(self) -> Dict[str, int]:
+        """Один проход по всем источникам; возвращает число обработанных строк"""
+        processed = {}
+        with SessionLocal() as db:
+            for source in self.sources:
+                try:
+                    processed[source.name] = self.process_source(db, source)
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    logger.error(f"Rollup of {source.name} failed: {e}")
+
+            now = datetime.utcnow()
+            if (self._last_snapshot_at is None or
+                    now - self._last_snapshot_at >= timedelta(seconds=self.snapshot_interval)):
+                try:
+                    self.refresh_snapshots(db)
+                    self._last_snapshot_at = now
+                except SQLAlchemyError as e:
+                    db.rollback()
+                    logger.error(f"Rollup snapshot refresh failed: {e}")
+        return processed
+
+    def process_source(self, db: Session, source: RollupSource, now: Optional[datetime] = None) -> int:
+        """Обработка новых строк источника пачками от водяного знака"""
+        cutoff = (now or datetime.utcnow()) - self.commit_lag
+        total = 0
+        while True:
+            watermark = self._lock_watermark(db, source.name)
+            if watermark is None:
+                return total
+
+            id_column = source.columns[0]
+            rows = (
+                db.query(*source.columns)
+                .filter(id_column > watermark.last_id)
+                .order_by(id_column)
+                .limit(self.batch_size)
+                .all()
+            )
+            fetched = len(rows)
+            # Водяной знак доходит только до первой строки моложе cutoff, чтобы
+            # строки с меньшим id из еще открытых транзакций не были пропущены
+            for index, row in enumerate(rows):
+                if to_utc_naive(row.created_at) > cutoff:
+                    rows = rows[:index]
+                    break
+            if not rows:
+                db.commit()
+                return total
+
+            increments: Dict[RollupKey, float] = defaultdict(float)
+            for row in rows:
+                created_at = to_utc_naive(row.created_at)
+                for metric, value, dimension in source.extract(row):
+                    if not value:
+                        continue
+                    if not dimension:
+                        increments[(metric, RollupGranularity.HOUR, floor_hour(created_at), "")] += value
+                        increments[(metric, RollupGranularity.DAY, floor_day(created_at), "")] += value
+                    increments[(metric, RollupGranularity.TOTAL, TOTAL_BUCKET_START, dimension)] += value
+
+            self._apply_increments(db, increments)
+            watermark.last_id = rows[-1].id
+            watermark.rows_processed = (watermark.rows_processed or 0) + len(rows)
+            db.commit()
+
+            total += len(rows)
+            if fetched < self.batch_size or len(rows) < fetched:
+                return total
+
+    def _lock_watermark(self, db: Session, source_name: str) -> Optional[RollupWatermark]:
+        """Водяной знак под блокировкой строки, чтобы воркеры не считали дважды"""
+        watermark = (
+            db.query(RollupWatermark)
+            .filter(RollupWatermark.source == source_name)
+            .with_for_update()
+            .first()
+        )
+        if watermark is not None:
+            return watermark
+
+        try:
+            watermark = RollupWatermark(source=source_name, last_id=0, rows_processed=0)
+            db.add(watermark)
+            db.flush()
+            return watermark
+        except IntegrityError:
+            # Водяной знак создан параллельным воркером - обработаем на следующем проходе
+            db.rollback()
+            return None
+
+    def record_deletions(self, db: Session, source_name: str, *criteria) -> int:
+        """
+        Вычитает удаляемые строки источника из накопительных итогов
+
+        Вызывается в транзакции удаления до самого DELETE. Вычитаются только
+        строки, которые фоновая задача уже посчитала (id не больше водяного
+        знака), - остальные в rollup просто не попадут. Почасовые и суточные
+        бакеты считают события создания и не меняются.
+        """
+        source = next(source for source in self.sources if source.name == source_name)
+        # Блокировка водяного знака не дает фоновой задаче посчитать строки параллельно
+        watermark = (
+            db.query(RollupWatermark)
+            .filter(RollupWatermark.source == source_name)
+            .with_for_update()
+            .first()
+        )
+        if watermark is None:
+            return 0
+
+        id_column = source.columns[0]
+        rows = db.query(*source.columns).filter(*criteria, id_column <= watermark.last_id).all()
+        decrements: Dict[RollupKey, float] = defaultdict(float)
+        for row in rows:
+            for metric, value, dimension in source.extract(row):
+                if value:
+                    decrements[(metric, RollupGranularity.TOTAL, TOTAL_BUCKET_START, dimension)] -= value
+        if decrements:
+            self._apply_increments(db, decrements)
+        return len(rows)
+
+    def _apply_increments(self, db: Session, increments: Dict[RollupKey, float]):
+        """Прибавление приращений к существующим бакетам или создание новых"""
+        by_group: Dict[Tuple[str, str], List[RollupKey]] = defaultdict(list)
+        for key in increments:
+            by_group[(key[0], key[1])].append(key)
+
+        for (metric, granularity), keys in by_group.items():
+            buckets = {key[2] for key in keys}
+            dimensions = {key[3] for key in keys}
+            existing = (
+                db.query(MetricRollup)
+                .filter(
+                    MetricRollup.metric == metric,
+                    MetricRollup.granularity == granularity,
+                    MetricRollup.bucket_start.in_(buckets),
+                    MetricRollup.dimension.in_(dimensions),
+                )
+                .with_for_update()
+                .all()
+            )
+            existing_map = {
+                (row.metric, row.granularity, row.bucket_start, row.dimension): row
+                for row in existing
+            }
+            for key in keys:
+                row = existing_map.get(key)
+                if row is not None:
+                    row.value = (row.value or 0) + increments[key]
+                else:
+                    db.add(MetricRollup(
+                        metric=key[0], granularity=key[1], bucket_start=key[2],
+                        dimension=key[3], value=increments[key]
+                    ))
+
+    def refresh_snapshots(self, db: Session):
+        """Пересчет метрик состояния (всего/активные/премиум/админы) одним агрегатным запросом"""
+        row = db.query(
+            func.count(User.id),
+            func.sum(case((User.is_active == True, 1), else_=0)),
+            func.sum(case((User.is_premium == True, 1), else_=0)),
+            func.sum(case((User.is_admin == True, 1), else_=0)),
+        ).one()
+        values = {
+            "users.total": row[0] or 0,
+            "users.active": row[1] or 0,
+            "users.premium": row[2] or 0,
+            "users.admins": row[3] or 0,
+        }
+
+        existing = {
+            r.metric: r for r in db.query(MetricRollup).filter(
+                MetricRollup.metric.in_(values.keys()),
+                MetricRollup.granularity == RollupGranularity.SNAPSHOT,
+            ).all()
+        }
+        for metric, value in values.items():
+            if metric in existing:
+                existing[metric].value = value
+            else:
+                db.add(MetricRollup(
+                    metric=metric, granularity=RollupGranularity.SNAPSHOT,
+                    bucket_start=TOTAL_BUCKET_START, dimension="", value=value
+                ))
+        db.commit()
+
+    # ------------------------------------------------------------------
+    # Чтение rollup-таблиц
+    # ------------------------------------------------------------------
+
+    def get_values(self, db: Session, metrics: List[str], granularity: str) -> Dict[str, float]:
+        """Итоговые или snapshot-значения нескольких метрик одним запросом"""
+        rows = (
+            db.query(MetricRollup.metric, MetricRollup.value)
+            .filter(
+                MetricRollup.metric.in_(metrics),
+                MetricRollup.granularity == granularity,
+                MetricRollup.bucket_start == TOTAL_BUCKET_START,
+                MetricRollup.dimension == "",
+            )
+            .all()
+        )
+        values = {metric: 0 for metric in metrics}
+        values.update({metric: value for metric, value in rows})
+        return values
+
+    def get_sums_since(
+        self,
+        db: Session,
+        metrics: List[str],
+        since: datetime,
+        now: Optional[datetime] = None
+    ) -> Dict[str, float]:
+        """
+        Суммы метрик начиная с момента since
+
+        Полные сутки берутся из суточных бакетов, полные часы - из почасовых,
+        а неполный первый час досчитывается по исходным строкам.
+        """
+        since = to_utc_naive(since)
+        now = to_utc_naive(now)
+        first_hour = ceil_hour(since)
+        first_day = ceil_day(first_hour)
+        today = floor_day(now)
+
+        hour_bucket = (
+            (MetricRollup.granularity == RollupGranularity.HOUR) &
+            (MetricRollup.bucket_start >= first_hour)
+        )
+        if first_day < today:
+            ranges = or_(
+                hour_bucket & ((MetricRollup.bucket_start < first_day) | (MetricRollup.bucket_start >= today)),
+                (MetricRollup.granularity == RollupGranularity.DAY) &
+                (MetricRollup.bucket_start >= first_day) &
+                (MetricRollup.bucket_start < today),
+            )
+        else:
+            ranges = hour_bucket
+
+        rows = (
+            db.query(MetricRollup.metric, func.sum(MetricRollup.value))
+            .filter(MetricRollup.metric.in_(metrics), MetricRollup.dimension == "", ranges)
+            .group_by(MetricRollup.metric)
+            .all()
+        )
+        values = {metric: 0 for metric in metrics}
+        values.update({metric: value or 0 for metric, value in rows})
+
+        if since < first_hour:
+            for metric, value in self._raw_sums(db, metrics, since, first_hour).items():
+                values[metric] += value
+        return values
+
+    def _raw_sums(self, db: Session, metrics: List[str], start: datetime, end: datetime) -> Dict[str, float]:
+        """Суммы метрик без разреза по исходным строкам за интервал [start, end)"""
+        wanted = set(metrics)
+        sums: Dict[str, float] = defaultdict(float)
+        for source in self.sources:
+            if not wanted.intersection(source.metrics):
+                continue
+            created_at = source.model.created_at
+            rows = db.query(*source.columns).filter(created_at >= start, created_at < end).all()
+            for row in rows:
+                for metric, value, dimension in source.extract(row):
+                    if metric in wanted and not dimension:
+                        sums[metric] += value
+        return sums
+
+    def get_series(
+        self,
+        db: Session,
+        metric: str,
+        start: datetime,
+        end: Optional[datetime] = None,
+        granularity: str = RollupGranularity.HOUR
+    ) -> List[Tuple[datetime, float]]:
+        """Временной ряд метрики по бакетам"""
+        floor = floor_hour if granularity == RollupGranularity.HOUR else floor_day
+        query = db.query(MetricRollup.bucket_start, MetricRollup.value).filter(
+            MetricRollup.metric == metric,
+            MetricRollup.granularity == granularity,
+            MetricRollup.bucket_start >= floor(to_utc_naive(start)),
+        )
+        if end is not None:
+            query = query.filter(MetricRollup.bucket_start <= to_utc_naive(end))
+        return [(bucket, value) for bucket, value in query.order_by(MetricRollup.bucket_start).all()]
+
+    def get_top_dimensions(self, db: Session, metric: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """Топ разрезов метрики по накопительному итогу"""
+        rows = (
+            db.query(MetricRollup.dimension, MetricRollup.value)
+            .filter(
+                MetricRollup.metric == metric,
+                MetricRollup.granularity == RollupGranularity.TOTAL,
+                MetricRollup.dimension != "",
+                MetricRollup.value > 0,
+            )
+            .order_by(MetricRollup.value.desc())
+            .limit(limit)
+            .all()
+        )
+        return [(dimension, value) for dimension, value in rows]
+
+    def get_last_updated(self, db: Session) -> Optional[datetime]:
+        """Время последнего обновления водяных знаков"""
+        return db.query(func.max(RollupWatermark.updated_at)).scalar()
+
+
+# Глобальный экземпляр сервиса
+rollup_service = RollupService()
@@ -12,10 +12,11 @@ from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
 from pathlib import Path
 
-from .unified_llm_service import unified_llm_service
+from .unified_llm_service import unified_llm_service, RequestPriority
 from .embeddings_service import embeddings_service
 from .vector_store_service import vector_store_service
 from ..core.config import settings
+from ..core.legal_structure import LegalStructure, LegalStructureType, LegalNode, get_legal_structure
 
 logger = logging.getLogger(__name__)
 
@@ -68,8 +69,14 @@ class SmartDocumentProcessor:
             'административный': ['административное правонарушение', 'штраф', 'предупреждение']
         }
     
-    async def process_document(self, file_path: str, content: str) -> Dict[str, Any]:
-        """Обрабатывает документ при загрузке"""
+    async def process_document(self, file_path: str, content: str, defer_analysis: bool = True) -> Dict[str, Any]:
+        """
+        Обрабатывает документ при загрузке
+        
+        AI-анализ (ключевая информация) по умолчанию выполняется в фоновой
+        низкоприоритетной очереди: ответ возвращается сразу с analysis_job_id,
+        а результат позже вливается в метаданные чанков.
+        """
         logger.info(f"🔍 Начинаем интеллектуальную обработку документа: {file_path}")
         
         start_time = time.time()
@@ -78,8 +85,8 @@ class SmartDocumentProcessor:
             # 1. Анализ структуры документа
             metadata = await self._analyze_document_structure(content)
             
-            # 2. Извлечение ключевой информации
-            extracted_info = await self._extract_key_information(content, metadata)
+            # 2. Извлечение ключевой информации (LLM) - синхронно только по явному запросу
+            extracted_info = {} if defer_analysis else await self._extract_key_information(content, metadata)
             
             # 3. Создание умных чанков
             smart_chunks = await self._create_smart_chunks(content, metadata, extracted_info)
@@ -88,7 +95,21 @@ class SmartDocumentProcessor:
             enhanced_chunks = await self._enhance_chunks_with_embeddings(smart_chunks)
             
             # 5. Сохранение в векторную базу
-            await self._save_enhanced_chunks(file_path, enhanced_chunks, metadata)
+            document_uuid = await self._save_enhanced_chunks(
+                file_path, enhanced_chunks, metadata,
+                analysis_status="pending" if defer_analysis else "completed"
+            )
+            
+            # 6. Постановка AI-анализа в фоновую очередь
+            analysis_job_id = None
+            if defer_analysis:
+                from .background_analysis_service import background_analysis_service
+                from ..models.analysis_job import AnalysisJobType
+                analysis_job_id = background_analysis_service.enqueue(
+                    AnalysisJobType.DOCUMENT_ANALYSIS,
+                    payload={"text": content, "filename": Path(file_path).name, "document_id": document_uuid},
+                    target={"where": {"document_id": document_uuid}}
+                )
             
             processing_time = time.time() - start_time
             
@@ -103,7 +124,10 @@ class SmartDocumentProcessor:
                 "articles_count": len(metadata.articles),
                 "sections_count": len(metadata.sections),
                 "metadata": metadata.__dict__,
-                "chunks_preview": [chunk.__dict__ for chunk in enhanced_chunks[:3]]
+                "chunks_preview": [chunk.__dict__ for chunk in enhanced_chunks[:3]],
+                "document_id": document_uuid,
+                "analysis_job_id": analysis_job_id,
+                "analysis_status": "pending" if defer_analysis else "completed"
             }
             
         except Exception as e:
@@ -118,23 +142,21 @@ class SmartDocumentProcessor:
         """Анализирует структуру документа"""
         logger.info("🔍 Анализируем структуру документа...")
         
+        # Структура документа разбирается за один проход (кэшируется по хэшу содержимого)
+        structure = get_legal_structure(content)
+        
         # Извлекаем статьи
         articles = []
-        article_matches = self.article_pattern.findall(content)
-        for i, article_num in enumerate(article_matches):
-            # Находим название статьи
-            article_text = self._extract_article_text(content, article_num)
+        for node in structure.articles:
+            article_text = content[node.start:node.end].strip()
             articles.append({
-                "number": article_num,
-                "title": self._extract_article_title(article_text),
+                "number": node.number,
+                "title": node.title or self._extract_article_title(article_text),
                 "content_preview": article_text[:200] + "..." if len(article_text) > 200 else article_text
             })
         
-        # Извлекаем разделы
-        sections = []
-        section_matches = self.section_pattern.findall(content)
-        for section in section_matches:
-            sections.append(section.strip())
+        # Извлекаем разделы и главы
+        sections = [self._section_label(node) for node in self._section_nodes(structure)]
         
         # Определяем тип документа
         document_type = self._classify_document_type(content)
@@ -162,7 +184,8 @@ class SmartDocumentProcessor:
             structure_score=structure_score
         )
     
-    async def _extract_key_information(self, content: str, metadata: DocumentMetadata) -> Dict[str, Any]:
+    async def _extract_key_information(self, content: str, metadata: Optional[DocumentMetadata],
+                                       priority: RequestPriority = RequestPriority.NORMAL) -> Dict[str, Any]:
         """Извлекает ключевую информацию с помощью AI"""
         logger.info("🤖 Извлекаем ключевую информацию с помощью AI...")
         
@@ -191,7 +214,8 @@ class SmartDocumentProcessor:
                 prompt=analysis_prompt,
                 max_tokens=settings.AI_DOCUMENT_ANALYSIS_TOKENS,  # Используем настройку токенов из конфигурации (4000)
                 temperature=0.1,
-                stream=True
+                stream=True,
+                priority=priority
             ):
                 analysis_result += chunk
             
@@ -218,10 +242,11 @@ class SmartDocumentProcessor:
         logger.info("🧩 Создаем умные чанки...")
         
         smart_chunks = []
+        structure = get_legal_structure(content)
         
-        # Разбиваем по статьям
-        for article in metadata.articles:
-            article_content = self._extract_article_content(content, article["number"])
+        # Разбиваем по статьям (узлы структуры идут в том же порядке, что и metadata.articles)
+        for article, node in zip(metadata.articles, structure.articles):
+            article_content = content[node.start:node.end].strip()
             if article_content:
                 chunk = SmartChunk(
                     content=article_content,
@@ -237,7 +262,7 @@ class SmartDocumentProcessor:
         
         # Разбиваем по разделам
         for section in metadata.sections:
-            section_content = self._extract_section_content(content, section)
+            section_content = self._extract_section_content(content, section, structure)
             if section_content:
                 chunk = SmartChunk(
                     content=section_content,
@@ -322,8 +347,9 @@ class SmartDocumentProcessor:
         logger.info(f"✅ Создано {len(enhanced_chunks)} чанков с эмбеддингами")
         return enhanced_chunks
     
-    async def _save_enhanced_chunks(self, file_path: str, enhanced_chunks: List[Dict[str, Any]], metadata: DocumentMetadata):
-        """Сохраняет улучшенные чанки в векторную базу"""
+    async def _save_enhanced_chunks(self, file_path: str, enhanced_chunks: List[Dict[str, Any]], metadata: DocumentMetadata,
+                                    analysis_status: Optional[str] = None) -> str:
+        """Сохраняет улучшенные чанки в векторную базу, возвращает document_id"""
         logger.info("💾 Сохраняем чанки в векторную базу...")
         
         # Подготавливаем данные для сохранения
@@ -341,6 +367,8 @@ class SmartDocumentProcessor:
                 "total_chunks": len(enhanced_chunks),
                 "structure_score": metadata.structure_score
             })
+            if analysis_status:
+                chunk_metadata["analysis_status"] = analysis_status
             metadatas.append(chunk_metadata)
         
         # Генерируем уникальный document_id
@@ -362,7 +390,7 @@ class SmartDocumentProcessor:
             metadata['document_id'] = document_uuid
             metadata['chunk_id'] = chunk_id
             
-            success = await self.vector_store_service.add_document(
+            success = self.vector_store_service.add_document(
                 content=content,
                 embedding=embedding,  # ИСПРАВЛЕНО: передаем embedding
                 metadata=metadata,
@@ -371,32 +399,30 @@ class SmartDocumentProcessor:
             if success:
                 added_count += 1
         
-        logger.info(f"✅ Сохранено {len(enhanced_chunks)} чанков")
+        logger.info(f"✅ Сохранено {added_count} чанков")
+        return document_uuid
     
     # Вспомогательные методы
-    def _extract_article_text(self, content: str, article_num: str) -> str:
-        """Извлекает текст статьи с улучшенным парсингом"""
-        # Нормализуем номер статьи
-        normalized_num = article_num.replace('.', r'\.').replace('№', '')
-        
-        # Улучшенные паттерны для поиска статей
-        patterns = [
-            # Статья 123
-            rf'\bстатья\s+{normalized_num}\b.*?(?=\bстатья\s+\d+|$)',
-            # Ст. 123
-            rf'\bст\.\s*{normalized_num}\b.*?(?=\bст\.\s*\d+|$)',
-            # Статья № 123
-            rf'\bстатья\s*№\s*{normalized_num}\b.*?(?=\bстатья\s*№\s*\d+|$)',
-            # Ст № 123
-            rf'\bст\s*№\s*{normalized_num}\b.*?(?=\bст\s*№\s*\d+|$)',
+    def _extract_article_text(self, content: str, article_num: str,
+                              structure: Optional[LegalStructure] = None) -> str:
+        """Извлекает текст статьи по разобранной структуре документа"""
+        structure = structure or get_legal_structure(content)
+        node = structure.find(LegalStructureType.ARTICLE, article_num.replace('№', '').strip())
+        if node is None:
+            return ""
+        return content[node.start:node.end].strip()
+    
+    def _section_nodes(self, structure: LegalStructure) -> List[LegalNode]:
+        """Разделы и главы документа в порядке следования"""
+        return [
+            node for node in structure.nodes
+            if node.type in (LegalStructureType.SECTION, LegalStructureType.CHAPTER)
         ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, content, re.IGNORECASE | re.DOTALL)
-            if match:
-                return match.group(0).strip()
-        
-        return ""
+    
+    def _section_label(self, node: LegalNode) -> str:
+        """Подпись раздела/главы: "Раздел I", "Глава 5" """
+        prefix = "Раздел" if node.type == LegalStructureType.SECTION else "Глава"
+        return f"{prefix} {node.number}"
     
     def _extract_article_title(self, article_text: str) -> str:
         """Извлекает название статьи"""
@@ -498,15 +524,21 @@ class SmartDocumentProcessor:
                 return line.strip()
         return "Без названия"
     
-    def _extract_article_content(self, content: str, article_num: str) -> str:
+    def _extract_article_content(self, content: str, article_num: str,
+                                 structure: Optional[LegalStructure] = None) -> str:
         """Извлекает полное содержание статьи"""
-        return self._extract_article_text(content, article_num)
+        return self._extract_article_text(content, article_num, structure)
     
-    def _extract_section_content(self, content: str, section: str) -> str:
-        """Извлекает содержание раздела"""
-        pattern = rf'{re.escape(section)}.*?(?=раздел|глава|$)'
-        match = re.search(pattern, content, re.IGNORECASE | re.DOTALL)
-        return match.group(0) if match else ""
+    def _extract_section_content(self, content: str, section: str,
+                                 structure: Optional[LegalStructure] = None) -> str:
+        """Извлекает содержание раздела (без вложенных статей, они разбиваются отдельно)"""
+        structure = structure or get_legal_structure(content)
+        for node in self._section_nodes(structure):
+            if self._section_label(node) == section:
+                children = structure.children(node)
+                end = children[0].start if children else node.end
+                return content[node.start:end].strip()
+        return ""
     
     def _extract_definitions(self, content: str) -> List[str]:
         """Извлекает определения из документа"""
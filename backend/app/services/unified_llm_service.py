@@ -8,7 +8,7 @@ import time
 import threading
 import asyncio
 import uuid
-from typing import Optional, AsyncGenerator, Any, Dict, List
+from typing import Optional, AsyncGenerator, Any, Dict, List, Set, Tuple
 from queue import Queue
 from dataclasses import dataclass
 from datetime import datetime
@@ -18,6 +18,11 @@ from ..core.config import settings
 # Внешняя зависимость llama_cpp
 from llama_cpp import Llama
 
+from .canary_service import canary_service
+from .lora_adapter_manager import (
+    LoRAAdapterCache, AdapterScheduler, AdapterLease, adapters_supported, apply_adapter
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -148,6 +153,24 @@ class UnifiedLLMService:
         # Background tasks
         self._background_tasks: List[asyncio.Task] = []
         
+        # Интерактивные запросы (чат) имеют приоритет над фоновыми (LOW): фоновая генерация
+        # стартует только при простое, а при появлении интерактивного запроса прерывается и
+        # после него начинается заново (n_tokens/KV-кэш модели к тому времени уже чужие)
+        self._generation_lock = threading.Lock()  # Одна генерация на экземпляре Llama в каждый момент
+        self._interactive_lock = threading.Lock()
+        self._interactive_requests = 0
+        self._last_interactive_activity = 0.0
+        self._background_gate = threading.Event()
+        self._background_gate.set()
+        
+        # LoRA-адаптеры canary-версий поверх одной базовой модели
+        self._adapter_paths: Dict[str, str] = {}
+        self._adapter_cache = LoRAAdapterCache(getattr(settings, "LORA_ADAPTER_CACHE_MB", 1024))
+        self._adapter_scheduler = AdapterScheduler(
+            self._activate_adapter, getattr(settings, "LORA_ADAPTER_MAX_BATCH", 8)
+        )
+        self._metric_tasks: Set[asyncio.Task] = set()
+        
     def _ensure_semaphore(self):
         """Инициализирует семафор для ограничения конкурентности"""
         if self._async_semaphore is None:
@@ -329,10 +352,135 @@ class UnifiedLLMService:
             logger.error(f"❌ Ошибка загрузки модели: {e}")
             return False
 
+    def _begin_interactive(self):
+        """Отмечает начало интерактивного запроса (фоновая генерация прерывается)"""
+        with self._interactive_lock:
+            self._interactive_requests += 1
+            self._last_interactive_activity = time.time()
+            self._background_gate.clear()
+
+    def _end_interactive(self):
+        """Отмечает завершение интерактивного запроса"""
+        with self._interactive_lock:
+            self._interactive_requests = max(0, self._interactive_requests - 1)
+            self._last_interactive_activity = time.time()
+            if self._interactive_requests == 0:
+                self._background_gate.set()
+
+    def is_interactive_idle(self, grace: float = 0.0) -> bool:
+        """True, если нет активных интерактивных запросов и прошло не меньше grace секунд с последнего"""
+        with self._interactive_lock:
+            if self._interactive_requests > 0:
+                return False
+            return time.time() - self._last_interactive_activity >= grace
+
+    async def wait_for_interactive_idle(self, grace: float = 0.0, poll_interval: float = 0.5):
+        """Ожидает простоя интерактивной очереди"""
+        while not self._shutdown_requested and not self.is_interactive_idle(grace):
+            await asyncio.sleep(poll_interval)
+
+    def _wait_background_turn(self) -> float:
+        """Блокирует фоновый поток, пока идут интерактивные запросы. Возвращает время паузы"""
+        paused_at = time.time()
+        while not self._shutdown_requested and not self._background_gate.wait(timeout=1.0):
+            pass
+        return time.time() - paused_at
+
+    def _acquire_background_generation(
+        self,
+        lease: Optional[AdapterLease] = None,
+        adapter_id: Optional[str] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None
+    ) -> Tuple[Optional[float], Optional[AdapterLease]]:
+        """
+        Захватывает модель для фоновой генерации при отсутствии интерактивных запросов.
+
+        На время паузы аренда адаптера отдается планировщику, чтобы интерактивные
+        запросы к другому адаптеру не ждали вытесненную фоновую работу; с loop
+        аренда adapter_id берется заново перед генерацией.
+        Возвращает (время ожидания, аренда); время None, если сервис останавливается
+        (модель не захвачена)
+        """
+        waited = 0.0
+        while not self._shutdown_requested:
+            if lease is not None and not self._background_gate.is_set():
+                lease.release_threadsafe()
+                lease = None
+            waited += self._wait_background_turn()
+            started = time.time()
+            if lease is None and loop is not None:
+                lease = asyncio.run_coroutine_threadsafe(
+                    self._adapter_scheduler.acquire(adapter_id), loop
+                ).result()
+            acquired = self._generation_lock.acquire(timeout=1.0)
+            waited += time.time() - started
+            if not acquired:
+                continue
+            if self._background_gate.is_set():
+                return waited, lease
+            # Пока ждали модель, пришел интерактивный запрос - уступаем ему
+            self._generation_lock.release()
+        return None, lease
+
+    async def resolve_adapter(self, user_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Адаптер для запроса пользователя по решению CanaryService
+
+        Returns:
+            (adapter_id, model_id): adapter_id None - базовая модель; model_id - версия для метрик canary
+        """
+        if not getattr(settings, "LORA_ADAPTERS_ENABLED", True) or user_id == "anonymous":
+            return None, None
+        route = await canary_service.get_adapter_for_request(user_id)
+        if route is None:
+            return None, None
+        model_id, adapter_path = route
+        if not adapter_path or self._adapter_cache.is_failed(model_id):
+            return None, model_id
+        self._adapter_paths[model_id] = adapter_path
+        return model_id, model_id
+
+    async def _activate_adapter(self, adapter_id: Optional[str]):
+        """Подключает адаптер к контексту базовой модели (вызывается планировщиком без активных генераций)"""
+        if adapter_id is None:
+            if self.model is not None and adapters_supported():
+                await asyncio.to_thread(apply_adapter, self.model, None)
+            return
+        await self.ensure_model_loaded_async()
+        if self.model is None:
+            raise RuntimeError("Базовая модель не загружена")
+        pinned = {self._adapter_scheduler.active} - {None}
+        adapter = await asyncio.to_thread(
+            self._adapter_cache.get, self.model, adapter_id, self._adapter_paths[adapter_id], pinned
+        )
+        await asyncio.to_thread(apply_adapter, self.model, adapter, getattr(settings, "LORA_ADAPTER_SCALE", 1.0))
+
+    def _record_canary_metrics(self, model_id: Optional[str], success: bool, response_time: float):
+        if model_id is None:
+            return
+        task = asyncio.create_task(canary_service.record_metrics(model_id, success, response_time))
+        self._metric_tasks.add(task)
+        task.add_done_callback(self._metric_tasks.discard)
+
+    def count_tokens(self, text: str) -> int:
+        """Число токенов текста по токенизатору модели (оценка, если модель не загружена)"""
+        if not text:
+            return 0
+        if self.model is not None and self._model_loaded:
+            try:
+                return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+            except Exception as e:
+                logger.debug("Ошибка токенизации, используем оценку: %s", e)
+        return _estimate_tokens(text)
+
+    def has_tokenizer(self) -> bool:
+        """Доступен ли точный подсчет токенов"""
+        return self.model is not None and self._model_loaded
+
     def _compute_max_gen_tokens(self, prompt: str, requested_max: int) -> int:
         """Ограничиваем max_tokens в зависимости от n_ctx и длины prompt"""
         n_ctx = getattr(settings, "VISTRAL_N_CTX", 8192)
-        prompt_tokens = _estimate_tokens(prompt)
+        prompt_tokens = self.count_tokens(prompt)
         safety_margin = getattr(settings, "VISTRAL_TOKEN_MARGIN", 32)
         available = max(1, n_ctx - prompt_tokens - safety_margin)
         if requested_max > available:
@@ -352,32 +500,67 @@ class UnifiedLLMService:
         user_id: str = "anonymous",
         priority: RequestPriority = RequestPriority.NORMAL
     ) -> AsyncGenerator[str, None]:
-        """Основной метод для генерации ответов с поддержкой streaming"""
-        
-        # Создаем запрос
-        request = LLMRequest(
-            id=str(uuid.uuid4()),
-            prompt=self._prepare_prompt(prompt, context),
-            context=context,
-            user_id=user_id,
-            timestamp=datetime.now(),
-            priority=priority,
-            stream=stream,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p
-        )
+        """
+        Основной метод для генерации ответов с поддержкой streaming.
         
-        if stream:
-            # Streaming режим
-            async for chunk in self._stream_response_internal(request):
-                yield chunk
+        prompt считается готовым (create_legal_prompt, собственный промпт анализатора);
+        в юридический шаблон оборачивается только вопрос, переданный вместе с context.
+        """
+        
+        # LOW - фоновая полоса: ждем простоя чата. Интерактивный запрос помечается активным
+        # до ожидания адаптера, иначе он стоял бы в очереди планировщика за арендой
+        # фоновой генерации, которую должен вытеснить
+        is_background = priority == RequestPriority.LOW
+        if is_background:
+            await self.wait_for_interactive_idle(getattr(settings, "BACKGROUND_ANALYSIS_IDLE_GRACE", 0.0))
         else:
-            # Обычный режим
-            response = await self._generate_response_internal(
-                request.prompt, max_tokens, temperature, top_p
+            self._begin_interactive()
+        
+        lease: Optional[AdapterLease] = None
+        routed_model_id: Optional[str] = None
+        started = time.time()
+        success = False
+        try:
+            # Адаптер canary-версии; модель выдается группами запросов одного адаптера
+            adapter_id, routed_model_id = await self.resolve_adapter(user_id)
+            lease = await self._adapter_scheduler.acquire(adapter_id)
+            
+            # Создаем запрос
+            request = LLMRequest(
+                id=str(uuid.uuid4()),
+                prompt=self._prepare_prompt(prompt, context) if context else prompt,
+                context=context,
+                user_id=user_id,
+                timestamp=datetime.now(),
+                priority=priority,
+                stream=stream,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p
             )
-            yield response
+            
+            started = time.time()
+            if stream:
+                # Streaming режим
+                success = True
+                async for chunk in self._stream_response_internal(request, lease):
+                    if chunk.startswith("[ERROR]"):
+                        success = False
+                    yield chunk
+            else:
+                # Обычный режим
+                response = await self._generate_response_internal(
+                    request.prompt, max_tokens, temperature, top_p
+                )
+                success = True
+                lease.release()
+                yield response
+        finally:
+            if lease is not None and not lease.transferred:
+                lease.release()
+            if not is_background:
+                self._end_interactive()
+            self._record_canary_metrics(routed_model_id, success, time.time() - started)
 
     async def _generate_response_internal(
         self,
@@ -408,6 +591,10 @@ class UnifiedLLMService:
             loop = asyncio.get_running_loop()
 
             def _blocking_call():
+                with self._generation_lock:
+                    return _generate()
+
+            def _generate():
                 try:
                     # Сначала пробуем chat-completion, совместимо с instruct-моделями
                     try:
@@ -492,7 +679,9 @@ class UnifiedLLMService:
                 logger.exception("❌ Ошибка извлечения текста из результата модели: %s", e)
                 raise
 
-    async def _stream_response_internal(self, request: LLMRequest) -> AsyncGenerator[str, None]:
+    async def _stream_response_internal(
+        self, request: LLMRequest, lease: Optional[AdapterLease] = None
+    ) -> AsyncGenerator[str, None]:
         """Внутренний метод для streaming ответа"""
         try:
             await self.ensure_model_loaded_async()
@@ -507,7 +696,12 @@ class UnifiedLLMService:
                 stop_tokens = None
             repeat_penalty = getattr(settings, "VISTRAL_REPEAT_PENALTY", 1.1)
 
+            # Фоновый поток отдает аренду на время вытеснения и берет ее заново
+            adapter_id = lease.adapter_id if lease is not None else None
+            lease_loop = loop if lease is not None else None
+
             def worker():
+                nonlocal lease
                 try:
                     logger.info(f"🚀 Starting model generation with prompt: {request.prompt[:100]}...")
                     logger.info(f"📊 Model settings: max_tokens={allowed_max}, temperature={request.temperature}, top_p={request.top_p}")
@@ -529,66 +723,104 @@ class UnifiedLLMService:
                     
                     logger.info(f"🔧 Using optimized generation params: {generation_params}")
                     
+                    is_background = request.priority == RequestPriority.LOW
+                    # Фоновый ответ копится и отдается целиком: при вытеснении генерация начинается заново
+                    background_parts: List[str] = []
                     start_time = time.time()
-                    # Предпочитаем chat streaming, затем фоллбэк на текстовый стрим
-                    stream_iter = None
-                    try:
-                        stream_iter = self.model.create_chat_completion(
-                            messages=[
-                                {"role": "system", "content": "Ты опытный юрист-консультант по законодательству РФ. Отвечай чётко и по делу."},
-                                {"role": "user", "content": request.prompt},
-                            ],
-                            stream=True,
-                            **{k: v for k, v in generation_params.items() if k != "stream"}
-                        )
-                    except Exception:
-                        stream_iter = self.model(request.prompt, **generation_params)
-
-                    for chunk in stream_iter:
-                        # Таймаут для генерации - используем настройку из конфигурации для чата
-                        # Используем таймаут для чата (10 минут для больших моделей на CPU)
-                        chat_timeout = getattr(settings, "AI_CHAT_RESPONSE_TIMEOUT", 600)  # 10 минут для чата
-                        if time.time() - start_time > chat_timeout:
-                            logger.error(f"❌ MODEL GENERATION TIMEOUT after {chat_timeout}s! Force stopping...")
-                            loop.call_soon_threadsafe(q.put_nowait, f"[TIMEOUT] Model generation exceeded {chat_timeout} seconds")
-                            break
-                        
-                        # Дополнительная проверка: если токены генерируются слишком медленно (более 10 секунд на токен после первых 30)
-                        # Для больших моделей на CPU нормальная скорость 2-8 сек/токен, поэтому порог увеличен
-                        if chunk_count > 30 and time.time() - start_time > 60:
-                            time_per_token = (time.time() - start_time) / chunk_count
-                            if time_per_token > 10.0:  # Более 10 секунд на токен - это действительно слишком медленно
-                                logger.warning(f"⚠️ Модель генерирует токены слишком медленно: {time_per_token:.2f} сек/токен. Прерываем генерацию.")
-                                loop.call_soon_threadsafe(q.put_nowait, f"[TIMEOUT] Model generation too slow: {time_per_token:.2f} sec/token")
+                    while True:
+                        if is_background:
+                            waited, lease = self._acquire_background_generation(lease, adapter_id, lease_loop)
+                            if waited is None:
                                 break
-                            
-                        chunk_count += 1
-                        if not chunk:
-                            logger.warning(f"⚠️ Empty chunk #{chunk_count}")
-                            continue
-                        choices = chunk.get("choices") or []
-                        if not choices:
-                            logger.warning(f"⚠️ No choices in chunk #{chunk_count}")
-                            continue
-                        # Поддержка chat-стрима (delta.content) и text-стрима (text)
-                        delta = (
-                            choices[0].get("delta", {}).get("content")
-                            or choices[0].get("text", "")
-                        )
-                        if delta:
-                            logger.info(f"✅ Generated token #{chunk_count}: '{delta[:50]}...'")
-                            loop.call_soon_threadsafe(q.put_nowait, delta)
+                            start_time += waited
                         else:
-                            logger.warning(f"⚠️ Empty delta in chunk #{chunk_count}")
+                            self._generation_lock.acquire()
+                        preempted = False
+                        background_parts = []
+                        chunk_count = 0
+                        stream_iter = None
+                        try:
+                            # Предпочитаем chat streaming, затем фоллбэк на текстовый стрим
+                            try:
+                                stream_iter = self.model.create_chat_completion(
+                                    messages=[
+                                        {"role": "system", "content": "Ты опытный юрист-консультант по законодательству РФ. Отвечай чётко и по делу."},
+                                        {"role": "user", "content": request.prompt},
+                                    ],
+                                    stream=True,
+                                    **{k: v for k, v in generation_params.items() if k != "stream"}
+                                )
+                            except Exception:
+                                stream_iter = self.model(request.prompt, **generation_params)
+
+                            for chunk in stream_iter:
+                                # Интерактивный запрос перезапишет состояние модели: фоновая генерация
+                                # прерывается между токенами и после него повторяется с prefill
+                                if is_background and not self._background_gate.is_set():
+                                    preempted = True
+                                    break
+                                # Таймаут для генерации - используем настройку из конфигурации для чата
+                                # Используем таймаут для чата (10 минут для больших моделей на CPU)
+                                chat_timeout = getattr(settings, "AI_CHAT_RESPONSE_TIMEOUT", 600)  # 10 минут для чата
+                                if time.time() - start_time > chat_timeout:
+                                    logger.error(f"❌ MODEL GENERATION TIMEOUT after {chat_timeout}s! Force stopping...")
+                                    loop.call_soon_threadsafe(q.put_nowait, f"[TIMEOUT] Model generation exceeded {chat_timeout} seconds")
+                                    break
+                        
+                                # Дополнительная проверка: если токены генерируются слишком медленно (более 10 секунд на токен после первых 30)
+                                # Для больших моделей на CPU нормальная скорость 2-8 сек/токен, поэтому порог увеличен
+                                if chunk_count > 30 and time.time() - start_time > 60:
+                                    time_per_token = (time.time() - start_time) / chunk_count
+                                    if time_per_token > 10.0:  # Более 10 секунд на токен - это действительно слишком медленно
+                                        logger.warning(f"⚠️ Модель генерирует токены слишком медленно: {time_per_token:.2f} сек/токен. Прерываем генерацию.")
+                                        loop.call_soon_threadsafe(q.put_nowait, f"[TIMEOUT] Model generation too slow: {time_per_token:.2f} sec/token")
+                                        break
+                            
+                                chunk_count += 1
+                                if not chunk:
+                                    logger.warning(f"⚠️ Empty chunk #{chunk_count}")
+                                    continue
+                                choices = chunk.get("choices") or []
+                                if not choices:
+                                    logger.warning(f"⚠️ No choices in chunk #{chunk_count}")
+                                    continue
+                                # Поддержка chat-стрима (delta.content) и text-стрима (text)
+                                delta = (
+                                    choices[0].get("delta", {}).get("content")
+                                    or choices[0].get("text", "")
+                                )
+                                if delta:
+                                    logger.info(f"✅ Generated token #{chunk_count}: '{delta[:50]}...'")
+                                    if is_background:
+                                        background_parts.append(delta)
+                                    else:
+                                        loop.call_soon_threadsafe(q.put_nowait, delta)
+                                else:
+                                    logger.warning(f"⚠️ Empty delta in chunk #{chunk_count}")
+                        finally:
+                            if stream_iter is not None and hasattr(stream_iter, "close"):
+                                stream_iter.close()
+                            self._generation_lock.release()
+                        if not preempted:
+                            break
+                        logger.info(f"⏸️ Фоновая генерация {request.id} вытеснена интерактивным запросом, будет повторена")
                     
+                    if is_background and background_parts and not self._shutdown_requested:
+                        loop.call_soon_threadsafe(q.put_nowait, "".join(background_parts))
                     logger.info(f"🏁 Model generation completed. Total chunks: {chunk_count}")
                     loop.call_soon_threadsafe(q.put_nowait, None)
                 except Exception as e:
                     logger.exception("❌ Ошибка в streaming worker: %s", e)
                     loop.call_soon_threadsafe(q.put_nowait, f"[ERROR] {str(e)}")
                     loop.call_soon_threadsafe(q.put_nowait, None)
+                finally:
+                    # Модель свободна - планировщик адаптеров может переключаться
+                    if lease is not None:
+                        lease.release_threadsafe()
 
             t = threading.Thread(target=worker, daemon=True)
+            if lease is not None:
+                lease.transferred = True
             t.start()
 
             while True:
@@ -690,6 +922,12 @@ class UnifiedLLMService:
             "model_loaded": self.is_model_loaded(),
             "active_requests": len(self._active_requests),
             "max_concurrency": self._max_concurrency,
+            "interactive_requests": self._interactive_requests,
+            "background_paused": not self._background_gate.is_set(),
+            "adapters": {
+                **self._adapter_scheduler.get_stats(),
+                "cache": self._adapter_cache.get_stats(),
+            },
         }
 
     async def _update_metrics_periodically(self):
@@ -783,6 +1021,8 @@ class UnifiedLLMService:
             except asyncio.CancelledError:
                 pass
         
+        self._adapter_cache.clear()
+        
         logger.info("✅ UnifiedLLMService успешно остановлен")
 
 
@@ -79,7 +79,10 @@ class VectorStoreService:
         # Настройки гибридной классификации
         self.use_ai_classification = os.getenv("USE_AI_CLASSIFICATION", "true").lower() == "true"
         self._classification_cache = {}  # Кэш для результатов классификации
-        self._ai_classifier = None  # Ленивая загрузка AI-классификатора
+        # document_id, уже отправленные на фоновую AI-классификацию (запись снимается по ее завершении;
+        # дубли между воркерами отсекает dedup_key очереди, поэтому множество можно ограничить)
+        self._queued_ai_classification = set()
+        self._max_queued_ai_classification = 10000
         
     def initialize(self):
         """Инициализация ChromaDB"""
@@ -195,7 +198,12 @@ class VectorStoreService:
             "title", "filename", "file_name", "file_path", "content_length", "added_at", 
             "part", "item", "document_type", "document_id", "chunk_index",
             "start_position", "end_position", "chunk_length", "total_chunks",
-            "processing_timestamp", "source_type", "text_length"
+            "processing_timestamp", "source_type", "text_length",
+            # Результаты фонового AI-анализа
+            "analysis_job_id", "analysis_status", "ai_legal_concepts", "ai_procedures",
+            "ai_entities", "ai_responsibilities", "ai_terms", "ai_document_type",
+            "ai_classification_confidence", "validation_status", "ai_validation_is_valid",
+            "ai_validation_confidence", "ai_validation_reason"
         }
         
         sanitized = {}
@@ -243,11 +251,13 @@ class VectorStoreService:
             
             # Определяем тип документа, если не указан (гибридный подход)
             if "document_type" not in sanitized_metadata:
-                file_name = sanitized_metadata.get("file_name", sanitized_metadata.get("filename", ""))
+                name_key = "file_name" if "file_name" in sanitized_metadata else "filename"
+                file_name = sanitized_metadata.get(name_key, "")
                 doc_type = self._determine_document_type_hybrid(
                     file_name=file_name,
                     document_id=document_id,
-                    text_content=content
+                    text_content=content,
+                    name_key=name_key
                 )
                 sanitized_metadata["document_type"] = doc_type
             
@@ -394,6 +404,41 @@ class VectorStoreService:
             
         return None
     
+    def update_documents_metadata(self,
+                                  updates: Dict[str, Any],
+                                  ids: Optional[List[str]] = None,
+                                  where: Optional[Dict[str, Any]] = None) -> int:
+        """Вливает поля в метаданные существующих чанков (по ids или фильтру where)"""
+        if not self.is_ready():
+            self.initialize()
+        if not self.is_ready() or (not ids and not where):
+            return 0
+        
+        try:
+            sanitized_updates = self._validate_metadata(updates)
+            if not sanitized_updates:
+                return 0
+            
+            if ids:
+                results = self.collection.get(ids=ids, include=['metadatas'])
+            else:
+                results = self.collection.get(where=where, include=['metadatas'])
+            
+            found_ids = results.get('ids') or []
+            if not found_ids:
+                return 0
+            
+            metadatas = [
+                {**(metadata or {}), **sanitized_updates}
+                for metadata in (results.get('metadatas') or [{}] * len(found_ids))
+            ]
+            self.collection.update(ids=found_ids, metadatas=metadatas)
+            return len(found_ids)
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления метаданных: {e}")
+            return 0
+    
     async def delete_document(self, document_id: str) -> bool:
         """Удаляет документ по ID"""
         if not self.is_ready():
@@ -440,12 +485,13 @@ class VectorStoreService:
         self,
         file_name: str,
         document_id: str,
-        text_content: str = ""
+        text_content: str = "",
+        name_key: str = "file_name"
     ) -> str:
         """
         Гибридный подход к определению типа документа:
         1. Сначала правило-основанная проверка (быстро)
-        2. Если не уверены (other) → используем AI (точно)
+        2. Если не уверены (other) → AI-классификация в фоновой очереди (точно, но позже)
         3. Кэшируем результаты
         """
         # Проверяем кэш
@@ -466,42 +512,32 @@ class VectorStoreService:
             self._classification_cache[cache_key] = rule_type
             return rule_type
         
-        # Шаг 3: Если не уверены (other) и AI включен - используем AI
-        if rule_type == 'other' and self.use_ai_classification and text_content:
-            try:
-                # Ленивая загрузка AI-классификатора
-                if self._ai_classifier is None:
-                    try:
-                        from .ai_document_classifier import ai_document_classifier
-                        self._ai_classifier = ai_document_classifier
-                    except ImportError:
-                        logger.warning("AI-классификатор недоступен, используем rule-based")
-                        self.use_ai_classification = False
-                        self._classification_cache[cache_key] = rule_type
-                        return rule_type
-                
-                # Используем AI (синхронная версия для совместимости)
+        # Шаг 3: Если не уверены (other) и AI включен - ставим AI-классификацию в фоновую очередь.
+        # LLM не вызывается в пути загрузки: результат позже вольется в метаданные чанков файла
+        if rule_type == 'other' and self.use_ai_classification and text_content and file_name:
+            if document_id not in self._queued_ai_classification:
                 try:
-                    from .ai_document_classifier import classify_document_with_ai_sync
-                    ai_type = classify_document_with_ai_sync(
-                        text_content[:2000],  # Первые 2000 символов для анализа
-                        file_name,
-                        document_id
+                    from .background_analysis_service import background_analysis_service
+                    from ..models.analysis_job import AnalysisJobType
+                    background_analysis_service.enqueue(
+                        AnalysisJobType.DOCUMENT_CLASSIFICATION,
+                        payload={"text": text_content, "file_name": file_name, "document_id": document_id},
+                        target={"where": {name_key: file_name}},
+                        dedup_key=f"classify:{document_id}"
                     )
-                    
-                    if ai_type != 'other':
-                        logger.info(f"✅ AI определил тип: {ai_type} (было: {rule_type})")
-                        self._classification_cache[cache_key] = ai_type
-                        return ai_type
+                    if len(self._queued_ai_classification) >= self._max_queued_ai_classification:
+                        self._queued_ai_classification.clear()
+                    self._queued_ai_classification.add(document_id)
                 except Exception as e:
-                    logger.debug(f"⚠️ AI-классификация недоступна для этого документа: {e}")
-            
-            except Exception as e:
-                logger.warning(f"⚠️ AI-классификация недоступна: {e}")
+                    logger.warning(f"⚠️ AI-классификация недоступна: {e}")
         
         # Возвращаем rule-based результат и кэшируем
         self._classification_cache[cache_key] = rule_type
         return rule_type
 
+    def finish_ai_classification(self, document_id: str):
+        """Снимает отметку о фоновой AI-классификации документа (задача завершена или окончательно упала)"""
+        self._queued_ai_classification.discard(document_id)
+
 # Глобальный экземпляр сервиса
 vector_store_service = VectorStoreService()
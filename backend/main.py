@@ -37,38 +37,28 @@ from app.services.vector_store_service import vector_store_service
 from app.core.advanced_performance_optimizer import performance_optimizer
 from app.middleware.ml_rate_limit import MLRateLimiter
 
-# Prometheus метрики
+# Prometheus метрики (общий экземпляр модуля, а не второй набор метрик)
 try:
-    from app.core.prometheus_metrics import PrometheusMetrics
+    from app.core.prometheus_metrics import prometheus_metrics
 except ImportError:
     # Fallback для случаев когда prometheus_metrics недоступен
-    class PrometheusMetrics:
-        def __init__(self):
-            pass
+    class MockPrometheusMetrics:
         def record_http_request(self, *args, **kwargs):
             pass
         def record_ai_inference(self, *args, **kwargs):
             pass
         def record_error(self, *args, **kwargs):
             pass
+        def render(self, extra_metrics: str = "") -> str:
+            from prometheus_client import generate_latest
+            return generate_latest().decode('utf-8') + extra_metrics
+        def mark_process_dead(self):
+            pass
+    prometheus_metrics = MockPrometheusMetrics()
 
 # Настройка улучшенного логирования
 logger = get_logger(__name__)
 
-# Инициализация Prometheus метрик
-try:
-    prometheus_metrics = PrometheusMetrics()
-except:
-    # Fallback для случаев когда prometheus_metrics недоступен
-    class MockPrometheusMetrics:
-        def record_http_request(self, *args, **kwargs):
-            pass
-        def record_ai_inference(self, *args, **kwargs):
-            pass
-        def record_error(self, *args, **kwargs):
-            pass
-    prometheus_metrics = MockPrometheusMetrics()
-
 # Lifespan context manager для инициализации
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -90,6 +80,61 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.log_error(e, {"service": "cache"})
     
+    # Фоновое обновление rollup-счетчиков для дашбордов
+    try:
+        from app.services.rollup_service import rollup_service
+        await rollup_service.start()
+        logger.info("✅ Rollup service started")
+    except Exception as e:
+        logger.log_error(e, {"service": "rollup"})
+    
+    # Фоновая низкоприоритетная очередь AI-анализа документов
+    try:
+        from app.services.background_analysis_service import background_analysis_service
+        await background_analysis_service.start()
+        logger.info("✅ Background analysis service started")
+    except Exception as e:
+        logger.log_error(e, {"service": "background_analysis"})
+    
+    # Доставка уведомлений во внешние каналы (email, Slack, Telegram, webhooks)
+    try:
+        from app.services.notification_delivery_service import notification_delivery_service
+        await notification_delivery_service.start()
+        logger.info("✅ Notification delivery service started")
+    except Exception as e:
+        logger.log_error(e, {"service": "notification_delivery"})
+    
+    # Пакетная запись участников и событий A/B-тестов
+    try:
+        from app.services.ab_testing_service import ab_testing_service
+        await ab_testing_service.start()
+        logger.info("✅ A/B testing writer started")
+    except Exception as e:
+        logger.log_error(e, {"service": "ab_testing"})
+    
+    # Доставка webhook-событий подписчикам
+    try:
+        from app.core.webhooks import webhook_manager
+        await webhook_manager.start()
+        logger.info("✅ Webhook delivery started")
+    except Exception as e:
+        logger.log_error(e, {"service": "webhook_delivery"})
+    
+    # Фоновые экспорты: возобновление задач, прерванных перезапуском
+    try:
+        from app.core.export import export_manager
+        await export_manager.start()
+        logger.info("✅ Export workers started")
+    except Exception as e:
+        logger.log_error(e, {"service": "export"})
+    
+    # Периодическая проверка алертов аналитики чата
+    try:
+        from app.core.analytics_engine import analytics_engine
+        await analytics_engine.start()
+    except Exception as e:
+        logger.log_error(e, {"service": "analytics_alerts"})
+    
     # Новая унифицированная система управления сервисами
     app.state.service_manager = service_manager
     app.state.unified_services = {
@@ -233,6 +278,74 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.log_error(e, {"service": "alert_evaluation", "phase": "shutdown"})
     
+    try:
+        from app.services.rollup_service import rollup_service
+        await rollup_service.stop()
+        logger.info("✅ Rollup service stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "rollup", "phase": "shutdown"})
+    
+    try:
+        from app.services.background_analysis_service import background_analysis_service
+        await background_analysis_service.stop()
+        logger.info("✅ Background analysis service stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "background_analysis", "phase": "shutdown"})
+    
+    try:
+        from app.services.notification_delivery_service import notification_delivery_service
+        await notification_delivery_service.stop()
+        logger.info("✅ Notification delivery service stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "notification_delivery", "phase": "shutdown"})
+    
+    try:
+        from app.services.ab_testing_service import ab_testing_service
+        await ab_testing_service.stop()
+        logger.info("✅ A/B testing writer stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "ab_testing", "phase": "shutdown"})
+    
+    try:
+        from app.core.webhooks import webhook_manager
+        await webhook_manager.stop()
+        logger.info("✅ Webhook delivery stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "webhook_delivery", "phase": "shutdown"})
+    
+    try:
+        from app.core.export import export_manager
+        await export_manager.stop()
+        logger.info("✅ Export workers stopped")
+    except Exception as e:
+        logger.log_error(e, {"service": "export", "phase": "shutdown"})
+    
+    try:
+        from app.core.analytics_engine import analytics_engine
+        await analytics_engine.stop()
+    except Exception as e:
+        logger.log_error(e, {"service": "analytics_alerts", "phase": "shutdown"})
+    
+    # Возврат неизрасходованных блоков квот в общие счетчики
+    try:
+        from app.core.subscription import subscription_manager
+        await asyncio.to_thread(subscription_manager.release_leases)
+    except Exception as e:
+        logger.log_error(e, {"service": "subscription_quotas", "phase": "shutdown"})
+    
+    # Выгрузка уже сохраненных трасс перед остановкой
+    try:
+        from app.core.jaeger_tracing import jaeger_tracing
+        await asyncio.to_thread(jaeger_tracing.close)
+    except Exception as e:
+        logger.log_error(e, {"service": "jaeger_tracing", "phase": "shutdown"})
+    
+    # Live-gauge этого воркера больше не должны попадать в общий /metrics
+    try:
+        prometheus_metrics.mark_process_dead()
+    except Exception as e:
+        logger.log_error(e, {"service": "prometheus_metrics", "phase": "shutdown"})
+    
     # Остановка оптимизаторов производительности (legacy)
     try:
         await performance_optimizer.stop_background_optimizations()
@@ -307,11 +420,12 @@ async def rate_limit_middleware(request: Request, call_next):
     client_ip = request.client.host if request.client else "unknown"
     path = str(request.url.path)
     
-    # Проверяем rate limit
-    if not enhanced_rate_limiter.is_allowed(
+    # Проверяем rate limit (одна проверка дает и данные для заголовков)
+    limit = await enhanced_rate_limiter.is_allowed(
         ip_address=client_ip,
         endpoint=path
-    ):
+    )
+    if not limit:
         # Логируем превышение лимита
         logger.log_security_event(
             event=SecurityEvent.RATE_LIMIT_EXCEEDED,
@@ -325,18 +439,15 @@ async def rate_limit_middleware(request: Request, call_next):
             content={
                 "error": "Rate limit exceeded",
                 "message": "Too many requests. Please try again later.",
-                "retry_after": enhanced_rate_limiter.get_reset_time(client_ip, path)
+                "retry_after": limit.reset_after
             }
         )
     
     response = await call_next(request)
     
     # Добавляем заголовки rate limiting
-    remaining = enhanced_rate_limiter.get_remaining_requests(client_ip, path)
-    reset_time = enhanced_rate_limiter.get_reset_time(client_ip, path)
-    
-    response.headers["X-RateLimit-Remaining"] = str(remaining)
-    response.headers["X-RateLimit-Reset"] = str(int(time.time() + reset_time))
+    response.headers["X-RateLimit-Remaining"] = str(limit.remaining)
+    response.headers["X-RateLimit-Reset"] = str(int(time.time() + limit.reset_after))
     
     return response
 
@@ -509,17 +620,15 @@ async def check_endpoint_readiness(endpoint_path: str):
 @app.get("/metrics")
 async def get_prometheus_metrics():
     """Prometheus метрики в формате exposition"""
-    from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+    from prometheus_client import CONTENT_TYPE_LATEST
     from fastapi import Response
     
     # Получаем метрики от унифицированной системы мониторинга
     unified_metrics = unified_monitoring_service.get_prometheus_metrics()
     
-    # Получаем legacy метрики
-    legacy_metrics = generate_latest()
-    
-    # Объединяем метрики
-    combined_metrics = unified_metrics + "\n" + legacy_metrics.decode('utf-8')
+    # Метрики приложения (всех воркеров в multiprocess-режиме) и системные метрики;
+    # строки унифицированной системы с теми же именами отбрасываются
+    combined_metrics = prometheus_metrics.render(unified_metrics)
     
     return Response(
         content=combined_metrics,
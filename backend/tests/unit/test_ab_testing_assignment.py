@@ -0,0 +1,113 @@
+"""
+Unit tests for A/B test assignment read-through and participant rollup
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+pytest.importorskip("scipy")
+
+from app.models import Base
+from app.models.ab_testing import ABTest, ABTestParticipant, ABTestStatus, ABTestVariant
+from app.services import ab_testing_service as ab_module
+from app.services.ab_testing_service import ABTestingService
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ab.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(ab_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _create_test(db, traffic_allocation=100.0, weights=(100.0, 0.0)):
+    test = ABTest(
+        name="checkout", status=ABTestStatus.RUNNING, traffic_allocation=traffic_allocation, created_by=1
+    )
+    db.add(test)
+    db.flush()
+    variants = [
+        ABTestVariant(test_id=test.id, name=f"v{index}", traffic_percentage=weight, is_control=index == 0)
+        for index, weight in enumerate(weights)
+    ]
+    db.add_all(variants)
+    db.commit()
+    return test, variants
+
+
+@pytest.mark.unit
+async def test_stored_assignment_wins_over_current_weights(db):
+    test, (control, treatment) = _create_test(db, traffic_allocation=0.0)
+    db.add(ABTestParticipant(test_id=test.id, variant_id=treatment.id, user_id=7, participant_key="u:7"))
+    db.commit()
+
+    service = ABTestingService()
+    participant = await service.assign_participant(db, test.id, user_id=7)
+
+    assert participant is not None
+    assert participant.variant_id == treatment.id
+    assert participant.id is not None
+    assert not service._pending_participants
+
+
+@pytest.mark.unit
+async def test_new_participant_is_hashed_once_and_buffered(db):
+    test, (control, treatment) = _create_test(db)
+    service = ABTestingService()
+
+    first = await service.assign_participant(db, test.id, user_id=8)
+    second = await service.assign_participant(db, test.id, user_id=8)
+
+    assert first.variant_id == second.variant_id == control.id
+    assert list(service._pending_participants) == [(test.id, "u:8")]
+
+
+@pytest.mark.unit
+async def test_flush_caches_the_stored_variant(db):
+    test, (control, treatment) = _create_test(db)
+    service = ABTestingService()
+    await service.assign_participant(db, test.id, user_id=9)
+    # Another worker stored a different variant first
+    db.add(ABTestParticipant(test_id=test.id, variant_id=treatment.id, user_id=9, participant_key="u:9"))
+    db.commit()
+
+    await service.flush_buffers()
+
+    assert service._known_participants[(test.id, "u:9")][1] == treatment.id
+
+
+@pytest.mark.unit
+def test_participant_rollup_waits_for_commit_lag(db):
+    test, (control, _) = _create_test(db)
+    old = datetime.utcnow() - timedelta(minutes=10)
+    rows = [
+        ABTestParticipant(test_id=test.id, variant_id=control.id, participant_key=f"s:{index}", assigned_at=assigned_at)
+        for index, assigned_at in enumerate([old, datetime.utcnow(), old])
+    ]
+    db.add_all(rows)
+    db.commit()
+
+    service = ABTestingService()
+    assert service.rollup()["participants"] == 1
+
+    # The lagging row becomes old enough; nothing after it was skipped
+    db.query(ABTestParticipant).filter(ABTestParticipant.id == rows[1].id).update({"assigned_at": old})
+    db.commit()
+    assert service.rollup()["participants"] == 2
+
+    db.refresh(control)
+    assert control.participants_count == 3
@@ -0,0 +1,142 @@
+"""
+Unit tests for the rolling analytics window: latency sketch, minute buckets, user LRU
+"""
+import pytest
+
+from app.core.analytics_engine import AnalyticsEngine, LatencySketch, QueryAnalytics
+
+# Start of a minute, so that offsets below land in predictable buckets
+NOW = 60 * 29_000_000.0
+
+
+def _query(timestamp: float, response_time: float = 0.5, quality_score: float = 0.8,
+           user_id: str = None, legal_field: str = "civil") -> QueryAnalytics:
+    return QueryAnalytics(
+        query_id="q",
+        user_id=user_id,
+        query_text="текст",
+        response_time=response_time,
+        quality_score=quality_score,
+        confidence=0.9,
+        legal_field=legal_field,
+        complexity="simple",
+        timestamp=timestamp
+    )
+
+
+@pytest.mark.unit
+class TestLatencySketch:
+    """Quantiles of the log-bucketed latency histogram."""
+
+    def test_quantiles_stay_within_relative_error(self):
+        sketch = LatencySketch()
+        for value in range(1, 101):
+            sketch.add(float(value))
+
+        error = (LatencySketch.GAMMA - 1) / 2
+        assert sketch.count == 100
+        assert sketch.quantile(0.5) == pytest.approx(50, rel=error)
+        assert sketch.quantile(0.95) == pytest.approx(95, rel=error)
+        assert sketch.quantile(0.99) == pytest.approx(99, rel=error)
+
+    def test_merge_equals_adding_all_values(self):
+        left, right, together = LatencySketch(), LatencySketch(), LatencySketch()
+        for value in (0.01, 0.2, 3.0):
+            left.add(value)
+            together.add(value)
+        for value in (0.0, 7.0):
+            right.add(value)
+            together.add(value)
+
+        left.merge(right)
+
+        assert left.bins == together.bins
+        assert left.count == 5
+        # Zero is clamped to MIN_VALUE instead of failing on log(0)
+        assert left.quantile(0) == pytest.approx(LatencySketch.MIN_VALUE, rel=0.05)
+
+    def test_empty_sketch_reports_zero(self):
+        assert LatencySketch().quantile(0.99) == 0.0
+
+
+@pytest.mark.unit
+class TestWindow:
+    """Minute buckets of the last-hour window."""
+
+    def test_window_sums_buckets_of_the_last_hour(self):
+        engine = AnalyticsEngine()
+        engine.record_query(_query(NOW - 30 * 60, response_time=2.0, quality_score=0.2))
+        engine.record_query(_query(NOW + 10, response_time=0.5))
+        engine.record_query(_query(NOW + 20, response_time=0.5))
+
+        window = engine._window(NOW + 30)
+        performance = engine.get_performance_metrics(window)
+        quality = engine.get_quality_metrics(window)
+
+        assert performance.total_requests == 3
+        assert performance.average_response_time == pytest.approx(1.0)
+        assert performance.cache_hit_rate == pytest.approx(2 / 3)
+        assert performance.error_rate == pytest.approx(1 / 3)
+        assert quality.validation_success_rate == pytest.approx(2 / 3)
+
+    def test_buckets_older_than_an_hour_leave_the_window(self):
+        engine = AnalyticsEngine()
+        engine.record_query(_query(NOW))
+        engine.record_query(_query(NOW + 59 * 60))
+
+        assert engine._window(NOW + 59 * 60).count == 2
+        assert engine._window(NOW + 60 * 60).count == 1
+        assert engine._window(NOW + 2 * 60 * 60).count == 0
+
+    def test_slot_is_reset_when_its_minute_comes_round_again(self):
+        engine = AnalyticsEngine()
+        engine.record_query(_query(NOW))
+        engine.record_query(_query(NOW + 5))
+
+        engine.record_query(_query(NOW + 60 * 60))
+
+        slot = engine.buckets[int(NOW // 60) % engine.WINDOW_MINUTES]
+        assert slot.minute == int(NOW // 60) + 60
+        assert slot.count == 1
+
+    def test_late_query_for_a_reused_slot_is_dropped(self):
+        engine = AnalyticsEngine()
+        engine.record_query(_query(NOW + 60 * 60))
+
+        engine.record_query(_query(NOW))
+
+        assert engine._window(NOW + 60 * 60).count == 1
+        assert engine._window(NOW).count == 0
+
+
+@pytest.mark.unit
+class TestUserStats:
+    """Bounded per-user statistics."""
+
+    def test_user_stats_accumulate(self):
+        engine = AnalyticsEngine()
+        engine.record_query(_query(NOW + 10, response_time=1.0, quality_score=0.6, user_id="u"))
+        engine.record_query(_query(NOW, response_time=3.0, quality_score=1.0, user_id="u", legal_field="labor"))
+        engine.record_query(_query(NOW + 20, user_id="u"))
+
+        analytics = engine.get_user_analytics("u")
+
+        assert analytics["total_queries"] == 3
+        assert analytics["average_response_time"] == pytest.approx(1.5)
+        assert analytics["top_legal_field"] == "civil"
+        assert analytics["first_query"] == NOW
+        assert analytics["last_query"] == NOW + 20
+        assert engine.get_user_analytics("missing") == {"error": "User not found"}
+
+    def test_least_recently_active_user_is_evicted(self):
+        engine = AnalyticsEngine()
+        engine.monitoring_config["max_tracked_users"] = 2
+        engine.record_query(_query(NOW, user_id="a"))
+        engine.record_query(_query(NOW, user_id="b"))
+        engine.record_query(_query(NOW, user_id="a"))
+
+        engine.record_query(_query(NOW, user_id="c"))
+
+        assert list(engine.user_sessions) == ["a", "c"]
+        assert engine.get_user_analytics("a")["total_queries"] == 2
+        assert engine.get_user_analytics("b") == {"error": "User not found"}
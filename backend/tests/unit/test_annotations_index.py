@@ -0,0 +1,119 @@
+"""
+Unit tests for indexed document annotations: span bins, term and tag lookups, soft delete
+"""
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from app.core import annotations as annotations_module
+from app.core.annotations import (
+    AnnotationManager, AnnotationType, TextRange, _BIN_TOP, _overlapping_bins, _span_bin
+)
+from app.models import Base
+from app.models.annotation import AnnotationTag, AnnotationTerm
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'annotations.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(annotations_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def manager(session_factory):
+    return AnnotationManager()
+
+
+def _annotate(manager, start, end, content="", text="", user_id=1, document_id="doc", tags=None, is_public=False):
+    return manager.create_annotation(
+        document_id=document_id,
+        user_id=user_id,
+        annotation_type=AnnotationType.COMMENT,
+        text_range=TextRange(start_offset=start, end_offset=end, start_line=1, end_line=1, text=text),
+        content=content,
+        tags=tags,
+        is_public=is_public
+    )
+
+
+@pytest.mark.unit
+class TestSpanBins:
+    """The bin grid used for range lookups."""
+
+    def test_range_is_stored_in_the_smallest_covering_bin(self):
+        assert _span_bin(0, 1023) == _span_bin(10, 20)
+        assert _span_bin(1000, 1100) != _span_bin(10, 20)
+        assert _span_bin(1000, 1100) == _span_bin(0, 8191)
+        assert _span_bin(0, 1 << 30) == _BIN_TOP
+
+    def test_query_bins_include_every_bin_a_match_can_live_in(self):
+        bins = set(_overlapping_bins(5000, 5100))
+
+        for start, end in [(5050, 5060), (4000, 6000), (0, 60000), (0, 1 << 30)]:
+            assert _span_bin(start, end) in bins
+        assert _span_bin(100, 200) not in bins
+
+    def test_very_wide_windows_skip_the_bin_filter(self):
+        assert _overlapping_bins(0, (1 << 28) - 1) is None
+
+
+@pytest.mark.unit
+class TestAnnotationLookups:
+    """Range, term and tag lookups against SQLite."""
+
+    def test_window_returns_overlapping_annotations(self, manager):
+        near = _annotate(manager, 5050, 5060)
+        wide = _annotate(manager, 100, 20000)
+        _annotate(manager, 100, 200)
+        _annotate(manager, 9000, 9100)
+        _annotate(manager, 5050, 5060, document_id="other")
+
+        found = manager.get_document_annotations("doc", start_offset=5000, end_offset=5100)
+
+        assert [annotation.id for annotation in found] == [wide.id, near.id]
+
+    def test_search_matches_word_prefixes_and_ranks_content_first(self, manager):
+        in_text = _annotate(manager, 0, 10, content="заметка", text="Договорная неустойка")
+        in_content = _annotate(manager, 20, 30, content="Договор аренды и неустойка")
+        _annotate(manager, 40, 50, content="договор купли")
+
+        found = manager.search_annotations("догов неуст")
+
+        assert [annotation.id for annotation in found] == [in_content.id, in_text.id]
+
+    def test_search_filters_by_tags_and_visibility(self, manager):
+        mine = _annotate(manager, 0, 10, content="срок", tags=["важно", "срок"])
+        public = _annotate(manager, 0, 10, content="срок", user_id=2, tags=["важно"], is_public=True)
+        _annotate(manager, 0, 10, content="срок", user_id=2, tags=["важно"])
+
+        found = manager.search_annotations("срок", user_id=1, tags=["важно"])
+
+        assert {annotation.id for annotation in found} == {mine.id, public.id}
+        assert [annotation.id for annotation in manager.search_annotations("", tags=["срок"])] == [mine.id]
+
+    def test_updating_tags_and_content_rebuilds_the_indexes(self, manager):
+        annotation = _annotate(manager, 0, 10, content="старый текст", tags=["черновик"])
+
+        assert manager.update_annotation(annotation.id, content="новый текст", tags=["готово"])
+
+        assert manager.search_annotations("старый") == []
+        assert [found.id for found in manager.search_annotations("новый", tags=["готово"])] == [annotation.id]
+        assert manager.search_annotations("", tags=["черновик"]) == []
+
+    def test_soft_delete_hides_the_annotation_and_drops_its_index_rows(self, manager, session_factory):
+        annotation = _annotate(manager, 0, 10, content="удалить", tags=["метка"])
+
+        assert not manager.delete_annotation(annotation.id, user_id=2)
+        assert manager.delete_annotation(annotation.id, user_id=1)
+
+        assert manager.get_document_annotations("doc") == []
+        assert manager.search_annotations("удалить") == []
+        assert manager.get_annotation(annotation.id).status.value == "deleted"
+        assert manager.get_annotation_stats(user_id=1)["total_annotations"] == 0
+        with session_factory() as db:
+            assert db.execute(select(AnnotationTerm).where(AnnotationTerm.annotation_id == annotation.id)).first() is None
+            assert db.execute(select(AnnotationTag).where(AnnotationTag.annotation_id == annotation.id)).first() is None
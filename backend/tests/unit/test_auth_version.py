@@ -0,0 +1,57 @@
+"""
+Unit tests for token revocation through User.auth_version
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+from app.models.user import User
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.fixture
+def user(db):
+    user = User(email="user@example.com", username="user", hashed_password="hash", is_active=True, is_admin=False)
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("field, value", [
+    ("hashed_password", "new-hash"),
+    ("is_active", False),
+    ("is_admin", True),
+    ("email", "renamed@example.com"),
+])
+def test_credential_changes_revoke_tokens(db, user, field, value):
+    version = user.auth_version or 0
+    setattr(user, field, value)
+    db.commit()
+
+    assert user.auth_version == version + 1
+
+
+@pytest.mark.unit
+def test_self_2fa_changes_keep_session(db, user):
+    version = user.auth_version or 0
+    user.two_factor_enabled = True
+    user.two_factor_secret = "SECRET"
+    db.commit()
+    user.two_factor_enabled = False
+    user.two_factor_secret = None
+    db.commit()
+
+    assert (user.auth_version or 0) == version
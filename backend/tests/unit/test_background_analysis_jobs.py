@@ -0,0 +1,136 @@
+"""
+Unit tests for the background analysis queue: leases, requeue and retry backoff
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+
+from app.models import Base
+from app.models.analysis_job import AnalysisJob, AnalysisJobStatus, AnalysisJobType
+from app.services import background_analysis_service as service_module
+from app.services.background_analysis_service import BackgroundAnalysisService
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'analysis.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(service_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def service(session_factory):
+    service = BackgroundAnalysisService()
+    service.lease_seconds = 60
+    service.max_attempts = 3
+    service.retry_delay = 30
+    service.retry_max_delay = 600
+    return service
+
+
+def _job(factory, job_id):
+    with factory() as db:
+        return db.get(AnalysisJob, job_id)
+
+
+def _set(factory, job_id, **values):
+    with factory() as db:
+        db.query(AnalysisJob).filter(AnalysisJob.id == job_id).update(values)
+        db.commit()
+
+
+def _enqueue(service):
+    return service.enqueue(AnalysisJobType.DOCUMENT_ANALYSIS, {"text": "текст"})
+
+
+@pytest.mark.unit
+async def test_completed_job_releases_lease(service, session_factory):
+    job_id = _enqueue(service)
+
+    async def handler(payload):
+        return {"legal_concepts": ["договор"]}
+
+    service._handlers[AnalysisJobType.DOCUMENT_ANALYSIS] = handler
+    job = service._claim_next_job()
+    assert _job(session_factory, job_id).heartbeat_at == job["claimed_at"]
+
+    await service._run_job(job)
+
+    stored = _job(session_factory, job_id)
+    assert stored.status == AnalysisJobStatus.COMPLETED
+    assert stored.heartbeat_at is None
+    assert stored.result == {"legal_concepts": ["договор"]}
+
+
+@pytest.mark.unit
+def test_requeue_leaves_jobs_with_fresh_heartbeat(service, session_factory):
+    live_id = _enqueue(service)
+    service._claim_next_job()
+    stale_id = service.enqueue(AnalysisJobType.DOCUMENT_VALIDATION, {"text": "другой"})
+    service._claim_next_job()
+    _set(session_factory, stale_id, heartbeat_at=datetime.utcnow() - timedelta(seconds=120))
+
+    assert service._requeue_interrupted_jobs() == 1
+
+    assert _job(session_factory, live_id).status == AnalysisJobStatus.RUNNING
+    stale = _job(session_factory, stale_id)
+    assert stale.status == AnalysisJobStatus.PENDING
+    assert stale.heartbeat_at is None
+
+
+@pytest.mark.unit
+async def test_failed_job_waits_for_backoff_before_retry(service, session_factory):
+    job_id = _enqueue(service)
+
+    async def handler(payload):
+        raise RuntimeError("model unavailable")
+
+    service._handlers[AnalysisJobType.DOCUMENT_ANALYSIS] = handler
+    await service._run_job(service._claim_next_job())
+
+    stored = _job(session_factory, job_id)
+    assert stored.status == AnalysisJobStatus.PENDING
+    assert stored.error == "model unavailable"
+    delay = (stored.next_attempt_at - datetime.utcnow()).total_seconds()
+    assert 20 < delay <= 36
+    assert service._claim_next_job() is None
+
+    _set(session_factory, job_id, next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+    retry = service._claim_next_job()
+    assert retry["id"] == job_id
+    assert retry["attempts"] == 2
+
+
+@pytest.mark.unit
+def test_backoff_grows_and_is_capped(service):
+    assert 24 <= service._backoff(1) <= 36
+    assert 48 <= service._backoff(2) <= 72
+    assert service._backoff(10) <= 720
+
+
+@pytest.mark.unit
+async def test_result_is_dropped_after_lease_is_taken_over(service, session_factory):
+    job_id = _enqueue(service)
+    job = service._claim_next_job()
+    taken_over_at = job["claimed_at"] + timedelta(seconds=5)
+
+    async def handler(payload):
+        # Another worker requeued the job and claimed it while this one was running
+        _set(session_factory, job_id, started_at=taken_over_at)
+        return {"legal_concepts": []}
+
+    service._handlers[AnalysisJobType.DOCUMENT_ANALYSIS] = handler
+    await service._run_job(job)
+
+    stored = _job(session_factory, job_id)
+    assert stored.status == AnalysisJobStatus.RUNNING
+    assert stored.started_at == taken_over_at
+    assert not service._heartbeat(job_id, job["claimed_at"])
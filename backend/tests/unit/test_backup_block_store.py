@@ -0,0 +1,260 @@
+"""
+Unit tests for the deduplicating block store and incremental backup retention
+"""
+import os
+import time
+
+import pytest
+
+from app.services.backup_block_store import IncrementalBackupEngine, INDEX_FILENAME
+
+
+def _write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _age_blocks(engine, seconds: int = 7200):
+    """Блоки старше grace-периода сборщика мусора"""
+    past = time.time() - seconds
+    for _, path in engine.store.iter_digests():
+        os.utime(path, (past, past))
+
+
+def _backup(engine, source, backup_dir):
+    os.makedirs(backup_dir, exist_ok=True)
+    return engine.backup([("uploads", str(source), None)], os.path.join(backup_dir, INDEX_FILENAME))
+
+
+def _block_count(engine) -> int:
+    return sum(1 for _ in engine.store.iter_digests())
+
+
+@pytest.mark.unit
+class TestIncrementalBackupEngine:
+    """Backups store each block once and restore byte-identical files."""
+
+    def test_unchanged_data_is_not_stored_twice(self, tmp_path):
+        engine = IncrementalBackupEngine(str(tmp_path / "store"), workers=2)
+        source = tmp_path / "uploads"
+        _write(str(source / "a.bin"), os.urandom(200_000))
+        _write(str(source / "b.bin"), os.urandom(50_000))
+
+        first = _backup(engine, source, str(tmp_path / "b1"))
+        second = _backup(engine, source, str(tmp_path / "b2"))
+
+        assert first["stored_bytes"] > 0
+        assert second["stored_bytes"] == 0
+        assert second["new_blocks"] == 0
+
+        restore_dir = tmp_path / "restored"
+        engine.restore(str(tmp_path / "b2" / INDEX_FILENAME), {"uploads": str(restore_dir)})
+        assert (restore_dir / "a.bin").read_bytes() == (source / "a.bin").read_bytes()
+
+    def test_garbage_collection_keeps_live_blocks(self, tmp_path):
+        engine = IncrementalBackupEngine(str(tmp_path / "store"), workers=2)
+        source = tmp_path / "uploads"
+        _write(str(source / "a.bin"), os.urandom(100_000))
+        _backup(engine, source, str(tmp_path / "b1"))
+
+        _write(str(source / "a.bin"), os.urandom(100_000))
+        _backup(engine, source, str(tmp_path / "b2"))
+        _age_blocks(engine)
+
+        result = engine.collect_garbage([str(tmp_path / "b2" / INDEX_FILENAME)])
+
+        assert result["blocks_removed"] > 0
+        assert engine.verify(str(tmp_path / "b2" / INDEX_FILENAME))["errors"] == []
+
+
+@pytest.mark.unit
+class TestIncrementalBackupRetention:
+    """Old incremental backups are pruned and their blocks are freed."""
+
+    async def test_cleanup_prunes_incremental_backups(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("BACKUP_DIR", str(tmp_path / "backups"))
+        monkeypatch.setenv("MAX_BACKUPS", "2")
+        from app.services.backup_service import EnhancedBackupService
+
+        service = EnhancedBackupService()
+        engine = service.block_engine
+        source = tmp_path / "uploads"
+        names = ["backup_1_20261015_010000", "backup_2_20261016_010000", "backup_3_20261017_010000"]
+        for name in names:
+            _write(str(source / "data.bin"), os.urandom(100_000))
+            _backup(engine, source, os.path.join(service.backup_dir, name))
+        _age_blocks(engine)
+        blocks_before = _block_count(engine)
+
+        await service._cleanup_old_backups()
+
+        remaining = sorted(item for item in os.listdir(service.backup_dir) if item.startswith("backup_"))
+        assert remaining == names[1:]
+        assert _block_count(engine) < blocks_before
+        for name in remaining:
+            assert engine.verify(os.path.join(service.backup_dir, name, INDEX_FILENAME))["errors"] == []
+
+
+@pytest.mark.unit
+class TestEncryptedIncrementalBackups:
+    """Encrypted backups keep their blocks unreadable without the key."""
+
+    def test_encrypted_blocks_do_not_contain_plaintext(self, tmp_path):
+        engine = IncrementalBackupEngine(str(tmp_path / "store"), workers=2, encryption_key="secret")
+        secret = b"DATABASE_PASSWORD=hunter2\n" * 2000
+        source = tmp_path / "config"
+        _write(str(source / ".env"), secret)
+        os.makedirs(tmp_path / "b1")
+        index = str(tmp_path / "b1" / INDEX_FILENAME)
+
+        engine.backup([("config", str(source), None)], index, encrypted=True)
+
+        assert _block_count(engine) == 0  # Nothing went to the plaintext store
+        for _, path in engine.encrypted_store.iter_digests():
+            with open(path, "rb") as f:
+                assert b"hunter2" not in f.read()
+        assert engine.verify(index)["errors"] == []
+
+        restore_dir = tmp_path / "restored"
+        engine.restore(index, {"config": str(restore_dir)})
+        assert (restore_dir / ".env").read_bytes() == secret
+
+        other = IncrementalBackupEngine(str(tmp_path / "store"), workers=1)
+        assert other.verify(index)["errors"]
+
+    async def test_service_records_the_real_encryption_flag(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("BACKUP_DIR", str(tmp_path / "backups"))
+        monkeypatch.delenv("BACKUP_ENCRYPTION_KEY", raising=False)
+        monkeypatch.chdir(tmp_path)
+        _write(str(tmp_path / "backend" / "uploads" / "a.txt"), b"data")
+        from app.services.backup_service import EnhancedBackupService
+
+        service = EnhancedBackupService()
+        result = await service._perform_incremental_backup(1, ["uploads"], encryption_enabled=True)
+
+        assert result["success"]
+        assert result["encryption_enabled"] is False
+        assert result["compression_enabled"] is True
+        assert any("encryption" in warning for warning in result["warnings"])
+
+
+@pytest.mark.unit
+def test_garbage_collection_lists_indexes_under_the_store_lock(tmp_path):
+    engine = IncrementalBackupEngine(str(tmp_path / "store"), workers=1)
+    seen = []
+
+    def live_indexes():
+        # A backup holding the lock could not finish while the list is read
+        seen.append(engine._lock.locked())
+        return []
+
+    engine.collect_garbage(live_indexes)
+
+    assert seen == [True]
+
+
+class _FakeProcess:
+    def __init__(self, returncode, stderr=b""):
+        self.returncode = returncode
+        self._stderr = stderr
+
+    async def communicate(self):
+        return b"", self._stderr
+
+
+@pytest.mark.unit
+class TestIncrementalPostgresRestore:
+    """A PostgreSQL main_db is replayed through psql, not skipped."""
+
+    async def _service_with_dump(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("BACKUP_DIR", str(tmp_path / "backups"))
+        from app.services import backup_service as module
+
+        monkeypatch.setattr(module.settings, "DATABASE_URL", "postgresql+psycopg2://app@db/advakod")
+        service = module.EnhancedBackupService()
+        dump = tmp_path / "main_database.sql"
+        dump.write_bytes(b"DROP TABLE users; CREATE TABLE users (id int);\n")
+        backup_dir = tmp_path / "backups" / "backup_1_20261018_010000"
+        os.makedirs(backup_dir)
+        service.block_engine.backup(
+            [("main_db", str(dump), "main_database.sql")], str(backup_dir / INDEX_FILENAME)
+        )
+        return module, service, str(backup_dir)
+
+    async def test_dump_is_applied_with_psql(self, tmp_path, monkeypatch):
+        module, service, backup_dir = await self._service_with_dump(tmp_path, monkeypatch)
+        calls = []
+
+        async def fake_exec(*cmd, **kwargs):
+            dump_path = cmd[cmd.index("-f") + 1]
+            with open(dump_path, "rb") as f:
+                calls.append((cmd, f.read()))
+            return _FakeProcess(0)
+
+        monkeypatch.setattr(module.asyncio, "create_subprocess_exec", fake_exec)
+        result = await service.restore_backup(backup_dir)
+
+        assert result == {"status": "success", "restored": ["main_database"]}
+        (cmd, data), = calls
+        assert cmd[0] == "psql"
+        assert cmd[-1] == "postgresql://app@db/advakod"
+        assert data.startswith(b"DROP TABLE users")
+        assert os.listdir(os.path.join(service.backup_dir, "temp")) == []
+
+    async def test_psql_failure_fails_the_restore(self, tmp_path, monkeypatch):
+        module, service, backup_dir = await self._service_with_dump(tmp_path, monkeypatch)
+
+        async def fake_exec(*cmd, **kwargs):
+            return _FakeProcess(3, b"ERROR: permission denied")
+
+        monkeypatch.setattr(module.asyncio, "create_subprocess_exec", fake_exec)
+        result = await service.restore_backup(backup_dir)
+
+        assert result["status"] == "error"
+        assert "permission denied" in result["error"]
+
+
+@pytest.mark.unit
+async def test_schedule_runs_incremental_backup_and_updates_stats(tmp_path, monkeypatch):
+    monkeypatch.setenv("BACKUP_DIR", str(tmp_path / "backups"))
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.models.backup import BackupSchedule, BackupType
+    from app.services import backup_service as module
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'schedules.db'}")
+    BackupSchedule.__table__.create(engine)
+    Session = sessionmaker(bind=engine)
+
+    def get_db():
+        yield Session()
+
+    monkeypatch.setattr(module, "get_db", get_db)
+    db = Session()
+    db.add(BackupSchedule(
+        name="nightly", cron_expression="0 2 * * *", backup_components=["main_db"], incremental=True
+    ))
+    db.commit()
+    schedule = db.query(BackupSchedule).one()
+    db.close()
+
+    service = module.EnhancedBackupService()
+    calls = []
+
+    async def fake_create(**kwargs):
+        calls.append(kwargs)
+        return {"success": True}
+
+    monkeypatch.setattr(service, "create_backup_with_record", fake_create)
+    await service.run_scheduled_backup(schedule)
+
+    (call,) = calls
+    assert call["incremental"] is True
+    assert call["backup_type"] == BackupType.SCHEDULED
+    assert call["components"] == ["main_db"]
+    db = Session()
+    stored = db.query(BackupSchedule).one()
+    assert (stored.total_runs, stored.successful_runs, stored.last_run_status) == (1, 1, "completed")
+    assert stored.next_run_at is not None
+    db.close()
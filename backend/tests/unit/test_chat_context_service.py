@@ -0,0 +1,126 @@
+"""
+Unit tests for token-budgeted chat context assembly
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+pytest.importorskip("llama_cpp")
+
+from app.core.config import settings
+from app.models import Base
+from app.models.chat import ChatSession, ChatMessage
+from app.services.chat_context_service import ChatContextService
+
+
+class FakeLLM:
+    """One token per whitespace-separated word"""
+
+    def count_tokens(self, text):
+        return len(text.split())
+
+    def has_tokenizer(self):
+        return True
+
+    def is_model_ready(self):
+        return False
+
+    def create_legal_prompt(self, question, context=None):
+        return f"{context or ''}\nВопрос: {question}\nОтвет:"
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.fixture
+def chat(db):
+    session = ChatSession(user_id=1, title="test")
+    db.add(session)
+    db.commit()
+    return session
+
+
+def _add_messages(db, chat, count, words=3):
+    messages = []
+    for index in range(count):
+        message = ChatMessage(
+            session_id=chat.id,
+            role="user" if index % 2 == 0 else "assistant",
+            content=" ".join([f"m{index}"] * words)
+        )
+        db.add(message)
+        db.commit()
+        messages.append(message)
+    return messages
+
+
+@pytest.mark.unit
+def test_short_history_fits_without_drops(db, chat):
+    messages = _add_messages(db, chat, 4)
+    context = ChatContextService(llm_service=FakeLLM()).build_prompt(db, chat, "вопрос", max_tokens=256)
+
+    assert context.history_messages == 4
+    assert context.dropped_until_message_id is None
+    assert context.prompt_tokens <= context.budget
+    assert context.prompt.index(messages[0].content) < context.prompt.index(messages[-1].content)
+
+
+@pytest.mark.unit
+def test_message_count_limit_marks_older_messages_for_summary(db, chat, monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_CONTEXT_MAX_MESSAGES", 3)
+    messages = _add_messages(db, chat, 6)
+    context = ChatContextService(llm_service=FakeLLM()).build_prompt(db, chat, "вопрос", max_tokens=256)
+
+    assert context.history_messages == 3
+    # Message just before the oldest kept one
+    assert context.dropped_until_message_id == messages[2].id
+
+
+@pytest.mark.unit
+def test_count_limit_respects_existing_summary(db, chat, monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_CONTEXT_MAX_MESSAGES", 3)
+    messages = _add_messages(db, chat, 5)
+    chat.context_summary = "ранее обсуждали договор"
+    chat.summary_message_id = messages[1].id
+    db.commit()
+
+    context = ChatContextService(llm_service=FakeLLM()).build_prompt(db, chat, "вопрос", max_tokens=256)
+
+    assert context.history_messages == 3
+    assert context.summary_used
+    assert context.dropped_until_message_id is None
+
+
+@pytest.mark.unit
+def test_token_budget_drops_oldest_messages(db, chat, monkeypatch):
+    monkeypatch.setattr(settings, "VISTRAL_N_CTX", 400)
+    monkeypatch.setattr(settings, "VISTRAL_TOKEN_MARGIN", 0)
+    monkeypatch.setattr(settings, "CHAT_CONTEXT_RESPONSE_RESERVE", 100)
+    messages = _add_messages(db, chat, 10, words=60)
+    context = ChatContextService(llm_service=FakeLLM()).build_prompt(db, chat, "вопрос", max_tokens=100)
+
+    assert context.prompt_tokens <= context.budget
+    assert 0 < context.history_messages < 10
+    kept_oldest = messages[10 - context.history_messages]
+    assert context.dropped_until_message_id == messages[10 - context.history_messages - 1].id
+    assert kept_oldest.content in context.prompt
+
+
+@pytest.mark.unit
+def test_excluded_message_not_in_history(db, chat):
+    messages = _add_messages(db, chat, 3)
+    context = ChatContextService(llm_service=FakeLLM()).build_prompt(
+        db, chat, "вопрос", max_tokens=256, exclude_message_id=messages[-1].id
+    )
+
+    assert context.history_messages == 2
+    assert messages[-1].content not in context.prompt
@@ -0,0 +1,152 @@
+"""
+Unit tests for SQL cohort retention and its incremental cache
+"""
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+from app.models.chat import ChatMessage, ChatSession
+from app.models.user import User
+from app.services.cohort_analysis_service import CohortAnalysisService
+
+
+START = datetime(2025, 1, 1)
+END = datetime(2025, 6, 30)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.fixture
+def service():
+    return CohortAnalysisService()
+
+
+def _user(db, name, created_at):
+    user = User(email=f"{name}@example.com", username=name, hashed_password="x", created_at=created_at)
+    db.add(user)
+    db.flush()
+    session = ChatSession(user_id=user.id, created_at=created_at)
+    db.add(session)
+    db.commit()
+    return session.id
+
+
+def _messages(db, session_id, *created_at, role="user"):
+    for moment in created_at:
+        db.add(ChatMessage(session_id=session_id, role=role, content="вопрос", created_at=moment))
+    db.commit()
+
+
+@pytest.fixture
+def activity(db):
+    first = _user(db, "first", datetime(2025, 1, 5))
+    second = _user(db, "second", datetime(2025, 1, 20))
+    third = _user(db, "third", datetime(2025, 2, 10))
+    late = _user(db, "late", datetime(2025, 1, 25))
+    _messages(db, first, datetime(2025, 1, 6), datetime(2025, 2, 3), datetime(2025, 2, 20))
+    _messages(db, second, datetime(2025, 1, 21))
+    # Assistant replies are not user activity
+    _messages(db, second, datetime(2025, 2, 2), role="assistant")
+    _messages(db, third, datetime(2025, 2, 11), datetime(2025, 3, 1))
+    _messages(db, late, datetime(2025, 2, 15))
+    return {"first": first, "second": second, "third": third, "late": late}
+
+
+@pytest.mark.unit
+class TestRetentionMatrix:
+    """Retention computed from grouped SQL counts."""
+
+    async def test_registration_cohorts_count_distinct_active_users(self, db, service, activity):
+        result = await service._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+
+        assert result["cohorts"] == ["2025-01", "2025-02"]
+        assert result["cohort_sizes"] == [3, 1]
+        assert result["retention_matrix"][0][:3] == [66.7, 66.7, 0.0]
+        assert result["retention_matrix"][1][:3] == [100.0, 100.0, 0.0]
+        assert result["summary"] == {"total_users": 4, "total_cohorts": 2, "avg_retention": 83.3}
+
+    async def test_first_query_cohorts_start_at_the_first_user_message(self, db, service, activity):
+        result = await service._calculate_activity_cohorts(db, "first_query", "monthly", START, END)
+
+        assert result["cohorts"] == ["2025-01", "2025-02"]
+        assert result["cohort_sizes"] == [2, 2]
+        assert result["retention_matrix"][0][:2] == [100.0, 50.0]
+        assert result["retention_matrix"][1][:2] == [100.0, 50.0]
+
+    async def test_empty_range_returns_empty_result(self, db, service, activity):
+        result = await service._calculate_activity_cohorts(
+            db, "registration", "monthly", datetime(2024, 1, 1), datetime(2024, 6, 30)
+        )
+
+        assert result["cohorts"] == []
+        assert result["summary"]["total_users"] == 0
+
+    def test_sqlite_weekly_periods_start_on_monday(self, db, service):
+        session_id = _user(db, "weekly", datetime(2025, 3, 1))
+        days = [datetime(2025, 3, 3) + timedelta(days=offset, hours=15) for offset in range(7)]
+        _messages(db, session_id, *days)
+
+        period = service._period_expr(db, ChatMessage.created_at, "weekly")
+        starts = {service._to_period_date(value) for (value,) in db.query(period).all()}
+
+        assert starts == {date(2025, 3, 3)}
+        assert all(service._floor_period(day.date(), "weekly") == date(2025, 3, 3) for day in days)
+
+
+@pytest.mark.unit
+class TestRetentionCache:
+    """Cached counts keyed by the user and message id watermark."""
+
+    def test_unchanged_watermark_reuses_cached_counts(self, db, service, activity, monkeypatch):
+        first = service._get_retention_state(db, "registration", "monthly", START, END)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("counts were recomputed")
+
+        monkeypatch.setattr(service, "_query_retention_counts", fail)
+        monkeypatch.setattr(service, "_query_cohort_sizes", fail)
+
+        assert service._get_retention_state(db, "registration", "monthly", START, END) is first
+
+    async def test_new_rows_recompute_only_later_periods(self, db, service, activity, monkeypatch):
+        await service._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+        _messages(db, activity["second"], datetime(2025, 3, 10))
+
+        calls = []
+        query_counts = service._query_retention_counts
+
+        def spy(*args, activity_since=None):
+            calls.append(activity_since)
+            return query_counts(*args, activity_since=activity_since)
+
+        monkeypatch.setattr(service, "_query_retention_counts", spy)
+        result = await service._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+
+        assert calls == [datetime(2025, 3, 1)]
+        assert result["retention_matrix"][0][:3] == [66.7, 66.7, 33.3]
+        assert result["retention_matrix"][1][:3] == [100.0, 100.0, 0.0]
+
+    async def test_incremental_result_matches_full_recomputation(self, db, service, activity):
+        await service._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+        newcomer = _user(db, "newcomer", datetime(2025, 2, 25))
+        _messages(db, newcomer, datetime(2025, 2, 26), datetime(2025, 4, 2))
+        _messages(db, activity["first"], datetime(2025, 2, 28))
+
+        incremental = await service._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+        full = await CohortAnalysisService()._calculate_activity_cohorts(db, "registration", "monthly", START, END)
+
+        assert incremental == full
+        assert incremental["cohort_sizes"] == [3, 2]
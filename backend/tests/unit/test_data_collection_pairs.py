@@ -0,0 +1,134 @@
+"""
+Unit tests for chat pair extraction and batch scoring in DataCollectionService
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+from app.models.chat import ChatMessage, ChatSession
+from app.models.training_data import DataCollectionLog, TrainingData
+from app.services import data_collection_service as service_module
+from app.services.data_collection_service import DataCollectionService
+
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+QUESTION = "Как расторгнуть договор аренды квартиры?"
+ANSWER = "Договор аренды расторгается судом по требованию одной из сторон."
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.fixture
+def service(db):
+    return DataCollectionService(db)
+
+
+def _chat(db, *messages, created_at=NOW, user_id=1):
+    """Session with messages given as (role, content), one second apart"""
+    session = ChatSession(user_id=user_id, created_at=created_at)
+    db.add(session)
+    db.flush()
+    for offset, (role, content) in enumerate(messages):
+        db.add(ChatMessage(
+            session_id=session.id,
+            role=role,
+            content=content,
+            created_at=created_at + timedelta(seconds=offset)
+        ))
+    db.commit()
+    return session.id
+
+
+@pytest.mark.unit
+class TestChatPairs:
+    """User -> assistant pairs from the LEAD() window query."""
+
+    def test_only_direct_user_to_assistant_transitions_are_paired(self, db, service):
+        first = _chat(db, ("user", "вопрос 1"), ("assistant", "ответ 1"), ("user", "вопрос 2"),
+                      ("user", "вопрос 3"), ("assistant", "ответ 3"), ("user", "без ответа"))
+        # The next session's assistant message must not pair with the previous session's last question
+        second = _chat(db, ("assistant", "приветствие"), ("user", "вопрос 4"), ("system", "служебное"),
+                       created_at=NOW + timedelta(minutes=1))
+
+        pairs = service._get_chat_pairs(NOW - timedelta(days=1), limit=100)
+
+        assert [(pair.session_id, pair.instruction, pair.output) for pair in pairs] == [
+            (first, "вопрос 3", "ответ 3"),
+            (first, "вопрос 1", "ответ 1"),
+        ]
+        assert second not in {pair.session_id for pair in pairs}
+
+    def test_old_sessions_are_skipped_and_limit_keeps_the_newest(self, db, service):
+        _chat(db, ("user", "старый"), ("assistant", "ответ"), created_at=NOW - timedelta(days=40))
+        for index in range(3):
+            _chat(db, ("user", f"вопрос {index}"), ("assistant", "ответ"), created_at=NOW + timedelta(minutes=index))
+
+        pairs = service._get_chat_pairs(NOW - timedelta(days=30), limit=2)
+
+        assert [pair.instruction for pair in pairs] == ["вопрос 2", "вопрос 1"]
+
+    def test_pairs_are_streamed_in_batches(self, db, service, monkeypatch):
+        monkeypatch.setattr(service_module, "PAIR_BATCH_SIZE", 2)
+        for index in range(5):
+            _chat(db, ("user", f"вопрос {index}"), ("assistant", "ответ"), created_at=NOW + timedelta(minutes=index))
+
+        batches = list(service._iter_chat_pair_batches(NOW - timedelta(days=1), limit=100))
+
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+@pytest.mark.unit
+class TestBatchScoring:
+    """Vectorized quality and complexity rules."""
+
+    def test_quality_score_adds_up_the_rules(self, service):
+        # Length 64 -> 2.0, terms "договор" and "суд" -> 0.6, question length -> 1.0, varied question -> 0.5
+        scores = service._evaluate_quality_batch([QUESTION, "?"], [ANSWER, ""])
+
+        assert scores == [4.1, 1.0]
+        assert service._evaluate_quality_auto(QUESTION, ANSWER + " См. ст. 619 ГК РФ.") == 5.0
+
+    def test_complexity_categories(self, service):
+        complexities = service._categorize_complexity_batch(
+            [QUESTION, "Спорный вопрос о наследстве", QUESTION, "Спорный вопрос о наследстве"],
+            [ANSWER * 2, "Коротко.", "Коротко.", ANSWER * 2]
+        )
+
+        # The simple rule is checked first, as in the per-item version
+        assert complexities == ["simple", "complex", "medium", "simple"]
+
+
+@pytest.mark.unit
+class TestCollectChatData:
+    """End-to-end collection with deduplication."""
+
+    def test_duplicates_and_existing_pairs_are_skipped(self, db, service):
+        db.add(TrainingData(instruction="уже есть", output="ответ", source="manual"))
+        db.commit()
+        _chat(db, ("user", QUESTION), ("assistant", ANSWER * 2))
+        _chat(db, ("user", QUESTION), ("assistant", ANSWER * 2), created_at=NOW + timedelta(minutes=1))
+        _chat(db, ("user", "уже есть"), ("assistant", "ответ"), created_at=NOW + timedelta(minutes=2))
+        _chat(db, ("user", "уже есть"), ("assistant", "другой ответ"), created_at=NOW + timedelta(minutes=3))
+
+        stats = service.collect_chat_data(limit=100, days_back=1)
+
+        assert stats["total_found"] == 4
+        assert stats["total_processed"] == 2
+        assert stats["total_approved"] == 1
+        collected = db.query(TrainingData).filter(TrainingData.source == "chat").all()
+        assert sorted(item.output for item in collected) == sorted([ANSWER * 2, "другой ответ"])
+        assert db.get(DataCollectionLog, stats["collection_id"]).total_processed == 2
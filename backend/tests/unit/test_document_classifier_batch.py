@@ -0,0 +1,184 @@
+"""
+Unit tests for batch document classification: header rules, content-hash cache, packed prompts
+"""
+import json
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+pytest.importorskip("chromadb")
+
+from app.services import ai_document_classifier as classifier_module
+from app.services.ai_document_classifier import AIDocumentClassifier
+
+
+class FakeCache:
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ttl=None):
+        self.data[key] = value
+        return True
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = FakeCache()
+    monkeypatch.setattr(classifier_module, "cache_service", cache)
+    return cache
+
+
+@pytest.fixture
+def classifier(cache):
+    classifier = AIDocumentClassifier()
+    classifier.batch_size = 3
+    classifier.concurrency = 2
+    classifier.prompts = []
+    classifier.responses = []
+
+    async def generate(prompt, max_tokens, priority):
+        classifier.prompts.append(prompt)
+        return classifier.responses.pop(0)
+
+    classifier._generate = generate
+    return classifier
+
+
+def _doc(text, file_name="", document_id=""):
+    return {"text": text, "file_name": file_name, "document_id": document_id}
+
+
+def _answer(*types):
+    return json.dumps([
+        {"id": number, "type": doc_type, "confidence": 0.8, "reason": "тест"}
+        for number, doc_type in enumerate(types, 1)
+    ])
+
+
+@pytest.mark.unit
+class TestHeaderRules:
+    """Confident classification without the model."""
+
+    @pytest.mark.parametrize("header, expected", [
+        ("ФЕДЕРАЛЬНЫЙ ЗАКОН\nО защите прав потребителей", "federal_law"),
+        ("УКАЗ ПРЕЗИДЕНТА РОССИЙСКОЙ ФЕДЕРАЦИИ\nО мерах", "decree"),
+        ("ПОСТАНОВЛЕНИЕ ПЛЕНУМА ВЕРХОВНОГО СУДА РФ", "supreme_court_resolution"),
+        ("МИНИСТЕРСТВО ФИНАНСОВ\nПРИКАЗ\nот 1 марта", "order"),
+    ])
+    def test_unambiguous_header_names_the_type(self, classifier, header, expected):
+        result = classifier._classify_by_rules(header + "\nТекст документа.", "", "")
+
+        assert result["type"] == expected
+        assert result["method"] == "rule"
+
+    def test_codex_file_name_wins(self, classifier):
+        assert classifier._classify_by_rules("Статья 1", "Гражданский кодекс.pdf", "")["type"] == "codex"
+
+    def test_ambiguous_or_late_headers_go_to_the_model(self, classifier):
+        mixed = "Сборник актов\nФЕДЕРАЛЬНЫЙ ЗАКОН о связи\nУКАЗ ПРЕЗИДЕНТА о мерах"
+        late = "Пояснительная записка. " * 40 + "ФЕДЕРАЛЬНЫЙ ЗАКОН"
+
+        assert classifier._classify_by_rules(mixed, "", "") is None
+        assert classifier._classify_by_rules(late, "", "") is None
+
+
+@pytest.mark.unit
+class TestClassifyBatch:
+    """Rules, deduplication, cache and packed prompts together."""
+
+    async def test_only_ambiguous_unique_texts_reach_the_model(self, classifier):
+        classifier.responses = [_answer("resolution", "order")]
+        documents = [
+            _doc("ФЕДЕРАЛЬНЫЙ ЗАКОН\nО связи"),
+            _doc("Документ А без шапки"),
+            _doc("Документ Б без шапки"),
+            _doc("Документ А без шапки", file_name="copy.txt"),
+        ]
+
+        results = await classifier.classify_batch(documents)
+
+        assert [result["type"] for result in results] == ["federal_law", "resolution", "order", "resolution"]
+        assert [result["method"] for result in results] == ["rule", "ai_batch", "ai_batch", "ai_batch"]
+        assert len(classifier.prompts) == 1
+        assert "### Документ 2\nДокумент Б без шапки" in classifier.prompts[0]
+        assert classifier.stats["llm_documents"] == 2
+
+    async def test_results_are_cached_by_text_hash(self, classifier, cache):
+        classifier.responses = [_answer("resolution", "order")]
+        documents = [_doc("Документ А"), _doc("Документ Б")]
+        await classifier.classify_batch(documents)
+
+        # A fresh classifier has an empty local LRU and reads the shared cache
+        again = AIDocumentClassifier()
+        again._generate = classifier._generate
+        results = await again.classify_batch(documents + [_doc("  Документ А  ")])
+
+        assert [result["type"] for result in results] == ["resolution", "order", "resolution"]
+        assert len(classifier.prompts) == 1
+        assert again.stats["cache"] == 2
+        assert len(cache.data) == 2
+
+    async def test_documents_are_split_into_chunks_of_batch_size(self, classifier):
+        classifier.responses = [_answer("order", "order", "order"), _answer("decree", "decree")]
+
+        results = await classifier.classify_batch([_doc(f"Документ {index}") for index in range(5)])
+
+        assert [result["type"] for result in results] == ["order"] * 3 + ["decree"] * 2
+        assert classifier.stats["llm_requests"] == 2
+
+    async def test_documents_missing_from_the_answer_get_single_prompts(self, classifier):
+        single = json.dumps({"type": "decree", "confidence": 0.9, "reason": "указ"})
+        classifier.responses = [_answer("order"), single]
+
+        results = await classifier.classify_batch([_doc("Документ 1"), _doc("Документ 2")])
+
+        assert [result["type"] for result in results] == ["order", "decree"]
+        assert len(classifier.prompts) == 2
+        assert classifier.stats["llm_requests"] == 2
+
+    async def test_model_error_falls_back_to_rules_and_is_not_cached(self, classifier, cache):
+        async def broken(prompt, max_tokens, priority):
+            raise RuntimeError("model unavailable")
+
+        classifier._generate = broken
+
+        results = await classifier.classify_batch([_doc("Документ 1"), _doc("Документ 2")])
+
+        assert {result["method"] for result in results} == {"rule_fallback"}
+        assert cache.data == {}
+
+
+@pytest.mark.unit
+class TestBatchResponseParsing:
+    """Tolerant parsing of the JSON array answer."""
+
+    def test_code_fence_and_string_ids(self, classifier):
+        response = '```json\n[{"id": "2", "type": "order"}, {"id": "Документ 1", "type": "decree"}]\n```'
+
+        parsed = classifier._parse_batch_response(response, 2)
+
+        assert {number: item["type"] for number, item in parsed.items()} == {1: "decree", 2: "order"}
+
+    def test_truncated_array_keeps_complete_objects(self, classifier):
+        response = 'Ответ: [{"id": 1, "type": "order"}, {"id": 2, "type": "dec'
+
+        assert list(classifier._parse_batch_response(response, 2)) == [1]
+
+    def test_objects_without_ids_are_taken_in_order(self, classifier):
+        parsed = classifier._parse_batch_response('[{"type": "order"}, {"type": "codex"}]', 2)
+
+        assert parsed[2]["type"] == "codex"
+
+    def test_plain_text_lines_are_a_last_resort(self, classifier):
+        parsed = classifier._parse_batch_response("1: order\n2) federal_law\n7: codex", 2)
+
+        assert {number: item["type"] for number, item in parsed.items()} == {1: "order", 2: "federal_law"}
+
+    def test_unknown_type_uses_the_rule_fallback(self, classifier):
+        result = classifier._normalize_batch_item({"type": "letter", "confidence": 3}, "other")
+
+        assert result["method"] == "rule_fallback"
+        assert classifier._normalize_batch_item({"type": "ORDER", "confidence": 3}, "other")["confidence"] == 1.0
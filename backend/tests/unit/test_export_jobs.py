@@ -0,0 +1,125 @@
+"""
+Unit tests for background export jobs and their leases
+"""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+pytest.importorskip("reportlab")
+pytest.importorskip("openpyxl")
+pytest.importorskip("docx")
+
+from app.core import export as export_module
+from app.core.config import settings
+from app.core.export import ExportFormat, ExportManager, ExportType
+from app.models import Base
+from app.models.chat import ChatMessage, ChatSession
+from app.models.export_job import ExportJob, ExportJobStatus
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'export.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(export_module, "SessionLocal", factory)
+    monkeypatch.setattr(settings, "TEMP_DIR", str(tmp_path / "exports"))
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def manager():
+    manager = ExportManager()
+    manager.lease_seconds = 60
+    return manager
+
+
+def _job(factory, request_id):
+    db = factory()
+    try:
+        return db.get(ExportJob, request_id)
+    finally:
+        db.close()
+
+
+def _add_job(factory, request_id, **values):
+    db = factory()
+    try:
+        values.setdefault("rows_written", 0)
+        db.add(ExportJob(
+            id=request_id, user_id=1, export_type=ExportType.CHAT_HISTORY.value,
+            export_format=ExportFormat.CSV.value, filters={}, **values
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.mark.unit
+def test_csv_export_completes_and_releases_lease(session_factory, manager):
+    db = session_factory()
+    session = ChatSession(user_id=1, title="t")
+    db.add(session)
+    db.flush()
+    for role, content in [("user", "вопрос"), ("assistant", "ответ")] * 3:
+        db.add(ChatMessage(session_id=session.id, role=role, content=content))
+    db.commit()
+    db.close()
+
+    request = manager.create_export_request(1, ExportType.CHAT_HISTORY, ExportFormat.CSV)
+    assert manager.process_export(request.id)
+
+    job = _job(session_factory, request.id)
+    assert job.status == ExportJobStatus.COMPLETED
+    assert job.rows_written == 3
+    assert job.heartbeat_at is None
+    assert os.path.exists(job.file_path)
+    assert not [name for name in os.listdir(os.path.dirname(job.file_path)) if name.endswith(".part")]
+
+
+@pytest.mark.unit
+def test_recover_only_stale_jobs(session_factory, manager):
+    now = datetime.utcnow()
+    _add_job(session_factory, "live", status=ExportJobStatus.PROCESSING, started_at=now, heartbeat_at=now)
+    _add_job(
+        session_factory, "stale", status=ExportJobStatus.PROCESSING,
+        started_at=now - timedelta(hours=1), heartbeat_at=now - timedelta(minutes=5), rows_written=500
+    )
+    _add_job(session_factory, "queued", status=ExportJobStatus.PENDING)
+
+    assert manager._recover_interrupted(include_pending=False) == ["stale"]
+    assert _job(session_factory, "live").status == ExportJobStatus.PROCESSING
+    stale = _job(session_factory, "stale")
+    assert (stale.status, stale.rows_written) == (ExportJobStatus.PENDING, 0)
+    assert sorted(manager._recover_interrupted()) == ["queued", "stale"]
+
+
+@pytest.mark.unit
+def test_reclaimed_job_rejects_previous_owner(session_factory, manager):
+    _add_job(session_factory, "job", status=ExportJobStatus.PENDING)
+    first = datetime(2026, 10, 18, 12, 0, 0)
+    second = first + timedelta(minutes=10)
+
+    assert manager._claim("job", first) is not None
+    assert manager._heartbeat("job", first)
+    # Lease expired and another worker took the job over
+    manager._finish("job", first, status=ExportJobStatus.PENDING)
+    assert manager._claim("job", second) is not None
+
+    assert not manager._heartbeat("job", first)
+    assert not manager._finish("job", first, status=ExportJobStatus.FAILED)
+    assert _job(session_factory, "job").status == ExportJobStatus.PROCESSING
+    assert manager._heartbeat("job", second)
+
+
+@pytest.mark.unit
+def test_claim_is_exclusive(session_factory, manager):
+    _add_job(session_factory, "job", status=ExportJobStatus.PENDING)
+    claimed_at = datetime.utcnow().replace(microsecond=0)
+
+    assert manager._claim("job", claimed_at) is not None
+    assert manager._claim("job", claimed_at + timedelta(seconds=1)) is None
@@ -0,0 +1,174 @@
+"""
+Unit tests for head/tail trace sampling and in-memory span recording
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import jaeger_tracing as tracing_module
+from app.core.jaeger_tracing import JaegerTracing, TraceSampler, trace_function
+
+
+class FakeExporter:
+    def __init__(self):
+        self.traces = []
+        self.exported = 0
+        self.dropped = 0
+
+    def submit(self, trace):
+        self.traces.append(trace)
+
+
+@pytest.fixture
+def tracing(monkeypatch):
+    monkeypatch.setenv("JAEGER_DISABLED", "true")
+    tracing = JaegerTracing()
+    tracing.tracer = object()
+    tracing.enabled = True
+    tracing.exporter = FakeExporter()
+    tracing.sampler = TraceSampler(rate=0, per_operation_limit=0)
+    tracing.tail_enabled = True
+    tracing.max_buffered_spans = 100
+    monkeypatch.setattr(tracing_module, "jaeger_tracing", tracing)
+    return tracing
+
+
+def _root(trace):
+    return next(span for span in trace.spans if span.parent_id is None)
+
+
+@pytest.mark.unit
+def test_head_sampled_trace_nests_spans_through_context(tracing):
+    tracing.sampler = TraceSampler(rate=1, per_operation_limit=0)
+
+    with tracing.trace_operation("GET /admin") as root:
+        with tracing.trace_operation("db.select") as child:
+            with tracing.trace_operation("cache.get") as grandchild:
+                pass
+
+    assert child.parent_id == root.span_id
+    assert grandchild.parent_id == child.span_id
+    assert tracing_module._current_span.get() is None
+    [trace] = tracing.exporter.traces
+    assert len(trace.spans) == 3
+    assert _root(trace).tags["sampling.reason"] == "head"
+
+
+@pytest.mark.unit
+def test_per_operation_rate_limit_caps_head_sampling():
+    sampler = TraceSampler(rate=1, per_operation_limit=1)
+
+    assert sampler.should_sample("GET /a")
+    assert not sampler.should_sample("GET /a")
+    assert sampler.should_sample("GET /b")
+
+
+@pytest.mark.unit
+def test_tail_sampling_keeps_errors_and_drops_the_rest(tracing):
+    with tracing.trace_operation("GET /ok"):
+        with tracing.trace_operation("db.select"):
+            pass
+    with pytest.raises(ValueError):
+        with tracing.trace_operation("GET /broken"):
+            with tracing.trace_operation("db.select"):
+                raise ValueError("boom")
+
+    [trace] = tracing.exporter.traces
+    assert _root(trace).operation_name == "GET /broken"
+    assert _root(trace).tags["sampling.reason"] == "error"
+    assert tracing.stats["discarded"] == 1
+    assert tracing.stats["kept_error"] == 1
+    assert tracing.get_stats()["buffered_spans"] == 0
+
+
+@pytest.mark.unit
+def test_span_buffer_cap_truncates_tail_traces(tracing):
+    tracing.max_buffered_spans = 2
+
+    with tracing.trace_operation("GET /admin") as root:
+        with tracing.trace_operation("db.select"):
+            # The buffer is full: a new trace is not recorded at all
+            assert tracing._start_trace("GET /other") is None
+        with tracing.trace_operation("db.update") as extra:
+            extra.set_tag("error", True)
+
+    [trace] = tracing.exporter.traces
+    assert len(trace.spans) == 2
+    assert root.tags["trace.truncated"] is True
+    assert tracing.get_stats()["buffered_spans"] == 0
+
+
+@pytest.mark.unit
+def test_unsampled_trace_skips_nested_operations(tracing):
+    tracing.tail_enabled = False
+
+    with tracing.trace_operation("GET /admin") as root:
+        assert root is None
+        assert tracing_module._current_span.get() is tracing_module._UNSAMPLED
+        with tracing.trace_operation("db.select") as child:
+            assert child is None
+
+    assert tracing_module._current_span.get() is None
+    assert tracing.exporter.traces == []
+
+
+@pytest.mark.unit
+def test_trace_function_wraps_sync_and_async_functions(tracing):
+    tracing.sampler = TraceSampler(rate=1, per_operation_limit=0)
+
+    @trace_function("sync.op")
+    def add(a, b):
+        return a + b
+
+    @trace_function()
+    async def fetch():
+        return "done"
+
+    # With tracing disabled the call goes straight through
+    tracing.enabled = False
+    assert asyncio.run(fetch()) == "done"
+    tracing.enabled = True
+
+    with tracing.trace_operation("GET /admin"):
+        assert add(2, 3) == 5
+
+    spans = tracing.exporter.traces[-1].spans
+    assert [span.operation_name for span in spans] == ["GET /admin", "sync.op"]
+    assert spans[1].tags["function.name"] == "add"
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("status_code, is_error", [(404, False), (401, False), (503, True)])
+def test_only_server_errors_mark_http_traces(tracing, status_code, is_error):
+    request = SimpleNamespace(
+        method="GET",
+        url=SimpleNamespace(path="/api/v1/admin/users"),
+        client=None,
+        headers={}
+    )
+
+    with tracing.trace_operation("GET /api/v1/admin/users") as span:
+        tracing.trace_http_response(span, request, SimpleNamespace(status_code=status_code), 0.01)
+
+    assert span.trace.error is is_error
+    assert len(tracing.exporter.traces) == int(is_error)
+
+
+@pytest.mark.unit
+def test_trace_function_with_tags_reraises_the_original_error(tracing):
+    tracing.sampler = TraceSampler(rate=1, per_operation_limit=0)
+
+    # The tags argument used to shadow opentracing.ext.tags and raise AttributeError here
+    @trace_function("failing.op", tags={"component": "test"})
+    def fail():
+        raise KeyError("missing")
+
+    with pytest.raises(KeyError):
+        fail()
+
+    [trace] = tracing.exporter.traces
+    [span] = trace.spans
+    assert span.tags["component"] == "test"
+    assert span.tags["error"] is True
+    assert _root(trace).tags["sampling.reason"] == "head"
@@ -0,0 +1,106 @@
+"""
+Unit tests for the low-priority generation lane of UnifiedLLMService
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from app.services.unified_llm_service import UnifiedLLMService, RequestPriority
+
+
+class FakeLlama:
+    """Streams prompt-specific tokens and records overlapping generations on the instance."""
+
+    def __init__(self, tokens: int = 20, delay: float = 0.005):
+        self.tokens = tokens
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.prefills = []
+        self._lock = threading.Lock()
+
+    def create_chat_completion(self, messages, stream=True, **kwargs):
+        prompt = messages[-1]["content"]
+        self.prefills.append(prompt)
+
+        def generate():
+            with self._lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            try:
+                for i in range(self.tokens):
+                    time.sleep(self.delay)
+                    yield {"choices": [{"delta": {"content": f"{prompt}{i} "}}]}
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        return generate()
+
+    def tokenize(self, data, add_bos=False):
+        return data.split()
+
+
+def _expected(prompt: str, tokens: int) -> str:
+    return "".join(f"{prompt}{i} " for i in range(tokens))
+
+
+async def _collect(service, prompt, priority):
+    parts = []
+    async for chunk in service.generate_response(prompt=prompt, stream=True, priority=priority):
+        parts.append(chunk)
+    return "".join(parts)
+
+
+@pytest.mark.unit
+class TestBackgroundGenerationLane:
+    """Background generations never share the model with interactive ones."""
+
+    async def test_preempted_background_generation_restarts_cleanly(self):
+        service = UnifiedLLMService()
+        service.model = FakeLlama()
+        service._model_loaded = True
+
+        background = asyncio.create_task(_collect(service, "bg", RequestPriority.LOW))
+        await asyncio.sleep(0.03)  # Фоновая генерация успела выдать несколько токенов
+        interactive = await _collect(service, "chat", RequestPriority.NORMAL)
+        background_text = await background
+
+        assert interactive == _expected("chat", 20)
+        assert background_text == _expected("bg", 20)
+        assert service.model.max_active == 1
+        assert service.model.prefills.count("bg") == 2  # Повторный prefill после вытеснения
+
+    async def test_interactive_canary_request_preempts_background_adapter_lease(self):
+        service = UnifiedLLMService()
+        service.model = FakeLlama(tokens=40)
+        service._model_loaded = True
+        activated = []
+
+        async def activate(adapter_id):
+            activated.append(adapter_id)
+
+        async def resolve(user_id):
+            return ("canary", "canary") if user_id == "tester" else (None, None)
+
+        service._adapter_scheduler._activate = activate
+        service.resolve_adapter = resolve
+
+        background = asyncio.create_task(_collect(service, "bg", RequestPriority.LOW))
+        await asyncio.sleep(0.03)
+        parts = []
+        async for chunk in service.generate_response(prompt="chat", user_id="tester"):
+            parts.append(chunk)
+        # The canary request finished while the background stream was still paused
+        assert not background.done()
+        background_text = await background
+
+        assert "".join(parts) == _expected("chat", 40)
+        assert background_text == _expected("bg", 40)
+        assert activated == ["canary", None]
+        assert service.model.max_active == 1
+        assert service._adapter_scheduler.get_stats()["in_flight"] == 0
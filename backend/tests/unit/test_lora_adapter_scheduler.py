@@ -0,0 +1,106 @@
+"""
+Unit tests for AdapterScheduler: grouping requests by LoRA adapter
+"""
+import asyncio
+
+import pytest
+
+from app.services.lora_adapter_manager import AdapterScheduler
+
+
+def _scheduler(max_batch: int = 8, fail=()):
+    activated = []
+
+    async def activate(adapter_id):
+        if adapter_id in fail:
+            raise RuntimeError("broken adapter")
+        await asyncio.sleep(0)
+        activated.append(adapter_id)
+
+    return AdapterScheduler(activate, max_batch), activated
+
+
+@pytest.mark.unit
+async def test_requests_for_the_active_adapter_share_the_model():
+    scheduler, activated = _scheduler()
+
+    first = await scheduler.acquire(None)
+    second = await scheduler.acquire(None)
+
+    assert scheduler.get_stats()["in_flight"] == 2
+    assert activated == []
+    first.release()
+    second.release()
+    second.release()  # A lease is released only once
+    assert scheduler.get_stats()["in_flight"] == 0
+
+
+@pytest.mark.unit
+async def test_switch_waits_for_the_running_group():
+    scheduler, activated = _scheduler()
+    base = await scheduler.acquire(None)
+
+    waiter = asyncio.create_task(scheduler.acquire("canary"))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    base.release()
+    lease = await asyncio.wait_for(waiter, 1)
+    assert lease.adapter_id == "canary"
+    assert scheduler.active == "canary"
+    assert activated == ["canary"]
+    lease.release()
+
+
+@pytest.mark.unit
+async def test_active_adapter_stops_admitting_after_max_batch_when_others_wait():
+    scheduler, activated = _scheduler(max_batch=2)
+    leases = [await scheduler.acquire(None), await scheduler.acquire(None)]
+
+    other = asyncio.create_task(scheduler.acquire("canary"))
+    await asyncio.sleep(0.01)
+    # The batch is full and another adapter is waiting, so this one queues
+    late = asyncio.create_task(scheduler.acquire(None))
+    await asyncio.sleep(0.01)
+    assert not late.done()
+
+    for lease in leases:
+        lease.release()
+    canary = await asyncio.wait_for(other, 1)
+    assert not late.done()
+    canary.release()
+    (await asyncio.wait_for(late, 1)).release()
+
+    assert activated == ["canary", None]
+
+
+@pytest.mark.unit
+async def test_waiters_of_a_broken_adapter_fall_back_to_the_base_model():
+    scheduler, _ = _scheduler(fail={"broken"})
+    base = await scheduler.acquire(None)
+    waiter = asyncio.create_task(scheduler.acquire("broken"))
+    await asyncio.sleep(0.01)
+
+    base.release()
+    lease = await asyncio.wait_for(waiter, 1)
+
+    assert lease.adapter_id is None
+    assert scheduler.active is None
+    lease.release()
+
+
+@pytest.mark.unit
+async def test_cancelled_waiter_leaves_the_queue():
+    scheduler, _ = _scheduler()
+    base = await scheduler.acquire(None)
+    waiter = asyncio.create_task(scheduler.acquire("canary"))
+    await asyncio.sleep(0.01)
+
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    assert scheduler.get_stats()["waiting"] == {}
+    base.release()
+    await asyncio.sleep(0.01)
+    assert scheduler.active is None
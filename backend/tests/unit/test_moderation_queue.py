@@ -0,0 +1,153 @@
+"""
+Unit tests for the moderation queue: keyset pages, bulk message context, cached count
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+from app.models.chat import ChatMessage
+from app.models.feedback import ModerationQueue, ResponseFeedback
+from app.schemas.feedback import ModerationPriority, QueueFilters
+from app.services.moderation_service import ModerationService
+
+
+NOW = datetime(2026, 10, 18, 12, 0)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.fixture
+def service():
+    return ModerationService()
+
+
+def _message(db, session_id, role, content):
+    message = ChatMessage(session_id=session_id, role=role, content=content, created_at=NOW)
+    db.add(message)
+    db.flush()
+    return message.id
+
+
+def _queue(db, message_id, priority, minutes_ago=0):
+    item = ModerationQueue(
+        message_id=message_id,
+        priority=priority,
+        status="pending",
+        created_at=NOW - timedelta(minutes=minutes_ago)
+    )
+    db.add(item)
+    db.commit()
+    return item.id
+
+
+@pytest.fixture
+def queue(db):
+    """Eight answers; several share priority and created_at so the id breaks ties"""
+    plan = [
+        ("low", 30), ("high", 5), ("medium", 10), ("high", 5),
+        ("low", 30), ("medium", 20), ("high", 1), ("medium", 10),
+    ]
+    item_ids = []
+    for index, (priority, minutes_ago) in enumerate(plan):
+        answer = _message(db, index + 1, "assistant", f"ответ {index}")
+        item_ids.append(_queue(db, answer, priority, minutes_ago))
+    return item_ids
+
+
+async def _all_pages(service, db, page_size, filters=None):
+    seen, cursor = [], None
+    while True:
+        page, _, cursor = await service.get_moderation_queue(
+            db, moderator_id=1, filters=filters, page_size=page_size, cursor=cursor or None
+        )
+        seen.extend(entry["queue_item"].id for entry in page)
+        if cursor is None:
+            return seen
+
+
+@pytest.mark.unit
+class TestQueuePaging:
+    """Keyset cursor over (priority rank, created_at, id)."""
+
+    async def test_cursor_pages_follow_priority_then_age_then_id(self, db, service, queue):
+        expected = [queue[i] for i in (1, 3, 6, 5, 2, 7, 0, 4)]
+
+        assert await _all_pages(service, db, page_size=3) == expected
+        assert await _all_pages(service, db, page_size=1) == expected
+
+    async def test_cursor_and_offset_pages_agree(self, db, service, queue):
+        offset_ids = []
+        for page in (1, 2, 3):
+            items, total, _ = await service.get_moderation_queue(db, moderator_id=1, page=page, page_size=3)
+            offset_ids.extend(entry["queue_item"].id for entry in items)
+
+        assert total == 8
+        assert offset_ids == await _all_pages(service, db, page_size=3)
+
+    async def test_cursor_respects_filters(self, db, service, queue):
+        filters = QueueFilters(priority=ModerationPriority.MEDIUM)
+
+        assert await _all_pages(service, db, page_size=2, filters=filters) == [queue[5], queue[2], queue[7]]
+
+    async def test_last_page_has_no_cursor(self, db, service, queue):
+        _, _, cursor = await service.get_moderation_queue(db, moderator_id=1, page_size=8)
+
+        assert cursor is None
+
+    def test_malformed_cursor_is_rejected(self, service):
+        with pytest.raises(ValueError):
+            service._decode_cursor("not-a-cursor")
+
+
+@pytest.mark.unit
+class TestQueueContext:
+    """Question, feedback and reviews loaded for the whole page."""
+
+    async def test_question_is_the_previous_user_message_in_the_session(self, db, service):
+        _message(db, 1, "user", "первый вопрос")
+        first_answer = _message(db, 1, "assistant", "первый ответ")
+        _message(db, 1, "user", "второй вопрос")
+        _message(db, 1, "assistant", "уточнение")
+        second_answer = _message(db, 1, "assistant", "второй ответ")
+        orphan = _message(db, 2, "assistant", "ответ без вопроса")
+        db.add(ResponseFeedback(message_id=second_answer, user_id=1, rating="dislike"))
+        for message_id in (first_answer, second_answer, orphan):
+            _queue(db, message_id, "high")
+
+        page, _, _ = await service.get_moderation_queue(db, moderator_id=1)
+        messages = {entry["message"]["message_id"]: entry["message"] for entry in page}
+
+        assert messages[first_answer]["user_question"] == "первый вопрос"
+        assert messages[second_answer]["user_question"] == "второй вопрос"
+        assert messages[orphan]["user_question"] == "N/A"
+        assert messages[second_answer]["user_feedback"].rating == "dislike"
+        assert messages[first_answer]["user_feedback"] is None
+
+
+@pytest.mark.unit
+class TestQueueCount:
+    """Total count cached per filter set."""
+
+    async def test_count_is_cached_until_a_status_changes(self, db, service, queue):
+        answer = _message(db, 99, "assistant", "новый ответ")
+        _, total, _ = await service.get_moderation_queue(db, moderator_id=1)
+        _queue(db, answer, "low")
+
+        _, cached_total, _ = await service.get_moderation_queue(db, moderator_id=1)
+        await service._update_queue_status(db, answer, "completed")
+        _, fresh_total, _ = await service.get_moderation_queue(db, moderator_id=1)
+
+        assert (total, cached_total, fresh_total) == (8, 8, 9)
@@ -0,0 +1,126 @@
+"""
+Unit tests for the notification outbox worker
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+from app.models.notification import ChannelType, NotificationChannel, NotificationOutbox, OutboxStatus
+from app.services import notification_delivery_service as delivery_module
+from app.services.external_notification_service import EmailNotificationService
+from app.services.notification_delivery_service import NotificationDeliveryService
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(delivery_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def service():
+    service = NotificationDeliveryService()
+    service.lease_seconds = 60
+    return service
+
+
+def _add_outbox(factory, count, **values):
+    db = factory()
+    try:
+        channel = NotificationChannel(name="mail", type=ChannelType.EMAIL, configuration={})
+        db.add(channel)
+        db.flush()
+        rows = [
+            NotificationOutbox(
+                channel_id=channel.id,
+                channel_type="email",
+                recipient=f"user{index}@example.com",
+                payload={"title": "t", "content": "c"},
+                next_attempt_at=datetime.utcnow() - timedelta(seconds=1),
+                **values
+            )
+            for index in range(count)
+        ]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+    finally:
+        db.close()
+
+
+def _statuses(factory):
+    db = factory()
+    try:
+        return {row.id: (row.status, row.claimed_at) for row in db.query(NotificationOutbox).all()}
+    finally:
+        db.close()
+
+
+@pytest.mark.unit
+def test_claim_sets_lease(session_factory, service):
+    ids = _add_outbox(session_factory, 3)
+    items, channels = service._claim_batch()
+
+    assert sorted(item["id"] for item in items) == ids
+    assert len(channels) == 1
+    for status, claimed_at in _statuses(session_factory).values():
+        assert status == OutboxStatus.SENDING
+        assert claimed_at is not None
+
+
+@pytest.mark.unit
+def test_requeue_skips_live_leases(session_factory, service):
+    live = _add_outbox(session_factory, 2, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow())
+    expired = _add_outbox(
+        session_factory, 2, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow() - timedelta(seconds=120)
+    )
+    legacy = _add_outbox(session_factory, 1, status=OutboxStatus.SENDING)
+
+    service._requeue_interrupted()
+    statuses = _statuses(session_factory)
+
+    assert all(statuses[row_id][0] == OutboxStatus.SENDING for row_id in live)
+    assert all(statuses[row_id] == (OutboxStatus.PENDING, None) for row_id in expired + legacy)
+
+
+@pytest.mark.unit
+def test_outcomes_release_lease(session_factory, service):
+    sent, retried = _add_outbox(session_factory, 2, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow())
+    service._store_outcomes([
+        {"id": sent, "status": OutboxStatus.SENT, "channel_id": 1},
+        {"id": retried, "status": OutboxStatus.PENDING, "delay": 5, "error": "timeout"},
+    ])
+    statuses = _statuses(session_factory)
+
+    assert statuses[sent] == (OutboxStatus.SENT, None)
+    assert statuses[retried] == (OutboxStatus.PENDING, None)
+
+
+@pytest.mark.unit
+async def test_refused_recipient_is_permanent(monkeypatch):
+    aiosmtplib = pytest.importorskip("aiosmtplib")
+
+    class RefusingPool:
+        async def send(self, message):
+            raise aiosmtplib.SMTPRecipientsRefused([
+                aiosmtplib.SMTPRecipientRefused(550, "No such user", "nobody@example.com")
+            ])
+
+    email = EmailNotificationService()
+    monkeypatch.setattr(email, "_get_pool", lambda config: RefusingPool())
+    channel = NotificationChannel(name="mail", type=ChannelType.EMAIL, configuration={
+        "smtp_host": "smtp.example.com", "smtp_port": 465, "smtp_username": "u",
+        "smtp_password": "p", "from_email": "noreply@example.com"
+    })
+
+    result = await email.send_email(channel, "nobody@example.com", "subject", "body")
+
+    assert result["success"] is False
+    assert result["retryable"] is False
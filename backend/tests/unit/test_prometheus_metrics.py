@@ -0,0 +1,190 @@
+"""
+Unit tests for scrape-time system metrics and multiprocess /metrics output
+"""
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import prometheus_metrics as metrics_module
+from app.core.prometheus_metrics import PrometheusMetrics, SystemMetricsCollector
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+
+
+class FakeHost:
+    """psutil stand-in that counts reads"""
+
+    def __init__(self):
+        self.cpu_calls = 0
+        self.partition_calls = 0
+        self.fail = False
+
+    def cpu_percent(self, interval=None):
+        assert interval is None  # A blocking interval would stall the scrape
+        self.cpu_calls += 1
+        return 12.5
+
+    def virtual_memory(self):
+        if self.fail:
+            raise RuntimeError("psutil failed")
+        return SimpleNamespace(used=1024)
+
+    def disk_partitions(self):
+        self.partition_calls += 1
+        return [SimpleNamespace(mountpoint="/"), SimpleNamespace(mountpoint="/secret")]
+
+    def disk_usage(self, mount_point):
+        if mount_point == "/secret":
+            raise PermissionError(mount_point)
+        return SimpleNamespace(used=40)
+
+
+@pytest.fixture
+def host(monkeypatch):
+    host = FakeHost()
+    for name in ("cpu_percent", "virtual_memory", "disk_partitions", "disk_usage"):
+        monkeypatch.setattr(metrics_module.psutil, name, getattr(host, name))
+    return host
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metrics_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def _samples(families):
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in families for sample in family.samples
+    }
+
+
+def _value(text, line_prefix):
+    [line] = [line for line in text.splitlines() if line.startswith(line_prefix)]
+    return float(line.rsplit(" ", 1)[1])
+
+
+@pytest.mark.unit
+class TestSystemMetricsCollector:
+    """Host gauges read at scrape time with a short cache."""
+
+    def test_scrape_reads_host_once_per_ttl(self, host, clock):
+        collector = SystemMetricsCollector(cache_ttl=5)
+        host.cpu_calls = 0
+
+        first = _samples(collector.collect())
+        clock[0] += 1
+        collector.collect()
+        clock[0] += 10
+        collector.collect()
+
+        assert first == {
+            ("system_cpu_usage_percent", ()): 12.5,
+            ("system_memory_usage_bytes", ()): 1024,
+            ("system_disk_usage_bytes", (("mount_point", "/"),)): 40,
+        }
+        assert host.cpu_calls == 2
+
+    def test_partition_list_is_cached_longer_than_samples(self, host, clock):
+        collector = SystemMetricsCollector(cache_ttl=1)
+
+        for _ in range(3):
+            clock[0] += 2
+            collector.collect()
+        clock[0] += SystemMetricsCollector.PARTITIONS_TTL + 1
+        collector.collect()
+
+        assert host.partition_calls == 2
+
+    def test_failed_read_keeps_the_previous_sample(self, host, clock):
+        collector = SystemMetricsCollector(cache_ttl=1)
+        collector.collect()
+        host.fail = True
+        clock[0] += 2
+
+        assert _samples(collector.collect())[("system_memory_usage_bytes", ())] == 1024
+
+
+@pytest.mark.unit
+class TestSingleProcessOutput:
+    """The /metrics payload of one process."""
+
+    def test_metrics_include_system_gauges_without_a_background_thread(self, host, monkeypatch):
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+        threads = {thread.name for thread in metrics_module.threading.enumerate()}
+        metrics = PrometheusMetrics()
+
+        metrics.record_http_request("GET", "/api/v1/chat", 200, 0.2)
+        metrics.record_http_request("GET", "/api/v1/chat", 200, 0.3)
+        text = metrics.get_metrics().decode()
+
+        assert {thread.name for thread in metrics_module.threading.enumerate()} == threads
+        assert _value(text, 'http_requests_total{endpoint="/api/v1/chat",method="GET",status_code="200"}') == 2
+        assert _value(text, "system_cpu_usage_percent") == 12.5
+        assert len(metrics._http_children) == 1
+
+    def test_bound_children_cache_is_capped(self, host, monkeypatch):
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+        metrics = PrometheusMetrics()
+        metrics.MAX_BOUND_CHILDREN = 2
+
+        for index in range(4):
+            metrics.record_cache_operation("redis", "get", f"result-{index}")
+
+        assert len(metrics._cache_children) == 2
+        assert 'cache_operations_total{cache_type="redis",operation="get",result="result-3"} 1.0' in metrics.render()
+
+    def test_render_drops_extra_lines_that_clash_with_registry_names(self, host, monkeypatch):
+        monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+        metrics = PrometheusMetrics()
+
+        text = metrics.render("system_cpu_usage_percent 99\nunified_requests_total 5\n")
+
+        assert _value(text, "system_cpu_usage_percent") == 12.5
+        assert _value(text, "unified_requests_total") == 5
+
+
+WORKER = textwrap.dedent("""
+    import sys
+    from app.core.prometheus_metrics import prometheus_metrics
+
+    requests, cache_size, dies = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3] == "dead"
+    for _ in range(requests):
+        prometheus_metrics.record_http_request("POST", "/api/v1/chat", 200, 0.5)
+    prometheus_metrics.update_cache_stats("redis", 0.5, cache_size)
+    prometheus_metrics.update_model_status("saiga", "ready")
+    if dies:
+        prometheus_metrics.mark_process_dead()
+""")
+
+
+@pytest.mark.unit
+def test_multiprocess_scrape_sums_workers(tmp_path, host, monkeypatch):
+    metrics_dir = tmp_path / "prometheus"
+    metrics_dir.mkdir()
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(metrics_dir), PYTHONPATH=str(BACKEND_DIR))
+    # The value class is chosen at import, so each worker is a separate interpreter
+    for args in (("2", "3", "alive"), ("1", "4", "dead")):
+        subprocess.run([sys.executable, "-c", WORKER, *args], cwd=BACKEND_DIR, env=env, check=True, timeout=60)
+
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(metrics_dir))
+    scraper = PrometheusMetrics()
+    scraper.update_model_status("local", "loading")
+    text = scraper.get_metrics().decode()
+
+    assert scraper.multiprocess
+    assert _value(text, 'http_requests_total{endpoint="/api/v1/chat",method="POST",status_code="200"}') == 3
+    assert _value(text, 'http_request_duration_seconds_count{endpoint="/api/v1/chat",method="POST"}') == 3
+    # livesum: the worker that marked itself dead no longer counts
+    assert _value(text, 'cache_size_items{cache_type="redis"}') == 3
+    # Enum is per process: only the scraping process's own state is exported
+    assert 'model_status{model_name="local",model_status="loading"} 1.0' in text
+    assert 'model_name="saiga"' not in text
+    assert _value(text, "system_cpu_usage_percent") == 12.5
@@ -0,0 +1,118 @@
+"""
+Unit tests for the subscription quota store and the shared Redis script client
+"""
+import pytest
+
+from app.core.quota_backend import QuotaCounter, QuotaStore
+from app.core.redis_scripts import LocalFallbackStore, RedisScriptClient, process_singleton
+
+
+@pytest.fixture(params=["local", "redis"])
+def store(request):
+    if request.param == "local":
+        return QuotaStore(prefix="test")
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    store = QuotaStore(redis_client=fakeredis.FakeRedis(), prefix="test")
+    assert store.redis.get_scripts() is not None
+    return store
+
+
+@pytest.mark.unit
+def test_consume_respects_every_limit(store):
+    daily = QuotaCounter("u1:chat:day", limit=3, ttl_seconds=60)
+    monthly = QuotaCounter("u1:chat:month", limit=10, ttl_seconds=600)
+
+    assert store.consume([daily, monthly], 2).granted == 2
+    denied = store.consume([daily, monthly], 2)
+
+    assert not denied.allowed
+    # A denied request does not touch any counter
+    assert store.peek(["u1:chat:day", "u1:chat:month"]) == [2, 2]
+
+
+@pytest.mark.unit
+def test_prefetch_is_capped_by_share_of_room(store):
+    counter = QuotaCounter("u2:chat:day", limit=100, ttl_seconds=60)
+
+    decision = store.consume([counter], 1, want=50, share=0.1)
+
+    assert decision.granted == 10
+    assert decision.usage == [10]
+
+
+@pytest.mark.unit
+def test_release_returns_units_but_not_below_zero(store):
+    counter = QuotaCounter("u3:chat:day", limit=5, ttl_seconds=60)
+    store.consume([counter], 3)
+
+    store.release([counter], 2)
+    assert store.peek(["u3:chat:day"]) == [1]
+    store.release([counter], 5)
+    assert store.peek(["u3:chat:day"]) == [0]
+
+
+@pytest.mark.unit
+def test_delete_clears_counters(store):
+    counter = QuotaCounter("u4:chat:day", limit=1, ttl_seconds=60)
+    store.consume([counter], 1)
+
+    store.delete(["u4:chat:day"])
+
+    assert store.consume([counter], 1).allowed
+
+
+@pytest.mark.unit
+def test_redis_failure_falls_back_to_local_counters():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    store = QuotaStore(redis_client=fakeredis.FakeRedis(), prefix="test")
+    assert store.get_stats()["backend"] == "local"
+    counter = QuotaCounter("u5:chat:day", limit=1, ttl_seconds=60)
+    assert store.consume([counter], 1).allowed
+
+    def broken(*args, **kwargs):
+        raise ConnectionError("down")
+
+    store.redis.get_scripts()["consume"] = broken
+    assert store.consume([counter], 1).allowed  # local counters start empty
+
+    stats = store.get_stats()
+    assert stats["backend"] == "local"
+    assert stats["redis_calls"] == 1
+    assert stats["fallback_calls"] == 1
+    # Reconnection waits for the retry delay
+    assert store.redis.get_scripts() is None
+
+
+@pytest.mark.unit
+def test_client_without_redis_stays_local():
+    client = RedisScriptClient({"noop": "return 1"}, name="Test", timeout=0.1, retry_seconds=0)
+
+    assert client.get_scripts() is None
+    assert not client.active
+    client.delete(["key"])  # no-op without Redis
+
+
+@pytest.mark.unit
+def test_process_singleton_builds_once():
+    calls = []
+
+    @process_singleton
+    def get_thing():
+        """Shared thing"""
+        calls.append(1)
+        return object()
+
+    assert get_thing() is get_thing()
+    assert len(calls) == 1
+    assert get_thing.__doc__ == "Shared thing"
+
+
+@pytest.mark.unit
+def test_local_store_must_implement_sweep():
+    class NoSweep(LocalFallbackStore):
+        pass
+
+    with pytest.raises(TypeError):
+        NoSweep()
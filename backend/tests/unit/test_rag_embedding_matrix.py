@@ -0,0 +1,132 @@
+"""
+Unit tests for the float32 embedding matrix behind RAGSystem search
+"""
+import numpy as np
+import pytest
+
+from app.core.rag_system import Document, EmbeddingMatrix, QueryContext, RAGSystem
+
+
+def _matrix(initial_capacity: int = 2, min_tombstones: int = 2) -> EmbeddingMatrix:
+    matrix = EmbeddingMatrix()
+    matrix.INITIAL_CAPACITY = initial_capacity
+    matrix.COMPACT_MIN_TOMBSTONES = min_tombstones
+    return matrix
+
+
+@pytest.mark.unit
+class TestEmbeddingMatrix:
+    """Normalized rows, tombstones and compaction."""
+
+    def test_similarities_are_cosine_over_normalized_float32_rows(self):
+        matrix = _matrix()
+        matrix.add("a", [3.0, 4.0, 0.0], "law")
+        matrix.add("b", [0.0, 0.0, 2.0], "law")
+        matrix.add("c", [1.0, 1.0, 0.0], "court")
+
+        scores = matrix.similarities([6.0, 8.0, 0.0])
+
+        assert scores.dtype == np.float32
+        np.testing.assert_allclose(scores, [1.0, 0.0, 7 / (5 * np.sqrt(2))], rtol=1e-5)
+        assert matrix.capacity == 4  # Grown by doubling from the initial two rows
+
+    def test_zero_or_mismatched_query_scores_zero(self):
+        matrix = _matrix()
+        matrix.add("a", [1.0, 0.0], "law")
+
+        assert not matrix.similarities([0.0, 0.0]).any()
+        assert not matrix.similarities([1.0, 0.0, 0.0]).any()
+
+    def test_dimension_mismatch_is_rejected(self):
+        matrix = _matrix()
+        matrix.add("a", [1.0, 0.0], "law")
+
+        with pytest.raises(ValueError):
+            matrix.add("b", [1.0, 0.0, 0.0], "law")
+
+    def test_replace_tombstones_the_old_row(self):
+        matrix = _matrix(min_tombstones=10)
+        matrix.add("a", [1.0, 0.0], "law")
+        matrix.add("b", [0.0, 1.0], "law")
+
+        matrix.add("a", [0.0, 1.0], "court")
+
+        assert len(matrix) == 2
+        assert matrix.tombstones == 1
+        assert matrix.row_of("a") == 2
+        assert matrix.doc_id_at(0) is None
+        assert list(matrix.alive_mask()) == [False, True, True]
+        assert list(matrix.category_mask("law")) == [False, True, False]
+        # The dead row keeps its old vector; search filters it out with the alive mask
+        np.testing.assert_allclose(matrix.similarities([0.0, 1.0]), [0.0, 1.0, 1.0])
+
+    def test_compaction_drops_dead_rows_and_keeps_order(self):
+        matrix = _matrix(initial_capacity=4, min_tombstones=2)
+        for index, doc_id in enumerate("abcde"):
+            vector = [0.0] * 5
+            vector[index] = 1.0
+            matrix.add(doc_id, vector, "law")
+
+        assert matrix.remove("b")
+        assert matrix.compactions == 0
+        assert matrix.remove("d")
+        assert not matrix.remove("d")
+
+        assert matrix.compactions == 1
+        assert matrix.tombstones == 0
+        assert [matrix.doc_id_at(row) for row in range(matrix.size)] == ["a", "c", "e"]
+        assert matrix.row_of("e") == 2
+        assert matrix.capacity == 8
+        np.testing.assert_allclose(matrix.similarities([0, 0, 1, 0, 0]), [0.0, 1.0, 0.0])
+
+    def test_rows_mask_ignores_unknown_ids(self):
+        matrix = _matrix()
+        matrix.add("a", [1.0, 0.0], "law")
+        matrix.add("b", [0.0, 1.0], "law")
+
+        assert list(matrix.rows_mask(["b", "missing"])) == [False, True]
+
+
+def _document(doc_id: str, content: str, category: str = "law") -> Document:
+    return Document(id=doc_id, title=doc_id, content=content, category=category, source="test", metadata={})
+
+
+@pytest.fixture
+def rag(monkeypatch):
+    rag = RAGSystem()
+    vocabulary = ["договор", "аренда", "наследство", "убийство"]
+
+    async def embed(text):
+        words = text.split()
+        return [float(words.count(term)) for term in vocabulary]
+
+    monkeypatch.setattr(rag.embedding_service, "get_embedding", embed)
+    return rag
+
+
+@pytest.mark.unit
+class TestRAGSearch:
+    """Search over the matrix with replaced and deleted documents."""
+
+    async def test_search_ranks_by_semantic_and_keyword_scores(self, rag):
+        await rag.add_document(_document("lease", "договор аренда договор аренда"))
+        await rag.add_document(_document("will", "наследство наследство"))
+        await rag.add_document(_document("crime", "убийство", category="criminal"))
+
+        results = await rag.search(QueryContext("договор аренда", 1, None, None, {}, max_results=2))
+
+        assert [result.document.id for result in results] == ["lease"]
+        assert results[0].score == pytest.approx(1.0, rel=1e-5)
+
+    async def test_replaced_and_deleted_documents_are_not_returned(self, rag):
+        await rag.add_document(_document("doc", "договор аренда"))
+        await rag.add_document(_document("doc", "наследство"))
+        await rag.add_document(_document("other", "договор договор"))
+        await rag.delete_document("other")
+
+        by_lease = await rag.search(QueryContext("договор аренда", 1, None, None, {}))
+        by_will = await rag.search(QueryContext("наследство", 1, None, None, {}))
+
+        assert by_lease == []
+        assert [result.document.id for result in by_will] == ["doc"]
+        assert (await rag.get_stats())["vector_index"]["rows"] == 1
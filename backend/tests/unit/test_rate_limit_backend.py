@@ -0,0 +1,131 @@
+"""
+Unit tests for the shared token-bucket rate limit backend
+"""
+import pytest
+
+from app.core.rate_limit_backend import BucketSpec, LocalRateLimitBackend, RateLimitBackend
+from app.core.rate_limiter import RateLimiter
+
+
+@pytest.fixture(params=["local", "redis"])
+def backend(request):
+    if request.param == "local":
+        return RateLimitBackend(prefix="test")
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    backend = RateLimitBackend(redis_client=fakeredis.FakeRedis(), prefix="test")
+    assert backend.redis.get_scripts() is not None
+    return backend
+
+
+@pytest.mark.unit
+def test_buckets_are_charged_atomically(backend):
+    small = BucketSpec("small", capacity=1, refill_per_second=0.001)
+    large = BucketSpec("large", capacity=10, refill_per_second=0.001)
+
+    assert backend.check([small, large]).allowed
+    denied = backend.check([small, large])
+
+    assert not denied.allowed
+    assert denied.retry_after > 0
+    # The denied request did not take a token from the large bucket
+    assert backend.peek([large]).tokens[0] == pytest.approx(9, abs=0.01)
+
+
+@pytest.mark.unit
+def test_penalty_blocks_until_reset(backend):
+    bucket = BucketSpec("login", capacity=1, refill_per_second=100)
+
+    assert backend.check([bucket], "block", 3600).allowed
+    denied = backend.check([bucket], "block", 3600)
+    assert denied.penalized
+    assert denied.retry_after == pytest.approx(3600, abs=1)
+
+    # Bucket refills quickly, but the penalty still holds
+    assert not backend.check([bucket], "block", 3600).allowed
+    backend.reset(["block", "login"])
+    assert backend.check([bucket], "block", 3600).allowed
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("refill, capacity", [(0, 10), (-1, 10), (1, 0)])
+def test_degenerate_buckets_are_rejected(refill, capacity):
+    with pytest.raises(ValueError):
+        BucketSpec("bad", capacity=capacity, refill_per_second=refill)
+
+
+@pytest.mark.unit
+async def test_check_async_matches_check(backend):
+    bucket = BucketSpec("async", capacity=2, refill_per_second=0.001)
+
+    assert (await backend.check_async([bucket])).allowed
+    assert (await backend.check_async([bucket])).allowed
+    assert not (await backend.check_async([bucket])).allowed
+
+
+@pytest.mark.unit
+def test_local_sweep_drops_full_buckets():
+    local = LocalRateLimitBackend()
+    local.check([BucketSpec("fast", capacity=1, refill_per_second=1000)])
+    assert local.size() == 1
+
+    local._sweep(float("inf"))
+    assert local.size() == 0
+
+
+@pytest.mark.unit
+def test_rate_limiter_blocks_identifier_for_an_hour():
+    limiter = RateLimiter()
+    limiter.backend = RateLimitBackend(prefix="test")
+    limiter.update_limit_config("auth", requests=1, window=3600, burst=0)
+
+    assert limiter.check_rate_limit("10.0.0.1", "auth")[0] is False
+    is_limited, remaining, reset_time = limiter.check_rate_limit("10.0.0.1", "auth")
+    assert is_limited and remaining == 0
+
+    # The block applies to every limit type of the identifier
+    assert limiter.check_rate_limit("10.0.0.1", "default")[0] is True
+    assert limiter.check_rate_limit("10.0.0.2", "default")[0] is False
+
+    limiter.reset_rate_limit("10.0.0.1")
+    assert limiter.check_rate_limit("10.0.0.1", "default")[0] is False
+
+
+@pytest.mark.unit
+def test_rate_limiter_rejects_zero_limits():
+    with pytest.raises(ValueError):
+        RateLimiter().update_limit_config("auth", requests=0, window=3600, burst=0)
+
+
+@pytest.mark.unit
+async def test_rate_limiter_async_check_matches_sync():
+    limiter = RateLimiter()
+    limiter.backend = RateLimitBackend(prefix="test")
+    limiter.update_limit_config("auth", requests=2, window=3600, burst=0)
+
+    is_limited, remaining, _ = await limiter.check_rate_limit_async("10.0.0.3", "auth")
+    assert not is_limited and remaining == 1
+    assert (await limiter.check_rate_limit_async("10.0.0.3", "auth"))[0] is False
+    assert (await limiter.check_rate_limit_async("10.0.0.3", "auth"))[0] is True
+    assert limiter.check_rate_limit("10.0.0.3", "default")[0] is True
+
+
+@pytest.mark.unit
+async def test_enhanced_limiter_makes_one_backend_call_per_request():
+    from app.core.enhanced_rate_limiter import EnhancedRateLimiter, RateLimitConfig
+
+    limiter = EnhancedRateLimiter()
+    limiter.backend = RateLimitBackend(prefix="test")
+    limiter.endpoint_limits["/limited"] = RateLimitConfig(2, 60, penalty_seconds=30)
+
+    first = await limiter.is_allowed("10.0.0.4", "/limited")
+    assert first and first.remaining == 1
+    assert first.reset_after == pytest.approx(30, abs=0.5)
+    assert limiter.backend.fallback_calls == 1
+
+    assert await limiter.is_allowed("10.0.0.4", "/limited")
+    denied = await limiter.is_allowed("10.0.0.4", "/limited")
+    assert not denied
+    assert denied.remaining == 0
+    assert denied.reset_after == pytest.approx(30, abs=0.5)
+    assert limiter.backend.fallback_calls == 3
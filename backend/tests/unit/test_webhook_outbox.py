@@ -0,0 +1,126 @@
+"""
+Unit tests for the webhook delivery outbox
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core import webhooks as webhooks_module
+from app.core.webhooks import WebhookEvent, WebhookEventType, WebhookManager, WebhookSubscription
+from app.models import Base
+from app.models.notification import OutboxStatus, WebhookDelivery
+
+
+@pytest.fixture
+def session_factory(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'webhooks.db'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(bind=engine)
+    monkeypatch.setattr(webhooks_module, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def manager():
+    manager = WebhookManager()
+    manager.lease_seconds = 60
+    return manager
+
+
+def _deliveries(factory):
+    db = factory()
+    try:
+        return {row.id: row for row in db.query(WebhookDelivery).all()}
+    finally:
+        db.close()
+
+
+def _insert(factory, count, **values):
+    db = factory()
+    try:
+        rows = [
+            WebhookDelivery(
+                event_id=f"e{index}", event_type="chat.message.created", subscription_id="sub",
+                user_id=1, url="https://hooks.example.com/in", endpoint="hooks.example.com",
+                body="{}", headers={}, next_attempt_at=datetime.utcnow() - timedelta(seconds=1),
+                **values
+            )
+            for index in range(count)
+        ]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+    finally:
+        db.close()
+
+
+@pytest.mark.unit
+async def test_trigger_event_enqueues_signed_delivery(session_factory, manager):
+    manager.add_subscription(WebhookSubscription(
+        id="sub", url="https://hooks.example.com/in", events=[WebhookEventType.CHAT_MESSAGE_CREATED],
+        secret="s3cret", user_id=1, is_active=True, created_at=datetime.utcnow()
+    ))
+    await manager.trigger_event(WebhookEvent(
+        event_type=WebhookEventType.CHAT_MESSAGE_CREATED, data={"text": "hi"},
+        timestamp=datetime.utcnow(), user_id=1, event_id="evt-1"
+    ))
+
+    (row,) = _deliveries(session_factory).values()
+    assert row.status == OutboxStatus.PENDING
+    assert row.endpoint == "hooks.example.com"
+    signature = row.headers["X-Webhook-Signature"].split("=", 1)[1]
+    assert manager.verify_signature(row.body, signature, "s3cret")
+
+
+@pytest.mark.unit
+def test_claim_sets_lease_and_skips_saturated_endpoints(session_factory, manager):
+    ids = _insert(session_factory, 2)
+
+    assert manager._claim_batch(10, ["hooks.example.com"]) == []
+    items = manager._claim_batch(10, [])
+
+    assert sorted(item["id"] for item in items) == ids
+    for row in _deliveries(session_factory).values():
+        assert row.status == OutboxStatus.SENDING
+        assert row.claimed_at is not None
+        assert row.attempts == 1
+
+
+@pytest.mark.unit
+def test_requeue_only_expired_leases(session_factory, manager):
+    live = _insert(session_factory, 2, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow())
+    expired = _insert(
+        session_factory, 1, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow() - timedelta(minutes=5)
+    )
+
+    manager._requeue_interrupted()
+    rows = _deliveries(session_factory)
+
+    assert all(rows[row_id].status == OutboxStatus.SENDING for row_id in live)
+    assert rows[expired[0]].status == OutboxStatus.PENDING
+    assert rows[expired[0]].claimed_at is None
+
+
+@pytest.mark.unit
+def test_outcomes_release_lease(session_factory, manager):
+    sent, retried = _insert(session_factory, 2, status=OutboxStatus.SENDING, claimed_at=datetime.utcnow())
+    manager._store_outcomes([
+        {"id": sent, "status": OutboxStatus.SENT},
+        {"id": retried, "status": OutboxStatus.PENDING, "delay": 5, "error": "HTTP 503"},
+    ])
+    rows = _deliveries(session_factory)
+
+    assert (rows[sent].status, rows[sent].claimed_at) == (OutboxStatus.SENT, None)
+    assert (rows[retried].status, rows[retried].claimed_at) == (OutboxStatus.PENDING, None)
+    assert rows[retried].next_attempt_at > datetime.utcnow()
+
+
+@pytest.mark.unit
+def test_retryable_failure_backs_off_then_fails(manager):
+    item = {"id": 1, "subscription_id": "missing", "url": "u", "attempts": 1, "max_attempts": 2}
+    assert manager._failure(item, "HTTP 503", retryable=True)["status"] == OutboxStatus.PENDING
+    assert manager._failure(dict(item, attempts=2), "HTTP 503", retryable=True)["status"] == OutboxStatus.FAILED
+    assert manager._failure(item, "HTTP 404", retryable=False)["status"] == OutboxStatus.FAILED